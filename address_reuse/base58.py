@@ -0,0 +1,82 @@
+"""Encoding and decoding of Base58Check strings such as Bitcoin addresses."""
+
+from hashlib import sha256
+
+B58_ALPHABET = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+B58_DIGIT_VALUES = dict((char, i) for i, char in enumerate(B58_ALPHABET))
+
+#A decoded P2PKH or P2SH address: 1 version byte followed by a 20-byte hash160
+DECODED_ADDRESS_LEN = 21
+
+def b58decode(the_str):
+    """Decode a Base58 string into a byte string.
+
+    Returns:
+        str or None: The decoded bytes, or None if `the_str` contains a
+            character outside of the Base58 alphabet.
+    """
+    num = 0
+    for char in the_str:
+        if char not in B58_DIGIT_VALUES:
+            return None
+        num = num * 58 + B58_DIGIT_VALUES[char]
+
+    decoded = ''
+    while num > 0:
+        num, remainder = divmod(num, 256)
+        decoded = chr(remainder) + decoded
+
+    #each leading '1' represents a leading zero byte
+    num_leading_zeroes = len(the_str) - len(the_str.lstrip('1'))
+    return '\x00' * num_leading_zeroes + decoded
+
+def b58encode(the_bytes):
+    """Encode a byte string as a Base58 string."""
+    num = long(the_bytes.encode('hex'), 16) if the_bytes else 0
+    encoded = ''
+    while num > 0:
+        num, remainder = divmod(num, 58)
+        encoded = B58_ALPHABET[remainder] + encoded
+
+    num_leading_zeroes = len(the_bytes) - len(the_bytes.lstrip('\x00'))
+    return '1' * num_leading_zeroes + encoded
+
+def b58decode_check(the_str):
+    """Decode a Base58Check string and verify its 4-byte checksum.
+
+    Returns:
+        str or None: The decoded payload without the checksum, or None if the
+            string is malformed or the checksum does not match.
+    """
+    decoded = b58decode(the_str)
+    if decoded is None or len(decoded) < 4:
+        return None
+    payload, checksum = decoded[:-4], decoded[-4:]
+    if double_sha256(payload)[:4] != checksum:
+        return None
+    return payload
+
+def b58encode_check(payload):
+    """Encode a payload as a Base58Check string."""
+    return b58encode(payload + double_sha256(payload)[:4])
+
+def decode_address(btc_address):
+    """Decode a Bitcoin address to its version byte followed by its hash160.
+
+    Returns:
+        str or None: A 21-byte string, or None if `btc_address` is not a
+            well-formed Base58Check P2PKH or P2SH address.
+    """
+    payload = b58decode_check(btc_address)
+    if payload is None or len(payload) != DECODED_ADDRESS_LEN:
+        return None
+    return payload
+
+def encode_address(decoded_address):
+    """Inverse of `decode_address`."""
+    assert len(decoded_address) == DECODED_ADDRESS_LEN
+    return b58encode_check(decoded_address)
+
+def double_sha256(the_bytes):
+    """SHA256(SHA256(x)), as used throughout Bitcoin."""
+    return sha256(sha256(the_bytes).digest()).digest()
@@ -3,6 +3,7 @@
 ####################
 
 import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
 
 #############
@@ -39,10 +40,19 @@ class Benchmark:
     record_count = 0
     wallet_explorer_queries_avoided_by_caching = 0
     blockchain_info_queries_avoided_by_caching = 0
+    seen_address_filter_negatives = 0
+    seen_address_filter_true_positives = 0
+    seen_address_filter_false_positives = 0
+    http_cache_hits = 0
+    http_cache_misses = 0
+    wallet_explorer_not_found_cache_hits = 0
+    #stage name => seconds spent in that stage of processing blocks
+    stage_seconds = None
 
     #Timer is started when class is instantiated
     def __init__(self):
         self.first = time.time()
+        self.stage_seconds = OrderedDict()
 
     def increment_blocks_processed(self):
         self.block_count = self.block_count + 1
@@ -61,6 +71,33 @@ class Benchmark:
         self.blockchain_info_queries_avoided_by_caching = (
             self.blockchain_info_queries_avoided_by_caching + 1)
 
+    def increment_seen_address_filter_negatives(self):
+        self.seen_address_filter_negatives = (
+            self.seen_address_filter_negatives + 1)
+
+    def increment_seen_address_filter_true_positives(self):
+        self.seen_address_filter_true_positives = (
+            self.seen_address_filter_true_positives + 1)
+
+    def increment_seen_address_filter_false_positives(self):
+        self.seen_address_filter_false_positives = (
+            self.seen_address_filter_false_positives + 1)
+
+    def increment_http_cache_hits(self):
+        self.http_cache_hits = self.http_cache_hits + 1
+
+    def increment_http_cache_misses(self):
+        self.http_cache_misses = self.http_cache_misses + 1
+
+    def increment_wallet_explorer_not_found_cache_hits(self):
+        self.wallet_explorer_not_found_cache_hits = (
+            self.wallet_explorer_not_found_cache_hits + 1)
+
+    #Stages are printed in the order first added.
+    def add_stage_time(self, stage_name, seconds):
+        self.stage_seconds[stage_name] = (
+            self.stage_seconds.get(stage_name, 0.0) + seconds)
+
     def stop(self):
         self.last = time.time()
 
@@ -90,3 +127,40 @@ class Benchmark:
                 expected_time_to_process_all_tx,
                 self.wallet_explorer_queries_avoided_by_caching,
                 self.blockchain_info_queries_avoided_by_caching))
+
+        num_filter_lookups = (self.seen_address_filter_negatives +
+                              self.seen_address_filter_true_positives +
+                              self.seen_address_filter_false_positives)
+        if num_filter_lookups > 0:
+            #Observed rate is among addresses that weren't seen before.
+            num_filter_unseen = (self.seen_address_filter_negatives +
+                                 self.seen_address_filter_false_positives)
+            observed_fp_rate = 0.0
+            if num_filter_unseen > 0:
+                observed_fp_rate = (1.0 *
+                                    self.seen_address_filter_false_positives /
+                                    num_filter_unseen)
+            print (("Seen address Bloom filter: %d lookup(s) skipped the "
+                    "database, %d true positive(s), %d false positive(s). "
+                    "Observed false positive rate: %.6f") %
+                   (self.seen_address_filter_negatives,
+                    self.seen_address_filter_true_positives,
+                    self.seen_address_filter_false_positives,
+                    observed_fp_rate))
+
+        num_http_cache_lookups = self.http_cache_hits + self.http_cache_misses
+        if num_http_cache_lookups > 0:
+            print (("HTTP response cache: %d hit(s), %d miss(es). Hit rate: "
+                    "%.6f") % (self.http_cache_hits, self.http_cache_misses,
+                               1.0 * self.http_cache_hits /
+                               num_http_cache_lookups))
+
+        if self.wallet_explorer_not_found_cache_hits > 0:
+            print (("Not found cache: avoided %d call(s) to WalletExplorer.com "
+                    "for addresses and transactions it recently found nothing "
+                    "for.") % self.wallet_explorer_not_found_cache_hits)
+
+        if len(self.stage_seconds) > 0:
+            print("Time per stage: %s" % ', '.join(
+                ["%s %.3f sec" % (stage_name, seconds)
+                 for stage_name, seconds in self.stage_seconds.items()]))
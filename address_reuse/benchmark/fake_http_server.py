@@ -0,0 +1,170 @@
+"""A stand-in for the API sites that `http.fetch_url` queries.
+
+Answers every GET with a small JSON body naming the path requested, over
+keep-alive HTTP/1.1 connections, optionally compressed with gzip or deflate
+when the client accepts it. A delay per new connection stands in for the TCP
+and TLS handshakes with a remote site, and a delay per request for the rest
+of the round trip.
+
+Usage:
+    server = fake_http_server.FakeHTTPServer()
+    server.start()
+    http.fetch_url(server.get_url('/rawblock/0'))
+    ...
+    server.stop()
+"""
+
+####################
+# INTERNAL IMPORTS #
+####################
+
+import address_reuse.benchmark.fake_bitcoind as fake_bitcoind
+
+####################
+# EXTERNAL IMPORTS #
+####################
+
+from BaseHTTPServer import BaseHTTPRequestHandler
+from threading import Lock, Thread
+import gzip
+import json
+import time
+import zlib
+from cStringIO import StringIO
+
+###########
+# CLASSES #
+###########
+
+class FakeHTTPServer(object):
+    """Serves JSON on localhost from a daemon thread.
+
+    Args:
+        connection_latency_sec (Optional[float]): Delay before answering the
+            first request on each connection.
+        latency_sec (Optional[float]): Delay before answering each request.
+        content_encoding (Optional[str]): 'gzip' or 'deflate' to compress
+            responses to clients that accept it.
+        max_requests_per_connection (Optional[int]): Close each connection
+            after this many requests without telling the client, as a server
+            does with connections left idle too long.
+
+    Attributes:
+        num_connections (int): Connections accepted so far.
+        num_http_requests (int): Requests answered so far.
+        max_concurrent_requests (int): Most requests being answered at once
+            so far.
+        redirects (dict): Maps a path to the location it redirects to.
+        statuses (dict): Maps a path to the status code it is answered with,
+            instead of 200.
+    """
+
+    def __init__(self, connection_latency_sec = 0.0, latency_sec = 0.0,
+                 content_encoding = None, max_requests_per_connection = None):
+        self.connection_latency_sec = connection_latency_sec
+        self.latency_sec = latency_sec
+        self.content_encoding = content_encoding
+        self.max_requests_per_connection = max_requests_per_connection
+        self.num_connections = 0
+        self.num_http_requests = 0
+        self.num_requests_in_progress = 0
+        self.max_concurrent_requests = 0
+        self.redirects = {}
+        self.statuses = {}
+        self.lock = Lock()
+        self.http_server = fake_bitcoind.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                             RequestHandler)
+        self.http_server.fake_http_server = self
+        self.thread = None
+
+    def start(self):
+        self.thread = Thread(target=self.http_server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.http_server.shutdown()
+        self.http_server.close_connections()
+        self.http_server.server_close()
+        self.thread.join()
+
+    def get_url(self, path):
+        return 'http://127.0.0.1:%d%s' % (self.http_server.server_address[1],
+                                          path)
+
+class RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    #Send each response in one segment; otherwise delayed ACKs add ~40ms to
+    #   every request.
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    #Called once per connection
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        fake_http_server = self.server.fake_http_server
+        with fake_http_server.lock:
+            fake_http_server.num_connections = (
+                fake_http_server.num_connections + 1)
+        self.num_requests_on_connection = 0
+        if fake_http_server.connection_latency_sec > 0:
+            time.sleep(fake_http_server.connection_latency_sec)
+
+    def do_GET(self):
+        fake_http_server = self.server.fake_http_server
+        with fake_http_server.lock:
+            fake_http_server.num_requests_in_progress = (
+                fake_http_server.num_requests_in_progress + 1)
+            fake_http_server.max_concurrent_requests = max(
+                fake_http_server.max_concurrent_requests,
+                fake_http_server.num_requests_in_progress)
+        if fake_http_server.latency_sec > 0:
+            time.sleep(fake_http_server.latency_sec)
+        with fake_http_server.lock:
+            fake_http_server.num_requests_in_progress = (
+                fake_http_server.num_requests_in_progress - 1)
+            fake_http_server.num_http_requests = (
+                fake_http_server.num_http_requests + 1)
+
+        status = fake_http_server.statuses.get(self.path, 200)
+        headers = [('Content-Type', 'application/json')]
+        if self.path in fake_http_server.redirects:
+            status = 302
+            headers.append(('Location',
+                            fake_http_server.redirects[self.path]))
+        body = json.dumps({'path': self.path})
+        accepted = self.headers.getheader('Accept-Encoding') or ''
+        if (fake_http_server.content_encoding is not None and
+                fake_http_server.content_encoding in accepted):
+            body = compress(body, fake_http_server.content_encoding)
+            headers.append(('Content-Encoding',
+                            fake_http_server.content_encoding))
+
+        self.send_response(status)
+        for (name, value) in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+        self.num_requests_on_connection = self.num_requests_on_connection + 1
+        if (fake_http_server.max_requests_per_connection is not None and
+                self.num_requests_on_connection >=
+                fake_http_server.max_requests_per_connection):
+            self.close_connection = 1
+
+    def log_message(self, format, *args):
+        pass #don't log each request to stderr
+
+#############
+# FUNCTIONS #
+#############
+
+def compress(body, content_encoding):
+    if content_encoding == 'gzip':
+        buf = StringIO()
+        gzip_file = gzip.GzipFile(fileobj = buf, mode = 'wb')
+        gzip_file.write(body)
+        gzip_file.close()
+        return buf.getvalue()
+    return zlib.compress(body)
@@ -0,0 +1,87 @@
+"""Compare http.fetch_url() with and without its connection pool.
+
+Fetches pages from `fake_http_server` from a number of threads, once opening
+a connection per request with urllib2, and once reusing pooled connections.
+The server's delay per new connection stands in for the TCP and TLS
+handshakes with a remote API site. Reports requests per second and the
+number of connections opened.
+
+Usage (from the repository root, so that the config file is found):
+    python -m address_reuse.benchmark.http_pool_benchmark
+"""
+
+####################
+# INTERNAL IMPORTS #
+####################
+
+import address_reuse.http
+import address_reuse.benchmark.fake_http_server as fake_http_server
+
+####################
+# EXTERNAL IMPORTS #
+####################
+
+from threading import Thread
+import time
+
+#############
+# CONSTANTS #
+#############
+
+NUM_REQUESTS_PER_THREAD = 100
+
+#Round trips for the TCP and TLS handshakes, and for each request
+CONNECTION_LATENCY_SEC = 0.01
+LATENCY_SEC = 0.002
+
+#(use connection pool, number of threads)
+CONFIGURATIONS = [(False, 1), (True, 1), (False, 4), (True, 4)]
+
+#############
+# FUNCTIONS #
+#############
+
+def fetch_pages(server, thread_num):
+    for page_num in range(0, NUM_REQUESTS_PER_THREAD):
+        address_reuse.http.fetch_url(server.get_url('/thread/%d/page/%d' %
+                                                    (thread_num, page_num)))
+
+def run_configuration(use_connection_pool, num_threads):
+    """Returns the number of seconds taken and connections opened."""
+    address_reuse.http.USE_CONNECTION_POOL = use_connection_pool
+    address_reuse.http.connection_pool = address_reuse.http.ConnectionPool(
+        max_connections_per_host = num_threads)
+    server = fake_http_server.FakeHTTPServer(
+        connection_latency_sec = CONNECTION_LATENCY_SEC,
+        latency_sec = LATENCY_SEC, content_encoding = 'gzip')
+    server.start()
+    try:
+        threads = [Thread(target = fetch_pages, args = (server, thread_num))
+                   for thread_num in range(0, num_threads)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+    finally:
+        address_reuse.http.connection_pool.close()
+        server.stop()
+    return (elapsed, server.num_connections)
+
+def main():
+    address_reuse.http.ENABLE_DEBUG_PRINT = False
+    print(("%d requests per thread, %.1f ms per new connection, %.1f ms per "
+           "request:") % (NUM_REQUESTS_PER_THREAD,
+                          CONNECTION_LATENCY_SEC * 1000, LATENCY_SEC * 1000))
+    for (use_connection_pool, num_threads) in CONFIGURATIONS:
+        (elapsed, num_connections) = run_configuration(use_connection_pool,
+                                                       num_threads)
+        num_requests = NUM_REQUESTS_PER_THREAD * num_threads
+        print(("\t%-9s %d threads %8.2f sec %8.1f requests/sec %6d "
+               "connections") % ('pooled' if use_connection_pool else
+                                 'unpooled', num_threads, elapsed,
+                                 num_requests / elapsed, num_connections))
+
+if __name__ == "__main__":
+    main()
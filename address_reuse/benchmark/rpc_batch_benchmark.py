@@ -0,0 +1,100 @@
+"""Compare ways for LocalBlockchainRPCReader.get_tx_list() to call bitcoind.
+
+Reads every block of a synthetic blockchain served by `fake_bitcoind`, once
+per JSON-RPC batch size, with and without verbose getblock calls, and with an
+empty tx output cache so that each input's previous transaction is also
+fetched over RPC. Reports wall-clock time and the number of HTTP requests
+made. A batch size of 1 is the unbatched behaviour.
+
+Usage (from the repository root, so that the config file is found):
+    python -m address_reuse.benchmark.rpc_batch_benchmark
+"""
+
+####################
+# INTERNAL IMPORTS #
+####################
+
+import address_reuse.blockchain_reader
+import address_reuse.db
+import address_reuse.benchmark.fake_bitcoind as fake_bitcoind
+
+####################
+# EXTERNAL IMPORTS #
+####################
+
+import os
+import time
+from collections import OrderedDict
+
+#############
+# CONSTANTS #
+#############
+
+BENCHMARK_DB_FILENAME = 'rpc_batch_benchmark.db-temp'
+
+NUM_BLOCKS = 20
+NUM_TXS_PER_BLOCK = 200
+
+#Round trip to bitcoind on the same host, per HTTP request
+LATENCY_SEC = 0.0005
+
+#(USE_VERBOSE_GETBLOCK, batch size)
+CONFIGURATIONS = [(False, 1), (False, 10), (False, 100), (False, 1000),
+                  (True, 1), (True, 100)]
+
+#############
+# FUNCTIONS #
+#############
+
+def remove_db_file():
+    try:
+        os.remove(BENCHMARK_DB_FILENAME)
+    except OSError:
+        pass
+
+def run_configuration(server, use_verbose_getblock, batch_size):
+    """Returns the number of seconds and HTTP requests taken to read all
+    blocks."""
+    address_reuse.blockchain_reader.USE_VERBOSE_GETBLOCK = use_verbose_getblock
+    remove_db_file()
+    database = address_reuse.db.Database(BENCHMARK_DB_FILENAME)
+    reader = address_reuse.blockchain_reader.LocalBlockchainRPCReader(
+        database, rpc_url = server.get_rpc_url(),
+        rpc_batch_size = batch_size)
+    num_http_requests_before = server.num_http_requests
+
+    start = time.time()
+    for block_height in range(0, NUM_BLOCKS):
+        reader.get_tx_list(block_height)
+    elapsed = time.time() - start
+
+    database.close()
+    remove_db_file()
+    return (elapsed, server.num_http_requests - num_http_requests_before)
+
+def main():
+    address_reuse.db.ENABLE_DEBUG_PRINT = False
+    address_reuse.blockchain_reader.ENABLE_DEBUG_PRINT = False
+    blockchain = fake_bitcoind.FakeBlockchain(
+        num_blocks = NUM_BLOCKS, num_txs_per_block = NUM_TXS_PER_BLOCK)
+    server = fake_bitcoind.FakeBitcoindServer(blockchain, LATENCY_SEC)
+    server.start()
+    results = OrderedDict()
+    try:
+        for (use_verbose_getblock, batch_size) in CONFIGURATIONS:
+            results[(use_verbose_getblock, batch_size)] = run_configuration(
+                server, use_verbose_getblock, batch_size)
+    finally:
+        server.stop()
+
+    print("%d blocks of %d txs, %.1f ms latency per HTTP request:" %
+          (NUM_BLOCKS, NUM_TXS_PER_BLOCK, LATENCY_SEC * 1000))
+    for ((use_verbose_getblock, batch_size),
+         (elapsed, num_http_requests)) in results.items():
+        getblock_desc = 'verbose getblock' if use_verbose_getblock else ''
+        print(("\tbatch size %-6d %-17s %8.2f sec %8.2f blocks/sec %8d HTTP "
+               "requests") % (batch_size, getblock_desc, elapsed,
+                              NUM_BLOCKS / elapsed, num_http_requests))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+"""Compare SQLite PRAGMA profiles on a multi-process deferred-blame workload.
+
+Builds a synthetic database of deferred blame records, then resolves them with
+several worker processes at once, the way multiple instances of
+`update_deferred_blame_records.py` do, while another process writes tx output
+addresses the way `update_txout_cache.py` does. The same workload is run once
+per profile, each against a fresh database file, and wall-clock time is
+reported for each.
+
+Usage (from the repository root, so that the config file is found):
+    python -m address_reuse.benchmark.sqlite_pragma_benchmark
+"""
+
+####################
+# INTERNAL IMPORTS #
+####################
+
+import address_reuse.db
+import address_reuse.config
+
+####################
+# EXTERNAL IMPORTS #
+####################
+
+import os
+import time
+from collections import OrderedDict
+from multiprocessing import Process
+
+#############
+# CONSTANTS #
+#############
+
+BENCHMARK_DB_FILENAME = 'sqlite_pragma_benchmark.db-temp'
+
+NUM_BLOCKS = 200
+NUM_RECORDS_PER_BLOCK = 100
+NUM_TX_OUTPUTS_PER_BLOCK = 500
+NUM_DEFERRED_BLAME_WORKERS = 4
+
+#Explicit checkpoint interval used by workers when the profile is in WAL mode
+CHECKPOINT_INTERVAL_BLOCKS = 10
+
+DEFERRED_PLACEHOLDER = address_reuse.db.DB_DEFERRED_BLAME_PLACEHOLDER
+
+PROFILES = OrderedDict()
+PROFILES['legacy (TRUNCATE)'] = [('journal_mode', 'TRUNCATE')]
+PROFILES['WAL, synchronous=FULL'] = [
+    ('busy_timeout', 10000),
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'FULL')]
+PROFILES['WAL, synchronous=NORMAL, cache+mmap'] = [
+    ('busy_timeout', 10000),
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('cache_size', -65536),
+    ('mmap_size', 268435456),
+    ('temp_store', 'MEMORY')]
+
+#############
+# FUNCTIONS #
+#############
+
+def get_fake_address(block_height, index):
+    return '1Fake%dx%d' % (block_height, index)
+
+def get_fake_tx_id(block_height, index):
+    return '%032x%032x' % (block_height, index)
+
+def remove_db_files():
+    for suffix in ['', '-journal', '-wal', '-shm']:
+        try:
+            os.remove(BENCHMARK_DB_FILENAME + suffix)
+        except OSError:
+            pass
+
+def populate_deferred_records(pragmas):
+    """Store NUM_RECORDS_PER_BLOCK deferred records for each block."""
+    database = address_reuse.db.Database(BENCHMARK_DB_FILENAME,
+                                         sqlite_pragmas=pragmas)
+    for block_height in range(0, NUM_BLOCKS):
+        with database.block_transaction():
+            for index in range(0, NUM_RECORDS_PER_BLOCK):
+                database.store_blame(
+                    DEFERRED_PLACEHOLDER,
+                    address_reuse.db.AddressReuseType.TX_HISTORY,
+                    address_reuse.db.AddressReuseRole.RECEIVER,
+                    address_reuse.db.DataSource.WALLET_EXPLORER, block_height,
+                    get_fake_tx_id(block_height, index),
+                    get_fake_address(block_height, index))
+            database.write_stored_blame()
+    database.close()
+
+def resolve_deferred_records(pragmas, min_height, max_height):
+    """Worker: resolve deferred records for a contiguous span of blocks."""
+    database = address_reuse.db.Database(BENCHMARK_DB_FILENAME,
+                                         sqlite_pragmas=pragmas)
+    if ('journal_mode', 'WAL') in pragmas:
+        database.config_store.SQLITE_CHECKPOINT_INTERVAL_BLOCKS = (
+            CHECKPOINT_INTERVAL_BLOCKS)
+    for block_height in range(min_height, max_height + 1):
+        blame_records = database.get_all_deferred_blame_records_at_height(
+            block_height)
+        for blame_record in blame_records:
+            #a remote lookup would happen here; check the label cache first as
+            #   the blamer does
+            database.get_blame_label_for_btc_address(
+                blame_record.relevant_address)
+            blame_record.blame_label = 'wallet-%d' % (block_height % 10)
+            database.cache_blame_label_for_btc_address(
+                blame_record.relevant_address, blame_record.blame_label)
+            database.update_blame_record(blame_record)
+        if address_reuse.db.UPDATE_BLAME_STATS_ONCE_PER_BLOCK:
+            database.write_deferred_blame_record_resolutions()
+        database.checkpoint_if_due()
+    print("Worker for blocks %d-%d: %s" % (min_height, max_height,
+                                           str(database.contention_stats)))
+    database.close()
+
+def cache_tx_outputs(pragmas):
+    """Producer: write tx output addresses one block at a time."""
+    database = address_reuse.db.Database(BENCHMARK_DB_FILENAME,
+                                         sqlite_pragmas=pragmas)
+    for block_height in range(0, NUM_BLOCKS):
+        for index in range(0, NUM_TX_OUTPUTS_PER_BLOCK):
+            database.add_output_address_to_mem_cache(
+                block_height, get_fake_tx_id(block_height, index), 0,
+                get_fake_address(block_height, index))
+        database.write_stored_output_addresses()
+    database.close()
+
+def run_profile(pragmas):
+    """Returns the number of seconds the concurrent workload took."""
+    remove_db_files()
+    populate_deferred_records(pragmas)
+
+    processes = [Process(target=cache_tx_outputs, args=(pragmas,))]
+    blocks_per_worker = NUM_BLOCKS // NUM_DEFERRED_BLAME_WORKERS
+    for worker_num in range(0, NUM_DEFERRED_BLAME_WORKERS):
+        min_height = worker_num * blocks_per_worker
+        max_height = min_height + blocks_per_worker - 1
+        if worker_num == NUM_DEFERRED_BLAME_WORKERS - 1:
+            max_height = NUM_BLOCKS - 1
+        processes.append(Process(target=resolve_deferred_records,
+                                 args=(pragmas, min_height, max_height)))
+
+    start = time.time()
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    elapsed = time.time() - start
+
+    remove_db_files()
+    return elapsed
+
+def main():
+    address_reuse.db.ENABLE_DEBUG_PRINT = False
+    results = OrderedDict()
+    for profile_name, pragmas in PROFILES.items():
+        results[profile_name] = run_profile(pragmas)
+
+    num_blocks_total = NUM_BLOCKS * 2 #each block resolved and cached once
+    print(("%d deferred-blame workers + 1 txout cache producer, %d blocks, %d "
+           "records/block:") % (NUM_DEFERRED_BLAME_WORKERS, NUM_BLOCKS,
+                                NUM_RECORDS_PER_BLOCK))
+    for profile_name, elapsed in results.items():
+        print("\t%-40s %8.2f sec %8.2f blocks/sec" %
+              (profile_name, elapsed, num_blocks_total / elapsed))
+
+if __name__ == "__main__":
+    main()
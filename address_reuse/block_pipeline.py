@@ -0,0 +1,134 @@
+"""Fetching upcoming blocks in the background while the current one is processed.
+
+Reading a block from bitcoind is mostly waiting on I/O, while processing it is
+mostly CPU and SQLite work, so `BlockPrefetcher` fetches the blocks after the
+one being processed from a pool of worker threads. Workers claim heights in
+order and may finish out of order, but blocks are handed out strictly in
+order of height, since the seen address index requires that blocks be
+processed in order. No more than `queue_depth` blocks are fetched or being
+fetched ahead of the consumer at a time.
+
+Only the fetching of each block's decoded transactions happens in the
+workers. Everything that reads or writes the database stays in the
+consumer's thread.
+"""
+
+####################
+# EXTERNAL IMPORTS #
+####################
+
+import sys
+import threading
+import time
+
+###########
+# CLASSES #
+###########
+
+class BlockPrefetcher(object):
+    """Fetches a range of blocks from worker threads, ahead of their use.
+
+    Args:
+        block_fetcher_factory (callable): Returns a function that takes a
+            block height and returns the block's fetched contents. Called once
+            in each worker thread, so that workers don't share connections.
+        start_height (int): First block to fetch.
+        end_height (int): Block after the last one to fetch.
+        queue_depth (int): Maximum number of blocks fetched or being fetched
+            ahead of the consumer.
+        num_workers (int): Number of worker threads.
+
+    Attributes:
+        fetch_seconds (float): Time spent fetching, summed over all workers.
+        wait_seconds (float): Time the consumer spent waiting for blocks that
+            hadn't been fetched yet.
+    """
+
+    def __init__(self, block_fetcher_factory, start_height, end_height,
+                 queue_depth, num_workers):
+        assert queue_depth >= 1
+        assert num_workers >= 1
+        self.block_fetcher_factory = block_fetcher_factory
+        self.end_height = end_height
+        self.queue_depth = queue_depth
+        self.num_workers = num_workers
+        self.next_height_to_fetch = start_height
+        self.next_height_to_get = start_height
+        #block height => (fetched contents, exc_info or None)
+        self.results = {}
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.threads = []
+        self.fetch_seconds = 0.0
+        self.wait_seconds = 0.0
+
+    def start(self):
+        for _ in range(0, self.num_workers):
+            thread = threading.Thread(target = self.work)
+            #don't keep the process alive if the consumer dies
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        """Stops the workers once their current fetches finish."""
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def is_next(self, block_height):
+        """Whether `block_height` is the next block `get` will return."""
+        return (block_height == self.next_height_to_get and
+                block_height < self.end_height)
+
+    def get(self, block_height):
+        """Returns the contents of the next block, waiting until it's fetched.
+
+        Raises:
+            Whatever the block fetcher raised while fetching the block.
+        """
+        assert self.is_next(block_height)
+        with self.condition:
+            if block_height not in self.results:
+                wait_start = time.time()
+                while block_height not in self.results:
+                    self.condition.wait()
+                self.wait_seconds = (self.wait_seconds + time.time() -
+                                     wait_start)
+            (contents, exc_info) = self.results.pop(block_height)
+            self.next_height_to_get = self.next_height_to_get + 1
+            self.condition.notify_all()
+        if exc_info is not None:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        return contents
+
+    def work(self):
+        fetch_block = self.block_fetcher_factory()
+        while True:
+            with self.condition:
+                while (not self.stopped and
+                       self.next_height_to_fetch < self.end_height and
+                       self.next_height_to_fetch - self.next_height_to_get >=
+                       self.queue_depth):
+                    self.condition.wait()
+                if (self.stopped or
+                        self.next_height_to_fetch >= self.end_height):
+                    return
+                block_height = self.next_height_to_fetch
+                self.next_height_to_fetch = self.next_height_to_fetch + 1
+
+            fetch_start = time.time()
+            try:
+                result = (fetch_block(block_height), None)
+            except Exception:
+                #re-raised in the consumer's thread
+                result = (None, sys.exc_info())
+            fetch_time = time.time() - fetch_start
+
+            with self.condition:
+                self.results[block_height] = result
+                self.fetch_seconds = self.fetch_seconds + fetch_time
+                self.condition.notify_all()
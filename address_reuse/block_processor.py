@@ -13,6 +13,7 @@ from __future__ import division # make division of two ints return float
 
 #get name of this script for `check_int_and_die` using `os.path.basename`
 import os
+import time
 
 ####################
 # INTERNAL IMPORTS #
@@ -38,6 +39,16 @@ THIS_FILE = os.path.basename(__file__)
 SKIP_CLIENT_LOOKUP_BEFORE_BLOCK_HEIGHT = 168085
 DO_SKIP_CLIENT_LOOKUP_BELOW_FIRST_BLOCK = False
 
+#Before processing the txs in a block, ask the block reader about the prior tx
+#   history of all output addresses in the block at once rather than once per
+#   output. Only has an effect for readers that support it.
+RESOLVE_PRIOR_TX_HISTORY_PER_BLOCK = True #TODO: move flag to config file?
+
+#Before resolving a block's deferred blame records, fetch everything they need
+#   from the remote APIs concurrently rather than one request per record, and
+#   write the resolutions in one transaction.
+PREFETCH_DEFERRED_BLAME_LOOKUPS = True #TODO: move flag to config file?
+
 #See: e.g. https://www.blocktrail.com/BTC/tx/e3bf3d07d4b0375638d5f1db5255fe07ba2c4cb067cd81b84ee974b6585fb468
 WEIRD_TXS_TO_SKIP_FOR_RELAYED_BY_CACHING = {
     #tx hash => block height
@@ -132,29 +143,66 @@ class BlockProcessor(object):
 
         assert isinstance(block_height, int)
 
-        current_block_state = block_state.BlockState(block_height) # block stats collector
-
+        stage_start = time.time()
         tx_list = self.block_reader.get_tx_list(block_height,
                                                 use_tx_out_addr_cache_only)
-
-        for tx in tx_list:
-            self.process_tx(tx, current_block_state, block_height, benchmarker,
-                            defer_blaming)
-
-        #Per requirements of db.store_blame(), call write_stored_blame() to
-        #   write the records cached in Python memory to the database as a
-        #   block-sized batch
-        if db.INSERT_BLAME_STATS_ONCE_PER_BLOCK:
-            self.database.write_stored_blame()
-            dprint("Committed stored blame stats to db.")
+        spent_utxo_keys = self.block_reader.take_spent_spilled_utxo_keys()
+        if benchmarker is not None:
+            benchmarker.add_stage_time('get tx list',
+                                       time.time() - stage_start)
+            stage_start = time.time()
+
+        #Everything written for this block is committed at once, or not at all
+        #   if processing is interrupted. If the database is locked, the block
+        #   is processed again from the start.
+        def process_and_write_block():
+            current_block_state = block_state.BlockState(block_height) # block stats collector
+
+            prior_tx_history_map = None
+            if RESOLVE_PRIOR_TX_HISTORY_PER_BLOCK:
+                prior_tx_history_map = (
+                    self.block_reader.get_prior_tx_history_for_block(
+                        tx_list, block_height, benchmarker))
+
+            for tx in tx_list:
+                self.process_tx(tx, current_block_state, block_height,
+                                benchmarker, defer_blaming,
+                                prior_tx_history_map)
+
+            #Per requirements of db.store_blame(), call write_stored_blame() to
+            #   write the records cached in Python memory to the database as a
+            #   block-sized batch
+            if db.INSERT_BLAME_STATS_ONCE_PER_BLOCK:
+                self.database.write_stored_blame()
+                dprint("Committed stored blame stats to db.")
+
+            #Likewise, per requirements of
+            #   db.has_address_been_seen_cache_if_not(), write addresses first
+            #   seen in this block to the database.
+            if db.USE_IN_MEMORY_SEEN_ADDRESS_INDEX:
+                self.database.write_stored_seen_addresses()
+
+            #Spent outputs leave the UTXO cache's table on disk with the block
+            self.database.delete_spilled_utxos(spent_utxo_keys)
+
+            current_block_state.update_sendback_reuse_pct()
+            current_block_state.update_receiver_histoy_pct()
+            self.database.record_block_stats(current_block_state)
+
+        self.database.run_in_block_transaction(process_and_write_block)
+
+        #Only persist the filter once the rows it now covers are committed
+        if (not db.USE_IN_MEMORY_SEEN_ADDRESS_INDEX and
+                db.USE_SEEN_ADDRESS_BLOOM_FILTER):
+            self.database.flush_seen_address_bloom_filter()
+
+        self.database.checkpoint_if_due()
 
         if benchmarker is not None:
+            benchmarker.add_stage_time('process and write block',
+                                       time.time() - stage_start)
             benchmarker.increment_blocks_processed()
 
-        current_block_state.update_sendback_reuse_pct()
-        current_block_state.update_receiver_histoy_pct()
-        self.database.record_block_stats(current_block_state)
-
     #TODO: http://pylint-messages.wikidot.com/messages:r0201
     def _get_input_address_list(self, tx_obj):
         """Helper for `process_tx`, gets input addr list from tx JSON."""
@@ -192,6 +240,12 @@ class BlockProcessor(object):
             `RECEIVER`, use the `update_blame_record` function to update the
             `BlameRecord` information. Update the record in the database with
             the new information.
+
+        All lookups are made before the block's transaction is opened; only
+        the resulting updates and deletes are written inside it. If
+        `PREFETCH_DEFERRED_BLAME_LOOKUPS` is set, the remote lookups for all of
+        the block's records are made concurrently beforehand (see
+        `prefetch_deferred_blame_lookups`).
         """
 
         blame_records = self.database.get_all_deferred_blame_records_at_height(
@@ -200,27 +254,87 @@ class BlockProcessor(object):
         dprint("Retrieved %d deferred blame records from db @ height %d" %
                (len(blame_records), block_height))
 
+        if PREFETCH_DEFERRED_BLAME_LOOKUPS:
+            self.prefetch_deferred_blame_lookups(blame_records, benchmarker)
+
+        #Resolve every label before opening the block's transaction, so that
+        #   remote lookups (including whole wallet downloads) neither hold the
+        #   database lock nor get repeated if the writes have to be retried.
+        client_records = {}
+        wallet_labels = {}
         for blame_record in blame_records:
             if blame_record.address_reuse_role == CLIENT:
-                self.process_deferred_client_blame_record(blame_record)
+                client_records[blame_record.row_id] = (
+                    self.get_deferred_client_blame_record(blame_record))
 
-            if (blame_record.address_reuse_type == SENDBACK
+            if not (blame_record.address_reuse_type == SENDBACK
                     and blame_record.address_reuse_role == RECEIVER):
-                self.delete_deferred_sendback_receiver_record(blame_record)
+                wallet_labels[blame_record.row_id] = (
+                    self.blamer.get_single_wallet_label(
+                        blame_record.relevant_address, benchmarker))
+
+        def write_resolutions():
+            for blame_record in blame_records:
+                if blame_record.address_reuse_role == CLIENT:
+                    self.write_deferred_client_blame_record(
+                        blame_record, client_records[blame_record.row_id])
 
-            else:
-                blame_record.blame_label = self.blamer.get_single_wallet_label(
-                    blame_record.relevant_address)
-                dprint(("Attempting to update record with new blame label %s") %
-                       blame_record.blame_label)
-                self.database.update_blame_record(blame_record)
+                if (blame_record.address_reuse_type == SENDBACK
+                        and blame_record.address_reuse_role == RECEIVER):
+                    self.delete_deferred_sendback_receiver_record(blame_record)
 
-        if db.UPDATE_BLAME_STATS_ONCE_PER_BLOCK:
-            self.database.write_deferred_blame_record_resolutions()
+                else:
+                    blame_record.blame_label = wallet_labels[
+                        blame_record.row_id]
+                    dprint(("Attempting to update record with new blame label "
+                            "%s") % blame_record.blame_label)
+                    self.database.update_blame_record(blame_record)
+
+            if db.UPDATE_BLAME_STATS_ONCE_PER_BLOCK:
+                self.database.write_deferred_blame_record_resolutions()
+
+        self.database.run_in_block_transaction(write_resolutions)
+
+        self.database.checkpoint_if_due()
 
         if benchmarker is not None:
             benchmarker.increment_blocks_processed()
 
+    def prefetch_deferred_blame_lookups(self, blame_records,
+                                        benchmarker=None):
+        """Fetch the remote data needed to resolve these records concurrently.
+
+        Collects the distinct txs whose wallet client and addresses whose
+        wallet label `process_block_after_deferred_blaming` will look up for
+        these records, and fetches whichever aren't cached with up to the
+        config file's `max_concurrent_requests` at once, within the remote
+        APIs' rate limits. The records are then resolved as usual, but without
+        waiting on the remote APIs for each one.
+
+        Args:
+            blame_records (List[`tx_blame.BlameRecord`]): Deferred records from
+                one or more blocks.
+            benchmarker (Optional[`block_reader_benchmark.Benchmark`]): Counts
+                hits and misses of the HTTP response cache.
+        """
+
+        client_tx_ids = []
+        label_addresses = []
+        for blame_record in blame_records:
+            if (blame_record.address_reuse_role == CLIENT and
+                    not (DO_SKIP_CLIENT_LOOKUP_BELOW_FIRST_BLOCK and
+                         blame_record.block_height <
+                         SKIP_CLIENT_LOOKUP_BEFORE_BLOCK_HEIGHT)):
+                client_tx_ids.append(blame_record.tx_id)
+            if not (blame_record.address_reuse_type == SENDBACK and
+                    blame_record.address_reuse_role == RECEIVER):
+                label_addresses.append(blame_record.relevant_address)
+
+        self.blamer.prefetch_remote_lookups(
+            client_tx_ids, label_addresses,
+            self.database.config_store.HTTP_MAX_CONCURRENT_REQUESTS,
+            benchmarker)
+
     def process_deferred_client_blame_record(self, blame_record):
         """Determine wallet client or delete the record.
 
@@ -237,20 +351,43 @@ class BlockProcessor(object):
                 resolved wallet client name yet.
         """
 
+        client_record = self.get_deferred_client_blame_record(blame_record)
+        self.write_deferred_client_blame_record(blame_record, client_record)
+
+    def get_deferred_client_blame_record(self, blame_record):
+        """Look up the wallet client for a deferred `CLIENT` record.
+
+        Args:
+            blame_record (`tx_blame.BlameRecord`): The record that has no
+                resolved wallet client name yet.
+
+        Returns:
+            `tx_blame.BlameRecord`: The wallet client's record, or None if it
+                cannot be obtained or the lookup is skipped for this height.
+        """
+
         assert isinstance(blame_record, tx_blame.BlameRecord)
         assert blame_record.address_reuse_role == CLIENT
 
         dprint("Processing record: " + str(blame_record))
 
-        client_record = None
         if (DO_SKIP_CLIENT_LOOKUP_BELOW_FIRST_BLOCK and
                 blame_record.block_height <
                 SKIP_CLIENT_LOOKUP_BEFORE_BLOCK_HEIGHT):
             #don't bother looking up client info
-            pass
-        else:
-            client_record = self.blamer.get_wallet_client_blame_record(
-                blame_record.tx_id)
+            return None
+        return self.blamer.get_wallet_client_blame_record(blame_record.tx_id)
+
+    def write_deferred_client_blame_record(self, blame_record, client_record):
+        """Update a deferred `CLIENT` record with its client, or delete it.
+
+        Args:
+            blame_record (`tx_blame.BlameRecord`): The record that has no
+                resolved wallet client name yet.
+            client_record (Optional[`tx_blame.BlameRecord`]): The result of
+                `get_deferred_client_blame_record` for it.
+        """
+
         if client_record is None:
             dprint("No client information, must delete this record.")
             self.database.delete_blame_record(blame_record.row_id)
@@ -274,16 +411,22 @@ class BlockProcessor(object):
         """Cache 'relayed by' field in db for all txs in the block."""
 
         tx_list = self.block_reader.get_tx_list(block_height)
-        for tx_obj in tx_list:
-            tx_id = tx_obj['hash']
-            relayed_by = tx_obj['relayed_by']
-            if (tx_id in WEIRD_TXS_TO_SKIP_FOR_RELAYED_BY_CACHING and
-                    WEIRD_TXS_TO_SKIP_FOR_RELAYED_BY_CACHING[tx_id] ==
-                    block_height):
-                pass
-            else:
-                self.database.record_relayed_by(tx_id, block_height, relayed_by)
-            if benchmarker is not None:
+
+        def write_relayed_by():
+            for tx_obj in tx_list:
+                tx_id = tx_obj['hash']
+                relayed_by = tx_obj['relayed_by']
+                if (tx_id in WEIRD_TXS_TO_SKIP_FOR_RELAYED_BY_CACHING and
+                        WEIRD_TXS_TO_SKIP_FOR_RELAYED_BY_CACHING[tx_id] ==
+                        block_height):
+                    pass
+                else:
+                    self.database.record_relayed_by(tx_id, block_height,
+                                                    relayed_by)
+
+        self.database.run_in_block_transaction(write_relayed_by)
+        if benchmarker is not None:
+            for _ in tx_list:
                 benchmarker.increment_transactions_processed()
         if benchmarker is not None:
             benchmarker.increment_blocks_processed()
@@ -297,9 +440,9 @@ class BlockProcessor(object):
         block explorer remote API.
         """
 
-        tx_id_list = self.block_reader.get_tx_ids_at_height(block_height)
-        for tx_id in tx_id_list:
-            rpc_style_tx_json = self.block_reader.get_decoded_tx(tx_id)
+        (tx_id_list, rpc_style_tx_jsons) = (
+            self.block_reader.get_decoded_txs_at_height(block_height))
+        for tx_id, rpc_style_tx_json in zip(tx_id_list, rpc_style_tx_jsons):
             address_list = self.block_reader.get_output_addresses(
                 rpc_style_tx_json)
             for output_pos in range(0, len(address_list)):
@@ -315,7 +458,8 @@ class BlockProcessor(object):
 
     #TODO: This function is too long and indented, break into smaller pieces
     def process_tx(self, tx_obj, current_block_state, block_height,
-                   benchmarker=None, defer_blaming=False):
+                   benchmarker=None, defer_blaming=False,
+                   prior_tx_history_map=None):
         """Finds address reuse in speicfied tx and stores records in db.
 
         Args:
@@ -331,6 +475,10 @@ class BlockProcessor(object):
                 this when processing the blockchain locally so that one thread
                 can focus on parsing the blockchain, and another can focus on
                 remote API lookups. Default: False
+            prior_tx_history_map (Optional[dict]): Prior tx history of every
+                output in the block as returned by the block reader's
+                `get_prior_tx_history_for_block`. If not specified, the block
+                reader is asked once per output.
         """
         current_block_state.incr_total_tx_num()
         tx_contains_sendback_reuse = False
@@ -378,11 +526,17 @@ class BlockProcessor(object):
 
         #Look through outputs to see if any of them have a tx history PRIOR to
         #   this tx
-        for btc_output in tx_obj['out']:
+        for output_pos, btc_output in enumerate(tx_obj['out']):
             if 'addr' in btc_output:
                 output_addr = btc_output['addr']
-                if self._does_output_have_prior_tx_history(
-                        output_addr, tx_id, block_height, benchmarker):
+                if prior_tx_history_map is not None:
+                    has_prior_tx_history = prior_tx_history_map[
+                        (tx_id, output_pos)]
+                else:
+                    has_prior_tx_history = (
+                        self._does_output_have_prior_tx_history(
+                            output_addr, tx_id, block_height, benchmarker))
+                if has_prior_tx_history:
                     #Found an instance of send-back address reuse. Find parties
                     #   to blame and store that in the db
                     blame_records = self.blamer.get_wallet_blame_list(
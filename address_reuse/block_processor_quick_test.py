@@ -3,7 +3,14 @@
 #Covers these classesand functions:
 #   BlockProcessor:
 #       cache_tx_output_addresses_for_block_only(block_height, benchmarker)
+#           * also against a stand-in bitcoind
+#       process_block(block_height)
+#           * deleting spent outputs spilled from the UTXO cache
 #       process_deferred_client_blame_record()
+#       process_block_after_deferred_blaming(block_height)
+#           * with remote lookups prefetched at once
+#           * with remote lookups made outside the block's transaction
+#           * resuming a wallet download interrupted while processing it
 
 ####################
 # INTERNAL IMPORTS #
@@ -12,6 +19,9 @@
 import block_processor
 import blockchain_reader
 import db
+import http
+import tx_blame
+import benchmark.fake_bitcoind
 
 ####################
 # EXTERNAL IMPORTS #
@@ -19,6 +29,7 @@ import db
 
 import unittest
 import os
+import json
 
 #############
 # CONSTANTS #
@@ -77,6 +88,34 @@ class BlockProcessorForTxOutputAddrCacheTest(unittest.TestCase):
         
     #TODO: A test for what happens when an address can't be decoded. Find such 
     #   a block.
+
+    #Uses a stand-in bitcoind, whose coinbase txs each have an output with no
+    #   address.
+    def test_cache_tx_output_addresses_for_block_only_with_verbose_getblock(self):
+        blockchain = benchmark.fake_bitcoind.FakeBlockchain(
+            num_blocks = 2, num_txs_per_block = 3)
+        server = benchmark.fake_bitcoind.FakeBitcoindServer(blockchain)
+        server.start()
+        try:
+            reader = blockchain_reader.LocalBlockchainRPCReader(
+                self.temp_db, rpc_url = server.get_rpc_url())
+            processor = block_processor.BlockProcessor(reader, self.temp_db)
+            processor.cache_tx_output_addresses_for_block_only(1)
+            #getblockhash and getblock only
+            self.assertEqual(server.num_rpc_calls, 2)
+        finally:
+            server.stop()
+
+        coinbase_tx_id = benchmark.fake_bitcoind.get_hash('tx', 1, 0)
+        last_tx_id = benchmark.fake_bitcoind.get_hash('tx', 1, 2)
+        self.assertEqual(
+            self.temp_db.get_output_addresses(
+                [(coinbase_tx_id, 0), (coinbase_tx_id, 1), (last_tx_id, 1)]),
+            {(coinbase_tx_id, 0):
+                 benchmark.fake_bitcoind.get_fake_address(1, 0, 0),
+             (coinbase_tx_id, 1): None,
+             (last_tx_id, 1):
+                 benchmark.fake_bitcoind.get_fake_address(1, 2, 1)})
     
     def test_process_deferred_client_blame_record_for_uncached_and_remotely_null_client(self):
         #test with a record for which there is no cached client info in the
@@ -316,5 +355,256 @@ class BlockProcessorForTxOutputAddrCacheTest(unittest.TestCase):
         
         self.assertIsNone(result)
 
+    def test_process_block_deletes_spent_spilled_utxos(self):
+        tx_id = 'ab' * 32
+        self.temp_db.write_spilled_utxos(
+            [(tx_id, 0, '1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa'), (tx_id, 1, None)])
+        coinbase_tx = {'hash': 'cd' * 32, 'inputs': [],
+                       'out': [{'n': 0,
+                                'addr': '15NUwyBYrZcnUgTagsm1A7M2yL2GntpuaZ'}]}
+        self.blockchain_reader.get_tx_list = (
+            lambda block_height, use_tx_out_addr_cache_only = False:
+            [coinbase_tx])
+        self.blockchain_reader.take_spent_spilled_utxo_keys = (
+            lambda: [(tx_id, 0)])
+        depths_at_delete = []
+        delete_spilled_utxos = self.temp_db.delete_spilled_utxos
+        def record_delete(output_keys):
+            depths_at_delete.append(self.temp_db.block_transaction_depth)
+            delete_spilled_utxos(output_keys)
+        self.temp_db.delete_spilled_utxos = record_delete
+
+        processor = block_processor.BlockProcessor(
+            self.blockchain_reader, self.temp_db)
+        processor.process_block(1, defer_blaming = True)
+
+        #Deleted in the block's transaction
+        self.assertEqual(depths_at_delete, [1])
+        self.assertEqual(self.temp_db.get_spilled_utxos(
+            [(tx_id, 0), (tx_id, 1)]), {(tx_id, 1): None})
+
+    def store_deferred_records(self, block_height):
+        """Store deferred records for two txs and return the remote responses
+        needed to resolve them, by URL."""
+
+        tx_id_1 = ('b1fea52486ce0c62bb442b530a3f0132b826c74e473d1f2c220bfa78'
+                   '111c5082')
+        tx_id_2 = ('f4184fc596403b9d638783cf57adfe4c75c605f6356fbc91338530e9'
+                   '831e9e16')
+        address_1 = '1PSSGeFHDnKNxiEyFrD1wcEaHr9hrQDDWc'
+        address_2 = '1Q2TWHE3GMdB6BZKafqwxXtWAWgFt5Jvm3'
+        SENDBACK = db.AddressReuseType.SENDBACK
+        TX_HISTORY = db.AddressReuseType.TX_HISTORY
+        BCI = db.DataSource.BLOCKCHAIN_INFO
+        WE = db.DataSource.WALLET_EXPLORER
+        for (reuse_type, role, data_source, tx_id, address) in [
+                (SENDBACK, db.AddressReuseRole.CLIENT, BCI, tx_id_1, address_1),
+                (SENDBACK, db.AddressReuseRole.SENDER, WE, tx_id_1, address_1),
+                (SENDBACK, db.AddressReuseRole.RECEIVER, WE, tx_id_1,
+                 address_1),
+                (TX_HISTORY, db.AddressReuseRole.RECEIVER, WE, tx_id_2,
+                 address_2)]:
+            self.temp_db.store_blame(DB_DEFERRED_BLAME_PLACEHOLDER, reuse_type,
+                                     role, data_source, block_height, tx_id,
+                                     address)
+        if db.INSERT_BLAME_STATS_ONCE_PER_BLOCK:
+            self.temp_db.write_stored_blame()
+
+        bci_url = blockchain_reader.BlockchainInfoURLBuilder(
+            self.temp_db.config_store.BLOCKCHAIN_INFO_API_KEY).get_tx_info(
+                tx_id_1)
+        urlbuilder = blockchain_reader.WalletExplorerURLBuilder()
+        api_key = self.temp_db.config_store.WALLETEXPLORER_API_KEY
+        we_url_1 = urlbuilder.get_address_info(address_1, api_key)
+        we_url_2 = urlbuilder.get_address_info(address_2, api_key)
+        remote_responses = {
+            bci_url: {'relayed_by': '127.0.0.1', 'block_height': block_height,
+                      'hash': tx_id_1},
+            we_url_1: {'found': True, 'label': 'Exchange', 'wallet_id': 'a1'},
+            we_url_2: {'found': True, 'wallet_id': 'b2'}}
+        return (remote_responses, bci_url, we_url_1, we_url_2)
+
+    def test_process_block_after_deferred_blaming_prefetches_lookups(self):
+        block_height = 170
+        tx_id_1 = ('b1fea52486ce0c62bb442b530a3f0132b826c74e473d1f2c220bfa78'
+                   '111c5082')
+        address_1 = '1PSSGeFHDnKNxiEyFrD1wcEaHr9hrQDDWc'
+        address_2 = '1Q2TWHE3GMdB6BZKafqwxXtWAWgFt5Jvm3'
+        (remote_responses, bci_url, we_url_1, we_url_2) = (
+            self.store_deferred_records(block_height))
+        fetched_urls = []
+        def fetch_urls(urls, num_threads, benchmarker = None):
+            fetched_urls.extend(urls)
+            return dict((url, json.dumps(remote_responses[url]))
+                        for url in urls)
+        def fetch_url(url):
+            self.fail('Fetched %s one at a time' % url)
+
+        original_fetch_urls = http.fetch_urls
+        original_fetch_url = http.fetch_url
+        original_cache_all = blockchain_reader.CACHE_ALL_WALLET_ADDRESSES
+        http.fetch_urls = fetch_urls
+        http.fetch_url = fetch_url
+        blockchain_reader.CACHE_ALL_WALLET_ADDRESSES = False
+        try:
+            processor = block_processor.BlockProcessor(
+                self.blockchain_reader, self.temp_db)
+            processor.process_block_after_deferred_blaming(block_height)
+        finally:
+            http.fetch_urls = original_fetch_urls
+            http.fetch_url = original_fetch_url
+            blockchain_reader.CACHE_ALL_WALLET_ADDRESSES = original_cache_all
+
+        #Each tx and address is fetched once, though address_1 is looked up
+        #   for two records
+        self.assertEqual(sorted(fetched_urls),
+                         sorted([bci_url, we_url_1, we_url_2]))
+        self.assertEqual(self.temp_db.get_cached_relayed_by(tx_id_1),
+                         '127.0.0.1')
+        self.assertEqual(self.temp_db.get_blame_label_for_btc_address(
+            address_1), 'Exchange')
+        self.assertEqual(self.temp_db.get_blame_label_for_btc_address(
+            address_2), 'b2')
+
+        #The send-back receiver record is deleted, and the rest resolved
+        self.assertEqual(self.temp_db.get_all_deferred_blame_records_at_height(
+            block_height), [])
+        stmt = ('SELECT label FROM ' + db.SQL_TABLE_NAME_BLAME_STATS + ' '
+                'INNER JOIN ' + db.SQL_TABLE_NAME_BLAME_IDS + ' ON '
+                'blame_recipient_id = ' + db.SQL_TABLE_NAME_BLAME_IDS + ''
+                '.rowid WHERE role = ?')
+        caller = ('test_process_block_after_deferred_blaming_prefetches_'
+                  'lookups')
+        records = self.temp_db.fetch_query_and_handle_errors(
+            stmt, (db.AddressReuseRole.RECEIVER,), caller)
+        self.assertEqual([record['label'] for record in records], ['b2'])
+        records = self.temp_db.fetch_query_and_handle_errors(
+            stmt, (db.AddressReuseRole.SENDER,), caller)
+        self.assertEqual([record['label'] for record in records], ['Exchange'])
+
+    def test_process_block_after_deferred_blaming_looks_up_outside_tx(self):
+        block_height = 170
+        address_1 = '1PSSGeFHDnKNxiEyFrD1wcEaHr9hrQDDWc'
+        remote_responses = self.store_deferred_records(block_height)[0]
+        depths_at_fetch = []
+        def fetch_url(url, benchmarker = None, use_cache = True):
+            depths_at_fetch.append(self.temp_db.block_transaction_depth)
+            return json.dumps(remote_responses[url])
+
+        original_fetch_url = http.fetch_url
+        original_prefetch = block_processor.PREFETCH_DEFERRED_BLAME_LOOKUPS
+        original_cache_all = blockchain_reader.CACHE_ALL_WALLET_ADDRESSES
+        http.fetch_url = fetch_url
+        block_processor.PREFETCH_DEFERRED_BLAME_LOOKUPS = False
+        blockchain_reader.CACHE_ALL_WALLET_ADDRESSES = False
+        try:
+            processor = block_processor.BlockProcessor(
+                self.blockchain_reader, self.temp_db)
+            processor.process_block_after_deferred_blaming(block_height)
+        finally:
+            http.fetch_url = original_fetch_url
+            block_processor.PREFETCH_DEFERRED_BLAME_LOOKUPS = original_prefetch
+            blockchain_reader.CACHE_ALL_WALLET_ADDRESSES = original_cache_all
+
+        #Every remote lookup is made before the block's transaction is opened
+        self.assertEqual(depths_at_fetch, [0, 0, 0])
+        self.assertEqual(self.temp_db.get_blame_label_for_btc_address(
+            address_1), 'Exchange')
+        self.assertEqual(self.temp_db.get_all_deferred_blame_records_at_height(
+            block_height), [])
+
+    def test_process_block_after_deferred_blaming_resumes_wallet_download(self):
+        block_height = 170
+        label = 'SomeExchange'
+        addresses = [benchmark.fake_bitcoind.get_fake_address(3, tx_num, 0)
+                     for tx_num in range(0, 250)]
+        address = addresses[200]
+        self.temp_db.store_blame(DB_DEFERRED_BLAME_PLACEHOLDER,
+                                 db.AddressReuseType.TX_HISTORY,
+                                 db.AddressReuseRole.RECEIVER,
+                                 db.DataSource.WALLET_EXPLORER, block_height,
+                                 ('f4184fc596403b9d638783cf57adfe4c75c605f635'
+                                  '6fbc91338530e9831e9e16'), address)
+        if db.INSERT_BLAME_STATS_ONCE_PER_BLOCK:
+            self.temp_db.write_stored_blame()
+
+        urlbuilder = blockchain_reader.WalletExplorerURLBuilder()
+        api_key = self.temp_db.config_store.WALLETEXPLORER_API_KEY
+        page_urls = [urlbuilder.get_wallet_addresses_at_offset(label, offset,
+                                                               api_key)
+                     for offset in range(0, len(addresses), 100)]
+        remote_responses = {
+            urlbuilder.get_address_info(address, api_key): {
+                'found': True, 'label': label, 'wallet_id': 'a1'}}
+        for (page_url, offset) in zip(page_urls, range(0, 250, 100)):
+            remote_responses[page_url] = {
+                'found': True, 'label': label, 'addresses_count': 250,
+                'addresses': [{'address': page_address} for page_address in
+                              addresses[offset:offset + 100]]}
+        fetched_urls = []
+        def fetch_url(url, benchmarker = None, use_cache = True):
+            fetched_urls.append(url)
+            return json.dumps(remote_responses[url])
+        #The download is interrupted when the last page is first fetched
+        interrupted = [False]
+        def fetch_urls_as_completed(urls, num_threads, benchmarker = None):
+            for url in urls:
+                if url == page_urls[2] and not interrupted[0]:
+                    interrupted[0] = True
+                    raise KeyboardInterrupt
+                yield (url, fetch_url(url))
+
+        original_fetch_url = http.fetch_url
+        original_fetch_urls_as_completed = http.fetch_urls_as_completed
+        original_prefetch = block_processor.PREFETCH_DEFERRED_BLAME_LOOKUPS
+        original_cache_all = blockchain_reader.CACHE_ALL_WALLET_ADDRESSES
+        original_batch_size = blockchain_reader.WALLET_ADDRESS_CACHE_BATCH_SIZE
+        http.fetch_url = fetch_url
+        http.fetch_urls_as_completed = fetch_urls_as_completed
+        block_processor.PREFETCH_DEFERRED_BLAME_LOOKUPS = False
+        blockchain_reader.CACHE_ALL_WALLET_ADDRESSES = True
+        blockchain_reader.WALLET_ADDRESS_CACHE_BATCH_SIZE = 100
+        try:
+            processor = block_processor.BlockProcessor(
+                self.blockchain_reader, self.temp_db)
+            with self.assertRaises(KeyboardInterrupt):
+                processor.process_block_after_deferred_blaming(block_height)
+
+            #The pages cached before the interruption stay committed, as seen
+            #   when the process is started again
+            self.assertEqual(self.temp_db.block_transaction_depth, 0)
+            self.temp_db.close()
+            self.temp_db = db.Database(TEMP_DB_FILENAME)
+            self.assertEqual(self.temp_db.get_wallet_download_progress(label),
+                             (250, set([0, 100])))
+            self.assertEqual(self.temp_db.get_blame_label_for_btc_address(
+                addresses[0]), label)
+            self.assertIsNone(self.temp_db.get_blame_label_for_btc_address(
+                address))
+
+            #Processing the block again fetches only the missing page
+            del fetched_urls[:]
+            processor = block_processor.BlockProcessor(
+                blockchain_reader.LocalBlockchainRPCReader(self.temp_db),
+                self.temp_db)
+            processor.process_block_after_deferred_blaming(block_height)
+        finally:
+            http.fetch_url = original_fetch_url
+            http.fetch_urls_as_completed = original_fetch_urls_as_completed
+            block_processor.PREFETCH_DEFERRED_BLAME_LOOKUPS = original_prefetch
+            blockchain_reader.CACHE_ALL_WALLET_ADDRESSES = original_cache_all
+            blockchain_reader.WALLET_ADDRESS_CACHE_BATCH_SIZE = (
+                original_batch_size)
+
+        self.assertEqual(fetched_urls, [
+            urlbuilder.get_address_info(address, api_key), page_urls[2]])
+        self.assertEqual(self.temp_db.get_wallet_download_progress(label),
+                         (None, set()))
+        for cached_address in [addresses[0], address, addresses[249]]:
+            self.assertEqual(self.temp_db.get_blame_label_for_btc_address(
+                cached_address), label)
+        self.assertEqual(self.temp_db.get_all_deferred_blame_records_at_height(
+            block_height), [])
+
 unittest.TestLoader().loadTestsFromTestCase(
     BlockProcessorForTxOutputAddrCacheTest)
@@ -17,14 +17,19 @@ import tx_blame
 import db
 import custom_errors
 import data_subscription
+import utxo_cache
+import block_file
+import block_pipeline
+import response_cache
 
 ####################
 # EXTERNAL IMPORTS #
 ####################
 
-from time import sleep, clock   #for throttling HTTP requests
+import copy
 import json
 import os  #get name of this script for check_int_and_die using os.path.basename
+import time
 
 from bitcoinrpc.authproxy import AuthServiceProxy, JSONRPCException
 import decimal #to help json parser
@@ -37,6 +42,26 @@ import decimal #to help json parser
 #   addresses before querying bitcoind via RPC interface.
 USE_TX_OUTPUT_ADDR_CACHE_FIRST = True
 
+#Flag determines whether LocalBlockchainRPCReader keeps the addresses of
+#   unspent outputs it has read in memory, and looks up each input's previous
+#   output there before consulting the SQL db or bitcoind. Useful when one
+#   process reads every block in order; outputs created before it started are
+#   still looked up the usual way.
+USE_UTXO_CACHE = False #TODO: move flag to config file?
+
+#Flag determines whether LocalBlockchainRPCReader fetches each block with its
+#   transactions already decoded, in a single getblock call with verbosity 2,
+#   rather than fetching and decoding each transaction separately. Requires
+#   bitcoind 0.15 or later.
+USE_VERBOSE_GETBLOCK = True #TODO: move flag to config file?
+
+#Getblock verbosity that includes each transaction decoded
+GETBLOCK_VERBOSITY_DECODED_TXS = 2
+
+#Number of transactions with unspent outputs to keep in memory before spilling
+#   the oldest to the SQL db.
+MAX_UTXO_CACHE_TXS = 2000000 #TODO: move flag to config file?
+
 ENABLE_DEBUG_PRINT = True
 
 #If using an API reader, this flag determines whether we will cache in which
@@ -62,10 +87,29 @@ CACHE_LOCALLY_FOR_ALL_INPUT_ADDRESSES = True #TODO: Move me to config file
 #   in the wallet are also likeyl to be involved in address reuse.
 CACHE_ALL_WALLET_ADDRESSES = True #TODO: Move me to config file
 
+#When caching all addresses in a wallet, write their labels to the database
+#   in batches of about this many addresses as the pages of addresses arrive,
+#   rather than holding the whole wallet in memory.
+WALLET_ADDRESS_CACHE_BATCH_SIZE = 10000 #TODO: Move me to config file
+
+#When fetching all addresses in a wallet, fetch the pages after the first up
+#   to config HTTP_MAX_CONCURRENT_REQUESTS at a time, under each host's rate
+#   limit, rather than one after another.
+FETCH_WALLET_PAGES_CONCURRENTLY = True #TODO: Move me to config file
+
+#When WalletExplorer.com finds nothing for an address or transaction, e.g. an
+#   address it can't cluster, record that in the database and don't look it
+#   up again for this many seconds.
+USE_NOT_FOUND_CACHE = True #TODO: Move me to config file
+NOT_FOUND_CACHE_TTL_SEC = 7 * 24 * 60 * 60 #TODO: Move me to config file
+
 THIS_FILE = os.path.basename(__file__)
 
 DB_DEFERRED_BLAME_PLACEHOLDER = 'DB_DEFERRED_BLAME_PLACEHOLDER'
 
+GENESIS_TX_ID = ('4a5e1e4baab89f3a32518a88c31bc87f618f76673e2cc77ab2127b7afdeda'
+                 '33b')
+
 WALLET_EXPLORER_NOT_FOUND_PLACEHOLDER = 'WE_NOT_FOUND_PLACEHOLDER'
 
 #THESE ADDRESSES FOR VARIOUS REASONS WERE NOT INDEXED BY WALLETEXPLORER.COM
@@ -169,29 +213,58 @@ class BlockExplorerReader:
                                          benchmarker = None):
         raise NotImplementedError
 
-#TODO: Do more accurate sleeping by sleeping for difference in elapsed time
-#   since last request vs the expected throttle, using time.clock(). Then we
-#   can allow the throttle to be a float rather than an int. Alternatively, just
-#   deprecate the sleep since we are using an API key, and will timeout
-#   and/or retry when necessary, which acts as a natural throttling mechanism.
+    #Answers `is_first_transaction_for_address` for every output of every tx in
+    #   a block at once. Returns a dict mapping (tx_id, output position in
+    #   tx_obj['out']) to True if that output's address has tx history prior to
+    #   the output, or None if this reader can't do better than asking once per
+    #   output.
+    def get_prior_tx_history_for_block(self, tx_list, block_height,
+                                       benchmarker = None):
+        return None
+
+    #Returns the keys of outputs spilled to the database that the txs
+    #   returned by get_tx_list() since the last call spend. The caller deletes
+    #   them with db.delete_spilled_utxos() in the block's transaction.
+    def take_spent_spilled_utxo_keys(self):
+        return []
+
 #Uses the Blockchain.info API remotely
 class ThrottledBlockchainReader(BlockExplorerReader):
 
     config = None
     database_connector = None
+    prefetched_responses = None #url => response, see prefetch_urls()
+
+    #http.fetch_url() waits as long as the host's rate limit requires, which
+    #   is shared with every other thread and process querying it. Set
+    #   use_cache to False for urls whose response changes over time.
+    def throttled_fetch_url(self, url, benchmarker = None, use_cache = True):
+        if self.prefetched_responses and url in self.prefetched_responses:
+            return self.prefetched_responses.pop(url)
+        return http.fetch_url(url, benchmarker, use_cache)
+
+    #Returns the urls that get_tx_relayed_by_using_tx_id() would fetch for
+    #   these txs, skipping those whose 'relayed by' field is cached.
+    def get_relayed_by_urls_to_prefetch(self, tx_ids):
+        urlbuilder = BlockchainInfoURLBuilder(
+            self.config.BLOCKCHAIN_INFO_API_KEY)
+        urls = []
+        for tx_id in set(tx_ids):
+            if self.database_connector.get_cached_relayed_by(tx_id) is None:
+                urls.append(urlbuilder.get_tx_info(tx_id))
+        return urls
 
-    #sleep a bit before fetching data from API to avoid bombarding it
-    def throttled_fetch_url(self, url):
-        if self.config.API_NUM_SEC_SLEEP > 0:
-            sleep(float(self.config.API_NUM_SEC_SLEEP))
-        return http.fetch_url(url)
+    #Serves these responses (url => response) from throttled_fetch_url() in
+    #   place of HTTP requests, once each. Replaces any still unused.
+    def set_prefetched_responses(self, responses):
+        self.prefetched_responses = responses
 
     def get_current_blockchain_block_height(self):
         urlbuilder = BlockchainInfoURLBuilder(
             self.config.BLOCKCHAIN_INFO_API_KEY)
         url = urlbuilder.get_current_height_url()
 
-        response = self.throttled_fetch_url(url)
+        response = self.throttled_fetch_url(url, use_cache = False)
         try:
             jsonObj = json.loads(response)
             height = jsonObj['height']
@@ -240,8 +313,12 @@ class ThrottledBlockchainReader(BlockExplorerReader):
                 #Something weird came back from API despite HTTP 200 OK, try a
                 #   few more times before giving up. For example, sometimes BCI
                 #   API will return 'No Free Cluster Connection' when
-                #   overloaded.
+                #   overloaded. Don't keep it in the response cache, so that
+                #   it's fetched again.
+                http.uncache_response(url)
                 current_num_retries = current_num_retries + 1
+                if current_num_retries <= MAX_NUM_RETRIES:
+                    response = self.throttled_fetch_url(url)
 
         #Exceeded maximum time we're willing to wait for the API, time to give
         #   up. Examples of irreconcilable return values: 'Unknown Error
@@ -257,7 +334,8 @@ class ThrottledBlockchainReader(BlockExplorerReader):
             self.config.BLOCKCHAIN_INFO_API_KEY)
         url = urlbuilder.get_number_of_transactions_for_address(addr)
 
-        response = self.throttled_fetch_url(url)
+        #n_tx grows as the address is used again
+        response = self.throttled_fetch_url(url, use_cache = False)
         try:
             jsonObj = json.loads(response)
             n_tx = jsonObj['n_tx']
@@ -287,8 +365,8 @@ class ThrottledBlockchainReader(BlockExplorerReader):
         #   there, add it to the cache as an address that has been seen, and
         #   then do API lookups to determine whether this tx is the address's
         #   first.
-        if self.database_connector.has_address_been_seen_cache_if_not(addr,
-                                                                      block_height):
+        if self.database_connector.has_address_been_seen_cache_if_not(
+                addr, block_height, benchmarker):
             if benchmarker is not None:
                 benchmarker.increment_blockchain_info_queries_avoided_by_caching()
                 benchmarker.increment_blockchain_info_queries_avoided_by_caching()
@@ -301,7 +379,8 @@ class ThrottledBlockchainReader(BlockExplorerReader):
             self.config.BLOCKCHAIN_INFO_API_KEY)
         url = urlbuilder.get_tx_for_address_at_offset(addr, offset)
 
-        response = self.throttled_fetch_url(url)
+        #Newer txs shift which tx is at this offset, and it must match n_tx
+        response = self.throttled_fetch_url(url, use_cache = False)
         try:
             jsonObj = json.loads(response)
             tx_list = jsonObj['txs']
@@ -345,13 +424,15 @@ class ThrottledBlockchainReader(BlockExplorerReader):
         urlbuilder = BlockchainInfoURLBuilder(
             self.config.BLOCKCHAIN_INFO_API_KEY)
         url = urlbuilder.get_tx_info(tx_id)
-        response = self.throttled_fetch_url(url)
+        response = self.throttled_fetch_url(url, benchmarker)
 
         try:
             jsonObj = json.loads(response)
             return self.get_tx_relayed_by_using_txObj(jsonObj)
         except ValueError as e:
-            #Something went wrong, panic
+            #Something went wrong, panic, but don't keep it in the response
+            #   cache for the next run
+            http.uncache_response(url)
             msg = ("Expected JSON response for tx id '%s', instead received "
                    "'%s'") % (str(tx_id), str(response))
             logger.log_and_die(msg)
@@ -380,26 +461,57 @@ class DecimalEncoder(json.JSONEncoder):
             return float(o)
         return super(DecimalEncoder, self).default(o)
 
-#Uses bitcoind's RPC interface to query about the state of the blockchain as
-#   reflected locally. This (hopefully) is much faster than querying a remote
-#   API.
-#TODO: Raise a custom error if trying to fetch information not yet in bitcoind's DB
-class LocalBlockchainRPCReader(BlockExplorerReader):
+#Parent class for readers that get each block's transactions in the form
+#   returned by bitcoind's decoderawtransaction RPC call, and convert them to
+#   BCI-like tuples. Subclasses say where the decoded transactions come from by
+#   overriding get_decoded_txs_at_height() and get_decoded_txs().
+class DecodedTxBlockReader(BlockExplorerReader):
 
-    rpc_connection              = None
-    #transaction_output_cache    = None ''' deprecated '''
+    utxo_cache                  = None
+    block_prefetcher            = None
+    #When set, prior tx history is answered from the database's first seen
+    #   index rather than the seen address index, so that blocks the index
+    #   covers can be processed in any order. See first_seen_index.
+    use_first_seen_index        = False
 
     def __init__(self, database_connector = None):
         BlockExplorerReader.__init__(self, database_connector) #super
 
-        self.rpc_connection = AuthServiceProxy(
-            "http://%s:%s@%s:%s" % (self.config.RPC_USERNAME,
-                                    self.config.RPC_PASSWORD,
-                                    self.config.RPC_HOST,
-                                    self.config.RPC_PORT))
-
-    def get_current_blockchain_block_height(self):
-        raise NotImplementedError #TODO maybe... for now can use another class
+        if USE_UTXO_CACHE:
+            self.utxo_cache = utxo_cache.UTXOCache(self.database_connector,
+                                                   MAX_UTXO_CACHE_TXS)
+
+    #Starts fetching the decoded txs of the blocks from start_height up to but
+    #   not including end_height in background threads, so that get_tx_list()
+    #   finds them ready. get_tx_list() must then be called for those blocks in
+    #   order; it fetches any other block itself.
+    #param0: start_height: First block to prefetch
+    #param1: end_height: Block after the last one to prefetch
+    #param2: queue_depth: Max number of blocks fetched ahead
+    #param3: num_workers: Number of threads fetching blocks
+    def start_prefetching(self, start_height, end_height, queue_depth,
+                          num_workers):
+        self.stop_prefetching()
+        self.block_prefetcher = block_pipeline.BlockPrefetcher(
+            self.get_block_fetcher, start_height, end_height, queue_depth,
+            num_workers)
+        self.block_prefetcher.start()
+
+    def stop_prefetching(self):
+        if self.block_prefetcher is not None:
+            self.block_prefetcher.stop()
+            self.block_prefetcher = None
+
+    def take_spent_spilled_utxo_keys(self):
+        if self.utxo_cache is None:
+            return []
+        return self.utxo_cache.take_spent_spilled_keys()
+
+    #Returns a function that does the work of get_decoded_txs_at_height() and
+    #   can be called from another thread than this reader's other methods.
+    #   Called once per prefetching thread.
+    def get_block_fetcher(self):
+        raise NotImplementedError
 
     #Retreives a list of transactions at specified block height. Each tx
     #   will be formatted as a BCI-like tuple per
@@ -411,27 +523,41 @@ class LocalBlockchainRPCReader(BlockExplorerReader):
     #   process will sleep until the data is available in the cache. Default:
     #   False.
     def get_tx_list(self, block_height, use_tx_out_addr_cache_only = False):
-        ids = self.get_tx_ids_at_height(block_height)
+        if (self.block_prefetcher is not None and
+                self.block_prefetcher.is_next(block_height)):
+            (ids, tx_jsons) = self.block_prefetcher.get(block_height)
+        else:
+            (ids, tx_jsons) = self.get_decoded_txs_at_height(block_height)
+        self.cache_output_addresses(block_height, ids, tx_jsons)
+
+        #resolve the previous outputs of the whole block at once
+        prev_out_addresses = self.get_prev_out_addresses(
+            zip(ids, tx_jsons), use_tx_out_addr_cache_only)
 
         txs = []
-        for tx_id in ids:
-            bci_like_tuple = self.get_bci_like_tuple_for_tx_id(
-                tx_id, use_tx_out_addr_cache_only)
+        for tx_id, tx_json in zip(ids, tx_jsons):
+            bci_like_tuple = self.get_bci_like_tuple_for_tx_json(
+                tx_id, tx_json, prev_out_addresses)
             txs.append(bci_like_tuple)
         return txs
 
     #Checks if the specified transaction is the first time the specified address
     #   has received funds. If it is, it will cache this for the specified
-    #   block height in the database so subsequent lookups will answer
-    #   correctly. IMPORTANT: This function assumes that that blocks are being
+    #   block height in the database's seen address index so subsequent lookups
+    #   will answer correctly. IMPORTANT: This function assumes that that blocks are being
     #   processed in a complete, monotonically-increasing fashion from the
     #   genesis block. Otherwise, correct results not guaranteed! It is the
     #   caller's responsibility to ensure that enough blocks have been
     #   processed.
     def is_first_transaction_for_address(self, addr, tx_id, block_height,
                                          benchmarker = None):
-        if self.database_connector.has_address_been_seen_cache_if_not(addr,
-                                                                      block_height):
+        if self.use_first_seen_index:
+            logger.log_and_die(('The first seen index is only consulted a '
+                                'block at a time. Set '
+                                'RESOLVE_PRIOR_TX_HISTORY_PER_BLOCK in '
+                                'block_processor.'))
+        if self.database_connector.has_address_been_seen_cache_if_not(
+                addr, block_height, benchmarker):
             dprint("Address %s at block height %d was already seen." %
                 (addr, block_height))
             return False
@@ -440,6 +566,251 @@ class LocalBlockchainRPCReader(BlockExplorerReader):
                   (addr, block_height))
             return True
 
+    #Block-at-a-time version of is_first_transaction_for_address(), with the
+    #   same caveats. An address that received funds earlier in the same block,
+    #   whether in an earlier tx or an earlier output of the same tx, counts as
+    #   having prior history.
+    def get_prior_tx_history_for_block(self, tx_list, block_height,
+                                       benchmarker = None):
+        if self.use_first_seen_index:
+            return self.get_prior_tx_history_from_first_seen_index(
+                tx_list, block_height)
+
+        output_keys = []
+        address_list = []
+        for tx_obj in tx_list:
+            for output_pos, btc_output in enumerate(tx_obj['out']):
+                if 'addr' in btc_output:
+                    output_keys.append((tx_obj['hash'], output_pos))
+                    address_list.append(btc_output['addr'])
+
+        seen_list = self.database_connector.have_addresses_been_seen_cache_if_not(
+            address_list, block_height, benchmarker)
+        return dict(zip(output_keys, seen_list))
+
+    #Does the work of get_prior_tx_history_for_block() by comparing the
+    #   position of each output with the position at which its address first
+    #   received funds. Neither reads nor writes the seen address index, so the
+    #   block need not follow the last one processed, but the first seen index
+    #   must already cover it.
+    def get_prior_tx_history_from_first_seen_index(self, tx_list,
+                                                   block_height):
+        address_list = []
+        for tx_obj in tx_list:
+            for btc_output in tx_obj['out']:
+                if 'addr' in btc_output:
+                    address_list.append(btc_output['addr'])
+        first_seen = self.database_connector.get_first_seen_positions(
+            address_list)
+
+        prior_tx_history_map = {}
+        for tx_index, tx_obj in enumerate(tx_list):
+            for output_pos, btc_output in enumerate(tx_obj['out']):
+                if 'addr' not in btc_output:
+                    continue
+                addr = btc_output['addr']
+                if addr not in first_seen:
+                    msg = ("Address %s in block %d is missing from the first "
+                           "seen index.") % (addr, block_height)
+                    logger.log_and_die(msg)
+                prior_tx_history_map[(tx_obj['hash'], output_pos)] = (
+                    first_seen[addr] < (block_height, tx_index, output_pos))
+        return prior_tx_history_map
+
+    #Returns a tuple of the list of tx ids in the block at the specified height
+    #   and the list of those transactions decoded, in block order.
+    def get_decoded_txs_at_height(self, block_height):
+        raise NotImplementedError
+
+    #Returns a list of the specified transactions decoded, in the same order
+    #   as tx_ids. Used to look up the outputs spent by a block that aren't
+    #   cached.
+    def get_decoded_txs(self, tx_ids):
+        raise NotImplementedError
+
+    #Called by get_tx_list() with each block's decoded txs, before their inputs
+    #   are resolved. Readers that can't decode previous txs on demand
+    #   override this to keep the addresses of the block's outputs.
+    def cache_output_addresses(self, block_height, tx_ids, tx_jsons):
+        pass
+
+    #Does the work of get_bci_like_tuple_for_tx_id() for a transaction that
+    #   has been decoded and whose inputs have been resolved already.
+    #param0: tx_id: Specified transaction hash
+    #param1: tx_json: The transaction as returned by get_decoded_txs()
+    #param2: prev_out_addresses: dict as returned by get_prev_out_addresses()
+    #   that includes every output spent by the transaction
+    def get_bci_like_tuple_for_tx_json(self, tx_id, tx_json,
+                                       prev_out_addresses):
+        json_tuple = {}
+        json_tuple['hash'] = tx_id
+        json_tuple['inputs'] = []
+        json_tuple['out'] = []
+
+        #populate input addresses
+        for (prev_txid, prev_vout_num) in get_prev_out_keys(tx_json):
+            prev_out = {'n': prev_vout_num}
+            address = prev_out_addresses[(prev_txid, prev_vout_num)]
+            if address is not None:
+                prev_out['addr'] = address
+            json_tuple['inputs'].append({'prev_out': prev_out})
+
+        #populate output addresses
+        for vout in tx_json['vout']:
+            output_index = vout['n']
+            current_output = {'n':output_index}
+            if 'scriptPubKey' in vout and 'addresses' in vout['scriptPubKey']:
+                address = vout['scriptPubKey']['addresses'][0]
+                current_output['addr'] = address
+            json_tuple['out'].append(current_output)
+
+        return json_tuple
+
+    #Looks up the address of every output spent by a list of transactions,
+    #   e.g. all transactions in a block. The UTXO cache is consulted first if
+    #   enabled, in memory and then on disk in a single query, then the SQL
+    #   db's tx output cache in a single query, and
+    #   bitcoind only for the outputs still missing, decoding each previous
+    #   transaction once.
+    #param0: tx_id_json_pairs: List of (tx_id, tx_json) tuples in block order,
+    #   where each tx_json is as returned by get_decoded_txs()
+    #param1: use_tx_out_addr_cache_only (Optional): Per
+    #   get_bci_like_tuple_for_tx_id(). The process sleeps once until every
+    #   missing output has been cached, rather than once per input.
+    #Returns: dict mapping each (prev_txid, output_pos) tuple to its address,
+    #   or to None if the address cannot be decoded
+    def get_prev_out_addresses(self, tx_id_json_pairs,
+                               use_tx_out_addr_cache_only = False):
+        prev_out_addresses = {}
+        missing_keys = []
+        for tx_id, tx_json in tx_id_json_pairs:
+            for key in get_prev_out_keys(tx_json):
+                if self.utxo_cache is not None:
+                    (is_known, address) = self.utxo_cache.spend(*key)
+                    if is_known:
+                        prev_out_addresses[key] = address
+                        continue
+                missing_keys.append(key)
+            #later txs in the block may spend these outputs
+            if self.utxo_cache is not None:
+                self.utxo_cache.add_tx_outputs(
+                    tx_id, zip(range(0, len(tx_json['vout'])),
+                               self.get_output_addresses(tx_json)))
+
+        #outputs spilled from the UTXO cache, in a single query
+        if self.utxo_cache is not None and len(missing_keys) > 0:
+            spilled = self.utxo_cache.spend_spilled(missing_keys)
+            prev_out_addresses.update(spilled)
+            missing_keys = [key for key in missing_keys if key not in spilled]
+
+        if len(missing_keys) == 0:
+            return prev_out_addresses
+
+        if use_tx_out_addr_cache_only:
+            #flag specifies that we will wait for cache to catch up before
+            #   continuing this operation. Process/thread will sleep until then.
+            subscription = data_subscription.TxOutputAddressSetCacheSubscriber(
+                self.database_connector, missing_keys)
+            dprint(("get_prev_out_addresses: May sleep until %d tx output "
+                    "addresses are cached...") % len(missing_keys))
+            subscription.do_sleep_until_producers_ready()
+            prev_out_addresses.update(subscription.output_addresses)
+            return prev_out_addresses
+
+        if USE_TX_OUTPUT_ADDR_CACHE_FIRST:
+            cached = self.database_connector.get_output_addresses(missing_keys)
+            prev_out_addresses.update(cached)
+            missing_keys = [key for key in missing_keys if key not in cached]
+
+        #not in cache, fall back to querying RPC interface
+        prev_tx_ids = list(set([prev_txid for (prev_txid, _) in missing_keys]))
+        prev_tx_jsons = dict(zip(prev_tx_ids,
+                                 self.get_decoded_txs(prev_tx_ids)))
+        for (prev_txid, prev_vout_num) in missing_keys:
+            try:
+                address = self.get_output_address_from_tx_json(
+                    prev_txid, prev_vout_num, prev_tx_jsons[prev_txid])
+            except custom_errors.PrevOutAddressCannotBeDecodedError:
+                address = None
+            prev_out_addresses[(prev_txid, prev_vout_num)] = address
+        return prev_out_addresses
+
+    #Returns an ordered list of output addresses for the specified transaction
+    #   JSON as returned by the bitcoind RPC interface. If an address cannot be
+    #   decoded for one of the outputs, a value of None will be inserted
+    #   at that position in the list.
+    #TODO: This does not properly handle multisig outputs that list multiple
+    #   addresses per output. See:
+    #   http://bitcoin.stackexchange.com/questions/4687/can-a-scriptpubkey-have-multiple-addresses
+    #   When support for this is added, make sure to add a test case.
+    def get_output_addresses(self, tx_json):
+        assert 'vout' in tx_json
+        output_addresses = []
+        for vout in tx_json['vout']:
+            assert 'scriptPubKey' in vout
+            if 'addresses' in vout['scriptPubKey']:
+                ouput_address = vout['scriptPubKey']['addresses'][0]
+                output_addresses.append(ouput_address)
+            else:
+                output_addresses.append(None)
+        return output_addresses
+
+    #Raises: custom_errors.PrevOutAddressCannotBeDecoded
+    def get_output_address_from_tx_json(self, tx_id, output_index, tx_json):
+        if 'vout' in tx_json and len(tx_json['vout']) > output_index and \
+                'scriptPubKey' in tx_json['vout'][output_index]:
+            if 'addresses' not in tx_json['vout'][output_index]['scriptPubKey']:
+                raise custom_errors.PrevOutAddressCannotBeDecodedError
+            else:
+                return tx_json['vout'][output_index]['scriptPubKey'][
+                    'addresses'][0]
+        else:
+            msg = ("Missing element for vout in get_output_address() with tx "
+                   "id %s and output index %d") % (tx_id, output_index)
+            logger.log_and_die(msg)
+
+#Uses bitcoind's RPC interface to query about the state of the blockchain as
+#   reflected locally. This (hopefully) is much faster than querying a remote
+#   API.
+#TODO: Raise a custom error if trying to fetch information not yet in bitcoind's DB
+class LocalBlockchainRPCReader(DecodedTxBlockReader):
+
+    rpc_connection              = None
+    #transaction_output_cache    = None ''' deprecated '''
+
+    #param0: database_connector (Optional)
+    #param1: rpc_url (Optional): URL of a bitcoind RPC interface to use
+    #   instead of the one specified in the config file, with credentials
+    #param2: rpc_batch_size (Optional): Overrides rpc_batch_size in the config
+    #   file
+    def __init__(self, database_connector = None, rpc_url = None,
+                 rpc_batch_size = None):
+        DecodedTxBlockReader.__init__(self, database_connector) #super
+
+        if rpc_batch_size is None:
+            self.rpc_batch_size = self.config.RPC_BATCH_SIZE
+        else:
+            self.rpc_batch_size = rpc_batch_size
+
+        if rpc_url is None:
+            self.rpc_url = "http://%s:%s@%s:%s" % (self.config.RPC_USERNAME,
+                                                   self.config.RPC_PASSWORD,
+                                                   self.config.RPC_HOST,
+                                                   self.config.RPC_PORT)
+        else:
+            self.rpc_url = rpc_url
+        self.rpc_connection = AuthServiceProxy(self.rpc_url)
+
+    #A proxy can't be shared between threads, so each prefetching thread
+    #   fetches with a copy of this reader that has its own connection.
+    def get_block_fetcher(self):
+        fetcher = copy.copy(self)
+        fetcher.rpc_connection = AuthServiceProxy(self.rpc_url)
+        return fetcher.get_decoded_txs_at_height
+
+    def get_current_blockchain_block_height(self):
+        raise NotImplementedError #TODO maybe... for now can use another class
+
     def get_block_hash_at_height(self, block_height):
         return self.rpc_connection.getblockhash(block_height)
 
@@ -454,6 +825,21 @@ class LocalBlockchainRPCReader(BlockExplorerReader):
             tx_ids.append(tx_id)
         return tx_ids
 
+    #Returns a tuple of the list of tx ids in the block at the specified height
+    #   and the list of those transactions decoded as by get_decoded_tx(), in
+    #   block order. Uses a single getblock call if USE_VERBOSE_GETBLOCK is set.
+    def get_decoded_txs_at_height(self, block_height):
+        if not USE_VERBOSE_GETBLOCK:
+            tx_ids = self.get_tx_ids_at_height(block_height)
+            return (tx_ids, self.get_decoded_txs(tx_ids))
+
+        block_hash = self.get_block_hash_at_height(block_height)
+        block_json = self.rpc_connection.getblock(
+            block_hash, GETBLOCK_VERBOSITY_DECODED_TXS)
+        tx_jsons = block_json['tx']
+        tx_ids = [tx_json['txid'] for tx_json in tx_jsons]
+        return (tx_ids, tx_jsons)
+
     #Returns the transaction in raw format. If the requested transaction is
     #   the sole transaction of the genesis block, bitcoind's RPC interface
     #   will throw an error 'No information available about transaction
@@ -461,8 +847,7 @@ class LocalBlockchainRPCReader(BlockExplorerReader):
     #   should handle; iterating callers should just move onto the next tx.
     #throws: NoDataAvailableForGenesisBlockError
     def get_raw_tx(self, tx_id):
-        if tx_id == ('4a5e1e4baab89f3a32518a88c31bc87f618f76673e2cc77ab2127b7af'
-                     'deda33b'):
+        if tx_id == GENESIS_TX_ID:
             raise custom_errors.NoDataAvailableForGenesisBlockError()
         else:
             return self.rpc_connection.getrawtransaction(tx_id)
@@ -473,40 +858,42 @@ class LocalBlockchainRPCReader(BlockExplorerReader):
             return self.rpc_connection.decoderawtransaction(
                 self.get_raw_tx(tx_id))
         except custom_errors.NoDataAvailableForGenesisBlockError:
-            #bitcoind won't generate this, but here's what it would look like
-            genesis_json = {
-                'txid':    ('4a5e1e4baab89f3a32518a88c31bc87f618f76673e2cc77ab2'
-                            '127b7afdeda33b'),
-                'version':  1,
-                'locktime': 0,
-                'vin': [{
-                    "sequence":4294967295,
-                    'coinbase': ('04ffff001d0104455468652054696d65732030332f4a6'
-                                 '16e2f32303039204368616e63656c6c6f72206f6e2062'
-                                 '72696e6b206f66207365636f6e64206261696c6f75742'
-                                 '0666f722062616e6b73')
-                }],
-                'vout': [
-                    {
-                        'value': 50.00000000,
-                        'n': 0,
-                        'scriptPubKey': {
-                            'asm': ('04678afdb0fe5548271967f1a67130b7105cd6a828'
-                                    'e03909a67962e0ea1f61deb649f6bc3f4cef38c4f3'
-                                    '5504e51ec112de5c384df7ba0b8d578a4c702b6bf1'
-                                    '1d5f OP_CHECKSIG'),
-                            'hex': ('4104678afdb0fe5548271967f1a67130b7105cd6a8'
-                                    '28e03909a67962e0ea1f61deb649f6bc3f4cef38c4'
-                                    'f35504e51ec112de5c384df7ba0b8d578a4c702b6b'
-                                    'f11d5fac'),
-                            'reqSigs': 1,
-                            'type': 'pubkey',
-                            'addresses': ['1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa']
-                        }
-                    }
-                ]
-            }
-            return genesis_json
+            return get_genesis_tx_json()
+
+    #Bulk version of get_decoded_tx(). Unless rpc_batch_size is 1, fetches the
+    #   raw transactions in JSON-RPC batches of up to rpc_batch_size calls,
+    #   then decodes them in batches, rather than making two round trips to
+    #   bitcoind per transaction.
+    #Returns: List of decoded transactions in the same order as tx_ids
+    def get_decoded_txs(self, tx_ids):
+        if self.rpc_batch_size <= 1:
+            return [self.get_decoded_tx(tx_id) for tx_id in tx_ids]
+
+        #bitcoind has no data for the genesis tx
+        fetched_tx_ids = [tx_id for tx_id in tx_ids if tx_id != GENESIS_TX_ID]
+        raw_txs = self.call_rpc_batch(
+            [['getrawtransaction', tx_id] for tx_id in fetched_tx_ids])
+        decoded_txs = self.call_rpc_batch(
+            [['decoderawtransaction', raw_tx] for raw_tx in raw_txs])
+        decoded_by_tx_id = dict(zip(fetched_tx_ids, decoded_txs))
+        return [decoded_by_tx_id[tx_id] if tx_id != GENESIS_TX_ID
+                else get_genesis_tx_json() for tx_id in tx_ids]
+
+    #Makes a list of RPC calls in JSON-RPC batches of up to rpc_batch_size
+    #   calls each.
+    #param0: rpc_calls: List of lists, each the method name followed by its
+    #   params, e.g. [['getrawtransaction', tx_id], ...]
+    #Returns: List of results in the same order as rpc_calls. bitcoind answers
+    #   each batch in the order of its calls.
+    #Raises: JSONRPCException if any call fails
+    def call_rpc_batch(self, rpc_calls):
+        results = []
+        for start in range(0, len(rpc_calls), self.rpc_batch_size):
+            #batch_() consumes the lists it is given
+            batch = [list(rpc_call) for rpc_call in
+                     rpc_calls[start:start + self.rpc_batch_size]]
+            results.extend(self.rpc_connection.batch_(batch))
+        return results
 
     #Converts required infromation from local bitcoind RPC into a format similar
     #   to that returned by Blockchain.info's API. This helps to make the code
@@ -527,81 +914,11 @@ class LocalBlockchainRPCReader(BlockExplorerReader):
     #   False.
     def get_bci_like_tuple_for_tx_id(self, tx_id,
                                      use_tx_out_addr_cache_only = False):
-        json_tuple = {}
-        json_tuple['hash'] = tx_id
-        json_tuple['inputs'] = []
-        json_tuple['out'] = []
-
-        subscription = None
-        if use_tx_out_addr_cache_only:
-            subscription = data_subscription.TxOutputAddressCacheSubscriber(
-                database = self.database_connector)
-
         tx_json = self.get_decoded_tx(tx_id)
-
-        #populate input addresses
-        for vin in tx_json['vin']:
-            #look up address based on its previous transaction
-            prev_txid = None
-            if 'txid' in vin:
-                prev_txid = vin['txid']
-            prev_vout = None
-            if 'vout' in vin:
-                prev_vout_num = vin['vout'] #yes, this RPC field is poorly named
-                prev_out = {'n': prev_vout_num}
-                try:
-                    if use_tx_out_addr_cache_only:
-                        #flag specifies that we will wait for cache to catch up
-                        #   before continuing this operation. Process/thread
-                        #   will sleep until then.
-                        subscription.next_tx_id_needed = prev_txid
-                        subscription.next_prev_tx_ouput_pos_needed = prev_vout_num
-                        dprint(("get_bci_like_tuple_for_tx_id: May sleep until "
-                                "tx output address is cached..."))
-                        subscription.do_sleep_until_producers_ready()
-
-                    address = self.get_output_address(prev_txid, prev_vout_num)
-                    prev_out['addr'] = address
-                except custom_errors.PrevOutAddressCannotBeDecodedError:
-                    pass
-                current_input = {'prev_out': prev_out}
-                json_tuple['inputs'].append(current_input)
-            else:
-                #If there's no index specifying the txo from prev tx, there's
-                #   probably nothing to do here. Should only come up for
-                #   coinbase transactions.
-                continue
-
-        #populate output addresses
-        for vout in tx_json['vout']:
-            output_index = vout['n']
-            current_output = {'n':output_index}
-            if 'scriptPubKey' in vout and 'addresses' in vout['scriptPubKey']:
-                address = vout['scriptPubKey']['addresses'][0]
-                current_output['addr'] = address
-            json_tuple['out'].append(current_output)
-
-        return json_tuple
-
-    #Returns an ordered list of output addresses for the specified transaction
-    #   JSON as returned by the bitcoind RPC interface. If an address cannot be
-    #   decoded for one of the outputs, a value of None will be inserted
-    #   at that position in the list.
-    #TODO: This does not properly handle multisig outputs that list multiple
-    #   addresses per output. See:
-    #   http://bitcoin.stackexchange.com/questions/4687/can-a-scriptpubkey-have-multiple-addresses
-    #   When support for this is added, make sure to add a test case.
-    def get_output_addresses(self, tx_json):
-        assert 'vout' in tx_json
-        output_addresses = []
-        for vout in tx_json['vout']:
-            assert 'scriptPubKey' in vout
-            if 'addresses' in vout['scriptPubKey']:
-                ouput_address = vout['scriptPubKey']['addresses'][0]
-                output_addresses.append(ouput_address)
-            else:
-                output_addresses.append(None)
-        return output_addresses
+        prev_out_addresses = self.get_prev_out_addresses(
+            [(tx_id, tx_json)], use_tx_out_addr_cache_only)
+        return self.get_bci_like_tuple_for_tx_json(tx_id, tx_json,
+                                                   prev_out_addresses)
 
     #Raises: custom_errors.PrevOutAddressCannotBeDecoded
     #TODO: This does not properly handle multisig outputs that list multiple
@@ -616,18 +933,86 @@ class LocalBlockchainRPCReader(BlockExplorerReader):
         #not in cache, fall back to querying RPC interface
         if tx_json is None:
             tx_json = self.get_decoded_tx(tx_id)
+        return self.get_output_address_from_tx_json(tx_id, output_index,
+                                                    tx_json)
+
+
+#Reads blocks straight from the blk*.dat files in bitcoind's blocks directory,
+#   decoding output scripts to addresses itself, rather than asking bitcoind
+#   over RPC. bitcoind needn't be running. The files can't be searched by tx
+#   id, so the outputs of each block read are written to the SQL db's tx output
+#   cache, where inputs in later blocks find them. Blocks must therefore be
+#   read in order from the genesis block, as already required by
+#   is_first_transaction_for_address().
+class RawBlockFileReader(DecodedTxBlockReader):
+
+    blocks_dir                  = None
+    block_file_index            = None
+
+    #param0: database_connector (Optional)
+    #param1: blocks_dir (Optional): Overrides blocks_dir in the config file
+    def __init__(self, database_connector = None, blocks_dir = None):
+        DecodedTxBlockReader.__init__(self, database_connector) #super
+
+        if blocks_dir is None:
+            blocks_dir = self.config.BLOCKS_DIR
+        if blocks_dir is None:
+            logger.log_and_die(('RawBlockFileReader requires blocks_dir in '
+                                'the [BlockFiles] section of the config '
+                                'file.'))
+        if block_file.is_obfuscated(blocks_dir):
+            msg = ("RawBlockFileReader: The block files in '%s' are "
+                   "obfuscated. Start bitcoind with -blocksxor=0 and "
+                   "reindex to read them.") % blocks_dir
+            logger.log_and_die(msg)
+        self.blocks_dir = blocks_dir
 
-        if 'vout' in tx_json and len(tx_json['vout']) > output_index and \
-                'scriptPubKey' in tx_json['vout'][output_index]:
-            if 'addresses' not in tx_json['vout'][output_index]['scriptPubKey']:
-                raise custom_errors.PrevOutAddressCannotBeDecodedError
-            else:
-                return tx_json['vout'][output_index]['scriptPubKey'][
-                    'addresses'][0]
-        else:
-            msg = ("Missing element for vout in get_output_address() with tx "
-                   "id %s and output index %d") % (tx_id, output_index)
+    #The index of block locations is built on first use, by scanning the
+    #   headers of every block file once.
+    def get_block_file_index(self):
+        if self.block_file_index is None:
+            self.block_file_index = block_file.BlockFileIndex(self.blocks_dir)
+            dprint("RawBlockFileReader: Indexed %d blocks in '%s'." %
+                   (len(self.block_file_index.locations), self.blocks_dir))
+        return self.block_file_index
+
+    def get_current_blockchain_block_height(self):
+        return self.get_block_file_index().get_height()
+
+    def get_decoded_txs_at_height(self, block_height):
+        tx_jsons = self.get_block_file_index().get_decoded_txs(block_height)
+        return ([tx_json['txid'] for tx_json in tx_jsons], tx_jsons)
+
+    #Each prefetching thread reads the block files through its own copy of the
+    #   index, which maps one file at a time.
+    def get_block_fetcher(self):
+        fetcher = copy.copy(self)
+        fetcher.block_file_index = self.get_block_file_index().copy()
+        return fetcher.get_decoded_txs_at_height
+
+    #Keeps the address of each output in the block for the inputs of later
+    #   blocks. Skipped when using the first seen index, which is only built
+    #   after every output up to its end has been cached this way.
+    def cache_output_addresses(self, block_height, tx_ids, tx_jsons):
+        if self.use_first_seen_index:
+            return
+        for tx_id, tx_json in zip(tx_ids, tx_jsons):
+            address_list = self.get_output_addresses(tx_json)
+            for output_pos in range(0, len(address_list)):
+                self.database_connector.add_output_address_to_mem_cache(
+                    block_height, tx_id, output_pos, address_list[output_pos])
+        self.database_connector.write_stored_output_addresses()
+
+    #Only called for outputs missing from the tx output cache, which means
+    #   that the blocks creating them weren't read.
+    def get_decoded_txs(self, tx_ids):
+        if len(tx_ids) > 0:
+            msg = ("RawBlockFileReader: The outputs of %d previous "
+                   "transactions such as '%s' aren't cached. Blocks must be "
+                   "read in order from the genesis block.") % (len(tx_ids),
+                                                                tx_ids[0])
             logger.log_and_die(msg)
+        return []
 
 #Queries WalletExplorer.com for cluster analysis information about addresses.
 #   This information can be used to blame particular parties for address reuse.
@@ -636,6 +1021,7 @@ class WalletExplorerReader:
     config = None
     database_connector = None
     consecutive_lookup_misses = None
+    prefetched_responses = None #url => response
 
     def __init__(self, database_connector = None):
         self.config = config.Config()
@@ -645,9 +1031,42 @@ class WalletExplorerReader:
             self.database_connector = database_connector #Use existing db conn
         self.consecutive_lookup_misses = 0
 
-    #sleep a bit before fetching data from API to avoid bombarding it
-    def fetch_url(self, url):
-        return http.fetch_url(url)
+    #Rate limited per host by http.fetch_url(), like the Blockchain.info API
+    def fetch_url(self, url, benchmarker = None):
+        if self.prefetched_responses and url in self.prefetched_responses:
+            return self.prefetched_responses.pop(url)
+        return http.fetch_url(url, benchmarker)
+
+    #Returns the urls that get_wallet_label_for_single_address() would fetch
+    #   for these addresses, skipping those whose label is cached.
+    def get_address_urls_to_prefetch(self, addresses):
+        api_key = self.config.WALLETEXPLORER_API_KEY
+        urlbuilder = WalletExplorerURLBuilder()
+        urls = []
+        for address in set(addresses):
+            if self.get_label_from_cache(address) is None:
+                url = urlbuilder.get_address_info(address, api_key)
+                if not self.is_cached_as_not_found(url):
+                    urls.append(url)
+        return urls
+
+    #Like http.fetch_urls_as_completed(), yields (url, response) for each url
+    #   as it's fetched, serving prefetched responses first.
+    def fetch_urls_as_completed(self, urls, num_threads, benchmarker = None):
+        urls_to_fetch = []
+        for url in urls:
+            if self.prefetched_responses and url in self.prefetched_responses:
+                yield (url, self.prefetched_responses.pop(url))
+            else:
+                urls_to_fetch.append(url)
+        for url_and_response in http.fetch_urls_as_completed(
+                urls_to_fetch, num_threads, benchmarker):
+            yield url_and_response
+
+    #Serves these responses (url => response) from fetch_url() in place of
+    #   HTTP requests, once each. Replaces any still unused.
+    def set_prefetched_responses(self, responses):
+        self.prefetched_responses = responses
 
     #Returns the label for a bitcoin address if it can retreived from the
     #   cache, otherwise returns None
@@ -712,7 +1131,7 @@ class WalletExplorerReader:
     #   single bitcoin address. Used when updating specific blame records in
     #   the database after deferring blaming during local RPC blockchain
     #   processing.
-    def get_wallet_label_for_single_address(self, addr):
+    def get_wallet_label_for_single_address(self, addr, benchmarker = None):
         label = None
 
         #if addr in ADDRESSES_TO_SKIP_FOR_WALLET_EXPLORER_COM:
@@ -724,7 +1143,7 @@ class WalletExplorerReader:
         if label is None:
             #Must query remote API via HTTP
             try:
-                remote_json = self.get_address_json_net(addr)
+                remote_json = self.get_address_json_net(addr, benchmarker)
             except custom_errors.NotFoundAtRemoteAPIError:
                 #A small percentage of addresses are not clustered. For those,
                 #   just use a placeholder for now.
@@ -739,6 +1158,16 @@ class WalletExplorerReader:
                 #   instead, which is just a random alphanum string
                 label = remote_json['wallet_id']
 
+            self.database_connector.set_wallet_id_for_wallet_cluster(
+                label, remote_json['wallet_id'])
+
+            if CACHE_ALL_WALLET_ADDRESSES:
+                #Aggressively query and cache all addresses in this wallet.
+                #   This address's own label is cached only afterwards, so that
+                #   if the download is interrupted, looking the address up
+                #   again resumes it.
+                self.cache_label_for_all_wallet_addresses_net(label)
+
             cached = self.database_connector.cache_blame_label_for_btc_address(
                 addr, label)
             if cached:
@@ -746,26 +1175,62 @@ class WalletExplorerReader:
             else:
                 pass #TODO can handle this differently
 
-            if CACHE_ALL_WALLET_ADDRESSES:
-                #Aggressively query and cache all addresses in this wallet
-                addresses = self.get_addresses_for_wallet_label_net(label)
-                for addr in addresses:
-                    #TODO: Need to create an executemany version of this, very
-                    #   slow to insert one record at a time for big wallets
-                    cached = self.database_connector.cache_blame_label_for_btc_address(
-                        addr, label)
-                    if cached:
-                        pass
-                    else:
-                        #WE.com sometimes has weirdly formatted addresses
-                        #   returned for this API call such as
-                        #   '#multisig_a74f4a173bb335f7_1'. These will be
-                        #   rejected by a validation check, result in a False
-                        #   return value. We can safely ignore this.
-                        pass
-
         return label
 
+    #Caches the label for every address in the wallet with that label,
+    #   writing a batch of about WALLET_ADDRESS_CACHE_BATCH_SIZE addresses at a
+    #   time as the pages of addresses are fetched. Each batch is written in
+    #   the same transaction as a record of the pages it came from, so if the
+    #   download is interrupted, the next call for this label fetches only the
+    #   pages not yet cached. Must not be called within a block_transaction(),
+    #   since the batches would then only be committed along with it.
+    #Returns: The number of addresses cached by this call.
+    def cache_label_for_all_wallet_addresses_net(self, blame_label):
+        db_conn = self.database_connector
+        assert db_conn.block_transaction_depth == 0
+        (addresses_count, cached_offsets) = (
+            db_conn.get_wallet_download_progress(blame_label))
+        if len(cached_offsets) > 0:
+            dprint(("Resuming download of wallet '%s': %d of its pages are "
+                    "already cached.") % (blame_label, len(cached_offsets)))
+
+        num_cached = 0
+        batch = []
+        batch_offsets = []
+        for (offset, addresses_count, addresses) in (
+                self.get_address_pages_for_wallet_label_net(
+                    blame_label, cached_offsets, addresses_count)):
+            batch.extend(addresses)
+            batch_offsets.append(offset)
+            if len(batch) >= WALLET_ADDRESS_CACHE_BATCH_SIZE:
+                num_cached = num_cached + self.cache_wallet_address_batch(
+                    blame_label, batch, batch_offsets, addresses_count)
+                batch = []
+                batch_offsets = []
+        if len(batch_offsets) > 0:
+            num_cached = num_cached + self.cache_wallet_address_batch(
+                blame_label, batch, batch_offsets, addresses_count)
+        db_conn.delete_wallet_download_progress(blame_label)
+        return num_cached
+
+    #Helper function for cache_label_for_all_wallet_addresses_net()
+    #Returns: The number of addresses cached.
+    def cache_wallet_address_batch(self, blame_label, addresses, page_offsets,
+                                   addresses_count):
+        db_conn = self.database_connector
+
+        def write_batch():
+            #WE.com sometimes has weirdly formatted addresses returned for
+            #   this API call such as '#multisig_a74f4a173bb335f7_1'. These
+            #   are skipped by a validation check.
+            num_cached = db_conn.cache_blame_label_for_btc_addresses(
+                addresses, blame_label)
+            db_conn.record_wallet_download_progress(blame_label, page_offsets,
+                                                    addresses_count)
+            return num_cached
+
+        return db_conn.run_in_block_transaction(write_batch)
+
     #Helper function for get_addresses_for_wallet_label_net() extracts addresses
     #   from JSON retrieved from remote API.
     def get_address_list_from_json(self, address_list_json):
@@ -794,35 +1259,57 @@ class WalletExplorerReader:
     #Does a remote API lookup to fetch all addresses that belong to the wallet
     #   with the specified label such as 'BTC-e.com' or '637e58bb505ab93d'
     def get_addresses_for_wallet_label_net(self, blame_label):
-        offset = 0
+        pages = sorted(self.get_address_pages_for_wallet_label_net(blame_label))
+        addresses = []
+        for (_, _, page) in pages:
+            addresses.extend(page)
+        return addresses
+
+    #Like get_addresses_for_wallet_label_net(), but yields each page of
+    #   addresses as it is fetched, so that callers needn't hold every address
+    #   of a large wallet in memory. Pages after the first may arrive in any
+    #   order if FETCH_WALLET_PAGES_CONCURRENTLY is set.
+    #param0: blame_label: The wallet's label
+    #param1: offsets_to_skip (Optional): Offsets of pages not to fetch, e.g.
+    #   those already cached by an interrupted download.
+    #param2: addresses_count (Optional): The number of addresses in the wallet,
+    #   if known. The first page is fetched to find it otherwise.
+    #Yields: A tuple of the page's offset, the number of addresses in the
+    #   wallet, and the list of addresses in the page.
+    def get_address_pages_for_wallet_label_net(self, blame_label,
+                                               offsets_to_skip = None,
+                                               addresses_count = None):
+        if offsets_to_skip is None:
+            offsets_to_skip = set()
 
         api_key = self.config.WALLETEXPLORER_API_KEY
         urlbuilder = WalletExplorerURLBuilder()
-        url = urlbuilder.get_wallet_addresses_at_offset(blame_label, offset,
-                                                        api_key)
-        json = self.get_json_net(url)
-
-        addresses = self.get_address_list_from_json(json)
-
-        addresses_count = 0
-        try:
-            addresses_count = json['addresses_count']
-        except KeyError as e:
-            logger.log_and_die(str(e))
-
-        #start by retrieving up to 100 addresses, continue until all fetched.
-        addresses_remaining = addresses_count - 100
-        offset = 100
-        while addresses_remaining > 0:
-            url = urlbuilder.get_wallet_addresses_at_offset(blame_label,
-                                                            offset, api_key)
+        if addresses_count is None or 0 not in offsets_to_skip:
+            url = urlbuilder.get_wallet_addresses_at_offset(blame_label, 0,
+                                                            api_key)
             json = self.get_json_net(url)
-            addresses.extend(self.get_address_list_from_json(json))
-
-            addresses_remaining = addresses_remaining - 100
-            offset = offset + 100
-
-        return addresses
+            try:
+                addresses_count = json['addresses_count']
+            except KeyError as e:
+                logger.log_and_die(str(e))
+            if 0 not in offsets_to_skip:
+                yield (0, addresses_count, self.get_address_list_from_json(json))
+
+        #The remaining pages of up to 100 addresses each
+        offsets_by_url = {}
+        for offset in range(100, addresses_count, 100):
+            if offset not in offsets_to_skip:
+                url = urlbuilder.get_wallet_addresses_at_offset(blame_label,
+                                                                offset, api_key)
+                offsets_by_url[url] = offset
+        num_threads = 1
+        if FETCH_WALLET_PAGES_CONCURRENTLY:
+            num_threads = self.config.HTTP_MAX_CONCURRENT_REQUESTS
+        for (url, response) in self.fetch_urls_as_completed(
+                sorted(offsets_by_url, key = offsets_by_url.get), num_threads):
+            json = self.get_json_from_response(url, response)
+            yield (offsets_by_url[url], addresses_count,
+                   self.get_address_list_from_json(json))
 
     #Looks in local database cache for all labels that we need. If not all of
     #   the labels we need are cached, a single HTTP request is made to look
@@ -862,7 +1349,8 @@ class WalletExplorerReader:
             else:
                 #The label for the input addresses has never been cached. Resort to
                 #   HTTP query.
-                remote_json = self.get_transaction_json_net(tx_id)
+                remote_json = self.get_transaction_json_net(tx_id,
+                                                            benchmarker)
                 sender_label = self.get_sender_label_from_json(remote_json)
 
         if sender_label is not None:
@@ -893,7 +1381,8 @@ class WalletExplorerReader:
                 #The label for the output address has never been cached. Resort
                 #   to HTTP query.
                 if remote_json is None: #Don't make more than one HTTP query.
-                    remote_json = self.get_transaction_json_net(tx_id)
+                    remote_json = self.get_transaction_json_net(tx_id,
+                                                                benchmarker)
                 receiver_label = self.get_receiver_label_from_json(remote_json,
                                                                    reused_output_address)
 
@@ -921,12 +1410,34 @@ class WalletExplorerReader:
     #If object cannot be found at remote API for consecutive calls, a counter
     #   is incremented until it reaches NUM_CONSECUTIVE_API_MISSES_TO_DIE,
     #   otherwise just raises raises a NotFoundAtRemoteAPIError.
-    def get_json_net(self, url):
-        response = self.fetch_url(url)
+    #Lookups that recently found nothing raise a NotFoundAtRemoteAPIError
+    #   without a request if USE_NOT_FOUND_CACHE is set.
+    def get_json_net(self, url, benchmarker = None):
+        if self.is_cached_as_not_found(url):
+            dprint("Cached as not found, skipping url: %s" % url)
+            if benchmarker is not None:
+                benchmarker.increment_wallet_explorer_not_found_cache_hits()
+            raise custom_errors.NotFoundAtRemoteAPIError
+        response = self.fetch_url(url, benchmarker)
+        return self.get_json_from_response(url, response)
+
+    #Whether a lookup of this url found nothing within the last
+    #   NOT_FOUND_CACHE_TTL_SEC seconds.
+    def is_cached_as_not_found(self, url):
+        if not USE_NOT_FOUND_CACHE:
+            return False
+        return self.database_connector.is_remote_lookup_cached_as_not_found(
+            response_cache.remove_api_keys(url), time.time())
+
+    #Parses a response fetched from url for get_json_net(), which describes
+    #   the errors handled.
+    def get_json_from_response(self, url, response):
         try:
             jsonObj = json.loads(response)
         except ValueError as e:
-            #Something went wrong with JSON response from API, panic
+            #Something went wrong with JSON response from API, panic, but
+            #   don't keep it in the response cache for the next run
+            http.uncache_response(url)
             msg = (("Expected JSON response from '%s' instead received '%s'") %
                 (url, str(response)))
             logger.log_and_die(msg)
@@ -942,6 +1453,14 @@ class WalletExplorerReader:
                 self.consecutive_lookup_misses + 1)
             dprint("Not found for url: %s. %d consecutive misses so far." %
                    (url, self.consecutive_lookup_misses))
+            #The response cache may keep responses however old they are, so
+            #   leave remembering misses to the not-found cache, whose entries
+            #   expire.
+            http.uncache_response(url)
+            if USE_NOT_FOUND_CACHE:
+                self.database_connector.cache_remote_lookup_not_found(
+                    response_cache.remove_api_keys(url),
+                    time.time() + NOT_FOUND_CACHE_TTL_SEC)
             if (self.consecutive_lookup_misses ==
                     NUM_CONSECUTIVE_API_MISSES_TO_DIE):
                 msg = ("Error: Encountered %d consecutive misses to "
@@ -956,28 +1475,75 @@ class WalletExplorerReader:
     #Fetch information for a given address from WalletExplorer.com via HTTP
     #If informationf or the specified address is not found at the remote API,
     #   raises custom_errors.NotFoundAtRemoteAPIError.
-    def get_address_json_net(self, addr):
+    def get_address_json_net(self, addr, benchmarker = None):
         api_key = self.config.WALLETEXPLORER_API_KEY
         urlbuilder = WalletExplorerURLBuilder()
         url = urlbuilder.get_address_info(addr, api_key)
         try:
-            json = self.get_json_net(url)
+            json = self.get_json_net(url, benchmarker)
             return json
         except custom_errors.NotFoundAtRemoteAPIError:
             raise
 
     #Fetch information for a given transaction from WalletExplorer.com via HTTP
     #Error conditions handled: WE.com returns found:false in the JSON.
-    def get_transaction_json_net(self, tx_id):
+    def get_transaction_json_net(self, tx_id, benchmarker = None):
         api_key = self.config.WALLETEXPLORER_API_KEY
         urlbuilder = WalletExplorerURLBuilder()
         url = urlbuilder.get_tx_info(tx_id, api_key)
-        return self.get_json_net(url)
+        return self.get_json_net(url, benchmarker)
 
 #############
 # FUNCTIONS #
 #############
 
+#Returns the decoded genesis transaction. bitcoind won't generate this, but
+#   here's what it would look like.
+def get_genesis_tx_json():
+    return {
+        'txid':    GENESIS_TX_ID,
+        'version':  1,
+        'locktime': 0,
+        'vin': [{
+            "sequence":4294967295,
+            'coinbase': ('04ffff001d0104455468652054696d65732030332f4a6'
+                         '16e2f32303039204368616e63656c6c6f72206f6e2062'
+                         '72696e6b206f66207365636f6e64206261696c6f75742'
+                         '0666f722062616e6b73')
+        }],
+        'vout': [
+            {
+                'value': 50.00000000,
+                'n': 0,
+                'scriptPubKey': {
+                    'asm': ('04678afdb0fe5548271967f1a67130b7105cd6a828'
+                            'e03909a67962e0ea1f61deb649f6bc3f4cef38c4f3'
+                            '5504e51ec112de5c384df7ba0b8d578a4c702b6bf1'
+                            '1d5f OP_CHECKSIG'),
+                    'hex': ('4104678afdb0fe5548271967f1a67130b7105cd6a8'
+                            '28e03909a67962e0ea1f61deb649f6bc3f4cef38c4'
+                            'f35504e51ec112de5c384df7ba0b8d578a4c702b6b'
+                            'f11d5fac'),
+                    'reqSigs': 1,
+                    'type': 'pubkey',
+                    'addresses': ['1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa']
+                }
+            }
+        ]
+    }
+
+#Returns a list of (prev_txid, output_pos) tuples identifying the outputs spent
+#   by each input of a transaction as returned by
+#   DecodedTxBlockReader.get_decoded_txs(). Inputs that don't spend a
+#   previous output, i.e. coinbase inputs, are skipped.
+def get_prev_out_keys(tx_json):
+    keys = []
+    for vin in tx_json['vin']:
+        #yes, the 'vout' RPC field is poorly named
+        if 'txid' in vin and 'vout' in vin:
+            keys.append((vin['txid'], vin['vout']))
+    return keys
+
 def dprint(str):
     if ENABLE_DEBUG_PRINT:
         print("DEBUG: %s" % str)
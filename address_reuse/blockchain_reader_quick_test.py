@@ -6,17 +6,72 @@
 #       get_raw_tx(tx_id)
 #       get_decoded_tx(tx_id)
 #       get_bci_like_tuple_for_tx_id(tx_id)
+#           * also with a UTXO cache, using made-up transactions
 #       get_output_addresses(tx_json)
 #       get_output_address(tx_id, output_index, [tx_json])
 #       get_tx_list(block_height)
+#           * also with made-up transactions, in both lookup modes
+#       get_prev_out_addresses(tx_id_json_pairs, use_tx_out_addr_cache_only)
+#       get_decoded_txs(tx_ids)
+#           * only via get_tx_list(), against a stand-in bitcoind
+#       get_decoded_txs_at_height(block_height)
+#           * only via get_tx_list(), against a stand-in bitcoind
+#       call_rpc_batch(rpc_calls)
+#       start_prefetching(start_height, end_height, queue_depth, num_workers)
+#           * against a stand-in bitcoind
 #       is_first_transaction_for_address(addr, tx_id, block_height, benchmarker)
+#       get_prior_tx_history_for_block(tx_list, block_height, benchmarker)
+#
+#   RawBlockFileReader, using block files written by the test:
+#       get_current_blockchain_block_height()
+#       get_tx_list(block_height)
+#           * with P2PKH, P2SH, P2PK, multisig, witness and undecodable
+#             outputs, a segwit tx, and a stale block
+#       start_prefetching(start_height, end_height, queue_depth, num_workers)
+#
+#   first_seen_index, using block files written by the test:
+#       build_first_seen_index(database, reader_factory, end_height,
+#                              num_workers, range_size)
+#       process_blocks_in_parallel(database, reader_factory, start_height,
+#                                  end_height, num_workers, range_size)
+#           * also db.merge_staging_database(), and
+#             DecodedTxBlockReader.get_prior_tx_history_for_block() with
+#             use_first_seen_index, compared with processing in order
+#
+#   BlockPrefetcher:
+#       get(block_height)
+#           * with blocks fetched out of order and a fetch that fails
+#
+#   block_file:
+#       parse_block(data)
+#           * with the genesis block
+#
+#   UTXOCache:
+#       add_tx_outputs(tx_id, outputs)
+#       spend(tx_id, output_pos)
+#       spend_spilled(keys)
+#           * also via get_tx_list(), with one lookup per block
+#       take_spent_spilled_keys()
+#       flush()
 #
 #   ThrottledBlockchainReader:
 #       get_tx_relayed_by_using_tx_id(tx_id, txObj, benchmarker)
 #           * only tests whether cache is used, not remote API lookup
+#       get_tx_list(block_height)
+#           * with a non-JSON response, which isn't kept in the response cache
+#       is_first_transaction_for_address(addr, tx_id, block_height)
+#           * only tests that the response cache isn't used
 #
 #   WalletExplorerReader:
 #       get_address_list_from_json(address_list_json)
+#       cache_label_for_all_wallet_addresses_net(blame_label)
+#           * with pages of addresses served in place of the remote API
+#           * resuming after an interrupted download
+#       get_wallet_label_for_single_address(addr, benchmarker)
+#           * an address cached as not found, and its entry expiring
+#           * a not-found response kept out of the HTTP response cache
+#       get_json_from_response(url, response)
+#           * a non-JSON response, which isn't kept in the response cache
 
 ####################
 # INTERNAL IMPORTS #
@@ -26,7 +81,14 @@ import address_reuse.blockchain_reader
 import address_reuse.custom_errors
 import address_reuse.block_processor
 import address_reuse.benchmark.block_reader_benchmark
+import address_reuse.benchmark.fake_bitcoind
 import address_reuse.db
+import address_reuse.utxo_cache
+import address_reuse.block_file
+import address_reuse.base58
+import address_reuse.block_pipeline
+import address_reuse.first_seen_index
+import address_reuse.response_cache
 
 ####################
 # EXTERNAL IMPORTS #
@@ -35,6 +97,10 @@ import address_reuse.db
 import unittest
 import os
 import json
+import shutil
+import tempfile
+import time
+from binascii import unhexlify
 
 #############
 # CONSTANTS #
@@ -106,6 +172,19 @@ SAMPLE_ADDRESS_LIST_JSON_AS_STR = '''
 }
 '''
 
+GENESIS_BLOCK_HEX = (
+    '01000000000000000000000000000000000000000000000000000000000000000000000'
+    '03ba3edfd7a7b12b27ac72c3e67768f617fc81bc3888a51323a9fb8aa4b1e5e4a29ab5f'
+    '49ffff001d1dac2b7c0101000000010000000000000000000000000000000000000000'
+    '000000000000000000000000ffffffff4d04ffff001d0104455468652054696d657320'
+    '30332f4a616e2f32303039204368616e63656c6c6f72206f6e206272696e6b206f6620'
+    '7365636f6e64206261696c6f757420666f722062616e6b73ffffffff0100f2052a0100'
+    '0000434104678afdb0fe5548271967f1a67130b7105cd6a828e03909a67962e0ea1f61'
+    'deb649f6bc3f4cef38c4f35504e51ec112de5c384df7ba0b8d578a4c702b6bf11d5fac'
+    '00000000')
+
+GENESIS_BLOCK_HASH = ('000000000019d6689c085ae165831e934ff763ae46a2a6c172b3f1b'
+                      '60a8ce26f')
 
 TEMP_DB_FILENAME = 'address_reuse.db-temp'
 
@@ -438,6 +517,264 @@ class LocalBlockchainRPCReaderTestCase(unittest.TestCase):
         self.do_is_first_transaction_for_address(addr, tx_id, block_height, 
                                                  False)
     
+    def test_get_prior_tx_history_for_block_within_block_ordering(self):
+        block_height = 187
+        second_tx_id = SECOND_TX_BLOCK_HEIGHT_187_AS_BCI_LIKE_TUPLE['hash']
+        reusing_tx = {
+            'hash': 'ab' * 32,
+            'inputs': [],
+            'out': [
+                {'n': 0,
+                 'addr': '15NUwyBYrZcnUgTagsm1A7M2yL2GntpuaZ'},
+                {'n': 1},
+                {'n': 2,
+                 'addr': '1PSSGeFHDnKNxiEyFrD1wcEaHr9hrQDDWc'},
+                {'n': 3,
+                 'addr': '1PSSGeFHDnKNxiEyFrD1wcEaHr9hrQDDWc'}
+            ]
+        }
+        tx_list = [FIRST_TX_BLOCK_HEIGHT_187_AS_BCI_LIKE_TUPLE,
+                   SECOND_TX_BLOCK_HEIGHT_187_AS_BCI_LIKE_TUPLE, reusing_tx]
+        #seen in an earlier block
+        self.database_connector.has_address_been_seen_cache_if_not(
+            '1FDMwEo8qNa9icVcooBUoGvA6NriePtJJ3', 186)
+
+        history_map = self.reader.get_prior_tx_history_for_block(tx_list,
+                                                                 block_height)
+        self.assertEqual(len(history_map), 5)
+        self.assertTrue(history_map[(
+            FIRST_TX_BLOCK_HEIGHT_187_AS_BCI_LIKE_TUPLE['hash'], 0)])
+        self.assertFalse(history_map[(second_tx_id, 0)])
+        #seen earlier in the same block
+        self.assertTrue(history_map[(reusing_tx['hash'], 0)])
+        self.assertNotIn((reusing_tx['hash'], 1), history_map)
+        #seen earlier in the same tx
+        self.assertFalse(history_map[(reusing_tx['hash'], 2)])
+        self.assertTrue(history_map[(reusing_tx['hash'], 3)])
+
+    #Uses made-up transactions in place of bitcoind, with room for one tx in
+    #   the UTXO cache's memory so that outputs are spilled to the database.
+    def test_get_bci_like_tuple_for_tx_id_uses_utxo_cache(self):
+        addr_a = '1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa'
+        addr_b = '15NUwyBYrZcnUgTagsm1A7M2yL2GntpuaZ'
+        coinbase_vin = [{'coinbase': '00'}]
+        def get_vout(n, addr = None):
+            script_pub_key = {'hex': '00'}
+            if addr is not None:
+                script_pub_key['addresses'] = [addr]
+            return {'n': n, 'scriptPubKey': script_pub_key}
+        def get_vin(tx_id, n):
+            return {'txid': tx_id, 'vout': n}
+        tx_a, tx_b, tx_c, tx_d, tx_e = [c * 64 for c in 'abcde']
+        decoded_txs = {
+            tx_a: {'vin': coinbase_vin,
+                   'vout': [get_vout(0, addr_a), get_vout(1)]},
+            tx_d: {'vin': coinbase_vin, 'vout': [get_vout(0, addr_b)]},
+            tx_b: {'vin': [get_vin(tx_a, 0), get_vin(tx_a, 1)],
+                   'vout': [get_vout(0, addr_b)]},
+            tx_c: {'vin': [get_vin(tx_b, 0)], 'vout': [get_vout(0)]},
+            #spends an output that was spent already, so isn't cached
+            tx_e: {'vin': [get_vin(tx_a, 0)], 'vout': []}}
+        self.reader.get_decoded_tx = lambda tx_id: decoded_txs[tx_id]
+        self.reader.rpc_batch_size = 1 #so that get_decoded_tx() is used
+        utxos = address_reuse.utxo_cache.UTXOCache(self.database_connector, 1)
+        self.reader.utxo_cache = utxos
+
+        self.reader.get_bci_like_tuple_for_tx_id(tx_a)
+        self.reader.get_bci_like_tuple_for_tx_id(tx_d) #spills tx_a
+        self.assertEqual(len(utxos), 1)
+
+        tx_b_tuple = self.reader.get_bci_like_tuple_for_tx_id(tx_b)
+        self.assertEqual(tx_b_tuple['inputs'],
+                         [{'prev_out': {'n': 0, 'addr': addr_a}},
+                          {'prev_out': {'n': 1}}])
+        self.assertEqual(utxos.num_spilled_hits, 2)
+        tx_c_tuple = self.reader.get_bci_like_tuple_for_tx_id(tx_c)
+        self.assertEqual(tx_c_tuple['inputs'],
+                         [{'prev_out': {'n': 0, 'addr': addr_b}}])
+        self.assertEqual(utxos.num_hits, 1)
+        tx_e_tuple = self.reader.get_bci_like_tuple_for_tx_id(tx_e)
+        self.assertEqual(tx_e_tuple['inputs'],
+                         [{'prev_out': {'n': 0, 'addr': addr_a}}])
+        self.assertEqual(utxos.num_misses, 1)
+
+        #tx_a's outputs stay on disk until deleted with the block spending them
+        spent_keys = self.reader.take_spent_spilled_utxo_keys()
+        self.assertEqual(sorted(spent_keys), [(tx_a, 0), (tx_a, 1)])
+        self.assertEqual(self.reader.take_spent_spilled_utxo_keys(), [])
+        self.database_connector.delete_spilled_utxos(spent_keys)
+
+        #tx_d's output was spilled and tx_c's is in memory
+        utxos.flush()
+        self.assertEqual(len(utxos), 0)
+        self.assertEqual(self.database_connector.get_spilled_utxos(
+            [(tx_a, 0), (tx_d, 0), (tx_c, 0), (tx_c, 1)]),
+            {(tx_d, 0): addr_b, (tx_c, 0): None})
+
+    #Uses made-up transactions in place of bitcoind, with every output of the
+    #   earlier block spilled from the UTXO cache.
+    def test_get_tx_list_looks_up_spilled_utxos_for_whole_block(self):
+        addr_a = '1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa'
+        tx_a, tx_b, tx_c = [c * 64 for c in 'abc']
+        utxos = address_reuse.utxo_cache.UTXOCache(self.database_connector, 1)
+        self.reader.utxo_cache = utxos
+        self.database_connector.write_spilled_utxos(
+            [(tx_a, 0, addr_a), (tx_a, 1, None)])
+        decoded_txs = {
+            tx_b: {'vin': [{'txid': tx_a, 'vout': 0}], 'vout': []},
+            tx_c: {'vin': [{'txid': tx_a, 'vout': 1}], 'vout': []}}
+        block_tx_ids = [tx_b, tx_c]
+        self.reader.get_decoded_txs_at_height = lambda block_height: (
+            block_tx_ids, [decoded_txs[tx_id] for tx_id in block_tx_ids])
+        lookups = []
+        get_spilled_utxos = self.database_connector.get_spilled_utxos
+        def record_lookup(output_keys):
+            lookups.append(sorted(output_keys))
+            return get_spilled_utxos(output_keys)
+        self.database_connector.get_spilled_utxos = record_lookup
+
+        txs = self.reader.get_tx_list(2)
+        self.assertEqual(txs[0]['inputs'],
+                         [{'prev_out': {'n': 0, 'addr': addr_a}}])
+        self.assertEqual(txs[1]['inputs'], [{'prev_out': {'n': 1}}])
+        self.assertEqual(lookups, [[(tx_a, 0), (tx_a, 1)]])
+        self.assertEqual(utxos.num_spilled_hits, 2)
+
+        #Not deleted until the block is written
+        self.assertEqual(len(get_spilled_utxos([(tx_a, 0), (tx_a, 1)])), 2)
+        self.assertEqual(sorted(self.reader.take_spent_spilled_utxo_keys()),
+                         [(tx_a, 0), (tx_a, 1)])
+
+    #Uses made-up transactions in place of bitcoind. Outputs of tx_x are in
+    #   the tx output cache, and tx_b spends an output of tx_a that isn't.
+    def test_get_tx_list_resolves_prev_outs_for_whole_block(self):
+        addr_x = '1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa'
+        addr_a = '15NUwyBYrZcnUgTagsm1A7M2yL2GntpuaZ'
+        tx_x, tx_a, tx_b = [c * 64 for c in 'fab']
+        self.database_connector.add_output_address_to_mem_cache(
+            1, tx_x, 0, addr_x)
+        self.database_connector.add_output_address_to_mem_cache(
+            1, tx_x, 1, None)
+        self.database_connector.write_stored_output_addresses()
+        decoded_txs = {
+            tx_a: {'vin': [{'txid': tx_x, 'vout': 0},
+                           {'txid': tx_x, 'vout': 1}],
+                   'vout': [{'n': 0, 'scriptPubKey': {'addresses': [addr_a]}}]},
+            tx_b: {'vin': [{'txid': tx_a, 'vout': 0}], 'vout': []}}
+        decoded_tx_ids = []
+        def get_decoded_tx(tx_id):
+            decoded_tx_ids.append(tx_id)
+            return decoded_txs[tx_id]
+        self.reader.get_decoded_tx = get_decoded_tx
+        self.reader.rpc_batch_size = 1 #so that get_decoded_tx() is used
+        block_tx_ids = [tx_a]
+        self.reader.get_decoded_txs_at_height = lambda block_height: (
+            block_tx_ids, self.reader.get_decoded_txs(block_tx_ids))
+        expected_tx_a_inputs = [{'prev_out': {'n': 0, 'addr': addr_x}},
+                                {'prev_out': {'n': 1}}]
+
+        #every input is cached, so this doesn't wait
+        txs = self.reader.get_tx_list(2, use_tx_out_addr_cache_only = True)
+        self.assertEqual(txs[0]['inputs'], expected_tx_a_inputs)
+        self.assertEqual(decoded_tx_ids, [tx_a])
+
+        block_tx_ids.append(tx_b)
+        del decoded_tx_ids[:]
+        txs = self.reader.get_tx_list(2)
+        self.assertEqual(txs[0]['inputs'], expected_tx_a_inputs)
+        self.assertEqual(txs[1]['inputs'],
+                         [{'prev_out': {'n': 0, 'addr': addr_a}}])
+        #tx_a is decoded again only to look up the output tx_b spends
+        self.assertEqual(decoded_tx_ids, [tx_a, tx_b, tx_a])
+
+    #Reads blocks from a stand-in bitcoind with and without batching, and with
+    #   and without verbose getblock calls
+    def test_get_tx_list_with_rpc_batches(self):
+        blockchain = address_reuse.benchmark.fake_bitcoind.FakeBlockchain(
+            num_blocks = 3, num_txs_per_block = 5)
+        server = address_reuse.benchmark.fake_bitcoind.FakeBitcoindServer(
+            blockchain)
+        server.start()
+        orig_val = address_reuse.blockchain_reader.USE_VERBOSE_GETBLOCK
+        try:
+            tx_lists = []
+            num_http_requests = []
+            for (use_verbose_getblock, batch_size) in [(False, 1), (False, 4),
+                                                       (True, 4)]:
+                address_reuse.blockchain_reader.USE_VERBOSE_GETBLOCK = (
+                    use_verbose_getblock)
+                reader_class = (
+                    address_reuse.blockchain_reader.LocalBlockchainRPCReader)
+                reader = reader_class(
+                    self.database_connector,
+                    rpc_url = server.get_rpc_url(),
+                    rpc_batch_size = batch_size)
+                num_http_requests_before = server.num_http_requests
+                tx_lists.append([reader.get_tx_list(block_height)
+                                 for block_height in range(0, 3)])
+                num_http_requests.append(server.num_http_requests -
+                                         num_http_requests_before)
+        finally:
+            address_reuse.blockchain_reader.USE_VERBOSE_GETBLOCK = orig_val
+            server.stop()
+
+        self.assertEqual(tx_lists[0], tx_lists[1])
+        self.assertEqual(tx_lists[0], tx_lists[2])
+        last_block_txs = tx_lists[0][2]
+        self.assertEqual(len(last_block_txs), 5)
+        #tx 1 spends output 0 of tx 1 in block 1 and output 1 of tx 1 in
+        #   block 0
+        self.assertEqual(
+            last_block_txs[1]['inputs'],
+            [{'prev_out': {
+                'n': 0,
+                'addr': address_reuse.benchmark.fake_bitcoind.get_fake_address(
+                    1, 1, 0)}},
+             {'prev_out': {
+                 'n': 1,
+                 'addr': address_reuse.benchmark.fake_bitcoind.get_fake_address(
+                     0, 1, 1)}}])
+        #the coinbase's last output has no address
+        self.assertEqual(last_block_txs[0]['out'][1], {'n': 1})
+        #per block: getblockhash, getblock, then per tx, getrawtransaction and
+        #   decoderawtransaction for it and for each distinct previous tx
+        self.assertEqual(num_http_requests[0], 2 * 3 + 2 * (15 + 4 + 8))
+        #per block: getblockhash, getblock, and 2 batches each of
+        #   getrawtransaction and decoderawtransaction for its 5 txs; then 1
+        #   batch of each for the 4 previous txs of block 1, and 2 for the 8 of
+        #   block 2
+        self.assertEqual(num_http_requests[1], 2 * 3 + 4 * 3 + 2 + 2 * 2)
+        #per block: getblockhash and getblock; then the same batches for
+        #   previous txs
+        self.assertEqual(num_http_requests[2], 2 * 3 + 2 + 2 * 2)
+
+    #Reads blocks with a stand-in bitcoind while they are prefetched from
+    #   several threads
+    def test_get_tx_list_with_prefetching(self):
+        blockchain = address_reuse.benchmark.fake_bitcoind.FakeBlockchain(
+            num_blocks = 8, num_txs_per_block = 5)
+        server = address_reuse.benchmark.fake_bitcoind.FakeBitcoindServer(
+            blockchain, latency_sec = 0.002)
+        server.start()
+        try:
+            reader = address_reuse.blockchain_reader.LocalBlockchainRPCReader(
+                self.database_connector, rpc_url = server.get_rpc_url())
+            expected = [reader.get_tx_list(block_height)
+                        for block_height in range(0, 8)]
+            reader.start_prefetching(1, 7, queue_depth = 3, num_workers = 3)
+            try:
+                #block 0 is before the prefetched range
+                tx_lists = [reader.get_tx_list(block_height)
+                            for block_height in range(0, 8)]
+                num_fetched = reader.block_prefetcher.next_height_to_fetch
+            finally:
+                reader.stop_prefetching()
+        finally:
+            server.stop()
+        self.assertEqual(tx_lists, expected)
+        self.assertEqual(num_fetched, 7)
+        self.assertIsNone(reader.block_prefetcher)
+
     #simulate caching of the 'relayed by' field for one transation, and then
     #   ensure that the get_tx_relayed_by_using_tx_id() is referencing
     #   the cache rather than doing a remote API lookup. This can be tested
@@ -466,6 +803,70 @@ class LocalBlockchainRPCReaderTestCase(unittest.TestCase):
                          ('Expected to avoid 1 query to BCI, instead %d' % 
                           queries_avoided))
     
+    def test_get_tx_list_fetches_non_json_response_again(self):
+        api_reader = address_reuse.blockchain_reader.ThrottledBlockchainReader(
+            self.database_connector)
+        url = address_reuse.blockchain_reader.BlockchainInfoURLBuilder(
+            api_reader.config.BLOCKCHAIN_INFO_API_KEY).get_block_at_height_url(
+                170)
+        block_json = json.dumps({'blocks': [
+            {'main_chain': False, 'tx': []},
+            {'main_chain': True, 'tx': [{'hash': 'b1fe'}]}]})
+        remote_responses = ['No Free Cluster Connection', block_json]
+        def fetch_url_from_remote(url):
+            return remote_responses.pop(0)
+
+        temp_dir = tempfile.mkdtemp()
+        http = address_reuse.blockchain_reader.http
+        original_fetch_url_from_remote = http.fetch_url_from_remote
+        http.fetch_url_from_remote = fetch_url_from_remote
+        cache = address_reuse.response_cache.ResponseCache(
+            os.path.join(temp_dir, 'responses.db'))
+        http.response_cache_for_process = cache
+        http.is_response_cache_enabled = True
+        try:
+            self.assertEqual(api_reader.get_tx_list(170), [{'hash': 'b1fe'}])
+            self.assertEqual(remote_responses, [])
+            #Only the valid response is kept
+            self.assertEqual(cache.get(url), block_json)
+        finally:
+            http.fetch_url_from_remote = original_fetch_url_from_remote
+            http.response_cache_for_process = None
+            http.is_response_cache_enabled = None
+            cache.close()
+            shutil.rmtree(temp_dir)
+
+    def test_is_first_transaction_for_address_skips_response_cache(self):
+        addr = '1PSSGeFHDnKNxiEyFrD1wcEaHr9hrQDDWc'
+        tx_id = ('b1fea52486ce0c62bb442b530a3f0132b826c74e473d1f2c220bfa78111c'
+                 '5082')
+        api_reader = address_reuse.blockchain_reader.ThrottledBlockchainReader(
+            self.database_connector)
+        urlbuilder = address_reuse.blockchain_reader.BlockchainInfoURLBuilder(
+            api_reader.config.BLOCKCHAIN_INFO_API_KEY)
+        remote_responses = {
+            urlbuilder.get_number_of_transactions_for_address(addr):
+                {'n_tx': 2},
+            urlbuilder.get_tx_for_address_at_offset(addr, 1):
+                {'txs': [{'hash': tx_id}]}}
+        use_cache_by_url = {}
+        def fetch_url(url, benchmarker = None, use_cache = True):
+            use_cache_by_url[url] = use_cache
+            return json.dumps(remote_responses[url])
+
+        http = address_reuse.blockchain_reader.http
+        original_fetch_url = http.fetch_url
+        http.fetch_url = fetch_url
+        try:
+            self.assertTrue(api_reader.is_first_transaction_for_address(
+                addr, tx_id, 170))
+        finally:
+            http.fetch_url = original_fetch_url
+
+        #Both answers change as the address is used again
+        self.assertEqual(use_cache_by_url,
+                         dict((url, False) for url in remote_responses))
+
     def do_get_output_addresses(self, tx_id, expected_output_addresses):
         print("asdf1")
         tx_json = self.reader.get_decoded_tx(tx_id)
@@ -492,6 +893,279 @@ class LocalBlockchainRPCReaderTestCase(unittest.TestCase):
         self.do_get_output_addresses(tx_id, expected_address)
         print("Done with test_get_output_addresses_of_second_tx_block_170()")
 
+class RawBlockFileReaderTestCase(unittest.TestCase):
+
+    database_connector  = None
+    blocks_dir          = None
+
+    def setUp(self):
+        try:
+            os.remove(TEMP_DB_FILENAME)
+        except OSError:
+            pass
+        self.database_connector = address_reuse.db.Database(TEMP_DB_FILENAME)
+        self.blocks_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.blocks_dir)
+
+    def test_parse_genesis_block(self):
+        block = unhexlify(GENESIS_BLOCK_HEX)
+        self.assertEqual(address_reuse.block_file.get_block_hash(block),
+                         GENESIS_BLOCK_HASH)
+        tx_json = address_reuse.block_file.parse_block(block)[0]
+        expected = address_reuse.blockchain_reader.get_genesis_tx_json()
+        self.assertEqual(tx_json['txid'], expected['txid'])
+        self.assertEqual(tx_json['vin'], expected['vin'])
+        self.assertEqual(tx_json['vout'][0]['value'], 50)
+        self.assertEqual(tx_json['vout'][0]['scriptPubKey']['addresses'],
+                         expected['vout'][0]['scriptPubKey']['addresses'])
+
+    #Writes the genesis block and two made-up blocks out of order across two
+    #   files, along with a stale block, and reads them back as BCI-like
+    #   tuples.
+    def test_get_tx_list_from_block_files(self):
+        block_file = address_reuse.block_file
+        hash_a = '\xaa' * 20
+        hash_b = '\xbb' * 20
+        pubkey_c = '\x02' + '\xcc' * 32
+        pubkey_d = '\x03' + '\xdd' * 32
+        p2pkh_a = '\x76\xa9\x14' + hash_a + '\x88\xac'
+        p2sh_b = '\xa9\x14' + hash_b + '\x87'
+        p2pk_c = '\x21' + pubkey_c + '\xac'
+        multisig_cd = '\x51\x21' + pubkey_c + '\x21' + pubkey_d + '\x52\xae'
+        p2wpkh_a = '\x00\x14' + hash_a
+        op_return = '\x6a\x04abcd'
+        address_a = address_reuse.base58.encode_address('\x00' + hash_a)
+        address_b = address_reuse.base58.encode_address('\x05' + hash_b)
+        address_c = block_file.get_pubkey_address(pubkey_c)
+        address_d = block_file.get_pubkey_address(pubkey_d)
+
+        coinbase_1 = block_file.serialize_tx(
+            [(None, 0, '\x51')], [(5000000000, p2pkh_a), (0, op_return)])
+        coinbase_1_id = block_file.parse_tx(coinbase_1, 0)[0]['txid']
+        block_1 = block_file.serialize_block(GENESIS_BLOCK_HASH, [coinbase_1])
+
+        coinbase_2 = block_file.serialize_tx([(None, 0, '\x52')],
+                                             [(5000000000, p2sh_b)])
+        spend_inputs = [(coinbase_1_id, 0, ''), (coinbase_1_id, 1, '')]
+        spend_outputs = [(100, p2pk_c), (200, multisig_cd), (300, p2wpkh_a)]
+        segwit_spend = block_file.serialize_tx(
+            spend_inputs, spend_outputs, witnesses = [['sig', 'key'], []])
+        (segwit_spend_json, _) = block_file.parse_tx(segwit_spend, 0)
+        segwit_spend_id = segwit_spend_json['txid']
+        #the txid excludes the witness data
+        self.assertEqual(segwit_spend_id, block_file.parse_tx(
+            block_file.serialize_tx(spend_inputs, spend_outputs), 0)[0]['txid'])
+        #spends an output created earlier in the same block
+        second_spend = block_file.serialize_tx([(segwit_spend_id, 1, '')],
+                                               [(150, p2pkh_a)])
+        block_2 = block_file.serialize_block(
+            block_file.get_block_hash(block_1),
+            [coinbase_2, segwit_spend, second_spend])
+        stale_block_1 = block_file.serialize_block(
+            GENESIS_BLOCK_HASH, [coinbase_2], timestamp = 1)
+
+        block_file.write_block_file(
+            os.path.join(self.blocks_dir, 'blk00000.dat'),
+            [unhexlify(GENESIS_BLOCK_HEX), block_2, stale_block_1])
+        block_file.write_block_file(
+            os.path.join(self.blocks_dir, 'blk00001.dat'), [block_1],
+            num_padding_bytes = 100)
+        open(os.path.join(self.blocks_dir, 'rev00000.dat'), 'wb').close()
+
+        reader = address_reuse.blockchain_reader.RawBlockFileReader(
+            self.database_connector, blocks_dir = self.blocks_dir)
+        self.assertEqual(reader.get_current_blockchain_block_height(), 2)
+        reader.start_prefetching(0, 3, queue_depth = 2, num_workers = 2)
+        try:
+            self.assertEqual(reader.get_tx_list(0),
+                             [GENESIS_TX_AS_BCI_LIKE_TUPLE])
+            self.assertEqual(reader.get_tx_list(1), [
+                {'hash': coinbase_1_id, 'inputs': [],
+                 'out': [{'n': 0, 'addr': address_a}, {'n': 1}]}])
+            tx_list = reader.get_tx_list(2)
+        finally:
+            reader.stop_prefetching()
+        self.assertEqual(len(tx_list), 3)
+        self.assertEqual(tx_list[0]['out'], [{'n': 0, 'addr': address_b}])
+        self.assertEqual(tx_list[1], {
+            'hash': segwit_spend_id,
+            'inputs': [{'prev_out': {'n': 0, 'addr': address_a}},
+                       {'prev_out': {'n': 1}}],
+            #a multisig output is attributed to its first address
+            'out': [{'n': 0, 'addr': address_c}, {'n': 1, 'addr': address_c},
+                    {'n': 2}]})
+        self.assertEqual(tx_list[2]['inputs'],
+                         [{'prev_out': {'n': 1, 'addr': address_c}}])
+        self.assertEqual(
+            segwit_spend_json['vout'][1]['scriptPubKey']['addresses'],
+            [address_c, address_d])
+
+class FirstSeenIndexTestCase(unittest.TestCase):
+
+    temp_dir            = None
+    blocks_dir          = None
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.blocks_dir = os.path.join(self.temp_dir, 'blocks')
+        os.mkdir(self.blocks_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    #Writes the genesis block and three made-up blocks in which addresses are
+    #   reused across blocks, across txs in a block, and within a tx.
+    def write_blocks(self):
+        block_file = address_reuse.block_file
+        p2pkh_a = '\x76\xa9\x14' + '\xaa' * 20 + '\x88\xac'
+        p2pkh_b = '\x76\xa9\x14' + '\xbb' * 20 + '\x88\xac'
+        p2pkh_c = '\x76\xa9\x14' + '\xcc' * 20 + '\x88\xac'
+
+        coinbase_1 = block_file.serialize_tx([(None, 0, '\x51')],
+                                             [(5000000000, p2pkh_a)])
+        coinbase_1_id = block_file.parse_tx(coinbase_1, 0)[0]['txid']
+        block_1 = block_file.serialize_block(GENESIS_BLOCK_HASH, [coinbase_1])
+
+        coinbase_2 = block_file.serialize_tx([(None, 0, '\x52')],
+                                             [(5000000000, p2pkh_b)])
+        spend_2 = block_file.serialize_tx([(coinbase_1_id, 0, '')],
+                                          [(100, p2pkh_a), (200, p2pkh_b)])
+        spend_2_id = block_file.parse_tx(spend_2, 0)[0]['txid']
+        block_2 = block_file.serialize_block(
+            block_file.get_block_hash(block_1), [coinbase_2, spend_2])
+
+        coinbase_3 = block_file.serialize_tx([(None, 0, '\x53')],
+                                             [(5000000000, p2pkh_c)])
+        spend_3 = block_file.serialize_tx([(spend_2_id, 0, '')],
+                                          [(50, p2pkh_c), (50, p2pkh_c)])
+        block_3 = block_file.serialize_block(
+            block_file.get_block_hash(block_2), [coinbase_3, spend_3])
+
+        block_file.write_block_file(
+            os.path.join(self.blocks_dir, 'blk00000.dat'),
+            [unhexlify(GENESIS_BLOCK_HEX), block_1, block_2, block_3])
+
+    def get_reader_factory(self, db_filename):
+        def make_reader():
+            return address_reuse.blockchain_reader.RawBlockFileReader(
+                address_reuse.db.Database(db_filename),
+                blocks_dir = self.blocks_dir)
+        return make_reader
+
+    def test_process_blocks_in_parallel(self):
+        self.write_blocks()
+        num_blocks = 4
+
+        #read and process in order, against the seen address index
+        sequential_reader = self.get_reader_factory(
+            os.path.join(self.temp_dir, 'sequential_read.db-temp'))()
+        expected_maps = []
+        for block_height in range(0, num_blocks):
+            tx_list = sequential_reader.get_tx_list(block_height)
+            expected_maps.append(
+                sequential_reader.get_prior_tx_history_for_block(
+                    tx_list, block_height))
+        sequential_reader.database_connector.close()
+        sequential_reader = self.get_reader_factory(
+            os.path.join(self.temp_dir, 'sequential.db-temp'))()
+        sequential_processor = address_reuse.block_processor.BlockProcessor(
+            sequential_reader, sequential_reader.database_connector)
+        for block_height in range(0, num_blocks):
+            sequential_processor.process_block(block_height,
+                                               defer_blaming = True)
+        self.assertEqual(sorted(expected_maps[2].values()),
+                         [False, True, True])
+        self.assertEqual(sorted(expected_maps[3].values()),
+                         [False, True, True])
+
+        #one block per range, so that ranges are merged into the index after
+        #   blocks that reuse their addresses have been read
+        parallel_factory = self.get_reader_factory(
+            os.path.join(self.temp_dir, 'parallel.db-temp'))
+        database = parallel_factory().database_connector
+        address_reuse.first_seen_index.build_first_seen_index(
+            database, parallel_factory, num_blocks, num_workers = 2,
+            range_size = 1)
+        self.assertEqual(database.get_first_seen_index_next_height(),
+                         num_blocks)
+
+        index_reader = parallel_factory()
+        index_reader.use_first_seen_index = True
+        for block_height in reversed(range(0, num_blocks)):
+            tx_list = index_reader.get_tx_list(block_height)
+            self.assertEqual(
+                index_reader.get_prior_tx_history_for_block(tx_list,
+                                                            block_height),
+                expected_maps[block_height])
+
+        throughput = (
+            address_reuse.first_seen_index.process_blocks_in_parallel(
+                database, parallel_factory, 0, num_blocks, num_workers = 2,
+                range_size = 3))
+        self.assertEqual(sum([num_blocks_by_worker for
+                              (num_blocks_by_worker, _, _) in
+                              throughput.values()]), num_blocks)
+        self.assertEqual(sum([num_txs for (_, num_txs, _) in
+                              throughput.values()]), 6)
+        #staging databases are removed once merged
+        self.assertEqual([filename for filename in os.listdir(self.temp_dir)
+                          if '-range-' in filename], [])
+        #nothing left to do when run again
+        self.assertEqual(
+            address_reuse.first_seen_index.process_blocks_in_parallel(
+                database, parallel_factory, 0, num_blocks, num_workers = 2,
+                range_size = 3), {})
+
+        stmt = ('SELECT i.label AS label, s.address_reuse_type AS type, '
+                's.role AS role, s.block_height AS block_height, '
+                's.confirmed_tx_id AS tx_id, s.relevant_address AS address '
+                'FROM tblBlameStats s JOIN tblBlameIds i ON '
+                'i.rowid = s.blame_recipient_id')
+        get_blame = lambda database: sorted(
+            [tuple(record) for record in database.fetch_query(stmt, [])])
+        expected_blame = get_blame(sequential_processor.database)
+        #a deferred record for each role, of 1 instance of send-back reuse
+        #   and 4 outputs with prior tx history
+        self.assertEqual(len(expected_blame), 15)
+        self.assertEqual(get_blame(database), expected_blame)
+        for block_height in range(0, num_blocks):
+            expected = sequential_processor.database.get_block_stats(
+                block_height)
+            actual = database.get_block_stats(block_height)
+            self.assertEqual(actual.num_tx_total, expected.num_tx_total)
+            self.assertEqual(actual.pct_tx_with_history_reuse,
+                             expected.pct_tx_with_history_reuse)
+            self.assertEqual(actual.pct_tx_with_sendback_reuse,
+                             expected.pct_tx_with_sendback_reuse)
+        sequential_processor.database.close()
+        database.close()
+
+class BlockPrefetcherTestCase(unittest.TestCase):
+
+    #Later blocks are fetched faster, so they finish first
+    def fetch_block(self, block_height):
+        time.sleep(0.01 * (5 - block_height))
+        if block_height == 3:
+            raise ValueError('no block 3')
+        return 'block %d' % block_height
+
+    def test_get_in_order(self):
+        prefetcher = address_reuse.block_pipeline.BlockPrefetcher(
+            lambda: self.fetch_block, 0, 5, queue_depth = 3, num_workers = 3)
+        prefetcher.start()
+        try:
+            self.assertEqual(prefetcher.get(0), 'block 0')
+            self.assertEqual(prefetcher.get(1), 'block 1')
+            self.assertEqual(prefetcher.get(2), 'block 2')
+            self.assertRaises(ValueError, prefetcher.get, 3)
+            self.assertFalse(prefetcher.is_next(3))
+            self.assertEqual(prefetcher.get(4), 'block 4')
+            self.assertFalse(prefetcher.is_next(5))
+        finally:
+            prefetcher.stop()
+
 class WalletExplorerReaderTestCase(unittest.TestCase):
     
     database_connector  = None
@@ -517,7 +1191,223 @@ class WalletExplorerReaderTestCase(unittest.TestCase):
         self.assertIn('1NbrsBgcktga92XFbcNuCGaPc1BAJoydKP', addresses)
         self.assertIn('1AsiYDrudPY3yTGZ4ArdYeiCdP7297niqe', addresses)
 
+    def test_cache_label_for_all_wallet_addresses_net(self):
+        label = 'SomeExchange'
+        addresses = [address_reuse.benchmark.fake_bitcoind.get_fake_address(
+            1, tx_num, 0) for tx_num in range(0, 250)]
+        #WalletExplorer.com lists some addresses that aren't addresses
+        addresses.append('#multisig_a74f4a173bb335f7_1')
+        urlbuilder = address_reuse.blockchain_reader.WalletExplorerURLBuilder()
+        api_key = self.reader.config.WALLETEXPLORER_API_KEY
+        pages = {}
+        for offset in range(0, len(addresses), 100):
+            url = urlbuilder.get_wallet_addresses_at_offset(label, offset,
+                                                            api_key)
+            pages[url] = json.dumps({
+                'found': True, 'label': label,
+                'addresses_count': len(addresses),
+                'addresses': [{'address': address} for address in
+                              addresses[offset:offset + 100]]})
+        self.reader.set_prefetched_responses(pages)
+
+        batch_sizes = []
+        cache_labels = self.database_connector.cache_blame_label_for_btc_addresses
+        def record_batch(btc_addresses, blame_label):
+            batch_sizes.append(len(btc_addresses))
+            return cache_labels(btc_addresses, blame_label)
+        self.database_connector.cache_blame_label_for_btc_addresses = (
+            record_batch)
+        original_batch_size = (
+            address_reuse.blockchain_reader.WALLET_ADDRESS_CACHE_BATCH_SIZE)
+        address_reuse.blockchain_reader.WALLET_ADDRESS_CACHE_BATCH_SIZE = 150
+        try:
+            num_cached = self.reader.cache_label_for_all_wallet_addresses_net(
+                label)
+        finally:
+            address_reuse.blockchain_reader.WALLET_ADDRESS_CACHE_BATCH_SIZE = (
+                original_batch_size)
+
+        self.assertEqual(num_cached, 250)
+        #Written as the pages arrive, once a batch is full and at the end
+        self.assertEqual(batch_sizes, [200, 51])
+        self.assertEqual(len(self.reader.prefetched_responses), 0)
+        for address in [addresses[0], addresses[149], addresses[249]]:
+            self.assertEqual(
+                self.database_connector.get_blame_label_for_btc_address(
+                    address), label)
+
+    def test_cache_label_for_all_wallet_addresses_net_resumes(self):
+        label = 'SomeOtherExchange'
+        addresses = [address_reuse.benchmark.fake_bitcoind.get_fake_address(
+            2, tx_num, 0) for tx_num in range(0, 450)]
+        urlbuilder = address_reuse.blockchain_reader.WalletExplorerURLBuilder()
+        api_key = self.reader.config.WALLETEXPLORER_API_KEY
+        pages = {}
+        for offset in range(0, len(addresses), 100):
+            url = urlbuilder.get_wallet_addresses_at_offset(label, offset,
+                                                            api_key)
+            pages[url] = json.dumps({
+                'found': True, 'label': label,
+                'addresses_count': len(addresses),
+                'addresses': [{'address': address} for address in
+                              addresses[offset:offset + 100]]})
+
+        #The download is interrupted while writing the second batch
+        num_batches = [0]
+        cache_labels = self.database_connector.cache_blame_label_for_btc_addresses
+        def fail_second_batch(btc_addresses, blame_label):
+            num_batches[0] = num_batches[0] + 1
+            if num_batches[0] == 2:
+                raise KeyboardInterrupt
+            return cache_labels(btc_addresses, blame_label)
+        self.database_connector.cache_blame_label_for_btc_addresses = (
+            fail_second_batch)
+        original_batch_size = (
+            address_reuse.blockchain_reader.WALLET_ADDRESS_CACHE_BATCH_SIZE)
+        address_reuse.blockchain_reader.WALLET_ADDRESS_CACHE_BATCH_SIZE = 200
+        try:
+            self.reader.set_prefetched_responses(dict(pages))
+            with self.assertRaises(KeyboardInterrupt):
+                self.reader.cache_label_for_all_wallet_addresses_net(label)
+            self.assertEqual(
+                self.database_connector.get_wallet_download_progress(label),
+                (450, set([0, 100])))
+
+            #Resuming fetches only the pages not yet cached
+            self.reader.set_prefetched_responses(dict(pages))
+            num_cached = self.reader.cache_label_for_all_wallet_addresses_net(
+                label)
+        finally:
+            address_reuse.blockchain_reader.WALLET_ADDRESS_CACHE_BATCH_SIZE = (
+                original_batch_size)
+
+        self.assertEqual(num_cached, 250)
+        self.assertEqual(
+            sorted(self.reader.prefetched_responses),
+            sorted(urlbuilder.get_wallet_addresses_at_offset(label, offset,
+                                                             api_key)
+                   for offset in [0, 100]))
+        self.assertEqual(
+            self.database_connector.get_wallet_download_progress(label),
+            (None, set()))
+        for address in [addresses[0], addresses[250], addresses[449]]:
+            self.assertEqual(
+                self.database_connector.get_blame_label_for_btc_address(
+                    address), label)
+
+    def test_get_wallet_label_for_single_address_caches_not_found(self):
+        addr = '3J98t1WpEZ73CNmQviecrnyiWrnqRhWNLy'
+        urlbuilder = address_reuse.blockchain_reader.WalletExplorerURLBuilder()
+        url = urlbuilder.get_address_info(
+            addr, self.reader.config.WALLETEXPLORER_API_KEY)
+        placeholder = (
+            address_reuse.blockchain_reader.WALLET_EXPLORER_NOT_FOUND_PLACEHOLDER)
+        self.reader.set_prefetched_responses(
+            {url: json.dumps({'found': False})})
+        self.assertEqual(
+            self.reader.get_wallet_label_for_single_address(addr), placeholder)
+        self.assertEqual(self.reader.prefetched_responses, {})
+
+        #Not looked up again, nor prefetched
+        fetched_urls = []
+        http = address_reuse.blockchain_reader.http
+        original_fetch_url = http.fetch_url
+        def fetch_url(url, benchmarker = None, use_cache = True):
+            fetched_urls.append(url)
+            return json.dumps({'found': False})
+        http.fetch_url = fetch_url
+        try:
+            benchmarker = (
+                address_reuse.benchmark.block_reader_benchmark.Benchmark())
+            for _ in range(0, 2):
+                self.assertEqual(
+                    self.reader.get_wallet_label_for_single_address(
+                        addr, benchmarker), placeholder)
+            self.assertEqual(fetched_urls, [])
+            self.assertEqual(
+                benchmarker.wallet_explorer_not_found_cache_hits, 2)
+            self.assertEqual(self.reader.get_address_urls_to_prefetch([addr]),
+                             [])
+
+            #...until its entry expires
+            self.database_connector.cache_remote_lookup_not_found(
+                address_reuse.response_cache.remove_api_keys(url),
+                time.time() - 1)
+            self.reader.get_wallet_label_for_single_address(addr)
+            self.assertEqual(fetched_urls, [url])
+        finally:
+            http.fetch_url = original_fetch_url
+
+    def test_get_wallet_label_for_single_address_uncaches_not_found(self):
+        addr = '3J98t1WpEZ73CNmQviecrnyiWrnqRhWNLy'
+        urlbuilder = address_reuse.blockchain_reader.WalletExplorerURLBuilder()
+        url = urlbuilder.get_address_info(
+            addr, self.reader.config.WALLETEXPLORER_API_KEY)
+        temp_dir = tempfile.mkdtemp()
+        http = address_reuse.blockchain_reader.http
+        original_fetch_url_from_remote = http.fetch_url_from_remote
+        remote_responses = [json.dumps({'found': False}),
+                            json.dumps({'found': True, 'wallet_id': 'a1'})]
+        def fetch_url_from_remote(url):
+            return remote_responses.pop(0)
+        original_cache_all = (
+            address_reuse.blockchain_reader.CACHE_ALL_WALLET_ADDRESSES)
+        address_reuse.blockchain_reader.CACHE_ALL_WALLET_ADDRESSES = False
+        http.fetch_url_from_remote = fetch_url_from_remote
+        cache = address_reuse.response_cache.ResponseCache(
+            os.path.join(temp_dir, 'responses.db'))
+        http.response_cache_for_process = cache
+        http.is_response_cache_enabled = True
+        try:
+            self.assertEqual(
+                self.reader.get_wallet_label_for_single_address(addr),
+                address_reuse.blockchain_reader.
+                WALLET_EXPLORER_NOT_FOUND_PLACEHOLDER)
+            self.assertIsNone(cache.get(url))
+
+            #Once its not-found entry expires, the address is looked up again
+            self.database_connector.cache_remote_lookup_not_found(
+                address_reuse.response_cache.remove_api_keys(url),
+                time.time() - 1)
+            self.assertEqual(
+                self.reader.get_wallet_label_for_single_address(addr), 'a1')
+            self.assertEqual(remote_responses, [])
+        finally:
+            address_reuse.blockchain_reader.CACHE_ALL_WALLET_ADDRESSES = (
+                original_cache_all)
+            http.fetch_url_from_remote = original_fetch_url_from_remote
+            http.response_cache_for_process = None
+            http.is_response_cache_enabled = None
+            cache.close()
+            shutil.rmtree(temp_dir)
+
+    def test_get_json_from_response_uncaches_non_json(self):
+        url = address_reuse.blockchain_reader.WalletExplorerURLBuilder(
+            ).get_address_info('3J98t1WpEZ73CNmQviecrnyiWrnqRhWNLy',
+                               self.reader.config.WALLETEXPLORER_API_KEY)
+        response = '<html><body>Service unavailable</body></html>'
+        temp_dir = tempfile.mkdtemp()
+        http = address_reuse.blockchain_reader.http
+        cache = address_reuse.response_cache.ResponseCache(
+            os.path.join(temp_dir, 'responses.db'))
+        cache.put(url, response)
+        http.response_cache_for_process = cache
+        http.is_response_cache_enabled = True
+        try:
+            with self.assertRaises(SystemExit):
+                self.reader.get_json_from_response(url, response)
+            self.assertIsNone(cache.get(url))
+        finally:
+            http.response_cache_for_process = None
+            http.is_response_cache_enabled = None
+            cache.close()
+            shutil.rmtree(temp_dir)
+
 suite = unittest.TestLoader().loadTestsFromTestCase(
     LocalBlockchainRPCReaderTestCase)
 suite2 = unittest.TestLoader().loadTestsFromTestCase(
     WalletExplorerReaderTestCase)
+suite3 = unittest.TestLoader().loadTestsFromTestCase(
+    RawBlockFileReaderTestCase)
+suite4 = unittest.TestLoader().loadTestsFromTestCase(
+    BlockPrefetcherTestCase)
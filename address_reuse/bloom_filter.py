@@ -0,0 +1,153 @@
+"""An on-disk, memory-mapped Bloom filter.
+
+A Bloom filter answers set membership with no false negatives and a tunable
+rate of false positives, using a fixed amount of space. The bit array lives in
+a file that is memory-mapped, so the filter persists across runs and only the
+pages that are touched are read from disk.
+"""
+
+####################
+# EXTERNAL IMPORTS #
+####################
+
+import mmap
+import math
+import os
+import struct
+from hashlib import sha256
+
+#############
+# CONSTANTS #
+#############
+
+FILE_MAGIC = 'ARBF'
+FILE_FORMAT_VERSION = 1
+
+#magic, version, num_bits, num_hashes, num_items, synced_rowid
+HEADER_FORMAT = '<4sIQIQq'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+###########
+# CLASSES #
+###########
+
+class BloomFilter(object):
+    """A Bloom filter whose bit array is stored in a memory-mapped file.
+
+    If `filename` already contains a filter, it is opened as-is and the sizing
+    arguments are ignored. Otherwise a new, empty filter is created that is
+    sized to hold `expected_num_items` at a `false_positive_rate`.
+
+    Args:
+        filename (str): File in which the filter is stored.
+        expected_num_items (int): Number of items the filter is sized for.
+        false_positive_rate (float): Desired false positive rate when the
+            filter contains `expected_num_items` items.
+
+    Attributes:
+        filename (str): File in which the filter is stored.
+        num_bits (int): Size of the bit array.
+        num_hashes (int): Number of bits set per item.
+        num_items (int): Number of items that have been added.
+        synced_rowid (int): Opaque marker for callers to record how much of a
+            backing table has been added to the filter. Persisted in the file
+            header. -1 for a new filter.
+    """
+
+    def __init__(self, filename, expected_num_items, false_positive_rate):
+        self.filename = filename
+        self.is_new = not os.path.exists(filename)
+        if self.is_new:
+            num_bits, num_hashes = get_optimal_size(expected_num_items,
+                                                    false_positive_rate)
+            num_bytes = HEADER_SIZE + (num_bits + 7) // 8
+            with open(filename, 'wb') as new_file:
+                new_file.truncate(num_bytes)
+        self.file = open(filename, 'r+b')
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        if self.is_new:
+            self.num_bits = num_bits
+            self.num_hashes = num_hashes
+            self.num_items = 0
+            self.synced_rowid = -1
+            self._write_header()
+        else:
+            self._read_header()
+
+    def __contains__(self, key):
+        the_map = self.map
+        for bit in self._get_bit_positions(key):
+            byte_pos = HEADER_SIZE + (bit >> 3)
+            if not ord(the_map[byte_pos]) & (1 << (bit & 7)):
+                return False
+        return True
+
+    def add(self, key):
+        """Add a key (a byte string) to the filter."""
+        the_map = self.map
+        for bit in self._get_bit_positions(key):
+            byte_pos = HEADER_SIZE + (bit >> 3)
+            the_map[byte_pos] = chr(ord(the_map[byte_pos]) | (1 << (bit & 7)))
+        self.num_items = self.num_items + 1
+
+    def get_estimated_false_positive_rate(self):
+        """Expected false positive rate given the number of items added."""
+        return math.pow(1.0 - math.exp(-1.0 * self.num_hashes *
+                                       self.num_items / self.num_bits),
+                        self.num_hashes)
+
+    def clear(self):
+        """Unset all bits, e.g. before rebuilding the filter."""
+        num_bytes = len(self.map) - HEADER_SIZE
+        chunk_size = 1024 * 1024
+        for offset in range(0, num_bytes, chunk_size):
+            length = min(chunk_size, num_bytes - offset)
+            self.map[HEADER_SIZE + offset:HEADER_SIZE + offset + length] = (
+                '\x00' * length)
+        self.num_items = 0
+        self.synced_rowid = -1
+
+    def flush(self):
+        """Write the header and any dirty pages to disk."""
+        self._write_header()
+        self.map.flush()
+
+    def close(self):
+        self.flush()
+        self.map.close()
+        self.file.close()
+
+    def _get_bit_positions(self, key):
+        """Double hashing: bit i is (h1 + i * h2) mod num_bits."""
+        digest = sha256(key).digest()
+        hash1, hash2 = struct.unpack('<QQ', digest[:16])
+        num_bits = self.num_bits
+        return [(hash1 + i * hash2) % num_bits
+                for i in xrange(self.num_hashes)]
+
+    def _read_header(self):
+        (magic, version, self.num_bits, self.num_hashes, self.num_items,
+         self.synced_rowid) = struct.unpack(HEADER_FORMAT,
+                                            self.map[:HEADER_SIZE])
+        if magic != FILE_MAGIC or version != FILE_FORMAT_VERSION:
+            raise ValueError("'%s' is not a Bloom filter file." % self.filename)
+
+    def _write_header(self):
+        self.map[:HEADER_SIZE] = struct.pack(
+            HEADER_FORMAT, FILE_MAGIC, FILE_FORMAT_VERSION, self.num_bits,
+            self.num_hashes, self.num_items, self.synced_rowid)
+
+#############
+# FUNCTIONS #
+#############
+
+def get_optimal_size(expected_num_items, false_positive_rate):
+    """Get (num_bits, num_hashes) for the desired capacity and error rate."""
+    assert expected_num_items > 0
+    assert 0.0 < false_positive_rate < 1.0
+    num_bits = int(math.ceil(-1.0 * expected_num_items *
+                             math.log(false_positive_rate) /
+                             (math.log(2) ** 2)))
+    num_hashes = max(1, int(round(1.0 * num_bits / expected_num_items *
+                                  math.log(2))))
+    return (num_bits, num_hashes)
@@ -10,6 +10,7 @@
 
 import ConfigParser         # Configuration file
 import sys                  # sys.exit
+import os                   # expanding ~ in paths
 from enum import IntEnum    #
 
 #TODO: only used for logging. We can remove these if we figure out how to
@@ -24,6 +25,58 @@ import datetime
 
 CONFIG_FILENAME = 'address_reuse.cfg'
 
+#Settings in the optional [SQLite] section of the config file. A setting that
+#   is missing or left blank is not applied, leaving SQLite's own default,
+#   except for journal_mode, which defaults to what the database has always
+#   used.
+DEFAULT_SQLITE_JOURNAL_MODE = 'TRUNCATE'
+SQLITE_JOURNAL_MODES = ['DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL',
+                        'OFF']
+SQLITE_SYNCHRONOUS_MODES = ['OFF', 'NORMAL', 'FULL', 'EXTRA']
+SQLITE_TEMP_STORE_MODES = ['DEFAULT', 'FILE', 'MEMORY']
+SQLITE_CHECKPOINT_MODES = ['PASSIVE', 'FULL', 'RESTART', 'TRUNCATE']
+DEFAULT_SQLITE_CHECKPOINT_MODE = 'PASSIVE'
+
+#Number of calls sent per JSON-RPC batch request to bitcoind by the optional
+#   rpc_batch_size setting in the [RPC] section. 1 sends every call in its own
+#   request.
+DEFAULT_RPC_BATCH_SIZE = 100
+
+#Requests http.fetch_url() may make to a host in a burst, and the file in
+#   which processes share the state of the rate limit, set by the optional
+#   max_burst_requests and rate_limit_state_filename settings in the [API]
+#   section. The rate itself is set by max_requests_per_sec, or per host in
+#   the [APIRateLimitPerHost] section, and is unlimited by default.
+DEFAULT_RATE_LIMIT_BURST = 1
+DEFAULT_RATE_LIMIT_STATE_FILENAME = 'rate_limit.db'
+
+#Connections to each host that http.fetch_url() keeps open for reuse, set by
+#   the optional max_connections_per_host setting in the [HTTP] section.
+DEFAULT_HTTP_MAX_CONNECTIONS_PER_HOST = 4
+
+#Requests made at once when looking up the remote data for a block's deferred
+#   blame records, set by the optional max_concurrent_requests setting in the
+#   [HTTP] section. 1 makes one request at a time.
+DEFAULT_HTTP_MAX_CONCURRENT_REQUESTS = 4
+
+#Size of the on-disk cache of API responses, set by the optional
+#   response_cache_max_mb setting in the [HTTP] section. The cache itself is
+#   enabled by response_cache_filename, and is disabled by default.
+DEFAULT_HTTP_RESPONSE_CACHE_MAX_MB = 1024
+
+#Blocks fetched ahead of the one being processed, and threads fetching them,
+#   set by the optional prefetch_queue_depth and prefetch_num_workers settings
+#   in the [General] section. A queue depth of 0 disables prefetching.
+DEFAULT_PREFETCH_QUEUE_DEPTH = 8
+DEFAULT_PREFETCH_NUM_WORKERS = 2
+
+#Worker processes, and blocks per unit of work, used by
+#   update_using_local_blockchain_in_parallel.py, set by the optional
+#   parallel_num_workers and parallel_range_size settings in the [General]
+#   section.
+DEFAULT_PARALLEL_NUM_WORKERS = 4
+DEFAULT_PARALLEL_RANGE_SIZE = 1000
+
 #########
 # ENUMS #
 #########
@@ -51,12 +104,36 @@ class Config:
     SQLITE_DB_LOCAL_FILENAME            = None
     BLOCKCHAIN_INFO_API_KEY             = None
     WALLETEXPLORER_API_KEY              = None
-    API_NUM_SEC_SLEEP                   = None #Sleep this many seconds between HTTP requests
+    API_NUM_SEC_SLEEP                   = None #1 / default requests per sec
+    RATE_LIMIT_REQUESTS_PER_SEC         = None #per host, None = unlimited
+    RATE_LIMIT_REQUESTS_PER_SEC_BY_HOST = None #dict, overrides the above
+    RATE_LIMIT_BURST                    = DEFAULT_RATE_LIMIT_BURST
+    RATE_LIMIT_STATE_FILENAME           = DEFAULT_RATE_LIMIT_STATE_FILENAME
     MAX_NUM_BLOCKS_TO_PROCESS_PER_RUN   = None
+    PREFETCH_QUEUE_DEPTH                = DEFAULT_PREFETCH_QUEUE_DEPTH
+    PREFETCH_NUM_WORKERS                = DEFAULT_PREFETCH_NUM_WORKERS
+    PARALLEL_NUM_WORKERS                = DEFAULT_PARALLEL_NUM_WORKERS
+    PARALLEL_RANGE_SIZE                 = DEFAULT_PARALLEL_RANGE_SIZE
     RPC_USERNAME                        = None
     RPC_PASSWORD                        = None
     RPC_HOST                            = None
     RPC_PORT                            = None
+    RPC_BATCH_SIZE                      = DEFAULT_RPC_BATCH_SIZE
+    BLOCKS_DIR                          = None #bitcoind's blk*.dat files
+    HTTP_MAX_CONNECTIONS_PER_HOST       = DEFAULT_HTTP_MAX_CONNECTIONS_PER_HOST
+    HTTP_MAX_CONCURRENT_REQUESTS        = DEFAULT_HTTP_MAX_CONCURRENT_REQUESTS
+    HTTP_RESPONSE_CACHE_FILENAME        = None #None = no response cache
+    HTTP_RESPONSE_CACHE_TTL_SEC         = None #None = never expire
+    HTTP_RESPONSE_CACHE_MAX_MB          = DEFAULT_HTTP_RESPONSE_CACHE_MAX_MB
+    SQLITE_JOURNAL_MODE                 = DEFAULT_SQLITE_JOURNAL_MODE
+    SQLITE_SYNCHRONOUS                  = None
+    SQLITE_CACHE_SIZE                   = None #pages, or KiB if negative
+    SQLITE_MMAP_SIZE                    = None #bytes
+    SQLITE_TEMP_STORE                   = None
+    SQLITE_BUSY_TIMEOUT                 = None #milliseconds
+    SQLITE_WAL_AUTOCHECKPOINT           = None #pages, 0 disables
+    SQLITE_CHECKPOINT_INTERVAL_BLOCKS   = None #blocks between checkpoints
+    SQLITE_CHECKPOINT_MODE              = DEFAULT_SQLITE_CHECKPOINT_MODE
     
     config_parser                       = None
     
@@ -99,8 +176,28 @@ class Config:
                         'API','blockchain_info_api_key')
                     self.WALLETEXPLORER_API_KEY = self.config_parser.get(
                         'API','walletexplorer_api_key')
-                    self.API_NUM_SEC_SLEEP = self.config_parser.get(
-                        'API','api_num_sec_sleep')
+                    try:
+                        self.API_NUM_SEC_SLEEP = float(self.config_parser.get(
+                            'API','api_num_sec_sleep'))
+                    except ValueError:
+                        log_and_die('Invalid format for api_num_sec_sleep in '
+                                    'config file.')
+                    self.RATE_LIMIT_REQUESTS_PER_SEC = self.get_optional_float(
+                        'API', 'max_requests_per_sec')
+                    self.RATE_LIMIT_BURST = self.get_optional_int(
+                        'API', 'max_burst_requests', DEFAULT_RATE_LIMIT_BURST)
+                    state_filename = self.get_optional(
+                        'API', 'rate_limit_state_filename')
+                    if state_filename is not None:
+                        self.RATE_LIMIT_STATE_FILENAME = state_filename
+                    if self.RATE_LIMIT_BURST < 1:
+                        log_and_die('max_burst_requests must be at least 1.')
+
+                elif section_name == 'APIRateLimitPerHost':
+                    self.RATE_LIMIT_REQUESTS_PER_SEC_BY_HOST = {}
+                    for host in self.config_parser.options(section_name):
+                        self.RATE_LIMIT_REQUESTS_PER_SEC_BY_HOST[host] = (
+                            self.get_optional_float(section_name, host))
                     
                 elif section_name == 'RPC':
                     self.RPC_USERNAME = self.config_parser.get('RPC',
@@ -109,7 +206,45 @@ class Config:
                                                                'rpc_password')
                     self.RPC_HOST = self.config_parser.get('RPC','rpc_host')
                     self.RPC_PORT = self.config_parser.get('RPC','rpc_port')
+                    self.RPC_BATCH_SIZE = self.get_optional_int(
+                        'RPC', 'rpc_batch_size', DEFAULT_RPC_BATCH_SIZE)
+                    if self.RPC_BATCH_SIZE < 1:
+                        log_and_die('rpc_batch_size must be at least 1.')
                     
+                elif section_name == 'BlockFiles':
+                    blocks_dir = self.get_optional('BlockFiles', 'blocks_dir')
+                    if blocks_dir is not None:
+                        self.BLOCKS_DIR = os.path.expanduser(blocks_dir)
+
+                elif section_name == 'HTTP':
+                    self.HTTP_MAX_CONNECTIONS_PER_HOST = self.get_optional_int(
+                        'HTTP', 'max_connections_per_host',
+                        DEFAULT_HTTP_MAX_CONNECTIONS_PER_HOST)
+                    if self.HTTP_MAX_CONNECTIONS_PER_HOST < 1:
+                        log_and_die('max_connections_per_host must be at '
+                                    'least 1.')
+                    self.HTTP_MAX_CONCURRENT_REQUESTS = self.get_optional_int(
+                        'HTTP', 'max_concurrent_requests',
+                        DEFAULT_HTTP_MAX_CONCURRENT_REQUESTS)
+                    if self.HTTP_MAX_CONCURRENT_REQUESTS < 1:
+                        log_and_die('max_concurrent_requests must be at '
+                                    'least 1.')
+                    self.HTTP_RESPONSE_CACHE_FILENAME = self.get_optional(
+                        'HTTP', 'response_cache_filename')
+                    self.HTTP_RESPONSE_CACHE_TTL_SEC = self.get_optional_float(
+                        'HTTP', 'response_cache_ttl_sec')
+                    self.HTTP_RESPONSE_CACHE_MAX_MB = self.get_optional_float(
+                        'HTTP', 'response_cache_max_mb',
+                        DEFAULT_HTTP_RESPONSE_CACHE_MAX_MB)
+                    if (self.HTTP_RESPONSE_CACHE_TTL_SEC is not None and
+                            self.HTTP_RESPONSE_CACHE_TTL_SEC <= 0):
+                        log_and_die('response_cache_ttl_sec must be positive.')
+                    if self.HTTP_RESPONSE_CACHE_MAX_MB <= 0:
+                        log_and_die('response_cache_max_mb must be positive.')
+
+                elif section_name == 'SQLite':
+                    self.read_sqlite_constants()
+
                 elif section_name == 'General':
                     try:
                         self.MAX_NUM_BLOCKS_TO_PROCESS_PER_RUN = int(
@@ -119,8 +254,125 @@ class Config:
                         msg = ('Invalid format for max_num_blocks_to_process_'
                                'per_run in config file.')
                         log_and_die(msg)
+                    self.PREFETCH_QUEUE_DEPTH = self.get_optional_int(
+                        'General', 'prefetch_queue_depth',
+                        DEFAULT_PREFETCH_QUEUE_DEPTH)
+                    self.PREFETCH_NUM_WORKERS = self.get_optional_int(
+                        'General', 'prefetch_num_workers',
+                        DEFAULT_PREFETCH_NUM_WORKERS)
+                    if self.PREFETCH_QUEUE_DEPTH < 0:
+                        log_and_die('prefetch_queue_depth must not be '
+                                    'negative.')
+                    if self.PREFETCH_NUM_WORKERS < 1:
+                        log_and_die('prefetch_num_workers must be at least 1.')
+                    self.PARALLEL_NUM_WORKERS = self.get_optional_int(
+                        'General', 'parallel_num_workers',
+                        DEFAULT_PARALLEL_NUM_WORKERS)
+                    self.PARALLEL_RANGE_SIZE = self.get_optional_int(
+                        'General', 'parallel_range_size',
+                        DEFAULT_PARALLEL_RANGE_SIZE)
+                    if self.PARALLEL_NUM_WORKERS < 1:
+                        log_and_die('parallel_num_workers must be at least 1.')
+                    if self.PARALLEL_RANGE_SIZE < 1:
+                        log_and_die('parallel_range_size must be at least 1.')
         except ConfigParser.NoOptionError as e:
             log_and_die("Invalid config file: '%s'" % str(e))
+
+        #api_num_sec_sleep predates max_requests_per_sec
+        if (self.RATE_LIMIT_REQUESTS_PER_SEC is None and
+                self.API_NUM_SEC_SLEEP > 0):
+            self.RATE_LIMIT_REQUESTS_PER_SEC = 1.0 / self.API_NUM_SEC_SLEEP
+        for requests_per_sec in ([self.RATE_LIMIT_REQUESTS_PER_SEC] +
+                                 (self.RATE_LIMIT_REQUESTS_PER_SEC_BY_HOST or
+                                  {}).values()):
+            if requests_per_sec is not None and requests_per_sec <= 0:
+                log_and_die('API request rates must be positive.')
+
+    #All options in the [SQLite] section are optional.
+    def read_sqlite_constants(self):
+        self.SQLITE_JOURNAL_MODE = self.get_optional_choice(
+            'SQLite', 'journal_mode', SQLITE_JOURNAL_MODES,
+            DEFAULT_SQLITE_JOURNAL_MODE)
+        self.SQLITE_SYNCHRONOUS = self.get_optional_choice(
+            'SQLite', 'synchronous', SQLITE_SYNCHRONOUS_MODES)
+        self.SQLITE_CACHE_SIZE = self.get_optional_int('SQLite', 'cache_size')
+        self.SQLITE_MMAP_SIZE = self.get_optional_int('SQLite', 'mmap_size')
+        self.SQLITE_TEMP_STORE = self.get_optional_choice(
+            'SQLite', 'temp_store', SQLITE_TEMP_STORE_MODES)
+        self.SQLITE_BUSY_TIMEOUT = self.get_optional_int('SQLite',
+                                                         'busy_timeout')
+        self.SQLITE_WAL_AUTOCHECKPOINT = self.get_optional_int(
+            'SQLite', 'wal_autocheckpoint')
+        self.SQLITE_CHECKPOINT_INTERVAL_BLOCKS = self.get_optional_int(
+            'SQLite', 'checkpoint_interval_blocks')
+        self.SQLITE_CHECKPOINT_MODE = self.get_optional_choice(
+            'SQLite', 'checkpoint_mode', SQLITE_CHECKPOINT_MODES,
+            DEFAULT_SQLITE_CHECKPOINT_MODE)
+
+    #Returns None if the option is missing or blank.
+    def get_optional(self, section_name, option_name):
+        if not self.config_parser.has_option(section_name, option_name):
+            return None
+        value = self.config_parser.get(section_name, option_name).strip()
+        if value == '':
+            return None
+        return value
+
+    def get_optional_int(self, section_name, option_name, default = None):
+        value = self.get_optional(section_name, option_name)
+        if value is None:
+            return default
+        try:
+            return int(value)
+        except ValueError:
+            msg = ('Invalid format for %s in [%s] section of config file.' %
+                   (option_name, section_name))
+            log_and_die(msg)
+
+    def get_optional_float(self, section_name, option_name, default = None):
+        value = self.get_optional(section_name, option_name)
+        if value is None:
+            return default
+        try:
+            return float(value)
+        except ValueError:
+            msg = ('Invalid format for %s in [%s] section of config file.' %
+                   (option_name, section_name))
+            log_and_die(msg)
+
+    def get_optional_choice(self, section_name, option_name, choices,
+                            default = None):
+        value = self.get_optional(section_name, option_name)
+        if value is None:
+            return default
+        value = value.upper()
+        if value not in choices:
+            msg = (("Invalid value for %s in [%s] section of config file: "
+                    "'%s'. Must be one of: %s") %
+                   (option_name, section_name, value, ', '.join(choices)))
+            log_and_die(msg)
+        return value
+
+    #Returns a list of (pragma name, value) tuples to apply to each new
+    #   connection to the main database, in order.
+    def get_sqlite_pragmas(self):
+        pragmas = []
+        #busy_timeout first so the other PRAGMAs wait on a locked database too
+        if self.SQLITE_BUSY_TIMEOUT is not None:
+            pragmas.append(('busy_timeout', self.SQLITE_BUSY_TIMEOUT))
+        pragmas.append(('journal_mode', self.SQLITE_JOURNAL_MODE))
+        if self.SQLITE_SYNCHRONOUS is not None:
+            pragmas.append(('synchronous', self.SQLITE_SYNCHRONOUS))
+        if self.SQLITE_CACHE_SIZE is not None:
+            pragmas.append(('cache_size', self.SQLITE_CACHE_SIZE))
+        if self.SQLITE_MMAP_SIZE is not None:
+            pragmas.append(('mmap_size', self.SQLITE_MMAP_SIZE))
+        if self.SQLITE_TEMP_STORE is not None:
+            pragmas.append(('temp_store', self.SQLITE_TEMP_STORE))
+        if self.SQLITE_WAL_AUTOCHECKPOINT is not None:
+            pragmas.append(('wal_autocheckpoint',
+                            self.SQLITE_WAL_AUTOCHECKPOINT))
+        return pragmas
         
 #############
 # FUNCTIONS #
@@ -10,3 +10,5 @@ class NotFoundAtRemoteAPIError(Exception):
     None
 class TooManyDatabaseErrors(Exception):
     None
+class DatabaseLockedInBlockTransactionError(Exception):
+    None
@@ -159,4 +159,28 @@ class TxOutputAddressCacheSubscriber(DataSubscriber):
     def get_output_address(self, tx_id, output_pos):
         addr = self.database.get_output_address(tx_id, output_pos)
         return addr
-    
\ No newline at end of file
+    
+#Waits for a whole set of tx outputs to be cached at once, e.g. every output
+#   spent in a block, rather than one output at a time.
+class TxOutputAddressSetCacheSubscriber(DataSubscriber):
+    
+    output_keys_needed  = None
+    output_addresses    = None
+    
+    #param1: output_keys_needed: List of (tx_id, output_pos) tuples
+    def __init__(self, database, output_keys_needed, 
+                 sleep_time = DEFAULT_SLEEP_TIME_IN_SEC):
+        DataSubscriber.__init__(self, database = database, 
+                                sleep_time = sleep_time) #super
+        self.output_keys_needed = list(output_keys_needed)
+        self.output_addresses = {}
+    
+    #Returns whether every output needed has been cached. Outputs found so far
+    #   are collected in output_addresses, and only the rest are looked up on
+    #   the next call.
+    def are_producers_ready(self):
+        found = self.database.get_output_addresses(self.output_keys_needed)
+        self.output_addresses.update(found)
+        self.output_keys_needed = [key for key in self.output_keys_needed
+                                   if key not in found]
+        return len(self.output_keys_needed) == 0
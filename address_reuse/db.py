@@ -10,6 +10,11 @@ import string
 import tx_blame
 import data_subscription
 import custom_errors
+import seen_address_index
+import bloom_filter
+import base58
+import intern_table
+import lru_cache
 
 ####################
 # EXTERNAL IMPORTS #
@@ -18,10 +23,14 @@ import custom_errors
 import sqlite3
 from enum import IntEnum
 from collections import OrderedDict, deque
+from contextlib import contextmanager
 from cgi import escape
 from copy import deepcopy
-from time import sleep
+from time import sleep, time
+from random import uniform
+from binascii import hexlify, unhexlify
 from os import getpid
+from os.path import exists
 
 #############
 # CONSTANTS #
@@ -45,13 +54,23 @@ FETCH_DEFERRED_RECORDS_IN_BATCH     = True  #TODO: move flag to config file?
 #   real	6m52.341s, user	5m31.745s, sys	0m28.268s
 FETCH_N_DEFERRED_RECORDS_IN_BATCH   = 200000 #TODO: move setting to config file?
 
-#If sqlite3 encounters an exception, try again this many times. Each time, the
-#   waiting function will sleep for an incremented number of seconds a total of
-#   n^2/2 seconds. This value is high because there may be multiple
-#   threads/processes operating on the same database file, and some query
-#   operations take a long time (up to 7 min) resulting in a locked database
-#   for other workers that want to modify that table.
+#If a statement fails because another process holds a lock on the database,
+#   try it this many times in total. SQLite's busy handler already waits up to
+#   the busy timeout for the lock on each attempt; between attempts we back off
+#   exponentially with jitter, starting at DB_LOCK_BACKOFF_MIN_SEC and capped
+#   at DB_LOCK_BACKOFF_MAX_SEC. This value is high because there may be
+#   multiple threads/processes operating on the same database file, and some
+#   query operations take a long time (up to 7 min) resulting in a locked
+#   database for other workers that want to modify that table. Any other error
+#   is not retried.
 NUM_ATTEMPTS_UPON_DB_ERROR = 50
+DB_LOCK_BACKOFF_MIN_SEC = 0.01
+DB_LOCK_BACKOFF_MAX_SEC = 2.0
+
+#Seconds SQLite's busy handler waits for a lock before a statement fails with
+#   "database is locked". For `Database`, `busy_timeout` in the config file
+#   takes precedence.
+SQLITE_BUSY_TIMEOUT_SEC = 5.0
 
 #Batch INSERT blame stats only once per block as a batch, rather than once per
 #   TX
@@ -65,9 +84,58 @@ UPDATE_BLAME_STATS_ONCE_PER_BLOCK = True
 #   TX.
 DELETE_BLAME_STATS_ONCE_PER_BLOCK = True
 
+#Answer "has this address been seen before?" from an in-process index that is
+#   loaded from the seen addresses table once, rather than with a SELECT and
+#   an INSERT per output address. New addresses are written to the table in
+#   one batch per block; see write_stored_seen_addresses().
+USE_IN_MEMORY_SEEN_ADDRESS_INDEX = True #TODO: move flag to config file?
+
+#Number of rows fetched at a time while loading the seen address index
+LOAD_SEEN_ADDRESS_INDEX_N_ROWS_AT_A_TIME = 100000
+
+#When the in-memory seen address index is disabled, consult an on-disk Bloom
+#   filter before the seen addresses table. Most output addresses are new, and
+#   a negative answer from the filter is definitive, so most lookups skip
+#   SQLite entirely. The filter is stored next to the database file, persists
+#   across runs, and is rebuilt from the table if it is missing.
+USE_SEEN_ADDRESS_BLOOM_FILTER = False #TODO: move flag to config file?
+SEEN_ADDRESS_BLOOM_FILTER_FILENAME_SUFFIX = '.seen.bloom'
+#Defaults size the filter at roughly 240MB.
+SEEN_ADDRESS_BLOOM_FILTER_EXPECTED_NUM_ITEMS = 200000000
+SEEN_ADDRESS_BLOOM_FILTER_FALSE_POSITIVE_RATE = 0.01
+
+#Keep the labels of the most recently looked up addresses in memory, in front
+#   of the blame label cache table. Writes that change a label already in the
+#   table increment a generation counter stored in the database; each process
+#   reads the counter once per block transaction and empties its in-memory
+#   labels when another process has changed it. See
+#   get_blame_label_for_btc_address().
+USE_IN_MEMORY_BLAME_LABEL_CACHE = True #TODO: move flag to config file?
+BLAME_LABEL_LRU_CACHE_SIZE = 100000 #TODO: move setting to config file?
+
 #SQLite limits the number of terms in a compound SELECT statement:
 #   http://www.sqlite.org/limits.html
 SQLITE_MAX_COMPOUND_SELECT = 500
+#...and the number of host parameters in a single statement.
+SQLITE_MAX_VARIABLE_NUMBER = 999
+
+#Schema version used when a new database file is created. Version 2 stores
+#   txids and addresses in the high-volume tables as BLOBs; version 3 stores
+#   integer ids referencing dictionary tables instead; version 4 stores each
+#   wallet cluster's label once, in a table of clusters. See the table
+#   definitions below. An existing file keeps the version recorded in its
+#   `user_version` PRAGMA, and can be converted with migrate_db_schema.py.
+#   WITHOUT ROWID tables require SQLite 3.8.2 or higher.
+DEFAULT_SCHEMA_VERSION = 1 #TODO: move setting to config file?
+LATEST_SCHEMA_VERSION = 4
+
+#Number of address <-> id and txid <-> id mappings cached in memory in each
+#   direction in schema version 3.
+INTERN_CACHE_SIZE = 1000000 #TODO: move setting to config file?
+
+#Number of label <-> cluster id mappings cached in memory in each direction
+#   in schema version 4.
+WALLET_CLUSTER_CACHE_SIZE = 100000 #TODO: move setting to config file?
 
 ENABLE_DEBUG_PRINT = True
 
@@ -140,6 +208,14 @@ SQL_SCHEMA_BLAME_LABEL_CACHE_WITH_CONSTRAINTS = deepcopy(
 #Addresses never get more than one wallet cluster label.
 SQL_SCHEMA_BLAME_LABEL_CACHE_WITH_CONSTRAINTS['UNIQUE (btc_address)'] = ''
 
+#A single row whose generation is incremented whenever a label already in the
+#   blame label cache is changed, so that processes holding labels in memory
+#   can tell when to discard them.
+SQL_TABLE_NAME_BLAME_LABEL_GENERATION = 'tblBlameLabelGeneration'
+SQL_SCHEMA_BLAME_LABEL_GENERATION = OrderedDict()
+SQL_SCHEMA_BLAME_LABEL_GENERATION['id']                     = 'INTEGER PRIMARY KEY'
+SQL_SCHEMA_BLAME_LABEL_GENERATION['generation']             = 'INTEGER NOT NULL'
+
 #A stateful list of addresses that we've seen so far while processing the
 #   blockchain. This is used as a fast way to determine whether an output
 #   address we are considering has a prior tx history.
@@ -182,6 +258,74 @@ SQL_SCHEMA_TX_OUTPUT_CACHE_WITH_CONSTRAINTS = deepcopy(
 SQL_SCHEMA_TX_OUTPUT_CACHE_WITH_CONSTRAINTS[
     'UNIQUE (tx_id, output_pos, address)'] = ''
 
+#Unspent outputs spilled from `utxo_cache.UTXOCache` when it is full. Rows are
+#   deleted as the outputs are spent. txids and addresses are always stored in
+#   their schema version 2 form, whatever the database's version.
+SQL_TABLE_NAME_UTXO_SPILL = 'tblUTXOSpill'
+SQL_SCHEMA_UTXO_SPILL = OrderedDict()
+SQL_SCHEMA_UTXO_SPILL['tx_id']                              = 'BLOB NOT NULL'
+SQL_SCHEMA_UTXO_SPILL['output_pos']                         = 'INTEGER NOT NULL'
+SQL_SCHEMA_UTXO_SPILL['address']                            = 'BLOB'
+SQL_SCHEMA_UTXO_SPILL['PRIMARY KEY (tx_id, output_pos)']    = ''
+
+#Position at which each address first received funds: its block, the index
+#   of the tx within the block, and the output's index within the tx. Lets
+#   blocks be processed out of order once the index covers them; see the
+#   first_seen_index module. Addresses are stored as the key
+#   seen_address_index.get_address_key() gives them, whatever the database's
+#   version.
+SQL_TABLE_NAME_FIRST_SEEN = 'tblFirstSeen'
+SQL_SCHEMA_FIRST_SEEN = OrderedDict()
+SQL_SCHEMA_FIRST_SEEN['address']                            = 'BLOB NOT NULL'
+SQL_SCHEMA_FIRST_SEEN['block_height']                       = 'INTEGER NOT NULL'
+SQL_SCHEMA_FIRST_SEEN['tx_index']                           = 'INTEGER NOT NULL'
+SQL_SCHEMA_FIRST_SEEN['output_pos']                         = 'INTEGER NOT NULL'
+SQL_SCHEMA_FIRST_SEEN['PRIMARY KEY (address)']              = ''
+
+#Single row holding the height of the first block not yet in tblFirstSeen
+SQL_TABLE_NAME_FIRST_SEEN_PROGRESS = 'tblFirstSeenProgress'
+SQL_SCHEMA_FIRST_SEEN_PROGRESS = OrderedDict()
+SQL_SCHEMA_FIRST_SEEN_PROGRESS['next_block_height']         = 'INTEGER NOT NULL'
+
+#One row per range of blocks processed in a staging database and merged into
+#   this one by first_seen_index.process_blocks_in_parallel(), recording the
+#   worker process's throughput.
+SQL_TABLE_NAME_PARALLEL_RANGE_STATS = 'tblParallelRangeStats'
+SQL_SCHEMA_PARALLEL_RANGE_STATS = OrderedDict()
+SQL_SCHEMA_PARALLEL_RANGE_STATS['start_height']             = 'INTEGER NOT NULL'
+SQL_SCHEMA_PARALLEL_RANGE_STATS['end_height']               = 'INTEGER NOT NULL'
+SQL_SCHEMA_PARALLEL_RANGE_STATS['num_blocks']               = 'INTEGER NOT NULL'
+SQL_SCHEMA_PARALLEL_RANGE_STATS['num_txs']                  = 'INTEGER NOT NULL'
+SQL_SCHEMA_PARALLEL_RANGE_STATS['worker_pid']               = 'INTEGER NOT NULL'
+SQL_SCHEMA_PARALLEL_RANGE_STATS['seconds']                  = 'REAL NOT NULL'
+
+#Remote API lookups, by url without its API key, that recently found nothing,
+#   e.g. addresses that WalletExplorer.com can't cluster. A lookup isn't
+#   repeated until its entry expires.
+SQL_TABLE_NAME_NOT_FOUND_CACHE = 'tblNotFoundCache'
+SQL_SCHEMA_NOT_FOUND_CACHE = OrderedDict()
+SQL_SCHEMA_NOT_FOUND_CACHE['lookup']                        = 'TEXT NOT NULL PRIMARY KEY'
+SQL_SCHEMA_NOT_FOUND_CACHE['expires_at']                    = 'REAL NOT NULL'
+
+#One row per page of a wallet cluster's addresses whose labels have been
+#   cached by WalletExplorerReader.cache_label_for_all_wallet_addresses_net(),
+#   so that an interrupted download of a large wallet can resume. A wallet's
+#   rows are deleted once all of its pages have been cached.
+SQL_TABLE_NAME_WALLET_DOWNLOAD_PROGRESS = 'tblWalletDownloadProgress'
+SQL_SCHEMA_WALLET_DOWNLOAD_PROGRESS = OrderedDict()
+SQL_SCHEMA_WALLET_DOWNLOAD_PROGRESS['label']                = 'TEXT NOT NULL'
+SQL_SCHEMA_WALLET_DOWNLOAD_PROGRESS['page_offset']          = 'INTEGER NOT NULL'
+SQL_SCHEMA_WALLET_DOWNLOAD_PROGRESS['addresses_count']      = 'INTEGER NOT NULL'
+SQL_SCHEMA_WALLET_DOWNLOAD_PROGRESS['PRIMARY KEY (label, page_offset)'] = ''
+
+#Per-connection scratch table listing the outputs whose addresses are being
+#   looked up in bulk, for get_output_addresses() to join against.
+SQL_TABLE_NAME_OUTPUT_KEYS_NEEDED = 'temp.tblOutputKeysNeeded'
+SQL_SCHEMA_OUTPUT_KEYS_NEEDED = OrderedDict()
+SQL_SCHEMA_OUTPUT_KEYS_NEEDED['key_index']                  = 'INTEGER PRIMARY KEY'
+SQL_SCHEMA_OUTPUT_KEYS_NEEDED['tx_id']                      = 'BLOB'
+SQL_SCHEMA_OUTPUT_KEYS_NEEDED['output_pos']                 = 'INTEGER'
+
 #Used to coordinate efforts between producers and subscribers of block-related
 #   data.
 SQL_TABLE_NAME_BLOCK_DATA_PRODUCTION_STATUS = 'tblBlockDataProductionStatus'
@@ -190,6 +334,99 @@ SQL_SCHEMA_BLOCK_DATA_PRODUCTION_STATUS = OrderedDict()
 SQL_SCHEMA_BLOCK_DATA_PRODUCTION_STATUS['producer_id']      = 'INTEGER'
 SQL_SCHEMA_BLOCK_DATA_PRODUCTION_STATUS['top_block_height_available'] = 'INTEGER'
 
+#Schema version 2: txids are stored as their 32 raw bytes and addresses as the
+#   21-byte version byte + hash160 they decode to, rather than as 64-char hex
+#   and Base58 TEXT. Values that can't be encoded (e.g. the deferred blame
+#   placeholder) are stored as TEXT in the same column. Encoding and decoding
+#   happen in the Database accessors, so callers see the same values under
+#   either version. Other tables are the same as in version 1.
+
+SQL_SCHEMA_BLAME_STATS_V2 = deepcopy(SQL_SCHEMA_BLAME_STATS)
+SQL_SCHEMA_BLAME_STATS_V2['confirmed_tx_id']                = 'BLOB'
+SQL_SCHEMA_BLAME_STATS_V2['relevant_address']               = 'BLOB'
+
+#Keeps its rowid, which the seen address Bloom filter uses to sync.
+SQL_SCHEMA_ADDRESSES_SEEN_V2_WITH_CONSTRAINTS = deepcopy(
+    SQL_SCHEMA_ADDRESSES_SEEN_WITH_CONSTRAINTS)
+SQL_SCHEMA_ADDRESSES_SEEN_V2_WITH_CONSTRAINTS['address']    = 'BLOB'
+
+#Created WITHOUT ROWID, so that the primary key is the table's only b-tree.
+SQL_SCHEMA_RELAYED_BY_CACHE_V2_WITH_CONSTRAINTS = OrderedDict()
+SQL_SCHEMA_RELAYED_BY_CACHE_V2_WITH_CONSTRAINTS['block_height'] = 'INTEGER'
+SQL_SCHEMA_RELAYED_BY_CACHE_V2_WITH_CONSTRAINTS['tx_id'] = (
+    'BLOB NOT NULL PRIMARY KEY')
+SQL_SCHEMA_RELAYED_BY_CACHE_V2_WITH_CONSTRAINTS['relayed_by']   = 'TEXT'
+
+#Created WITHOUT ROWID. Each output has at most one address cached, so the
+#   address no longer needs to be part of the key.
+SQL_SCHEMA_TX_OUTPUT_CACHE_V2_WITH_CONSTRAINTS = OrderedDict()
+SQL_SCHEMA_TX_OUTPUT_CACHE_V2_WITH_CONSTRAINTS['block_height']  = 'INTEGER'
+SQL_SCHEMA_TX_OUTPUT_CACHE_V2_WITH_CONSTRAINTS['tx_id']         = 'BLOB NOT NULL'
+SQL_SCHEMA_TX_OUTPUT_CACHE_V2_WITH_CONSTRAINTS['output_pos'] = (
+    'INTEGER NOT NULL')
+SQL_SCHEMA_TX_OUTPUT_CACHE_V2_WITH_CONSTRAINTS['address']       = 'BLOB'
+SQL_SCHEMA_TX_OUTPUT_CACHE_V2_WITH_CONSTRAINTS[
+    'PRIMARY KEY (tx_id, output_pos)'] = ''
+
+#Schema version 3: each distinct address and txid is stored once, in the
+#   version 2 form, in a dictionary table. The tables that referenced them
+#   store the dictionary id in the same column instead, and the label cache is
+#   keyed on address ids too. Ids are assigned densely on first sight and
+#   never change. The Database accessors translate between values and ids.
+
+#An explicit INTEGER PRIMARY KEY, since VACUUM may renumber implicit rowids
+SQL_TABLE_NAME_ADDRESS_DICT = 'tblAddressDict'
+SQL_SCHEMA_ADDRESS_DICT = OrderedDict()
+SQL_SCHEMA_ADDRESS_DICT['id']                               = 'INTEGER PRIMARY KEY'
+SQL_SCHEMA_ADDRESS_DICT['address']                          = 'BLOB NOT NULL UNIQUE'
+
+SQL_TABLE_NAME_TX_DICT = 'tblTxDict'
+SQL_SCHEMA_TX_DICT = OrderedDict()
+SQL_SCHEMA_TX_DICT['id']                                    = 'INTEGER PRIMARY KEY'
+SQL_SCHEMA_TX_DICT['tx_id']                                 = 'BLOB NOT NULL UNIQUE'
+
+SQL_SCHEMA_BLAME_STATS_V3 = deepcopy(SQL_SCHEMA_BLAME_STATS)
+SQL_SCHEMA_BLAME_STATS_V3['confirmed_tx_id']                = 'INTEGER'
+SQL_SCHEMA_BLAME_STATS_V3['relevant_address']               = 'INTEGER'
+
+SQL_SCHEMA_BLAME_LABEL_CACHE_V3_WITH_CONSTRAINTS = deepcopy(
+    SQL_SCHEMA_BLAME_LABEL_CACHE_WITH_CONSTRAINTS)
+SQL_SCHEMA_BLAME_LABEL_CACHE_V3_WITH_CONSTRAINTS['btc_address'] = 'INTEGER'
+
+SQL_SCHEMA_ADDRESSES_SEEN_V3_WITH_CONSTRAINTS = deepcopy(
+    SQL_SCHEMA_ADDRESSES_SEEN_WITH_CONSTRAINTS)
+SQL_SCHEMA_ADDRESSES_SEEN_V3_WITH_CONSTRAINTS['address']    = 'INTEGER'
+
+#An integer primary key is already the rowid, so no need for WITHOUT ROWID
+SQL_SCHEMA_RELAYED_BY_CACHE_V3_WITH_CONSTRAINTS = deepcopy(
+    SQL_SCHEMA_RELAYED_BY_CACHE_V2_WITH_CONSTRAINTS)
+SQL_SCHEMA_RELAYED_BY_CACHE_V3_WITH_CONSTRAINTS['tx_id'] = (
+    'INTEGER NOT NULL PRIMARY KEY')
+
+SQL_SCHEMA_TX_OUTPUT_CACHE_V3_WITH_CONSTRAINTS = deepcopy(
+    SQL_SCHEMA_TX_OUTPUT_CACHE_V2_WITH_CONSTRAINTS)
+SQL_SCHEMA_TX_OUTPUT_CACHE_V3_WITH_CONSTRAINTS['tx_id']     = 'INTEGER NOT NULL'
+SQL_SCHEMA_TX_OUTPUT_CACHE_V3_WITH_CONSTRAINTS['address']   = 'INTEGER'
+
+#Schema version 4: as version 3, but each wallet cluster's label is stored
+#   once, in a table of clusters. The label cache maps each address id to the
+#   id of its cluster rather than repeating the label for every address, so
+#   relabeling a cluster updates a single row.
+
+SQL_TABLE_NAME_WALLET_CLUSTERS = 'tblWalletClusters'
+SQL_SCHEMA_WALLET_CLUSTERS = OrderedDict()
+SQL_SCHEMA_WALLET_CLUSTERS['cluster_id']                    = 'INTEGER PRIMARY KEY'
+#WalletExplorer.com's id for the cluster, if known
+SQL_SCHEMA_WALLET_CLUSTERS['wallet_id']                     = 'TEXT'
+#HTML encoded, like the labels of earlier versions' label cache
+SQL_SCHEMA_WALLET_CLUSTERS['label']                         = 'TEXT NOT NULL UNIQUE'
+
+#The address id is the rowid. No index on cluster_id, since only merging two
+#   clusters needs to find every address of one.
+SQL_SCHEMA_BLAME_LABEL_CACHE_V4 = OrderedDict()
+SQL_SCHEMA_BLAME_LABEL_CACHE_V4['btc_address']              = 'INTEGER PRIMARY KEY'
+SQL_SCHEMA_BLAME_LABEL_CACHE_V4['cluster_id']               = 'INTEGER NOT NULL'
+
 ############################ END TABLE DEFINITIONS #############################
 
 ## SPECIAL DATABASE FOR COORDINATING MULTIPLE DEFERRED BLAME RESOLVER THREADS ##
@@ -241,6 +478,83 @@ class DataSource(IntEnum):
 # CLASSES #
 ###########
 
+class DatabaseContentionStats(object):
+    """Tallies time lost to lock contention across a connection's statements.
+
+    Attributes:
+        num_statements (int): Statements executed.
+        num_contended_statements (int): Statements that had to be retried
+            because the database was locked.
+        num_retries (int): Total retries across all statements.
+        sec_waited (float): Total seconds spent in failed attempts and backing
+            off between them.
+        max_sec_waited (float): Most seconds waited by a single statement.
+        num_retried_transactions (int): Block transactions rolled back and
+            run again because the database was locked.
+    """
+
+    def __init__(self):
+        self.num_statements = 0
+        self.num_contended_statements = 0
+        self.num_retries = 0
+        self.sec_waited = 0.0
+        self.max_sec_waited = 0.0
+        self.num_retried_transactions = 0
+
+    def record(self, num_retries, sec_waited):
+        """Record the outcome of one statement."""
+        self.num_statements = self.num_statements + 1
+        if num_retries > 0:
+            self.num_contended_statements = self.num_contended_statements + 1
+            self.num_retries = self.num_retries + num_retries
+            self.sec_waited = self.sec_waited + sec_waited
+            self.max_sec_waited = max(self.max_sec_waited, sec_waited)
+
+    def record_retried_transaction(self, sec_waited):
+        """Record a block transaction rolled back to be run again."""
+        self.num_retried_transactions = self.num_retried_transactions + 1
+        self.sec_waited = self.sec_waited + sec_waited
+
+    def __str__(self):
+        return (("%d of %d statement(s) hit a locked database, retried %d "
+                 "time(s), waited %.3f sec in total and %.3f sec at most; "
+                 "%d block transaction(s) retried.") %
+                (self.num_contended_statements, self.num_statements,
+                 self.num_retries, self.sec_waited, self.max_sec_waited,
+                 self.num_retried_transactions))
+
+class BlameLabelCacheStats(object):
+    """Tallies lookups served by a connection's in-memory blame labels.
+
+    Attributes:
+        num_hits (int): Lookups answered from memory.
+        num_misses (int): Lookups that queried the blame label cache table.
+        num_invalidations (int): Times the labels in memory were discarded
+            because labels in the table had changed.
+    """
+
+    def __init__(self):
+        self.num_hits = 0
+        self.num_misses = 0
+        self.num_invalidations = 0
+
+    def get_hit_ratio(self):
+        """Fraction of lookups answered from memory, or None if there have
+        been no lookups."""
+        num_lookups = self.num_hits + self.num_misses
+        if num_lookups == 0:
+            return None
+        return float(self.num_hits) / num_lookups
+
+    def __str__(self):
+        hit_ratio = self.get_hit_ratio()
+        if hit_ratio is None:
+            hit_ratio = 0.0
+        return (("%d of %d lookup(s) answered from memory (%.1f%%), labels "
+                 "discarded %d time(s).") %
+                (self.num_hits, self.num_hits + self.num_misses,
+                 100.0 * hit_ratio, self.num_invalidations))
+
 class BlameResolverCoordinationDatabase(object):
     """Helps multiple threads coordinate their blockchain processing.
 
@@ -252,6 +566,8 @@ class BlameResolverCoordinationDatabase(object):
         con (sqlite3.Connection): Connection to the sqlite3 database.
         cursor (sqlite3.Cursor): Maintains and updates state for database.
         db_filename (str): The name of the database file in use.
+        contention_stats (`DatabaseContentionStats`): Time lost to other
+            workers holding locks on the database.
         last_block_initialized (int): The highest block height at which this
             object knows for sure that there is an entry for all block hegihts
             between 0 and `last_block_initialized`. Various functions must
@@ -260,13 +576,16 @@ class BlameResolverCoordinationDatabase(object):
     """
 
     def __init__(self, filename_override = None):
+        self.contention_stats = DatabaseContentionStats()
         try:
             if filename_override is not None:
-                self.con = sqlite3.connect(filename_override)
+                self.con = sqlite3.connect(filename_override,
+                                           timeout=SQLITE_BUSY_TIMEOUT_SEC)
                 self.db_filename = filename_override
             else:
                 self.con = sqlite3.connect(
-                    BLAME_RESOLVER_COORDINATION_DB_FILENAME)
+                    BLAME_RESOLVER_COORDINATION_DB_FILENAME,
+                    timeout=SQLITE_BUSY_TIMEOUT_SEC)
                 self.db_filename = BLAME_RESOLVER_COORDINATION_DB_FILENAME
 
             self.con.row_factory = sqlite3.Row # permit accessing results by col name
@@ -303,38 +622,34 @@ class BlameResolverCoordinationDatabase(object):
                 `executemany` function.
 
         Raises:
-            custom_errors.TooManyDatabaseErrors: If database errors are
-                repeatedly encountered until the function gives up, the problem
-                is logged and this error is raised.
+            custom_errors.TooManyDatabaseErrors: If the statement fails with an
+                error other than a locked database, or the database stays
+                locked until the function gives up, the problem is logged and
+                this error is raised.
         """
 
         dprint("Statement: " + stmt)
         dprint("Arglist: " + str(arglist))
-        last_error = None
-        for sec_wait in range(1, NUM_ATTEMPTS_UPON_DB_ERROR):
-            try:
-                if execute_many:
-                    self.cursor.executemany(stmt, arglist)
-                else:
-                    self.cursor.execute(stmt, arglist)
-                self.con.commit()
 
-                #TODO: This should return a value indicating whether the
-                #   statement executed successfully or not
-                return
-            except Exception as e:
-                last_error = e
-                if sec_wait != NUM_ATTEMPTS_UPON_DB_ERROR:
-                    #Could you give it a second? It's going to space.
-                    print(("WARNING: Experienced error executing db statement, "
-                           "trying again in %f seconds.") % float(sec_wait))
-                    sleep(float(sec_wait))
-        if self.con is not None:
-            self.con.close()
-        msg = (("Could not execute database statement after %d tries. Last "
-                "error: %s") % (NUM_ATTEMPTS_UPON_DB_ERROR, str(last_error)))
-        logger.log_alert(msg)
-        raise custom_errors.TooManyDatabaseErrors
+        def execute_and_commit():
+            if execute_many:
+                self.cursor.executemany(stmt, arglist)
+            else:
+                self.cursor.execute(stmt, arglist)
+            self.con.commit()
+
+        try:
+            call_with_lock_retry(execute_and_commit, self.contention_stats)
+            #TODO: This should return a value indicating whether the
+            #   statement executed successfully or not
+            return
+        except Exception as err:
+            if self.con is not None:
+                self.con.close()
+            msg = ("Could not execute database statement. Error: %s" %
+                   str(err))
+            logger.log_alert(msg)
+            raise custom_errors.TooManyDatabaseErrors
 
     def get_mark_block_complete_stmt(self):
         """ SQL statement for marking a block complete."""
@@ -458,36 +773,29 @@ class BlameResolverCoordinationDatabase(object):
         """
         dprint(stmt)
         dprint(str(arglist))
-        results = None
 
-        last_error = None
-        for sec_wait in range(1, NUM_ATTEMPTS_UPON_DB_ERROR):
-            try:
-                self.cursor.execute(stmt, arglist)
-                results = self.cursor.fetchall()
-                if results is None:
-                    msg = ('Received null value from Database query in %s().' %
-                           caller)
-                    logger.log_and_die(msg)
-            except Exception as e:
-                dprint(str(e))
-                last_error = e
-                if sec_wait != NUM_ATTEMPTS_UPON_DB_ERROR:
-                    #Could you give it a second? It's going to space.
-                    print(("WARNING: Experienced error executing db statement, "
-                           "trying again in %f seconds.") % float(sec_wait))
-                    sleep(float(sec_wait))
+        def execute_and_fetch():
+            self.cursor.execute(stmt, arglist)
+            return self.cursor.fetchall()
 
-        if results is None:
+        try:
+            results = call_with_lock_retry(execute_and_fetch,
+                                           self.contention_stats)
+        except Exception as err:
+            dprint(str(err))
             msg = (("Could not fetch from database. Statement was '%s' error "
                     "is '%s' database filename is '%s'") %
-                   (stmt, str(last_error), self.db_filename))
+                   (stmt, str(err), self.db_filename))
             if self.con is not None:
                 self.con.close()
             logger.log_alert(msg)
             raise custom_errors.TooManyDatabaseErrors
-        else:
-            return results
+
+        if results is None:
+            msg = ('Received null value from Database query in %s().' %
+                   caller)
+            logger.log_and_die(msg)
+        return results
 
     def _initialize_block_span(self, max_block_height, min_block_height=0):
         """Initialize a span of blocks as unclaimed and incomplete.
@@ -730,6 +1038,49 @@ class Database:
     #   Used only when DELETE_BLAME_STATS_ONCE_PER_BLOCK is set to True.
     in_memory_deleted_blame_record_cache = None
 
+    #Only used when USE_IN_MEMORY_SEEN_ADDRESS_INDEX is set to True. The index
+    #   is loaded lazily on first use, so that processes that never look up
+    #   seen addresses don't pay to load it. Any `SeenAddressIndex` may be
+    #   assigned here before first use.
+    seen_address_index = None #seen_address_index.SeenAddressIndex
+    #This is an INSERT cache of (block_height, address) tuples for addresses
+    #   added to the index that are not yet in the seen addresses table.
+    in_memory_seen_address_cache = None #list of tuples
+
+    #Only used when USE_SEEN_ADDRESS_BLOOM_FILTER is set to True. Opened lazily
+    #   on first use.
+    seen_address_bloom_filter = None #bloom_filter.BloomFilter
+
+    #Number of nested `block_transaction()` contexts currently open. While
+    #   non-zero, `run_statement()` leaves committing to the outermost context.
+    block_transaction_depth = 0
+    #Whether the outermost open block transaction was started by
+    #   `run_in_block_transaction()`, which runs it again if the database is
+    #   locked.
+    is_block_transaction_retryable = False
+
+    #Version of the table layout in this database file. See
+    #   DEFAULT_SCHEMA_VERSION.
+    schema_version = None #int
+
+    #Only used in schema version 3 and later.
+    address_dict = None #intern_table.InternTable
+    tx_dict = None #intern_table.InternTable
+
+    #Maps wallet cluster labels to cluster ids. Only used in schema version 4.
+    wallet_cluster_dict = None #intern_table.InternTable
+
+    #Only used when USE_IN_MEMORY_BLAME_LABEL_CACHE is set to True. Maps
+    #   addresses to their HTML encoded labels, as stored in the blame label
+    #   cache table as of generation `blame_label_lru_generation` of the
+    #   table's labels.
+    blame_label_lru = None #lru_cache.LRUCache
+    blame_label_lru_generation = None #int
+    #Whether the generation has been read in the current block transaction,
+    #   so that it's read once per block rather than once per lookup.
+    blame_label_lru_is_synced = False
+    blame_label_cache_stats = None #BlameLabelCacheStats
+
     ############################ GENERAL FUNCTIONS #############################
 
     #Database constructor.
@@ -738,13 +1089,26 @@ class Database:
     #arg1: blockchain_mode (optional): Selects either the filename designated
     #   in the config file for remote API blockchain lookups, or the filename
     #   designated for bitcoind RPC blockchain lookups.
+    #arg2: sqlite_pragmas (optional): List of (pragma name, value) tuples to
+    #   apply to the connection instead of those from the [SQLite] section of
+    #   the config file.
+    #arg3: new_db_schema_version (optional): Schema version to create the
+    #   tables with if the database file is new, instead of
+    #   DEFAULT_SCHEMA_VERSION. Ignored for an existing file.
     def __init__(self, sqlite_db_filename = None,
-                 blockchain_mode = config.BlockchainMode.REMOTE_API):
+                 blockchain_mode = config.BlockchainMode.REMOTE_API,
+                 sqlite_pragmas = None, new_db_schema_version = None):
         if not isinstance(blockchain_mode, config.BlockchainMode):
             msg = ("Blockchain source must be a valid enum value: '%s'" %
                    str(blockchain_mode))
             logger.log_and_die(msg)
         self.config_store = config.Config(sqlite_db_filename, blockchain_mode)
+        if sqlite_pragmas is None:
+            self.sqlite_pragmas = self.config_store.get_sqlite_pragmas()
+        else:
+            self.sqlite_pragmas = sqlite_pragmas
+        self.num_blocks_since_checkpoint = 0
+        self.contention_stats = DatabaseContentionStats()
         self.in_memory_blame_cache = deque()
         self.in_memory_deferred_record_cache = deque()
         self.last_fetched_deferred_record_rowid = -1
@@ -752,19 +1116,28 @@ class Database:
         self.in_memory_updated_blame_record_cache = []
         self.in_memory_update_blame_label_cache_cache = []
         self.in_memory_deleted_blame_record_cache = []
+        self.in_memory_seen_address_cache = []
+        self.blame_label_lru = lru_cache.LRUCache(BLAME_LABEL_LRU_CACHE_SIZE)
+        self.blame_label_cache_stats = BlameLabelCacheStats()
+        if new_db_schema_version is None:
+            self.new_db_schema_version = DEFAULT_SCHEMA_VERSION
+        else:
+            self.new_db_schema_version = new_db_schema_version
 
         ####### must be called last in __init__() #######
         self.db_init()
 
-    def make_table(self, table_name, schema_as_dict):
-        stmt = get_conditional_create_stmt(table_name, schema_as_dict)
+    def make_table(self, table_name, schema_as_dict, without_rowid = False):
+        stmt = get_conditional_create_stmt(table_name, schema_as_dict,
+                                           without_rowid)
         arglist = []
         self.run_statement(stmt, arglist)
 
     def db_init(self):
         print("Attepmting to initialize database connection..")
         try:
-            self.con = sqlite3.connect(self.config_store.SQLITE_DB_FILENAME)
+            self.con = sqlite3.connect(self.config_store.SQLITE_DB_FILENAME,
+                                       timeout=SQLITE_BUSY_TIMEOUT_SEC)
             self.con.row_factory = sqlite3.Row # permit accessing results by col name
             self.cursor = self.con.cursor()
         except Exception as e:
@@ -774,24 +1147,191 @@ class Database:
             logger.log_and_die(msg)
         print("Connected to database.")
 
-        #Seems to resolve I/O issues with multiple processes accessing same db
-        #   file at once.
-        self.run_statement('PRAGMA journal_mode = TRUNCATE', [])
+        #TRUNCATE journal mode (the default) seems to resolve I/O issues with
+        #   multiple processes accessing same db file at once. WAL mode goes
+        #   further, letting readers proceed while another process writes.
+        for (pragma_name, value) in self.sqlite_pragmas:
+            self.run_statement('PRAGMA %s = %s' % (pragma_name, str(value)),
+                               [])
+
+        self.schema_version = self.get_schema_version()
+        if self.schema_version is None:
+            #new database file
+            self.schema_version = self.new_db_schema_version
+            self.run_statement('PRAGMA user_version = %d' %
+                               self.schema_version, [])
+        if self.schema_version > LATEST_SCHEMA_VERSION:
+            msg = ("Database schema version %d is newer than this code "
+                   "supports (%d).") % (self.schema_version,
+                                        LATEST_SCHEMA_VERSION)
+            logger.log_and_die(msg)
 
         self.make_table(SQL_TABLE_NAME_BLOCK_STATS, SQL_SCHEMA_BLOCK_STATS)
         self.make_table(SQL_TABLE_NAME_LAST_N_BLOCKS, SQL_SCHEMA_LAST_N_BLOCKS)
-        self.make_table(SQL_TABLE_NAME_BLAME_STATS, SQL_SCHEMA_BLAME_STATS)
         self.make_table(SQL_TABLE_NAME_BLAME_IDS, SQL_SCHEMA_BLAME_IDS)
-        self.make_table(SQL_TABLE_NAME_BLAME_LABEL_CACHE,
-                        SQL_SCHEMA_BLAME_LABEL_CACHE_WITH_CONSTRAINTS)
-        self.make_table(SQL_TABLE_NAME_ADDRESSES_SEEN,
-                        SQL_SCHEMA_ADDRESSES_SEEN_WITH_CONSTRAINTS)
-        self.make_table(SQL_TABLE_NAME_RELAYED_BY_CACHE,
-                        SQL_SCHEMA_RELAYED_BY_CACHE_WITH_CONSTRAINTS)
-        self.make_table(SQL_TABLE_NAME_TX_OUTPUT_CACHE,
-                        SQL_SCHEMA_TX_OUTPUT_CACHE_WITH_CONSTRAINTS)
         self.make_table(SQL_TABLE_NAME_BLOCK_DATA_PRODUCTION_STATUS,
                         SQL_SCHEMA_BLOCK_DATA_PRODUCTION_STATUS)
+        self.make_table(SQL_TABLE_NAME_UTXO_SPILL, SQL_SCHEMA_UTXO_SPILL)
+        self.make_table(SQL_TABLE_NAME_FIRST_SEEN, SQL_SCHEMA_FIRST_SEEN,
+                        without_rowid = True)
+        self.make_table(SQL_TABLE_NAME_FIRST_SEEN_PROGRESS,
+                        SQL_SCHEMA_FIRST_SEEN_PROGRESS)
+        self.make_table(SQL_TABLE_NAME_PARALLEL_RANGE_STATS,
+                        SQL_SCHEMA_PARALLEL_RANGE_STATS)
+        self.make_table(SQL_TABLE_NAME_WALLET_DOWNLOAD_PROGRESS,
+                        SQL_SCHEMA_WALLET_DOWNLOAD_PROGRESS,
+                        without_rowid = True)
+        self.make_table(SQL_TABLE_NAME_NOT_FOUND_CACHE,
+                        SQL_SCHEMA_NOT_FOUND_CACHE, without_rowid = True)
+        self.make_table(SQL_TABLE_NAME_OUTPUT_KEYS_NEEDED,
+                        SQL_SCHEMA_OUTPUT_KEYS_NEEDED)
+        self.make_table(SQL_TABLE_NAME_BLAME_LABEL_GENERATION,
+                        SQL_SCHEMA_BLAME_LABEL_GENERATION)
+        stmt = ('INSERT OR IGNORE INTO ' +
+                SQL_TABLE_NAME_BLAME_LABEL_GENERATION +
+                ' (id, generation) VALUES (0, 0)')
+        self.run_statement(stmt, [])
+        self.blame_label_lru_generation = self.get_blame_label_generation()
+        if self.schema_version >= 3:
+            self.make_table(SQL_TABLE_NAME_ADDRESS_DICT,
+                            SQL_SCHEMA_ADDRESS_DICT)
+            self.make_table(SQL_TABLE_NAME_TX_DICT, SQL_SCHEMA_TX_DICT)
+            self.make_table(SQL_TABLE_NAME_BLAME_STATS,
+                            SQL_SCHEMA_BLAME_STATS_V3)
+            if self.schema_version >= 4:
+                self.make_table(SQL_TABLE_NAME_WALLET_CLUSTERS,
+                                SQL_SCHEMA_WALLET_CLUSTERS)
+                self.make_table(SQL_TABLE_NAME_BLAME_LABEL_CACHE,
+                                SQL_SCHEMA_BLAME_LABEL_CACHE_V4)
+                #Labels are stored as given; callers HTML encode them
+                self.wallet_cluster_dict = intern_table.InternTable(
+                    self, SQL_TABLE_NAME_WALLET_CLUSTERS, 'label',
+                    lambda label: label, lambda label: label,
+                    WALLET_CLUSTER_CACHE_SIZE, id_col_name = 'cluster_id')
+            else:
+                self.make_table(
+                    SQL_TABLE_NAME_BLAME_LABEL_CACHE,
+                    SQL_SCHEMA_BLAME_LABEL_CACHE_V3_WITH_CONSTRAINTS)
+            self.make_table(SQL_TABLE_NAME_ADDRESSES_SEEN,
+                            SQL_SCHEMA_ADDRESSES_SEEN_V3_WITH_CONSTRAINTS)
+            self.make_table(SQL_TABLE_NAME_RELAYED_BY_CACHE,
+                            SQL_SCHEMA_RELAYED_BY_CACHE_V3_WITH_CONSTRAINTS)
+            self.make_table(SQL_TABLE_NAME_TX_OUTPUT_CACHE,
+                            SQL_SCHEMA_TX_OUTPUT_CACHE_V3_WITH_CONSTRAINTS,
+                            without_rowid = True)
+            self.address_dict = intern_table.InternTable(
+                self, SQL_TABLE_NAME_ADDRESS_DICT, 'address', encode_address,
+                decode_address, INTERN_CACHE_SIZE)
+            self.tx_dict = intern_table.InternTable(
+                self, SQL_TABLE_NAME_TX_DICT, 'tx_id', encode_tx_id,
+                decode_tx_id, INTERN_CACHE_SIZE)
+            return
+
+        self.make_table(SQL_TABLE_NAME_BLAME_LABEL_CACHE,
+                        SQL_SCHEMA_BLAME_LABEL_CACHE_WITH_CONSTRAINTS)
+        if self.schema_version >= 2:
+            self.make_table(SQL_TABLE_NAME_BLAME_STATS,
+                            SQL_SCHEMA_BLAME_STATS_V2)
+            self.make_table(SQL_TABLE_NAME_ADDRESSES_SEEN,
+                            SQL_SCHEMA_ADDRESSES_SEEN_V2_WITH_CONSTRAINTS)
+            self.make_table(SQL_TABLE_NAME_RELAYED_BY_CACHE,
+                            SQL_SCHEMA_RELAYED_BY_CACHE_V2_WITH_CONSTRAINTS,
+                            without_rowid = True)
+            self.make_table(SQL_TABLE_NAME_TX_OUTPUT_CACHE,
+                            SQL_SCHEMA_TX_OUTPUT_CACHE_V2_WITH_CONSTRAINTS,
+                            without_rowid = True)
+        else:
+            self.make_table(SQL_TABLE_NAME_BLAME_STATS, SQL_SCHEMA_BLAME_STATS)
+            self.make_table(SQL_TABLE_NAME_ADDRESSES_SEEN,
+                            SQL_SCHEMA_ADDRESSES_SEEN_WITH_CONSTRAINTS)
+            self.make_table(SQL_TABLE_NAME_RELAYED_BY_CACHE,
+                            SQL_SCHEMA_RELAYED_BY_CACHE_WITH_CONSTRAINTS)
+            self.make_table(SQL_TABLE_NAME_TX_OUTPUT_CACHE,
+                            SQL_SCHEMA_TX_OUTPUT_CACHE_WITH_CONSTRAINTS)
+
+    def get_schema_version(self):
+        """Get the schema version recorded in the database file.
+
+        Files created before schema versions were recorded have a
+        `user_version` of 0 and are version 1.
+
+        Returns:
+            int or None: The version, or None if the file has no tables yet.
+        """
+        caller = 'get_schema_version'
+        user_version = self.fetch_query_single_int('PRAGMA user_version', [],
+                                                   caller, 'user_version')
+        if user_version:
+            return user_version
+        stmt = ("SELECT COUNT(*) AS num_tables FROM sqlite_master WHERE "
+                "type = 'table'")
+        num_tables = self.fetch_query_single_int(stmt, [], caller,
+                                                 'num_tables')
+        if num_tables:
+            return 1
+        return None
+
+    def _encode_tx_id(self, tx_id, add_if_new = True):
+        """Get the form of a txid stored in this database's tables.
+
+        In schema version 3, a txid without an id is given one, unless
+        `add_if_new` is False, in which case it is encoded as None.
+        """
+        if self.schema_version >= 3:
+            return self.tx_dict.get_id(tx_id, add_if_new)
+        if self.schema_version >= 2:
+            return encode_tx_id(tx_id)
+        return tx_id
+
+    def _decode_tx_id(self, value):
+        if self.schema_version >= 3:
+            return self.tx_dict.get_value(value)
+        if self.schema_version >= 2:
+            return decode_tx_id(value)
+        return value
+
+    def _encode_address(self, btc_address, add_if_new = True):
+        """Get the form of an address stored in this database's tables.
+
+        In schema version 3, an address without an id is given one, unless
+        `add_if_new` is False, in which case it is encoded as None.
+        """
+        if self.schema_version >= 3:
+            return self.address_dict.get_id(btc_address, add_if_new)
+        if self.schema_version >= 2:
+            return encode_address(btc_address)
+        return btc_address
+
+    def _decode_address(self, value):
+        if self.schema_version >= 3:
+            return self.address_dict.get_value(value)
+        if self.schema_version >= 2:
+            return decode_address(value)
+        return value
+
+    def _encode_label_cache_address(self, btc_address, add_if_new = True):
+        """The label cache stores addresses as TEXT before version 3."""
+        if self.schema_version >= 3:
+            return self.address_dict.get_id(btc_address, add_if_new)
+        return btc_address
+
+    def _encode_label_cache_label(self, label, add_if_new = True):
+        """The label cache stores HTML encoded labels before version 4, and
+        the id of the wallet cluster with that label from version 4."""
+        label_escaped = html_escape(label)
+        if self.schema_version >= 4:
+            return self.wallet_cluster_dict.get_id(label_escaped, add_if_new)
+        return label_escaped
+
+    def _prefetch_ids(self, tx_ids = None, btc_addresses = None):
+        """Cache the ids of a batch of values about to be encoded."""
+        if self.schema_version < 3:
+            return
+        if tx_ids is not None:
+            self.tx_dict.prefetch_ids(tx_ids, SQLITE_MAX_VARIABLE_NUMBER)
+        if btc_addresses is not None:
+            self.address_dict.prefetch_ids(btc_addresses,
+                                           SQLITE_MAX_VARIABLE_NUMBER)
 
     def run_statement(self, stmt, arglist, execute_many = False):
         """Execute a SQL statement that returns no results.
@@ -811,67 +1351,252 @@ class Database:
 
         dprint("Statement: " + stmt)
         dprint("Arglist: " + str(arglist))
-        last_error = None
-        for sec_wait in range(1, NUM_ATTEMPTS_UPON_DB_ERROR):
+
+        def execute_and_commit():
             try:
                 if execute_many:
                     self.cursor.executemany(stmt, arglist)
                 else:
                     self.cursor.execute(stmt, arglist)
+            except Exception:
+                #Discard the rows written by a partially applied executemany
+                #   before it's retried
+                if self.block_transaction_depth == 0:
+                    self.con.rollback()
+                raise
+            if self.block_transaction_depth == 0:
                 self.con.commit()
 
-                #TODO: This should return a value indicating whether the
-                #   statement executed successfully or not
-                return
-            except Exception as e:
-                last_error = e
-                if sec_wait != NUM_ATTEMPTS_UPON_DB_ERROR:
-                    #Could you give it a second? It's going to space.
-                    print(("WARNING: Experienced error executing db statement, "
-                           "trying again in %f seconds.") % float(sec_wait))
-                    sleep(float(sec_wait))
-        if self.con is not None:
-            self.con.close()
-        msg = (("Could not execute database statement after %d tries. Last "
-                "error: %s") % (NUM_ATTEMPTS_UPON_DB_ERROR, str(last_error)))
-        logger.log_and_die(msg)
+        try:
+            call_with_lock_retry(execute_and_commit, self.contention_stats,
+                                 self.get_num_statement_attempts())
+            #TODO: This should return a value indicating whether the
+            #   statement executed successfully or not
+            return
+        except Exception as err:
+            self.raise_if_locked_in_block_transaction(err)
+            self.close_after_error()
+            msg = (("Could not execute database statement '%s'. Error: %s") %
+                   (stmt, str(err)))
+            logger.log_and_die(msg)
 
     def manual_commit(self):
         self.con.commit()
 
+    def checkpoint(self, mode = None):
+        """Copy the write-ahead log back into the database file.
+
+        Only has an effect in WAL journal mode. Must not be called inside
+        `block_transaction()`.
+
+        Args:
+            mode (Optional[str]): One of `config.SQLITE_CHECKPOINT_MODES`.
+                Defaults to the mode set in the config file. PASSIVE
+                checkpoints as much as possible without waiting on readers or
+                writers.
+
+        Returns:
+            tuple: (busy, log, checkpointed) as reported by SQLite. `busy` is 1
+                if a FULL, RESTART or TRUNCATE checkpoint could not complete.
+        """
+        if mode is None:
+            mode = self.config_store.SQLITE_CHECKPOINT_MODE
+        assert mode in config.SQLITE_CHECKPOINT_MODES
+        assert self.block_transaction_depth == 0
+        stmt = 'PRAGMA wal_checkpoint(%s)' % mode
+        caller = 'checkpoint'
+        rows = self.fetch_query_and_handle_errors(stmt, [], caller)
+        self.num_blocks_since_checkpoint = 0
+        return tuple(rows[0])
+
+    def checkpoint_if_due(self):
+        """Count a processed block, and checkpoint per the config file.
+
+        The checkpoint interval is set by `checkpoint_interval_blocks` in the
+        [SQLite] section of the config file. If it isn't set, this does nothing
+        and checkpoints are left to SQLite's `wal_autocheckpoint`.
+        """
+        interval = self.config_store.SQLITE_CHECKPOINT_INTERVAL_BLOCKS
+        if interval is None or interval <= 0:
+            return
+        self.num_blocks_since_checkpoint = self.num_blocks_since_checkpoint + 1
+        if self.num_blocks_since_checkpoint >= interval:
+            result = self.checkpoint()
+            dprint("Checkpoint (busy, log, checkpointed): %s" % str(result))
+
+    @contextmanager
+    def block_transaction(self):
+        """Group all writes made inside the context into one transaction.
+
+        Rather than committing after every statement, everything written
+        while processing a block is committed once when the outermost context
+        exits, so the block is stored atomically with a single journal sync.
+        If the context exits with an exception (including `SystemExit` from
+        `logger.log_and_die` and `KeyboardInterrupt`), the transaction is
+        rolled back along with any per-block in-memory caches, leaving the
+        database as it was after the last complete block.
+
+        Contexts may be nested; only the outermost one commits or rolls back.
+        Note that the `sqlite3` module commits implicitly before any statement
+        other than INSERT, UPDATE, DELETE, REPLACE or SELECT, so DDL such as
+        CREATE TABLE must not be run inside the context.
+
+        Usage:
+            with database.block_transaction():
+                ...
+        """
+        self.block_transaction_depth = self.block_transaction_depth + 1
+        try:
+            yield
+        except custom_errors.DatabaseLockedInBlockTransactionError as err:
+            self.block_transaction_depth = self.block_transaction_depth - 1
+            if self.block_transaction_depth == 0:
+                self.rollback_block_transaction()
+                if not self.is_block_transaction_retryable:
+                    logger.log_and_die("Block transaction rolled back: %s" %
+                                       str(err))
+            raise
+        except:
+            self.block_transaction_depth = self.block_transaction_depth - 1
+            if self.block_transaction_depth == 0:
+                self.rollback_block_transaction()
+            raise
+        self.block_transaction_depth = self.block_transaction_depth - 1
+        if self.block_transaction_depth == 0:
+            try:
+                call_with_lock_retry(self.con.commit, self.contention_stats,
+                                     num_attempts = 1)
+            except Exception as err:
+                self.rollback_block_transaction()
+                if is_lock_error(err) and self.is_block_transaction_retryable:
+                    raise custom_errors.DatabaseLockedInBlockTransactionError(
+                        str(err))
+                logger.log_and_die("Could not commit block transaction: %s" %
+                                   str(err))
+            #Other processes may change labels before the next block
+            self.blame_label_lru_is_synced = False
+
+    def run_in_block_transaction(self, func):
+        """Call `func` inside `block_transaction()` and return its result.
+
+        Statements inside a block transaction aren't retried while the
+        database is locked, because a deadlock with another connection's
+        transaction can't clear until one of them rolls back. Instead, the
+        whole transaction is rolled back and `func` is called again in a new
+        one, backing off between attempts like `call_with_lock_retry`, up to
+        `NUM_ATTEMPTS_UPON_DB_ERROR` attempts. `func` must therefore write
+        only through this database, or otherwise be safe to call again.
+
+        If a block transaction is already open, `func` runs inside it, and is
+        retried only if that transaction was itself started by this function.
+
+        Args:
+            func (function): Takes no arguments; makes the writes.
+        """
+        if self.block_transaction_depth > 0:
+            with self.block_transaction():
+                return func()
+        num_retries = 0
+        while True:
+            self.is_block_transaction_retryable = True
+            try:
+                with self.block_transaction():
+                    return func()
+            except custom_errors.DatabaseLockedInBlockTransactionError as err:
+                num_retries = num_retries + 1
+                if num_retries >= NUM_ATTEMPTS_UPON_DB_ERROR:
+                    logger.log_and_die(("Block transaction failed %d times "
+                                        "on a locked database: %s") %
+                                       (num_retries, str(err)))
+                backoff_sec = get_lock_backoff_sec(num_retries - 1)
+                dprint(("Database is locked, running block transaction again "
+                        "in %.3f seconds.") % backoff_sec)
+                sleep(backoff_sec)
+                self.contention_stats.record_retried_transaction(backoff_sec)
+            finally:
+                self.is_block_transaction_retryable = False
+
+    #Statements inside a block transaction are tried once; see
+    #   run_in_block_transaction().
+    def get_num_statement_attempts(self):
+        if self.block_transaction_depth > 0:
+            return 1
+        return NUM_ATTEMPTS_UPON_DB_ERROR
+
+    #Raises DatabaseLockedInBlockTransactionError in place of a locked
+    #   database error from a statement inside a block transaction, so that
+    #   the block transaction is rolled back and can be run again.
+    def raise_if_locked_in_block_transaction(self, err):
+        if self.block_transaction_depth > 0 and is_lock_error(err):
+            raise custom_errors.DatabaseLockedInBlockTransactionError(str(err))
+
+    def rollback_block_transaction(self):
+        """Discard uncommitted writes and pending per-block write caches."""
+        if self.con is not None:
+            self.con.rollback()
+        self.in_memory_blame_cache = deque()
+        self.in_memory_tx_output_cache = []
+        self.in_memory_updated_blame_record_cache = []
+        self.in_memory_update_blame_label_cache_cache = []
+        self.in_memory_deleted_blame_record_cache = []
+        self.in_memory_seen_address_cache = []
+        #The index and filter may hold addresses from the discarded block
+        self.seen_address_index = None
+        self._reset_seen_address_bloom_filter_sync_point()
+        #...and the dictionaries ids that were never committed
+        if self.schema_version >= 3:
+            self.address_dict.clear_cache()
+            self.tx_dict.clear_cache()
+        if self.schema_version >= 4:
+            self.wallet_cluster_dict.clear_cache()
+        #...and labels written or read in the discarded transaction
+        self.blame_label_lru.clear()
+        self.blame_label_lru_generation = None
+        self.blame_label_lru_is_synced = False
+        dprint("Rolled back uncommitted block transaction.")
+
     def close(self):
-        self.con.close()
+        if self.seen_address_bloom_filter is not None:
+            self.seen_address_bloom_filter.close()
+            self.seen_address_bloom_filter = None
+        if self.con is not None:
+            self.con.close()
+            self.con = None
+
+    #Closes the connection before dying on a statement that failed. Inside a
+    #   block transaction it is left open, so that block_transaction() can
+    #   roll the block back as the process exits.
+    def close_after_error(self):
+        if self.con is not None and self.block_transaction_depth == 0:
+            self.con.close()
+            self.con = None
 
     def fetch_query(self, stmt, arglist):
         dprint("Attempting to fetch from database...")
         dprint("Statement: " + stmt)
         dprint("Arglist: " + str(arglist))
 
-        last_error = None
-        for sec_wait in range(1, NUM_ATTEMPTS_UPON_DB_ERROR):
-            try:
-                self.cursor.execute(stmt, arglist)
-                fetched = self.cursor.fetchall()
-                #con.close()
-                for row in fetched:
-                    dprint(str(row))
-                dprint("Done fetching from database, fetched %d records." %
-                       len(fetched))
-                return fetched
-            except Exception as e:
-                last_error = e
-                if sec_wait != NUM_ATTEMPTS_UPON_DB_ERROR:
-                    #Could you give it a second? It's going to space.
-                    print(("WARNING: Experienced error executing db statement, "
-                           "trying again in %f seconds.") % float(sec_wait))
-                    sleep(float(sec_wait))
-
-        msg = ("Could not fetch from database. Statement was '%s' error is "
-               "'%s' database filename is '%s'" %
-               (stmt, str(last_error), self.config_store.SQLITE_DB_FILENAME))
-        if self.con is not None:
-            self.con.close()
-        logger.log_and_die(msg)
+        def execute_and_fetch():
+            self.cursor.execute(stmt, arglist)
+            return self.cursor.fetchall()
+
+        try:
+            fetched = call_with_lock_retry(execute_and_fetch,
+                                           self.contention_stats,
+                                           self.get_num_statement_attempts())
+        except Exception as err:
+            self.raise_if_locked_in_block_transaction(err)
+            msg = ("Could not fetch from database. Statement was '%s' error is "
+                   "'%s' database filename is '%s'" %
+                   (stmt, str(err), self.config_store.SQLITE_DB_FILENAME))
+            self.close_after_error()
+            logger.log_and_die(msg)
+
+        for row in fetched:
+            dprint(str(row))
+        dprint("Done fetching from database, fetched %d records." %
+               len(fetched))
+        return fetched
 
     #arg2: caller is the name of the function calling this, not including parens
     #returns the records fetched from the DB query, or None if records are empty
@@ -975,6 +1700,20 @@ class Database:
         column_name = SQL_ALIAS_HIGHEST_BLOCK_NUM
         return self.fetch_query_single_int(stmt, arglist, caller, column_name)
 
+    #Returns the set of heights from min_block_height up to but not including
+    #   max_block_height whose block stats have been recorded, for callers that
+    #   process blocks out of order.
+    def get_block_heights_processed_in_span(self, min_block_height,
+                                            max_block_height):
+        stmt = ('SELECT block_num FROM ' + SQL_TABLE_NAME_BLOCK_STATS + ' '
+                'WHERE block_num >= ? AND block_num < ?')
+        arglist = (min_block_height, max_block_height)
+        caller = 'get_block_heights_processed_in_span'
+        records = self.fetch_query_and_handle_errors(stmt, arglist, caller)
+        if records is None:
+            return set()
+        return set([record['block_num'] for record in records])
+
     def record_block_stats(self, block_state):
         col_names = get_comma_separated_list_of_col_names(
             SQL_SCHEMA_BLOCK_STATS)
@@ -1077,7 +1816,8 @@ class Database:
         else:
             address_list = []
             for record in records:
-                address_list.append(record['relevant_address'])
+                address_list.append(
+                    self._decode_address(record['relevant_address']))
             return address_list
 
     #Returns integer value of the id ('rowid' col) for the specified
@@ -1114,7 +1854,8 @@ class Database:
         stmt = ('SELECT blame_recipient_id FROM '
                 '' + SQL_TABLE_NAME_BLAME_STATS + ' WHERE role = ? AND '
                 'relevant_address = ? LIMIT 1')
-        arglist = (role, relevant_address)
+        arglist = (role, self._encode_address(relevant_address,
+                                              add_if_new = False))
         caller = 'get_blame_id_for_role_and_address'
         column_name = 'blame_recipient_id'
         return self.fetch_query_single_int(stmt, arglist, caller, column_name)
@@ -1161,7 +1902,8 @@ class Database:
         stmt = ('INSERT INTO ' + SQL_TABLE_NAME_BLAME_STATS + '('
                 '' + col_names + ') VALUES (?,?,?,?,?,?,?)')
         arglist = (blame_party_id, address_reuse_type, role, data_source,
-                   block_height, confirmed_tx_id, relevant_address)
+                   block_height, self._encode_tx_id(confirmed_tx_id),
+                   self._encode_address(relevant_address))
         self.run_statement(stmt, arglist)
 
     #Store a blame record in the database. If the
@@ -1209,6 +1951,10 @@ class Database:
 
         num_select_terms = 0 #counter keeps track of batch
         blame_record_tuple = None
+        self._prefetch_ids(
+            tx_ids = [record[5] for record in self.in_memory_blame_cache],
+            btc_addresses = [record[6] for record in
+                             self.in_memory_blame_cache])
         while True:
             try:
                 blame_record_tuple = self.in_memory_blame_cache.popleft() #FIFO
@@ -1235,8 +1981,9 @@ class Database:
             record_insert_arglist.append(role)
             record_insert_arglist.append(data_source)
             record_insert_arglist.append(block_height)
-            record_insert_arglist.append(confirmed_tx_id)
-            record_insert_arglist.append(relevant_address)
+            record_insert_arglist.append(self._encode_tx_id(confirmed_tx_id))
+            record_insert_arglist.append(
+                self._encode_address(relevant_address))
 
             num_select_terms = num_select_terms + 1
             #each compound SELECT statement can only contain at most
@@ -1305,7 +2052,8 @@ class Database:
         else:
             address_list = []
             for record in records:
-                address_list.append(record['relevant_address'])
+                address_list.append(
+                    self._decode_address(record['relevant_address']))
             return address_list
 
     #returns a list of top blamed parties as referenced by their integer rowid
@@ -1754,9 +2502,9 @@ class Database:
         address_reuse_role = AddressReuseRole(row['role'])
         data_source = DataSource(row['data_source'])
         row_id = row['rowid']
-        tx_id = row['confirmed_tx_id']
+        tx_id = self._decode_tx_id(row['confirmed_tx_id'])
         address_reuse_type = AddressReuseType(row['address_reuse_type'])
-        relevant_address = row['relevant_address']
+        relevant_address = self._decode_address(row['relevant_address'])
         block_height = row['block_height']
 
         blame_record = tx_blame.BlameRecord(blame_label, address_reuse_role,
@@ -1955,7 +2703,8 @@ class Database:
         rowid = blame_record.row_id
 
         arglist = (blame_recipient_id, address_reuse_type, role, data_source,
-                   block_height, confirmed_tx_id, relevant_address, rowid)
+                   block_height, self._encode_tx_id(confirmed_tx_id),
+                   self._encode_address(relevant_address), rowid)
 
         if UPDATE_BLAME_STATS_ONCE_PER_BLOCK:
             #caller responsible for calling
@@ -1984,7 +2733,12 @@ class Database:
         stmt2 = self.get_sql_blame_label_update_stmt()
         arglist = self.in_memory_update_blame_label_cache_cache
         if len(arglist) > 0:
-            self.run_statement(stmt2, arglist, execute_many=True)
+
+            def write_label_updates():
+                self.write_changed_blame_labels(arglist)
+                self.run_statement(stmt2, arglist, execute_many=True)
+
+            self.run_in_block_transaction(write_label_updates)
             self.in_memory_update_blame_label_cache_cache = []
 
         stmt3 = self.get_delete_blame_record_sql_stmt()
@@ -2024,17 +2778,106 @@ class Database:
     ########################## BLAME CACHE FUNCTIONS ###########################
 
     #Get the wallet cluster label for the specified BTC address. If it's not
-    #   cached, this will return None.
+    #   cached, this will return None. When USE_IN_MEMORY_BLAME_LABEL_CACHE is
+    #   set to True, labels are answered from memory where possible; deferred
+    #   blame placeholders and missing labels are always looked up again.
     def get_blame_label_for_btc_address(self, btc_address):
         validate.check_address_and_die(btc_address,
                                        'get_blame_label_for_btc_address')
-        stmt = ('SELECT label FROM ' + SQL_TABLE_NAME_BLAME_LABEL_CACHE + ''
-                ' WHERE btc_address = ? LIMIT 1')
-        arglist = (btc_address,)
-        caller = 'get_blame_label_for_btc_address'
+        if not USE_IN_MEMORY_BLAME_LABEL_CACHE:
+            return self.fetch_blame_label_for_btc_address(btc_address)
+
+        self.sync_blame_label_lru()
+        label = self.blame_label_lru.get(btc_address)
+        if label is not None:
+            self.blame_label_cache_stats.num_hits = (
+                self.blame_label_cache_stats.num_hits + 1)
+            return label
+        self.blame_label_cache_stats.num_misses = (
+            self.blame_label_cache_stats.num_misses + 1)
+        label = self.fetch_blame_label_for_btc_address(btc_address)
+        if label is not None and label != DB_DEFERRED_BLAME_PLACEHOLDER:
+            self.blame_label_lru.put(btc_address, label)
+        return label
+
+    #Get the wallet cluster label for the specified BTC address from the blame
+    #   label cache table, or None.
+    def fetch_blame_label_for_btc_address(self, btc_address):
+        if self.schema_version >= 4:
+            stmt = ('SELECT label FROM ' + SQL_TABLE_NAME_BLAME_LABEL_CACHE + ''
+                    ' JOIN ' + SQL_TABLE_NAME_WALLET_CLUSTERS + ' USING '
+                    '(cluster_id) WHERE btc_address = ? LIMIT 1')
+        else:
+            stmt = ('SELECT label FROM ' + SQL_TABLE_NAME_BLAME_LABEL_CACHE + ''
+                    ' WHERE btc_address = ? LIMIT 1')
+        arglist = (self._encode_label_cache_address(btc_address,
+                                                    add_if_new = False),)
+        caller = 'fetch_blame_label_for_btc_address'
         column_name = 'label'
         return self.fetch_query_single_str(stmt, arglist, caller, column_name)
 
+    #Discards the labels held in memory if another process has changed labels
+    #   in the blame label cache table since they were read. The generation is
+    #   read once per block transaction, or on every call outside of one.
+    def sync_blame_label_lru(self):
+        if self.blame_label_lru_is_synced:
+            return
+        generation = self.get_blame_label_generation()
+        if generation != self.blame_label_lru_generation:
+            if len(self.blame_label_lru) > 0:
+                self.blame_label_cache_stats.num_invalidations = (
+                    self.blame_label_cache_stats.num_invalidations + 1)
+            self.blame_label_lru.clear()
+            self.blame_label_lru_generation = generation
+        self.blame_label_lru_is_synced = self.block_transaction_depth > 0
+
+    def get_blame_label_generation(self):
+        stmt = ('SELECT generation FROM ' +
+                SQL_TABLE_NAME_BLAME_LABEL_GENERATION + ' WHERE id = 0')
+        return self.fetch_query_single_int(stmt, [],
+                                           'get_blame_label_generation',
+                                           'generation')
+
+    #Signals every process, including this one, to discard the labels held in
+    #   memory, because labels already in the blame label cache table are being
+    #   changed. Must be called in the block transaction making the change.
+    def increment_blame_label_generation(self):
+        if not USE_IN_MEMORY_BLAME_LABEL_CACHE:
+            return
+        stmt = ('UPDATE ' + SQL_TABLE_NAME_BLAME_LABEL_GENERATION + ' SET '
+                'generation = generation + 1 WHERE id = 0')
+        self.run_statement(stmt, [])
+        self.blame_label_lru.clear()
+        self.blame_label_lru_generation = self.get_blame_label_generation()
+        self.blame_label_cache_stats.num_invalidations = (
+            self.blame_label_cache_stats.num_invalidations + 1)
+
+    #Writes labels to addresses already in the blame label cache table with a
+    #   different label, other than a deferred blame placeholder, and if there
+    #   were any, increments the generation of the table's labels. Placeholders
+    #   are never held in memory, so replacing them, and adding new addresses,
+    #   leaves the labels in memory valid. Must be called in the block
+    #   transaction that writes the labels.
+    #param0: arglist: List of (label, address) tuples encoded for the table,
+    #   as for get_sql_blame_label_update_stmt()
+    def write_changed_blame_labels(self, arglist):
+        if not USE_IN_MEMORY_BLAME_LABEL_CACHE or len(arglist) == 0:
+            return
+        label_col_name = 'label'
+        if self.schema_version >= 4:
+            label_col_name = 'cluster_id'
+        placeholder = self._encode_label_cache_label(
+            DB_DEFERRED_BLAME_PLACEHOLDER, add_if_new = False)
+        stmt = ('UPDATE ' + SQL_TABLE_NAME_BLAME_LABEL_CACHE + ' SET '
+                '' + label_col_name + ' = ? WHERE btc_address = ? AND '
+                '' + label_col_name + ' IS NOT ? AND '
+                '' + label_col_name + ' IS NOT ?')
+        self.run_statement(stmt, [(label, address, label, placeholder)
+                                  for (label, address) in arglist],
+                           execute_many = True)
+        if self.cursor.rowcount > 0:
+            self.increment_blame_label_generation()
+
     #Stores label for an address. If it has already been cached and is not a
     #   deferred blame, this will be updated. The update occurs so that, if we
     #   are trying to pre-fetch a label for multiple addresses in the same
@@ -2047,52 +2890,229 @@ class Database:
     def cache_blame_label_for_btc_address(self, btc_address, label):
         if validate.looks_like_address(btc_address):
 
-            label_escaped = html_escape(label)
-            col_names = get_comma_separated_list_of_col_names(
-                SQL_SCHEMA_BLAME_LABEL_CACHE)
-            stmt_build = string.StringBuilder()
-            stmt_build.append('INSERT OR ')
-            if label == DB_DEFERRED_BLAME_PLACEHOLDER:
-                #I'm not sure if this would ever happen, but it woudl be a
-                #   resolved blame record with a deferred one, so prevent that.
-                stmt_build.append('IGNORE ')
-            else:
-                stmt_build.append('REPLACE ')
-            stmt_build.append(('INTO ' + SQL_TABLE_NAME_BLAME_LABEL_CACHE + '('
-                               '' + col_names + ') VALUES (?,?)'))
-            stmt = str(stmt_build)
-            arglist = (btc_address, label_escaped)
-            self.run_statement(stmt, arglist)
+            stmt = self.get_blame_label_cache_insert_stmt(label)
+
+            def write_label():
+                encoded_label = self._encode_label_cache_label(label)
+                arglist = (self._encode_label_cache_address(btc_address),
+                           encoded_label)
+                if label != DB_DEFERRED_BLAME_PLACEHOLDER:
+                    self.write_changed_blame_labels([(encoded_label,
+                                                      arglist[0])])
+                self.run_statement(stmt, arglist)
+
+            self.run_in_block_transaction(write_label)
+            if (USE_IN_MEMORY_BLAME_LABEL_CACHE and
+                    label != DB_DEFERRED_BLAME_PLACEHOLDER):
+                self.blame_label_lru.put(btc_address, html_escape(label))
             #TODO: return value should be based on return val of run_statement
             return True
         else:
             return False
 
+    #Stores the same label for many addresses at once, e.g. every address in a
+    #   wallet cluster, with one executemany in a single transaction rather
+    #   than committing once per address. Like
+    #   cache_blame_label_for_btc_address(), skips strings that don't look
+    #   like addresses.
+    #param0: btc_addresses: List of bitcoin addresses
+    #param1: label: The string that presents the wallet that the addresses
+    #   belong to. It wil be HTML encoded before being stored.
+    #Returns: The number of addresses cached.
+    def cache_blame_label_for_btc_addresses(self, btc_addresses, label):
+        btc_addresses = validate.get_plausible_addresses(btc_addresses)
+        if len(btc_addresses) == 0:
+            return 0
+
+        stmt = self.get_blame_label_cache_insert_stmt(label)
+
+        def write_labels():
+            self._prefetch_ids(btc_addresses = btc_addresses)
+            encoded_label = self._encode_label_cache_label(label)
+            arglist = [(self._encode_label_cache_address(btc_address),
+                        encoded_label) for btc_address in btc_addresses]
+            if label != DB_DEFERRED_BLAME_PLACEHOLDER:
+                self.write_changed_blame_labels(
+                    [(encoded_label, address) for (address, _) in arglist])
+            #Not added to the labels in memory: a wallet's addresses are
+            #   cached in bulk ahead of being looked up, and most never are.
+            self.run_statement(stmt, arglist, execute_many = True)
+
+        self.run_in_block_transaction(write_labels)
+        return len(btc_addresses)
+
+    def get_blame_label_cache_insert_stmt(self, label):
+        schema = SQL_SCHEMA_BLAME_LABEL_CACHE
+        if self.schema_version >= 4:
+            schema = SQL_SCHEMA_BLAME_LABEL_CACHE_V4
+        col_names = get_comma_separated_list_of_col_names(schema)
+        stmt_build = string.StringBuilder()
+        stmt_build.append('INSERT OR ')
+        if label == DB_DEFERRED_BLAME_PLACEHOLDER:
+            #I'm not sure if this would ever happen, but it woudl be a
+            #   resolved blame record with a deferred one, so prevent that.
+            stmt_build.append('IGNORE ')
+        else:
+            stmt_build.append('REPLACE ')
+        stmt_build.append(('INTO ' + SQL_TABLE_NAME_BLAME_LABEL_CACHE + '('
+                           '' + col_names + ') VALUES (?,?)'))
+        return str(stmt_build)
+
     def get_sql_blame_label_update_stmt(self):
+        if self.schema_version >= 4:
+            return ('UPDATE ' + SQL_TABLE_NAME_BLAME_LABEL_CACHE + ' SET '
+                    'cluster_id = ? WHERE btc_address = ?')
         return ('UPDATE ' + SQL_TABLE_NAME_BLAME_LABEL_CACHE + ' SET label = ? '
                 'WHERE btc_address = ?')
 
     #Updates label for an address. For example, if the label was set to a
     #   placeholder while deferring setting it a particular label earlier, we
-    #   can now update it.
+    #   can now update it. If the address had another label, every process
+    #   discards the labels it holds in memory once the update is written.
     def update_blame_label_for_btc_address(self, btc_address, label):
         caller = 'update_blame_label_for_btc_address'
         validate.check_address_and_die(btc_address, caller)
 
-        arglist = (label, btc_address)
+        arglist = (self._encode_label_cache_label(label),
+                   self._encode_label_cache_address(btc_address,
+                                                    add_if_new = False))
 
-        label_escaped = html_escape(label)
         if UPDATE_BLAME_STATS_ONCE_PER_BLOCK:
             self.in_memory_update_blame_label_cache_cache.append(arglist)
         else:
             stmt = self.get_sql_blame_label_update_stmt()
-            self.run_statement(stmt, arglist)
+
+            def write_label_update():
+                self.write_changed_blame_labels([arglist])
+                self.run_statement(stmt, arglist)
+
+            self.run_in_block_transaction(write_label_update)
+
+    #Replaces the label of a wallet cluster in the label cache, e.g. a
+    #   WalletExplorer.com wallet id with the name the site has since given the
+    #   cluster. In schema version 4, this updates the cluster's single row, or
+    #   merges it into the cluster that already has the new label; earlier
+    #   versions update every address with the old label.
+    def relabel_wallet_cluster(self, old_label, new_label):
+        old_label_escaped = html_escape(old_label)
+        new_label_escaped = html_escape(new_label)
+        if old_label_escaped == new_label_escaped:
+            return
+        if self.schema_version < 4:
+            stmt = ('UPDATE ' + SQL_TABLE_NAME_BLAME_LABEL_CACHE + ' SET '
+                    'label = ? WHERE label = ?')
+
+            def relabel():
+                self.run_statement(stmt, (new_label_escaped,
+                                          old_label_escaped))
+                if self.cursor.rowcount > 0:
+                    self.increment_blame_label_generation()
+
+            self.run_in_block_transaction(relabel)
+            return
+
+        old_cluster_id = self.wallet_cluster_dict.get_id(old_label_escaped,
+                                                         add_if_new = False)
+        if old_cluster_id is None:
+            return
+        new_cluster_id = self.wallet_cluster_dict.get_id(new_label_escaped,
+                                                         add_if_new = False)
+
+        def relabel():
+            if new_cluster_id is None:
+                stmt = ('UPDATE ' + SQL_TABLE_NAME_WALLET_CLUSTERS + ' SET '
+                        'label = ? WHERE cluster_id = ?')
+                self.run_statement(stmt, (new_label_escaped, old_cluster_id))
+            else:
+                #Rare, so scanning the label cache for the old cluster's
+                #   addresses is cheaper than indexing cluster_id.
+                stmt = ('UPDATE ' + SQL_TABLE_NAME_BLAME_LABEL_CACHE + ' SET '
+                        'cluster_id = ? WHERE cluster_id = ?')
+                self.run_statement(stmt, (new_cluster_id, old_cluster_id))
+                stmt = ('UPDATE ' + SQL_TABLE_NAME_WALLET_CLUSTERS + ' SET '
+                        'wallet_id = (SELECT wallet_id FROM '
+                        '' + SQL_TABLE_NAME_WALLET_CLUSTERS + ' WHERE '
+                        'cluster_id = ?) WHERE cluster_id = ? AND wallet_id IS '
+                        'NULL')
+                self.run_statement(stmt, (old_cluster_id, new_cluster_id))
+                stmt = ('DELETE FROM ' + SQL_TABLE_NAME_WALLET_CLUSTERS + ' '
+                        'WHERE cluster_id = ?')
+                self.run_statement(stmt, (old_cluster_id,))
+            self.increment_blame_label_generation()
+
+        self.run_in_block_transaction(relabel)
+        self.wallet_cluster_dict.clear_cache()
+
+    #Records WalletExplorer.com's id for the wallet cluster with this label,
+    #   if it hasn't been recorded yet. Not stored before schema version 4.
+    def set_wallet_id_for_wallet_cluster(self, label, wallet_id):
+        if self.schema_version < 4:
+            return
+        stmt = ('UPDATE ' + SQL_TABLE_NAME_WALLET_CLUSTERS + ' SET wallet_id = '
+                '? WHERE cluster_id = ? AND wallet_id IS NULL')
+        self.run_statement(stmt, (wallet_id,
+                                  self._encode_label_cache_label(label)))
+
+    #Returns whether a remote lookup was cached as having found nothing, by
+    #   cache_remote_lookup_not_found(), and its entry hasn't expired yet.
+    #param0: lookup: Identifies the lookup, e.g. its url without an API key
+    #param1: now: The current time in seconds since the epoch
+    def is_remote_lookup_cached_as_not_found(self, lookup, now):
+        stmt = ('SELECT expires_at FROM ' + SQL_TABLE_NAME_NOT_FOUND_CACHE + ' '
+                'WHERE lookup = ?')
+        caller = 'is_remote_lookup_cached_as_not_found'
+        records = self.fetch_query_and_handle_errors(stmt, (lookup,), caller)
+        return records is not None and records[0]['expires_at'] > now
+
+    #Records that a remote lookup found nothing, so that it isn't repeated
+    #   before expires_at (seconds since the epoch). Replaces any expired entry.
+    def cache_remote_lookup_not_found(self, lookup, expires_at):
+        stmt = ('INSERT OR REPLACE INTO ' + SQL_TABLE_NAME_NOT_FOUND_CACHE + ' '
+                '(lookup, expires_at) VALUES (?,?)')
+        self.run_statement(stmt, (lookup, expires_at))
+
+    #Returns a tuple of the number of addresses in the wallet with this label
+    #   and the set of offsets of its pages whose labels have been cached
+    #   since its download began, or (None, empty set) if no download is in
+    #   progress.
+    def get_wallet_download_progress(self, label):
+        stmt = ('SELECT page_offset, addresses_count FROM '
+                '' + SQL_TABLE_NAME_WALLET_DOWNLOAD_PROGRESS + ' WHERE '
+                'label = ?')
+        caller = 'get_wallet_download_progress'
+        records = self.fetch_query_and_handle_errors(stmt, (label,), caller)
+        if records is None:
+            return (None, set())
+        return (records[0]['addresses_count'],
+                set(record['page_offset'] for record in records))
+
+    #Records that the labels of these pages of a wallet's addresses have been
+    #   cached. Call within the same block_transaction() as caching them.
+    #param0: label: The wallet's label
+    #param1: page_offsets: Offsets of the pages, as passed to
+    #   WalletExplorerURLBuilder.get_wallet_addresses_at_offset()
+    #param2: addresses_count: The number of addresses in the wallet
+    def record_wallet_download_progress(self, label, page_offsets,
+                                        addresses_count):
+        stmt = ('INSERT OR REPLACE INTO '
+                '' + SQL_TABLE_NAME_WALLET_DOWNLOAD_PROGRESS + ' (label, '
+                'page_offset, addresses_count) VALUES (?,?,?)')
+        arglist = [(label, page_offset, addresses_count)
+                   for page_offset in page_offsets]
+        self.run_statement(stmt, arglist, execute_many = True)
+
+    #Forgets the progress of a wallet's download, e.g. once it's complete.
+    def delete_wallet_download_progress(self, label):
+        stmt = ('DELETE FROM ' + SQL_TABLE_NAME_WALLET_DOWNLOAD_PROGRESS + ' '
+                'WHERE label = ?')
+        self.run_statement(stmt, (label,))
 
     ###################### SEEN ADDRESSES CACHE FUNCTIONS ######################
 
     def has_address_been_seen_cache_if_not(self,
                                            btc_address,
-                                           block_height_first_seen = None):
+                                           block_height_first_seen = None,
+                                           benchmarker = None):
         validate.check_address_and_die(btc_address,
                                        'get_blame_label_for_btc_address')
         if block_height_first_seen is not None:
@@ -2100,29 +3120,295 @@ class Database:
                                        'block_height_first_seen',
                                        'has_address_been_seen_cache_if_not')
 
-        #http://stackoverflow.com/questions/9755860/valid-query-to-check-if-row-exists-in-sqlite3
-        stmt = ('SELECT EXISTS(SELECT 1 FROM '
-                '' + SQL_TABLE_NAME_ADDRESSES_SEEN + ''
-                ' WHERE address=? LIMIT 1) AS is_first')
-        arglist = (btc_address,)
-        caller = 'has_address_been_seen_cache_if_not'
-        column_name = 'is_first'
-        result = self.fetch_query_single_int(stmt, arglist, caller, column_name)
-        dprint("result: %s" % str(result))
+        if USE_IN_MEMORY_SEEN_ADDRESS_INDEX:
+            index = self.get_seen_address_index()
+            if btc_address in index:
+                return True
+            #caller responsible for calling write_stored_seen_addresses()
+            index.add(btc_address)
+            self.in_memory_seen_address_cache.append(
+                (block_height_first_seen, btc_address))
+            return False
+
+        bloom = None
+        key = None
+        if USE_SEEN_ADDRESS_BLOOM_FILTER:
+            bloom = self.get_seen_address_bloom_filter()
+            key = seen_address_index.get_address_key(btc_address)
+
+        if bloom is not None and key not in bloom:
+            #definitely not in the table, no need to ask it
+            result = 0
+            if benchmarker is not None:
+                benchmarker.increment_seen_address_filter_negatives()
+        else:
+            #http://stackoverflow.com/questions/9755860/valid-query-to-check-if-row-exists-in-sqlite3
+            stmt = ('SELECT EXISTS(SELECT 1 FROM '
+                    '' + SQL_TABLE_NAME_ADDRESSES_SEEN + ''
+                    ' WHERE address=? LIMIT 1) AS is_first')
+            arglist = (self._encode_address(btc_address, add_if_new = False),)
+            caller = 'has_address_been_seen_cache_if_not'
+            column_name = 'is_first'
+            result = self.fetch_query_single_int(stmt, arglist, caller,
+                                                 column_name)
+            dprint("result: %s" % str(result))
+            if bloom is not None and benchmarker is not None:
+                if result == 0:
+                    benchmarker.increment_seen_address_filter_false_positives()
+                else:
+                    benchmarker.increment_seen_address_filter_true_positives()
+
         if result == 0:
             if block_height_first_seen is None:
                 stmt = ('INSERT INTO ' + SQL_TABLE_NAME_ADDRESSES_SEEN + ''
                         '(address) VALUES (?)')
-                arglist = (btc_address,)
+                arglist = (self._encode_address(btc_address),)
             else:
                 stmt = ('INSERT INTO ' + SQL_TABLE_NAME_ADDRESSES_SEEN + ''
                         ' (block_height_first_seen, address) VALUES (?,?)')
-                arglist = (block_height_first_seen, btc_address,)
+                arglist = (block_height_first_seen,
+                           self._encode_address(btc_address),)
             self.run_statement(stmt, arglist)
+            if bloom is not None:
+                bloom.add(key)
+                bloom.synced_rowid = self.cursor.lastrowid
             return False
         else:
             return True
 
+    def have_addresses_been_seen_cache_if_not(self, btc_address_list,
+                                              block_height_first_seen,
+                                              benchmarker = None):
+        """Set-based version of `has_address_been_seen_cache_if_not`.
+
+        Answers for every address in a block at once: the addresses that are
+        already in the seen addresses table are found with a handful of
+        chunked `IN` queries, and the new ones are inserted as a batch. An
+        address that appears more than once in the list counts as seen from
+        its second appearance on, exactly as if the single-address function
+        had been called once per element in order.
+
+        Args:
+            btc_address_list (list of str): Output addresses in the order in
+                which they appear in the block.
+            block_height_first_seen (int): Height recorded for new addresses.
+            benchmarker (Optional[`block_reader_benchmark.Benchmark`])
+
+        Returns:
+            list of bool: For each element of `btc_address_list`, whether the
+                address had been seen before that position.
+        """
+        validate.check_int_and_die(block_height_first_seen,
+                                   'block_height_first_seen',
+                                   'have_addresses_been_seen_cache_if_not')
+
+        if USE_IN_MEMORY_SEEN_ADDRESS_INDEX:
+            #The index is already a hash lookup, nothing to batch
+            return [self.has_address_been_seen_cache_if_not(
+                        btc_address, block_height_first_seen, benchmarker)
+                    for btc_address in btc_address_list]
+
+        for btc_address in btc_address_list:
+            validate.check_address_and_die(
+                btc_address, 'have_addresses_been_seen_cache_if_not')
+
+        distinct_addresses = list(set(btc_address_list))
+
+        #Only ask the table about addresses that the Bloom filter can't rule
+        #   out
+        bloom = None
+        if USE_SEEN_ADDRESS_BLOOM_FILTER:
+            bloom = self.get_seen_address_bloom_filter()
+            candidates = []
+            for btc_address in distinct_addresses:
+                if seen_address_index.get_address_key(btc_address) in bloom:
+                    candidates.append(btc_address)
+                elif benchmarker is not None:
+                    benchmarker.increment_seen_address_filter_negatives()
+        else:
+            candidates = distinct_addresses
+
+        seen = self.get_addresses_in_seen_addresses_table(candidates)
+        if bloom is not None and benchmarker is not None:
+            for btc_address in candidates:
+                if btc_address in seen:
+                    benchmarker.increment_seen_address_filter_true_positives()
+                else:
+                    benchmarker.increment_seen_address_filter_false_positives()
+
+        results = []
+        new_addresses = []
+        for btc_address in btc_address_list:
+            if btc_address in seen:
+                results.append(True)
+            else:
+                results.append(False)
+                seen.add(btc_address)
+                new_addresses.append((block_height_first_seen, btc_address))
+
+        if len(new_addresses) > 0:
+            stmt = ('INSERT INTO ' + SQL_TABLE_NAME_ADDRESSES_SEEN + ''
+                    ' (block_height_first_seen, address) VALUES (?,?)')
+            self._prefetch_ids(btc_addresses = [btc_address for (_, btc_address)
+                                                in new_addresses])
+            arglist = [(block_height, self._encode_address(btc_address))
+                       for (block_height, btc_address) in new_addresses]
+            self.run_statement(stmt, arglist, execute_many=True)
+            if bloom is not None:
+                for (_, btc_address) in new_addresses:
+                    bloom.add(seen_address_index.get_address_key(btc_address))
+                self._reset_seen_address_bloom_filter_sync_point()
+
+        return results
+
+    def get_addresses_in_seen_addresses_table(self, btc_address_list):
+        """Get the subset of addresses that are in the seen addresses table.
+
+        Returns:
+            set of str
+        """
+        found = set()
+        caller = 'get_addresses_in_seen_addresses_table'
+        for start in range(0, len(btc_address_list),
+                           SQLITE_MAX_VARIABLE_NUMBER):
+            chunk = [self._encode_address(btc_address, add_if_new = False)
+                     for btc_address in
+                     btc_address_list[start:start + SQLITE_MAX_VARIABLE_NUMBER]]
+            stmt = ('SELECT address FROM ' + SQL_TABLE_NAME_ADDRESSES_SEEN + ''
+                    ' WHERE address IN (' + ','.join(['?'] * len(chunk)) + ')')
+            rows = self.fetch_query_and_handle_errors(stmt, chunk, caller)
+            if rows is not None:
+                for row in rows:
+                    found.add(self._decode_address(row['address']))
+        return found
+
+    def get_seen_address_index(self):
+        """Get the seen address index, loading it from the db if needed."""
+        if self.seen_address_index is None:
+            self.seen_address_index = (
+                seen_address_index.InMemorySeenAddressIndex())
+            self.load_seen_address_index(self.seen_address_index)
+        return self.seen_address_index
+
+    def load_seen_address_index(self, index):
+        """Add every address in the seen addresses table to `index`."""
+        stmt = ('SELECT ' + self._get_seen_address_col_expr() + ' AS address '
+                'FROM ' + self._get_seen_address_from_clause())
+        dprint("Loading seen address index...")
+        #Iterate with a separate cursor rather than fetch_query(), since the
+        #   table can be far too large to fetch all at once.
+        cursor = self.con.cursor()
+        cursor.execute(stmt)
+        while True:
+            rows = cursor.fetchmany(LOAD_SEEN_ADDRESS_INDEX_N_ROWS_AT_A_TIME)
+            if not rows:
+                break
+            index.load(row['address'] for row in rows)
+        cursor.close()
+        dprint("Loaded %d addresses into seen address index." % len(index))
+
+    def get_seen_address_bloom_filter(self):
+        """Get the seen address Bloom filter, opening or building it if needed.
+
+        If the filter file is missing it is built from the seen addresses
+        table. If rows were added to the table since the filter was last
+        synced, for example by a run with the filter disabled, they are added
+        to the filter first.
+        """
+        if self.seen_address_bloom_filter is None:
+            filename = (self.config_store.SQLITE_DB_FILENAME +
+                        SEEN_ADDRESS_BLOOM_FILTER_FILENAME_SUFFIX)
+            self.seen_address_bloom_filter = bloom_filter.BloomFilter(
+                filename, SEEN_ADDRESS_BLOOM_FILTER_EXPECTED_NUM_ITEMS,
+                SEEN_ADDRESS_BLOOM_FILTER_FALSE_POSITIVE_RATE)
+            self._sync_seen_address_bloom_filter(
+                self.seen_address_bloom_filter)
+        return self.seen_address_bloom_filter
+
+    def rebuild_seen_address_bloom_filter(self):
+        """Clear the seen address Bloom filter and refill it from the table."""
+        bloom = self.get_seen_address_bloom_filter()
+        bloom.clear()
+        self._sync_seen_address_bloom_filter(bloom)
+
+    def flush_seen_address_bloom_filter(self):
+        """Persist the Bloom filter, e.g. once per block processed."""
+        if self.seen_address_bloom_filter is not None:
+            self.seen_address_bloom_filter.flush()
+
+    def _sync_seen_address_bloom_filter(self, bloom):
+        """Add rows of the seen table above the filter's synced rowid."""
+        stmt = ('SELECT s.rowid AS rowid, ' + self._get_seen_address_col_expr() +
+                ' AS address FROM ' + self._get_seen_address_from_clause() +
+                ' WHERE s.rowid > ? ORDER BY s.rowid')
+        cursor = self.con.cursor()
+        cursor.execute(stmt, (bloom.synced_rowid,))
+        num_added = 0
+        while True:
+            rows = cursor.fetchmany(LOAD_SEEN_ADDRESS_INDEX_N_ROWS_AT_A_TIME)
+            if not rows:
+                break
+            for row in rows:
+                bloom.add(seen_address_index.get_address_key(row['address']))
+            bloom.synced_rowid = rows[-1]['rowid']
+            num_added = num_added + len(rows)
+        cursor.close()
+        bloom.flush()
+        dprint("Added %d addresses to seen address Bloom filter." % num_added)
+
+    def _get_seen_address_from_clause(self):
+        """FROM clause for reading seen addresses in bulk, aliased as `s`.
+
+        In schema version 3 this joins the address dictionary, so that
+        addresses are read in their encoded form without a lookup per row.
+        """
+        if self.schema_version >= 3:
+            return (SQL_TABLE_NAME_ADDRESSES_SEEN + ' s JOIN '
+                    '' + SQL_TABLE_NAME_ADDRESS_DICT + ' d ON d.id = s.address')
+        return SQL_TABLE_NAME_ADDRESSES_SEEN + ' s'
+
+    def _get_seen_address_col_expr(self):
+        if self.schema_version >= 3:
+            return 'd.address'
+        return 's.address'
+
+    def _reset_seen_address_bloom_filter_sync_point(self):
+        """Point the filter's synced rowid at the highest rowid in the table.
+
+        Called after rows are deleted from the table so that rowids reused by
+        later inserts aren't mistaken for rows already added to the filter.
+        Deleted addresses stay in the filter, which only costs a SELECT.
+        """
+        if self.seen_address_bloom_filter is None:
+            return
+        stmt = ('SELECT MAX(rowid) AS max_rowid FROM '
+                '' + SQL_TABLE_NAME_ADDRESSES_SEEN)
+        caller = '_reset_seen_address_bloom_filter_sync_point'
+        max_rowid = self.fetch_query_single_int(stmt, [], caller, 'max_rowid')
+        if max_rowid is None:
+            max_rowid = -1
+        self.seen_address_bloom_filter.synced_rowid = max_rowid
+        self.seen_address_bloom_filter.flush()
+
+    def write_stored_seen_addresses(self):
+        """Write addresses first seen since the last call to the db.
+
+        Must be called by users of `has_address_been_seen_cache_if_not` when
+        `USE_IN_MEMORY_SEEN_ADDRESS_INDEX` is set to True, e.g. once per block.
+        """
+        if len(self.in_memory_seen_address_cache) == 0:
+            return
+        stmt = ('INSERT OR IGNORE INTO ' + SQL_TABLE_NAME_ADDRESSES_SEEN + ' '
+                '(block_height_first_seen, address) VALUES (?,?)')
+        self._prefetch_ids(btc_addresses = [
+            btc_address for (_, btc_address)
+            in self.in_memory_seen_address_cache])
+        arglist = [(block_height, self._encode_address(btc_address))
+                   for (block_height, btc_address)
+                   in self.in_memory_seen_address_cache]
+        self.run_statement(stmt, arglist, execute_many = True)
+        self.in_memory_seen_address_cache = []
+
     #In the event that something goes wrong while updating the database and
     #   we need to rollback partial results, specfiy the maximum block height
     #   at which to retain data. Beyond that height, cached data is deleted.
@@ -2131,10 +3417,17 @@ class Database:
         caller = 'rollback_seen_addresses_cache_to_block_height'
         validate.check_int_and_die(max_block_height, var_name, caller)
 
+        #Pending addresses were all seen after the last block written, and the
+        #   index may now hold addresses that are about to be deleted, so
+        #   discard both and reload the index on next use.
+        self.in_memory_seen_address_cache = []
+        self.seen_address_index = None
+
         stmt = ('DELETE FROM ' + SQL_TABLE_NAME_ADDRESSES_SEEN + ''
                 ' WHERE block_height_first_seen > ?')
         arglist = (max_block_height,)
         self.run_statement(stmt, arglist)
+        self._reset_seen_address_bloom_filter_sync_point()
 
     ######################## RELAYED-BY CACHE FUNCTIONS ########################
 
@@ -2143,7 +3436,7 @@ class Database:
 
         stmt = ('SELECT relayed_by FROM ' + SQL_TABLE_NAME_RELAYED_BY_CACHE + ''
                 ' WHERE tx_id = ?')
-        arglist = (tx_id,)
+        arglist = (self._encode_tx_id(tx_id, add_if_new = False),)
         caller = 'get_cached_relayed_by'
         column_name = 'relayed_by'
         relayed_by = self.fetch_query_single_str(stmt, arglist, caller,
@@ -2158,7 +3451,7 @@ class Database:
             SQL_SCHEMA_RELAYED_BY_CACHE)
         stmt = ('INSERT INTO ' + SQL_TABLE_NAME_RELAYED_BY_CACHE + ''
                 '(' + col_names + ') VALUES (?,?,?)')
-        arglist = (block_height, tx_id, relayed_by)
+        arglist = (block_height, self._encode_tx_id(tx_id), relayed_by)
         self.run_statement(stmt, arglist)
 
     #In the event that something goes wrong while updating the database and
@@ -2201,8 +3494,15 @@ class Database:
     def write_stored_output_addresses(self):
         stmt = ('INSERT OR IGNORE INTO ' + SQL_TABLE_NAME_TX_OUTPUT_CACHE + ' '
                 '(block_height, tx_id, output_pos, address) VALUES (?,?,?,?)')
-        self.run_statement(stmt, self.in_memory_tx_output_cache,
-                           execute_many = True)
+        arglist = self.in_memory_tx_output_cache
+        if self.schema_version >= 2:
+            self._prefetch_ids(tx_ids = [tup[1] for tup in arglist],
+                               btc_addresses = [tup[3] for tup in arglist])
+            arglist = [(block_height, self._encode_tx_id(tx_id), output_pos,
+                        self._encode_address(address))
+                       for (block_height, tx_id, output_pos, address)
+                       in arglist]
+        self.run_statement(stmt, arglist, execute_many = True)
         self.in_memory_tx_output_cache = []
 
     #Queries from DB cache the output address for specified tx and output. If
@@ -2210,12 +3510,72 @@ class Database:
     def get_output_address(self, tx_id, output_pos):
         stmt = ('SELECT address FROM ' + SQL_TABLE_NAME_TX_OUTPUT_CACHE + ' '
                 'WHERE tx_id = ? AND output_pos = ? LIMIT 1')
-        arglist = (tx_id, output_pos)
+        arglist = (self._encode_tx_id(tx_id, add_if_new = False), output_pos)
         caller = 'get_output_address'
         column_name = 'address'
+        if self.schema_version >= 2:
+            #fetch_query_single_str() would turn a BLOB into its raw bytes
+            records = self.fetch_query_and_handle_errors(stmt, arglist, caller)
+            if records is None or records[0][column_name] is None:
+                return None
+            return self._decode_address(records[0][column_name])
         addr = self.fetch_query_single_str(stmt, arglist, caller, column_name)
         return addr
 
+    #Bulk version of get_output_address() that looks up many outputs with one
+    #   query. Unlike get_output_address(), distinguishes outputs cached with
+    #   no address (because it can't be decoded) from outputs not cached.
+    #param0: output_keys: List of (tx_id, output_pos) tuples
+    #Returns: dict mapping each (tx_id, output_pos) tuple found in the cache to
+    #   its address, or to None if the address can't be decoded
+    def get_output_addresses(self, output_keys):
+        if len(output_keys) == 0:
+            return {}
+        encode = encode_tx_id if self.schema_version >= 2 else lambda x: x
+        self._write_output_keys_needed(output_keys, encode)
+
+        if self.schema_version >= 3:
+            #Translate txids to and addresses from ids in the same query
+            stmt = ('SELECT k.key_index AS key_index, d.address AS address '
+                    'FROM ' + SQL_TABLE_NAME_OUTPUT_KEYS_NEEDED + ' k JOIN '
+                    '' + SQL_TABLE_NAME_TX_DICT + ' t ON t.tx_id = k.tx_id '
+                    'JOIN ' + SQL_TABLE_NAME_TX_OUTPUT_CACHE + ' c ON '
+                    'c.tx_id = t.id AND c.output_pos = k.output_pos LEFT JOIN '
+                    '' + SQL_TABLE_NAME_ADDRESS_DICT + ' d ON d.id = '
+                    'c.address')
+        else:
+            stmt = ('SELECT k.key_index AS key_index, c.address AS address '
+                    'FROM ' + SQL_TABLE_NAME_OUTPUT_KEYS_NEEDED + ' k JOIN '
+                    '' + SQL_TABLE_NAME_TX_OUTPUT_CACHE + ' c ON c.tx_id = '
+                    'k.tx_id AND c.output_pos = k.output_pos')
+        caller = 'get_output_addresses'
+        records = self.fetch_query_and_handle_errors(stmt, [], caller)
+        self.run_statement('DELETE FROM ' + SQL_TABLE_NAME_OUTPUT_KEYS_NEEDED,
+                           [])
+
+        addresses = {}
+        if records is None:
+            return addresses
+        for record in records:
+            address = record['address']
+            if self.schema_version >= 2:
+                address = decode_address(address)
+            addresses[output_keys[record['key_index']]] = address
+        return addresses
+
+    #Helper for bulk lookups of outputs, which join the temp table of output
+    #   keys filled in here with the table the outputs are in.
+    #param0: output_keys: List of (tx_id, output_pos) tuples
+    #param1: encode: Converts a txid to its form in the joined table
+    def _write_output_keys_needed(self, output_keys, encode):
+        arglist = [(key_index, encode(tx_id), output_pos)
+                   for key_index, (tx_id, output_pos) in enumerate(output_keys)]
+        self.run_statement('DELETE FROM ' + SQL_TABLE_NAME_OUTPUT_KEYS_NEEDED,
+                           [])
+        stmt = ('INSERT INTO ' + SQL_TABLE_NAME_OUTPUT_KEYS_NEEDED + ' '
+                '(key_index, tx_id, output_pos) VALUES (?,?,?)')
+        self.run_statement(stmt, arglist, execute_many = True)
+
     #Returns the highest block height in the cache. Returns None if information
     #   for no transactions has been cached.
     def get_highest_output_address_cached_height(self):
@@ -2231,6 +3591,223 @@ class Database:
         else:
             return highest
 
+    ########################### UTXO SPILL FUNCTIONS ###########################
+
+    #Writes (tx_id, output_pos, address) tuples spilled from a UTXO cache
+    def write_spilled_utxos(self, arglist):
+        if len(arglist) == 0:
+            return
+        stmt = ('INSERT OR REPLACE INTO ' + SQL_TABLE_NAME_UTXO_SPILL + ' '
+                '(tx_id, output_pos, address) VALUES (?,?,?)')
+        arglist = [(encode_tx_id(tx_id), output_pos, encode_address(address))
+                   for (tx_id, output_pos, address) in arglist]
+        self.run_statement(stmt, arglist, execute_many = True)
+
+    #Looks up many spilled outputs with one query, like
+    #   get_output_addresses(). The outputs stay spilled until
+    #   delete_spilled_utxos() is called for them.
+    #param0: output_keys: List of (tx_id, output_pos) tuples
+    #Returns: dict mapping each (tx_id, output_pos) tuple found to its
+    #   address, or to None if it has no address
+    def get_spilled_utxos(self, output_keys):
+        if len(output_keys) == 0:
+            return {}
+        self._write_output_keys_needed(output_keys, encode_tx_id)
+        stmt = ('SELECT k.key_index AS key_index, s.address AS address FROM '
+                '' + SQL_TABLE_NAME_OUTPUT_KEYS_NEEDED + ' k JOIN '
+                '' + SQL_TABLE_NAME_UTXO_SPILL + ' s ON s.tx_id = k.tx_id AND '
+                's.output_pos = k.output_pos')
+        caller = 'get_spilled_utxos'
+        records = self.fetch_query_and_handle_errors(stmt, [], caller)
+        self.run_statement('DELETE FROM ' + SQL_TABLE_NAME_OUTPUT_KEYS_NEEDED,
+                           [])
+
+        utxos = {}
+        if records is None:
+            return utxos
+        for record in records:
+            utxos[output_keys[record['key_index']]] = decode_address(
+                record['address'])
+        return utxos
+
+    #Deletes spilled outputs once they have been spent. Call within the
+    #   block_transaction() of the block spending them, so that they stay
+    #   spilled if the block isn't written.
+    #param0: output_keys: List of (tx_id, output_pos) tuples
+    def delete_spilled_utxos(self, output_keys):
+        if len(output_keys) == 0:
+            return
+        stmt = ('DELETE FROM ' + SQL_TABLE_NAME_UTXO_SPILL + ' WHERE tx_id = ? '
+                'AND output_pos = ?')
+        arglist = [(encode_tx_id(tx_id), output_pos)
+                   for (tx_id, output_pos) in output_keys]
+        self.run_statement(stmt, arglist, execute_many = True)
+
+    ######################## FIRST SEEN INDEX FUNCTIONS ########################
+
+    #Returns the height of the first block not yet merged into the first seen
+    #   index, i.e. 0 if the index is empty.
+    def get_first_seen_index_next_height(self):
+        stmt = ('SELECT next_block_height FROM '
+                '' + SQL_TABLE_NAME_FIRST_SEEN_PROGRESS + ' LIMIT 1')
+        caller = 'get_first_seen_index_next_height'
+        next_height = self.fetch_query_single_int(stmt, [], caller,
+                                                  'next_block_height')
+        if next_height is None:
+            return 0
+        return next_height
+
+    #Merges the first seen positions found in a range of blocks into the
+    #   index. Ranges must be merged in order of height with no gaps, so that
+    #   an address already in the index keeps its earlier position.
+    #param0: first_seen: dict mapping each address key, per
+    #   seen_address_index.get_address_key(), to its first (block_height,
+    #   tx_index, output_pos) in the range
+    #param1: start_height: First block of the range
+    #param2: end_height: Block after the last block of the range
+    def merge_first_seen_positions(self, first_seen, start_height,
+                                   end_height):
+        next_height = self.get_first_seen_index_next_height()
+        if start_height != next_height:
+            msg = ("Blocks %d to %d can't be merged into the first seen index, "
+                   "which ends before block %d.") % (start_height,
+                                                     end_height - 1,
+                                                     next_height)
+            logger.log_and_die(msg)
+
+        def write_first_seen():
+            stmt = ('INSERT OR IGNORE INTO ' + SQL_TABLE_NAME_FIRST_SEEN + ' '
+                    '(address, block_height, tx_index, output_pos) VALUES '
+                    '(?,?,?,?)')
+            arglist = [(buffer(key), block_height, tx_index, output_pos)
+                       for key, (block_height, tx_index, output_pos)
+                       in first_seen.iteritems()]
+            self.run_statement(stmt, arglist, execute_many = True)
+            self.run_statement(
+                'DELETE FROM ' + SQL_TABLE_NAME_FIRST_SEEN_PROGRESS, [])
+            stmt = ('INSERT INTO ' + SQL_TABLE_NAME_FIRST_SEEN_PROGRESS + ' '
+                    '(next_block_height) VALUES (?)')
+            self.run_statement(stmt, (end_height,))
+
+        self.run_in_block_transaction(write_first_seen)
+
+    #Returns a dict mapping each of the specified addresses that is in the
+    #   first seen index to its (block_height, tx_index, output_pos).
+    def get_first_seen_positions(self, btc_address_list):
+        keys_by_address = dict(
+            (btc_address, seen_address_index.get_address_key(btc_address))
+            for btc_address in set(btc_address_list))
+        addresses_by_key = dict((key, btc_address) for btc_address, key
+                                in keys_by_address.iteritems())
+        keys = addresses_by_key.keys()
+        positions = {}
+        caller = 'get_first_seen_positions'
+        for start in range(0, len(keys), SQLITE_MAX_VARIABLE_NUMBER):
+            chunk = [buffer(key) for key in
+                     keys[start:start + SQLITE_MAX_VARIABLE_NUMBER]]
+            stmt = ('SELECT address, block_height, tx_index, output_pos FROM '
+                    '' + SQL_TABLE_NAME_FIRST_SEEN + ' WHERE address IN '
+                    '(' + ','.join(['?'] * len(chunk)) + ')')
+            rows = self.fetch_query_and_handle_errors(stmt, chunk, caller)
+            if rows is not None:
+                for row in rows:
+                    btc_address = addresses_by_key[str(row['address'])]
+                    positions[btc_address] = (row['block_height'],
+                                              row['tx_index'],
+                                              row['output_pos'])
+        return positions
+
+    #Copies the block stats and blame stats of a range of blocks processed
+    #   into a separate staging database into this one, with INSERT ... SELECT
+    #   statements, and records the range's throughput. Blame ids, and in
+    #   schema version 3 the ids of txids and addresses, are looked up by
+    #   value, since the staging database numbers them independently. The
+    #   copy is one transaction, so a range is merged completely or not at
+    #   all.
+    #param0: staging_filename: Database file with the same schema version as
+    #   this one
+    #param1: start_height: First block of the range
+    #param2: end_height: Block after the last block of the range
+    #param3: worker_pid: Id of the process that processed the range
+    #param4: seconds: Time the worker took to process the range
+    #Returns: tuple of the number of blocks and the number of txs merged
+    def merge_staging_database(self, staging_filename, start_height,
+                               end_height, worker_pid, seconds):
+        #ATTACH is not allowed inside a transaction
+        self.run_statement('ATTACH DATABASE ? AS staging',
+                           (staging_filename,))
+        try:
+            stmt = ('SELECT COUNT(*) AS num_blocks, '
+                    'IFNULL(SUM(tx_total_num), 0) AS num_txs FROM '
+                    'staging.' + SQL_TABLE_NAME_BLOCK_STATS)
+            record = self.fetch_query_and_handle_errors(
+                stmt, [], 'merge_staging_database')[0]
+            (num_blocks, num_txs) = (record['num_blocks'], record['num_txs'])
+
+            if self.schema_version >= 3:
+                tx_expr = ('(SELECT id FROM main.' + SQL_TABLE_NAME_TX_DICT +
+                           ' WHERE tx_id = (SELECT tx_id FROM '
+                           'staging.' + SQL_TABLE_NAME_TX_DICT + ' WHERE id = '
+                           't.confirmed_tx_id))')
+                address_expr = ('(SELECT id FROM main.' +
+                                SQL_TABLE_NAME_ADDRESS_DICT + ' WHERE address '
+                                '= (SELECT address FROM '
+                                'staging.' + SQL_TABLE_NAME_ADDRESS_DICT + ' '
+                                'WHERE id = t.relevant_address))')
+            else:
+                tx_expr = 't.confirmed_tx_id'
+                address_expr = 't.relevant_address'
+            blame_id_expr = ('(SELECT rowid FROM main.' +
+                             SQL_TABLE_NAME_BLAME_IDS + ' WHERE label = '
+                             '(SELECT label FROM '
+                             'staging.' + SQL_TABLE_NAME_BLAME_IDS + ' WHERE '
+                             'rowid = t.blame_recipient_id) LIMIT 1)')
+
+            def write_merged_rows():
+                stmt = ('INSERT INTO main.' + SQL_TABLE_NAME_BLAME_IDS + ' '
+                        '(label) SELECT DISTINCT label FROM '
+                        'staging.' + SQL_TABLE_NAME_BLAME_IDS + ' s WHERE NOT '
+                        'EXISTS (SELECT 1 FROM main.' +
+                        SQL_TABLE_NAME_BLAME_IDS + ' WHERE label = s.label)')
+                self.run_statement(stmt, [])
+                if self.schema_version >= 3:
+                    for (dict_table, dict_col) in [
+                            (SQL_TABLE_NAME_TX_DICT, 'tx_id'),
+                            (SQL_TABLE_NAME_ADDRESS_DICT, 'address')]:
+                        stmt = ('INSERT OR IGNORE INTO main.%s (%s) SELECT %s '
+                                'FROM staging.%s' % (dict_table, dict_col,
+                                                     dict_col, dict_table))
+                        self.run_statement(stmt, [])
+
+                col_names = get_comma_separated_list_of_col_names(
+                    SQL_SCHEMA_BLOCK_STATS)
+                stmt = ('INSERT INTO main.' + SQL_TABLE_NAME_BLOCK_STATS + ' '
+                        '(' + col_names + ') SELECT ' + col_names + ' FROM '
+                        'staging.' + SQL_TABLE_NAME_BLOCK_STATS)
+                self.run_statement(stmt, [])
+
+                col_names = get_comma_separated_list_of_col_names(
+                    SQL_SCHEMA_BLAME_STATS)
+                stmt = ('INSERT INTO main.' + SQL_TABLE_NAME_BLAME_STATS + ' '
+                        '(' + col_names + ') SELECT ' + blame_id_expr + ', '
+                        't.address_reuse_type, t.role, t.data_source, '
+                        't.block_height, ' + tx_expr + ', ' + address_expr +
+                        ' FROM staging.' + SQL_TABLE_NAME_BLAME_STATS + ' t')
+                self.run_statement(stmt, [])
+
+                col_names = get_comma_separated_list_of_col_names(
+                    SQL_SCHEMA_PARALLEL_RANGE_STATS)
+                stmt = ('INSERT INTO ' + SQL_TABLE_NAME_PARALLEL_RANGE_STATS +
+                        ' (' + col_names + ') VALUES (?,?,?,?,?,?)')
+                self.run_statement(stmt, (start_height, end_height,
+                                          num_blocks, num_txs, worker_pid,
+                                          seconds))
+
+            self.run_in_block_transaction(write_merged_rows)
+        finally:
+            self.run_statement('DETACH DATABASE staging', [])
+        return (num_blocks, num_txs)
+
     ##################### BLOCK DATA PRODUCTION FUNCTIONS ######################
 
     #Returns the highest block height at which the specified block producer has
@@ -2293,12 +3870,16 @@ class IndexManager:
 # GENERAL PACKAGE FUNCTIONS #
 #############################
 
-def get_conditional_create_stmt(table_name, schema_as_dict):
+def get_conditional_create_stmt(table_name, schema_as_dict,
+                                without_rowid = False):
     stmt = 'CREATE TABLE IF NOT EXISTS %s (' % table_name
     for varname, datatype in schema_as_dict.iteritems():
         stmt = stmt + "%s %s," % (varname, datatype)
     stmt = stmt.rstrip(',') #remove trailing comma
-    stmt = stmt + ');'
+    stmt = stmt + ')'
+    if without_rowid:
+        stmt = stmt + ' WITHOUT ROWID'
+    stmt = stmt + ';'
     return stmt
 
 def get_comma_separated_list_of_col_names(schema_as_dict):
@@ -2308,10 +3889,246 @@ def get_comma_separated_list_of_col_names(schema_as_dict):
     col_names = col_names.rstrip(',') #remove trailing comma
     return col_names
 
+def encode_tx_id(tx_id):
+    """Get the schema version 2 form of a txid: its 32 bytes as a BLOB.
+
+    Anything other than a 64-character hex string is returned unchanged.
+    """
+    if tx_id is not None and len(tx_id) == 64:
+        try:
+            return buffer(unhexlify(tx_id))
+        except TypeError:
+            pass #not hex
+    return tx_id
+
+def decode_tx_id(value):
+    """Inverse of `encode_tx_id`."""
+    if isinstance(value, buffer):
+        return hexlify(value)
+    return value
+
+def encode_address(btc_address):
+    """Get the schema version 2 form of an address as a BLOB.
+
+    The BLOB is the address's version byte followed by its hash160. Anything
+    that isn't a Base58Check P2PKH or P2SH address is returned unchanged.
+    """
+    if btc_address is None:
+        return None
+    decoded = base58.decode_address(btc_address)
+    if decoded is None:
+        return btc_address
+    return buffer(decoded)
+
+def decode_address(value):
+    """Inverse of `encode_address`."""
+    if isinstance(value, buffer):
+        return base58.encode_address(str(value))
+    return value
+
+def migrate_db_schema(source_filename, dest_filename,
+                      dest_schema_version = LATEST_SCHEMA_VERSION):
+    """Copy a database into a new file with a later schema version.
+
+    Every table is copied; txids and addresses in the high-volume tables are
+    encoded on the way, and from version 4 the label cache's labels are moved
+    to the wallet clusters table. Rowids are preserved, so blame ids and the
+    seen address table's rowids (and thus its Bloom filter) remain valid. The
+    source file is not modified.
+
+    Args:
+        source_filename (str): Existing database file.
+        dest_filename (str): File to create. Must not exist yet.
+        dest_schema_version (Optional[int]): Version of the new file.
+    """
+    if exists(dest_filename):
+        logger.log_and_die("Migration destination '%s' already exists." %
+                           dest_filename)
+    source = Database(source_filename)
+    source_version = source.schema_version
+    source.close()
+    if not source_version < dest_schema_version <= LATEST_SCHEMA_VERSION:
+        msg = ("Cannot migrate '%s' from schema version %d to version %d.") % (
+            source_filename, source_version, dest_schema_version)
+        logger.log_and_die(msg)
+
+    dest = Database(dest_filename, new_db_schema_version = dest_schema_version)
+    #Both functions leave values that are already encoded as they are, so
+    #   they work on a version 2 source too.
+    dest.con.create_function('encode_tx_id', 1, encode_tx_id)
+    dest.con.create_function('encode_address', 1, encode_address)
+    dest.run_statement('ATTACH DATABASE ? AS src', (source_filename,))
+
+    if source_version >= 3:
+        #Keep the source's ids, so that the other tables' ids remain valid
+        for (dict_table, dict_col) in [(SQL_TABLE_NAME_TX_DICT, 'tx_id'),
+                                       (SQL_TABLE_NAME_ADDRESS_DICT,
+                                        'address')]:
+            print("Copying %s..." % dict_table)
+            stmt = ('INSERT INTO main.%s (id, %s) SELECT id, %s FROM src.%s' %
+                    (dict_table, dict_col, dict_col, dict_table))
+            dest.run_statement(stmt, [])
+        tx_expr = '%s'
+        address_expr = '%s'
+        label_cache_address_expr = '%s'
+    elif dest_schema_version >= 3:
+        #Fill the dictionaries first, so that the other tables can look up ids
+        for (dict_table, dict_col, encode_func, sources) in [
+                (SQL_TABLE_NAME_TX_DICT, 'tx_id', 'encode_tx_id',
+                 [(SQL_TABLE_NAME_BLAME_STATS, 'confirmed_tx_id'),
+                  (SQL_TABLE_NAME_RELAYED_BY_CACHE, 'tx_id'),
+                  (SQL_TABLE_NAME_TX_OUTPUT_CACHE, 'tx_id')]),
+                (SQL_TABLE_NAME_ADDRESS_DICT, 'address', 'encode_address',
+                 [(SQL_TABLE_NAME_ADDRESSES_SEEN, 'address'),
+                  (SQL_TABLE_NAME_BLAME_STATS, 'relevant_address'),
+                  (SQL_TABLE_NAME_BLAME_LABEL_CACHE, 'btc_address'),
+                  (SQL_TABLE_NAME_TX_OUTPUT_CACHE, 'address')])]:
+            for (table_name, col) in sources:
+                print("Adding %s.%s to %s..." % (table_name, col, dict_table))
+                stmt = ('INSERT OR IGNORE INTO main.%s (%s) SELECT %s(%s) '
+                        'FROM src.%s WHERE %s IS NOT NULL' %
+                        (dict_table, dict_col, encode_func, col, table_name,
+                         col))
+                dest.run_statement(stmt, [])
+
+        #Source columns are qualified with the alias `t` in the statements
+        #   below, as the dictionaries have columns of the same names.
+        tx_expr = ('(SELECT id FROM main.' + SQL_TABLE_NAME_TX_DICT + ' WHERE '
+                   'tx_id = encode_tx_id(t.%s))')
+        address_expr = ('(SELECT id FROM main.' + SQL_TABLE_NAME_ADDRESS_DICT +
+                        ' WHERE address = encode_address(t.%s))')
+        label_cache_address_expr = address_expr
+    else:
+        tx_expr = 'encode_tx_id(%s)'
+        address_expr = 'encode_address(%s)'
+        label_cache_address_expr = '%s'
+
+    if dest_schema_version >= 4:
+        print("Adding %s.label to %s..." % (SQL_TABLE_NAME_BLAME_LABEL_CACHE,
+                                            SQL_TABLE_NAME_WALLET_CLUSTERS))
+        stmt = ('INSERT OR IGNORE INTO main.%s (label) SELECT DISTINCT label '
+                'FROM src.%s WHERE label IS NOT NULL' %
+                (SQL_TABLE_NAME_WALLET_CLUSTERS,
+                 SQL_TABLE_NAME_BLAME_LABEL_CACHE))
+        dest.run_statement(stmt, [])
+        #The address id is the new table's rowid
+        label_cache = (
+            SQL_TABLE_NAME_BLAME_LABEL_CACHE, SQL_SCHEMA_BLAME_LABEL_CACHE_V4,
+            ('%s, (SELECT cluster_id FROM main.%s WHERE label = t.label)' %
+             (label_cache_address_expr % 'btc_address',
+              SQL_TABLE_NAME_WALLET_CLUSTERS)),
+            'WHERE btc_address IS NOT NULL AND label IS NOT NULL')
+    else:
+        label_cache = (
+            SQL_TABLE_NAME_BLAME_LABEL_CACHE, SQL_SCHEMA_BLAME_LABEL_CACHE,
+            'rowid, %s, label' % (label_cache_address_expr % 'btc_address'),
+            '')
+
+    #(table name, schema, expressions selected from the source table, extra
+    #   clauses). Rowids are kept except for WITHOUT ROWID tables.
+    tables = [
+        (SQL_TABLE_NAME_BLOCK_STATS, SQL_SCHEMA_BLOCK_STATS, None, ''),
+        (SQL_TABLE_NAME_LAST_N_BLOCKS, SQL_SCHEMA_LAST_N_BLOCKS, None, ''),
+        (SQL_TABLE_NAME_BLAME_IDS, SQL_SCHEMA_BLAME_IDS, None, ''),
+        label_cache,
+        (SQL_TABLE_NAME_BLOCK_DATA_PRODUCTION_STATUS,
+         SQL_SCHEMA_BLOCK_DATA_PRODUCTION_STATUS, None, ''),
+        (SQL_TABLE_NAME_BLAME_STATS, SQL_SCHEMA_BLAME_STATS,
+         ('rowid, blame_recipient_id, address_reuse_type, role, data_source, '
+          'block_height, %s, %s' % (tx_expr % 'confirmed_tx_id',
+                                    address_expr % 'relevant_address')), ''),
+        (SQL_TABLE_NAME_ADDRESSES_SEEN, SQL_SCHEMA_ADDRESSES_SEEN,
+         'rowid, block_height_first_seen, %s' % (address_expr % 'address'),
+         ''),
+        #Selecting in key order keeps the WITHOUT ROWID inserts sequential
+        (SQL_TABLE_NAME_RELAYED_BY_CACHE, SQL_SCHEMA_RELAYED_BY_CACHE,
+         'block_height, %s, relayed_by' % (tx_expr % 'tx_id'),
+         'WHERE tx_id IS NOT NULL ORDER BY tx_id'),
+        (SQL_TABLE_NAME_TX_OUTPUT_CACHE, SQL_SCHEMA_TX_OUTPUT_CACHE,
+         'block_height, %s, output_pos, %s' % (tx_expr % 'tx_id',
+                                              address_expr % 'address'),
+         ('WHERE tx_id IS NOT NULL AND output_pos IS NOT NULL ORDER BY '
+          'tx_id, output_pos'))]
+
+    for (table_name, schema, select_exprs, extra_clauses) in tables:
+        col_names = get_comma_separated_list_of_col_names(schema)
+        if select_exprs is None:
+            select_exprs = 'rowid, ' + col_names
+        if select_exprs.startswith('rowid, '):
+            col_names = 'rowid, ' + col_names
+        stmt = ('INSERT OR IGNORE INTO main.%s (%s) SELECT %s FROM src.%s t %s' %
+                (table_name, col_names, select_exprs, table_name,
+                 extra_clauses))
+        print("Copying %s..." % table_name)
+        dest.run_statement(stmt, [])
+
+    dest.run_statement('DETACH DATABASE src', [])
+    dest.close()
+
 #From: https://wiki.python.org/moin/EscapingHtml
 def html_escape(text):
     return ''.join(HTML_ESCAPE_TABLE.get(c, c) for c in text)
 
+def is_lock_error(err):
+    """Whether an exception from `sqlite3` is SQLITE_BUSY or SQLITE_LOCKED.
+
+    The `sqlite3` module doesn't expose SQLite's result codes, so this goes by
+    the messages SQLite uses for those codes.
+    """
+    if not isinstance(err, sqlite3.OperationalError):
+        return False
+    msg = str(err)
+    return ('database is locked' in msg or
+            'database table is locked' in msg or
+            'database schema is locked' in msg)
+
+def call_with_lock_retry(func, contention_stats = None,
+                         num_attempts = NUM_ATTEMPTS_UPON_DB_ERROR):
+    """Call `func` and return its result, retrying while the db is locked.
+
+    Errors other than a locked database are raised immediately. A locked
+    database is retried up to `num_attempts` attempts in total, sleeping
+    between attempts for an exponentially growing, jittered interval (see
+    `get_lock_backoff_sec`). The lock error is raised if the last attempt
+    fails too.
+
+    Args:
+        func (function): Takes no arguments; executes the statement.
+        contention_stats (Optional[`DatabaseContentionStats`]): Records the
+            number of retries and the time spent waiting on locks.
+        num_attempts (Optional[int]): Default: NUM_ATTEMPTS_UPON_DB_ERROR
+    """
+    num_retries = 0
+    sec_waited = 0.0
+    while True:
+        attempt_start = time()
+        try:
+            result = func()
+        except Exception as err:
+            if not is_lock_error(err) or num_retries + 1 >= num_attempts:
+                if contention_stats is not None:
+                    contention_stats.record(num_retries, sec_waited)
+                raise
+            sec_waited = sec_waited + (time() - attempt_start)
+            backoff_sec = get_lock_backoff_sec(num_retries)
+            dprint(("Database is locked, trying again in %.3f seconds.") %
+                   backoff_sec)
+            sleep(backoff_sec)
+            sec_waited = sec_waited + backoff_sec
+            num_retries = num_retries + 1
+        else:
+            if contention_stats is not None:
+                contention_stats.record(num_retries, sec_waited)
+            return result
+
+def get_lock_backoff_sec(num_retries):
+    """Seconds to wait before retrying after `num_retries` retries: between
+    half and all of an interval that doubles with each retry, from
+    `DB_LOCK_BACKOFF_MIN_SEC` up to `DB_LOCK_BACKOFF_MAX_SEC`."""
+    backoff_sec = min(DB_LOCK_BACKOFF_MAX_SEC,
+                      DB_LOCK_BACKOFF_MIN_SEC * (2 ** num_retries))
+    return uniform(backoff_sec / 2, backoff_sec)
+
 def dprint(str):
     if ENABLE_DEBUG_PRINT:
         print("DEBUG: %s" % str)
@@ -8,6 +8,7 @@
 #       mark_blocks_completed_up_through_height(block_height)
 #       get_list_of_block_heights_with_possibly_crashed_workers()
 #       get_next_block_height_available(starting_height, claim_it, jump_minimum)
+#       contention_stats
 #
 #   Database:
 #       update_blame_record(blame_record)
@@ -18,9 +19,33 @@
 #       get_lowest_block_height_with_deferred_records()
 #       get_all_deferred_blame_records_at_height(block_height)
 #       cache_blame_label_for_btc_address(btc_address, label)
+#       cache_blame_label_for_btc_addresses(btc_addresses, label)
 #       update_blame_label_for_btc_address(btc_address, label)
+#       get_blame_label_for_btc_address(btc_address)
+#           * labels answered from memory, and discarded when changed by this
+#             or another connection to the same file
+#       blame_label_cache_stats
+#       relabel_wallet_cluster(old_label, new_label)
+#           * renaming and merging clusters in schema version 4
+#       set_wallet_id_for_wallet_cluster(label, wallet_id)
 #       write_deferred_blame_record_resolutions()
 #       fetch_more_deferred_records_for_cache() #TODO
+#       has_address_been_seen_cache_if_not(btc_address, block_height_first_seen)
+#       have_addresses_been_seen_cache_if_not(btc_address_list,
+#           block_height_first_seen)
+#       write_stored_seen_addresses()
+#       get_seen_address_bloom_filter()
+#       rebuild_seen_address_bloom_filter()
+#       rollback_seen_addresses_cache_to_block_height(max_block_height)
+#       block_transaction()
+#           * exiting at once, rather than retrying statements, while locked
+#       run_in_block_transaction(func)
+#           * running the transaction again while the database is locked
+#       checkpoint(mode)
+#       checkpoint_if_due()
+#       schema_version
+#       get_output_addresses(output_keys)
+#   migrate_db_schema(source_filename, dest_filename, dest_schema_version)
 #
 #   TODO for Database:
 #       ####### BLOCK STATS FUNCTIONS #######
@@ -49,12 +74,7 @@
 #       get_blame_records_for_blame_id(blame_id, block_height)
 #       rollback_blame_stats_to_block_height(max_block_height)
 #
-#       ####### BLAME CACHE FUNCTIONS ########
-#       get_blame_label_for_btc_address(btc_address)
-#
 #       ####### SEEN ADDRESSES CACHE FUNCTIONS ######
-#       has_address_been_seen_cache_if_not(btc_address, block_height_first_seen)
-#       rollback_seen_addresses_cache_to_block_height(max_block_height)
 #
 #       ####### RELAYED-BY CACHE FUNCTIONS ####
 #       get_cached_relayed_by(tx_id)
@@ -69,6 +89,7 @@
 import address_reuse.db
 import address_reuse.tx_blame
 import address_reuse.custom_errors
+import address_reuse.benchmark.block_reader_benchmark
 
 ####################
 # EXTERNAL IMPORTS #
@@ -77,6 +98,8 @@ import address_reuse.custom_errors
 import unittest
 import os
 import sqlite3
+import threading
+import time
 
 #############
 # CONSTANTS #
@@ -940,6 +963,31 @@ class DatabaseTestCase(unittest.TestCase):
         self.assertEqual(rows[0]['btc_address'], btc_address)
         self.assertEqual(rows[0]['label'], label)
     
+    def test_cache_blame_label_for_btc_addresses(self):
+        label = 'MtGoxAndOthers'
+        btc_addresses = ['1Q6YQHqjC1d6AkPieGgBHwwkCx2ZtcWVQC',
+                         '1PSSGeFHDnKNxiEyFrD1wcEaHr9hrQDDWc',
+                         '#multisig_a74f4a173bb335f7_1']
+        self.database_connector.cache_blame_label_for_btc_address(
+            btc_addresses[0], DB_DEFERRED_BLAME_PLACEHOLDER)
+
+        num_cached = (
+            self.database_connector.cache_blame_label_for_btc_addresses(
+                btc_addresses, label))
+
+        self.assertEqual(num_cached, 2)
+        stmt = ('SELECT * FROM '
+                '' + address_reuse.db.SQL_TABLE_NAME_BLAME_LABEL_CACHE)
+        rows = self.database_connector.fetch_query_and_handle_errors(
+            stmt, [], 'test_cache_blame_label_for_btc_addresses')
+        self.assertEqual(sorted([(row['btc_address'], row['label'])
+                                 for row in rows]),
+                         sorted([(btc_addresses[0], label),
+                                 (btc_addresses[1], label)]))
+        self.assertEqual(
+            self.database_connector.cache_blame_label_for_btc_addresses(
+                [], label), 0)
+
     def test_update_blame_label_for_btc_address_with_no_batching(self):
         init_val = address_reuse.db.UPDATE_BLAME_STATS_ONCE_PER_BLOCK
         address_reuse.db.UPDATE_BLAME_STATS_ONCE_PER_BLOCK = False
@@ -1023,8 +1071,97 @@ class DatabaseTestCase(unittest.TestCase):
         self.assertEqual(len(rows), 1)
         self.assertEqual(rows[0]['btc_address'], btc_address)
         self.assertEqual(rows[0]['label'], new_label)
-        
+
         address_reuse.db.UPDATE_BLAME_STATS_ONCE_PER_BLOCK = init_val
+
+    def test_get_blame_label_for_btc_address_from_memory(self):
+        self.do_test_get_blame_label_for_btc_address_from_memory(1)
+        self.do_test_get_blame_label_for_btc_address_from_memory(4)
+
+    def do_test_get_blame_label_for_btc_address_from_memory(self,
+                                                            schema_version):
+        filename = TEMP_DB_FILENAME + '-v%d' % schema_version
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+        database = address_reuse.db.Database(
+            filename, new_db_schema_version=schema_version)
+        try:
+            addresses = ['1PSSGeFHDnKNxiEyFrD1wcEaHr9hrQDDWc',
+                         '1Q2TWHE3GMdB6BZKafqwxXtWAWgFt5Jvm3',
+                         '1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa']
+            database.cache_blame_label_for_btc_address(addresses[0],
+                                                       'Exchange & Co')
+            database.cache_blame_label_for_btc_address(
+                addresses[1], DB_DEFERRED_BLAME_PLACEHOLDER)
+            for _ in range(0, 3):
+                with database.block_transaction():
+                    self.assertEqual(
+                        [database.get_blame_label_for_btc_address(address)
+                         for address in addresses],
+                        ['Exchange &amp; Co', DB_DEFERRED_BLAME_PLACEHOLDER,
+                         None])
+            #The cached label was written through; placeholders and missing
+            #   labels are looked up every time
+            stats = database.blame_label_cache_stats
+            self.assertEqual((stats.num_hits, stats.num_misses), (3, 6))
+            self.assertAlmostEqual(stats.get_hit_ratio(), 1.0 / 3)
+            self.assertEqual(database.blame_label_lru.get(addresses[0]),
+                             'Exchange &amp; Co')
+
+            #Resolving a placeholder or caching a new address keeps the
+            #   labels in memory...
+            database.update_blame_label_for_btc_address(addresses[1],
+                                                        'Exchange & Co')
+            database.write_deferred_blame_record_resolutions()
+            database.cache_blame_label_for_btc_addresses(addresses,
+                                                         'Exchange & Co')
+            self.assertEqual(stats.num_invalidations, 0)
+            self.assertEqual(database.get_blame_label_for_btc_address(
+                addresses[0]), 'Exchange &amp; Co')
+            self.assertEqual(stats.num_hits, 4)
+
+            #...while changing a label discards them
+            database.update_blame_label_for_btc_address(addresses[0], 'Other')
+            database.write_deferred_blame_record_resolutions()
+            self.assertEqual(stats.num_invalidations, 1)
+            self.assertEqual(database.get_blame_label_for_btc_address(
+                addresses[0]), 'Other')
+        finally:
+            database.close()
+            os.remove(filename)
+
+    def test_blame_labels_in_memory_consistent_across_connections(self):
+        address = '1PSSGeFHDnKNxiEyFrD1wcEaHr9hrQDDWc'
+        self.database_connector.cache_blame_label_for_btc_address(address,
+                                                                  'Foo')
+        #e.g. another deferred blame worker
+        other_database = address_reuse.db.Database(TEMP_DB_FILENAME)
+        try:
+            self.assertEqual(
+                other_database.get_blame_label_for_btc_address(address), 'Foo')
+
+            self.database_connector.cache_blame_label_for_btc_address(address,
+                                                                      'Bar')
+            with other_database.block_transaction():
+                self.assertEqual(
+                    other_database.get_blame_label_for_btc_address(address),
+                    'Bar')
+                #Labels are current as of the start of each block
+                self.database_connector.relabel_wallet_cluster('Bar', 'Baz')
+                self.assertEqual(
+                    other_database.get_blame_label_for_btc_address(address),
+                    'Bar')
+            self.assertEqual(
+                other_database.get_blame_label_for_btc_address(address), 'Baz')
+            self.assertEqual(
+                self.database_connector.get_blame_label_for_btc_address(
+                    address), 'Baz')
+            self.assertEqual(
+                other_database.blame_label_cache_stats.num_invalidations, 2)
+        finally:
+            other_database.close()
         
     def test_fetch_more_deferred_records_for_cache(self):
         stmt = (('INSERT INTO %s (blame_recipient_id, address_reuse_type, role,'
@@ -1107,6 +1244,525 @@ class DatabaseTestCase(unittest.TestCase):
         self.assertFalse(res)
         
 
+    def test_has_address_been_seen_cache_if_not_with_index(self):
+        addr1 = '1PSSGeFHDnKNxiEyFrD1wcEaHr9hrQDDWc'
+        addr2 = '1Q2TWHE3GMdB6BZKafqwxXtWAWgFt5Jvm3'
+        self.assertFalse(
+            self.database_connector.has_address_been_seen_cache_if_not(addr1,
+                                                                       170))
+        self.assertTrue(
+            self.database_connector.has_address_been_seen_cache_if_not(addr1,
+                                                                       170))
+        self.assertFalse(
+            self.database_connector.has_address_been_seen_cache_if_not(addr2,
+                                                                       171))
+
+        stmt = 'SELECT * FROM ' + address_reuse.db.SQL_TABLE_NAME_ADDRESSES_SEEN
+        caller = 'test_has_address_been_seen_cache_if_not_with_index'
+        rows = self.database_connector.fetch_query_and_handle_errors(stmt, [],
+                                                                     caller)
+        if address_reuse.db.USE_IN_MEMORY_SEEN_ADDRESS_INDEX:
+            self.assertIsNone(rows) #not written until explicitly flushed
+            self.database_connector.write_stored_seen_addresses()
+            rows = self.database_connector.fetch_query_and_handle_errors(
+                stmt, [], caller)
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[0]['address'], addr1)
+        self.assertEqual(rows[0]['block_height_first_seen'], 170)
+        self.assertEqual(rows[1]['address'], addr2)
+        self.assertEqual(rows[1]['block_height_first_seen'], 171)
+
+    def test_seen_address_index_loaded_from_db_and_rolled_back(self):
+        addr1 = '1PSSGeFHDnKNxiEyFrD1wcEaHr9hrQDDWc'
+        addr2 = '1Q2TWHE3GMdB6BZKafqwxXtWAWgFt5Jvm3'
+        stmt = ('INSERT INTO ' + address_reuse.db.SQL_TABLE_NAME_ADDRESSES_SEEN +
+                ' (block_height_first_seen, address) VALUES (?,?)')
+        self.database_connector.run_statement(stmt, [(170, addr1), (171, addr2)],
+                                              execute_many=True)
+
+        self.assertTrue(
+            self.database_connector.has_address_been_seen_cache_if_not(addr2,
+                                                                       172))
+
+        self.database_connector.rollback_seen_addresses_cache_to_block_height(
+            170)
+        self.assertTrue(
+            self.database_connector.has_address_been_seen_cache_if_not(addr1,
+                                                                       171))
+        self.assertFalse(
+            self.database_connector.has_address_been_seen_cache_if_not(addr2,
+                                                                       171))
+
+    def test_has_address_been_seen_cache_if_not_with_bloom_filter(self):
+        addr1 = '1PSSGeFHDnKNxiEyFrD1wcEaHr9hrQDDWc'
+        addr2 = '1Q2TWHE3GMdB6BZKafqwxXtWAWgFt5Jvm3'
+        addr3 = '1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa'
+        bloom_filename = (TEMP_DB_FILENAME +
+                          address_reuse.db.SEEN_ADDRESS_BLOOM_FILTER_FILENAME_SUFFIX)
+        try:
+            os.remove(bloom_filename)
+        except OSError:
+            pass
+        old_index = address_reuse.db.USE_IN_MEMORY_SEEN_ADDRESS_INDEX
+        old_bloom = address_reuse.db.USE_SEEN_ADDRESS_BLOOM_FILTER
+        old_num_items = (
+            address_reuse.db.SEEN_ADDRESS_BLOOM_FILTER_EXPECTED_NUM_ITEMS)
+        address_reuse.db.USE_IN_MEMORY_SEEN_ADDRESS_INDEX = False
+        address_reuse.db.USE_SEEN_ADDRESS_BLOOM_FILTER = True
+        address_reuse.db.SEEN_ADDRESS_BLOOM_FILTER_EXPECTED_NUM_ITEMS = 1000
+        try:
+            #row added before the filter existed is picked up when it's built
+            stmt = ('INSERT INTO ' +
+                    address_reuse.db.SQL_TABLE_NAME_ADDRESSES_SEEN +
+                    ' (block_height_first_seen, address) VALUES (?,?)')
+            self.database_connector.run_statement(stmt, (170, addr1))
+
+            benchmarker = (
+                address_reuse.benchmark.block_reader_benchmark.Benchmark())
+            self.assertTrue(
+                self.database_connector.has_address_been_seen_cache_if_not(
+                    addr1, 171, benchmarker))
+            self.assertFalse(
+                self.database_connector.has_address_been_seen_cache_if_not(
+                    addr2, 171, benchmarker))
+            self.assertTrue(
+                self.database_connector.has_address_been_seen_cache_if_not(
+                    addr2, 172, benchmarker))
+            self.assertEqual(benchmarker.seen_address_filter_negatives, 1)
+            self.assertEqual(benchmarker.seen_address_filter_true_positives, 2)
+
+            #filter persists across connections
+            self.database_connector.close()
+            self.database_connector = address_reuse.db.Database(
+                TEMP_DB_FILENAME)
+            bloom = self.database_connector.get_seen_address_bloom_filter()
+            self.assertFalse(bloom.is_new)
+            self.assertEqual(bloom.num_items, 2)
+
+            #a rolled-back address stays in the filter, costing only a SELECT
+            self.database_connector.rollback_seen_addresses_cache_to_block_height(
+                170)
+            self.assertFalse(
+                self.database_connector.has_address_been_seen_cache_if_not(
+                    addr2, 171, benchmarker))
+            self.assertEqual(benchmarker.seen_address_filter_false_positives,
+                             1)
+            self.assertFalse(
+                self.database_connector.has_address_been_seen_cache_if_not(
+                    addr3, 171))
+
+            self.database_connector.rebuild_seen_address_bloom_filter()
+            self.assertEqual(bloom.num_items, 3)
+            self.assertEqual(bloom.synced_rowid, 3)
+        finally:
+            address_reuse.db.USE_IN_MEMORY_SEEN_ADDRESS_INDEX = old_index
+            address_reuse.db.USE_SEEN_ADDRESS_BLOOM_FILTER = old_bloom
+            address_reuse.db.SEEN_ADDRESS_BLOOM_FILTER_EXPECTED_NUM_ITEMS = (
+                old_num_items)
+            self.database_connector.close()
+            self.database_connector = address_reuse.db.Database(
+                TEMP_DB_FILENAME)
+            os.remove(bloom_filename)
+
+    def test_have_addresses_been_seen_cache_if_not_without_index(self):
+        addr1 = '1PSSGeFHDnKNxiEyFrD1wcEaHr9hrQDDWc'
+        addr2 = '1Q2TWHE3GMdB6BZKafqwxXtWAWgFt5Jvm3'
+        addr3 = '1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa'
+        old_index = address_reuse.db.USE_IN_MEMORY_SEEN_ADDRESS_INDEX
+        old_max_vars = address_reuse.db.SQLITE_MAX_VARIABLE_NUMBER
+        address_reuse.db.USE_IN_MEMORY_SEEN_ADDRESS_INDEX = False
+        address_reuse.db.SQLITE_MAX_VARIABLE_NUMBER = 2 #exercise chunking
+        try:
+            self.assertFalse(
+                self.database_connector.has_address_been_seen_cache_if_not(
+                    addr1, 170))
+            results = (
+                self.database_connector.have_addresses_been_seen_cache_if_not(
+                    [addr2, addr1, addr3, addr2], 171))
+            self.assertEqual(results, [False, True, False, True])
+
+            stmt = ('SELECT * FROM ' +
+                    address_reuse.db.SQL_TABLE_NAME_ADDRESSES_SEEN +
+                    ' ORDER BY rowid')
+            caller = 'test_have_addresses_been_seen_cache_if_not_without_index'
+            rows = self.database_connector.fetch_query_and_handle_errors(
+                stmt, [], caller)
+            self.assertEqual([(row['block_height_first_seen'], row['address'])
+                              for row in rows],
+                             [(170, addr1), (171, addr2), (171, addr3)])
+        finally:
+            address_reuse.db.USE_IN_MEMORY_SEEN_ADDRESS_INDEX = old_index
+            address_reuse.db.SQLITE_MAX_VARIABLE_NUMBER = old_max_vars
+
+    def test_block_transaction_commits_once_at_exit(self):
+        addr1 = '1PSSGeFHDnKNxiEyFrD1wcEaHr9hrQDDWc'
+        stmt = ('SELECT COUNT(*) AS num FROM ' +
+                address_reuse.db.SQL_TABLE_NAME_ADDRESSES_SEEN)
+        other_con = sqlite3.connect(TEMP_DB_FILENAME)
+        try:
+            with self.database_connector.block_transaction():
+                with self.database_connector.block_transaction():
+                    self.database_connector.has_address_been_seen_cache_if_not(
+                        addr1, 170)
+                    self.database_connector.write_stored_seen_addresses()
+                #nested context doesn't commit
+                self.assertEqual(other_con.execute(stmt).fetchone()[0], 0)
+            self.assertEqual(other_con.execute(stmt).fetchone()[0], 1)
+        finally:
+            other_con.close()
+
+    def test_block_transaction_rolls_back_on_exception(self):
+        addr1 = '1PSSGeFHDnKNxiEyFrD1wcEaHr9hrQDDWc'
+        addr2 = '1Q2TWHE3GMdB6BZKafqwxXtWAWgFt5Jvm3'
+        self.assertFalse(
+            self.database_connector.has_address_been_seen_cache_if_not(addr1,
+                                                                       170))
+        self.database_connector.write_stored_seen_addresses()
+
+        with self.assertRaises(KeyboardInterrupt):
+            with self.database_connector.block_transaction():
+                self.database_connector.has_address_been_seen_cache_if_not(
+                    addr2, 171)
+                self.database_connector.write_stored_seen_addresses()
+                self.database_connector.store_blame(
+                    'label', address_reuse.db.AddressReuseType.SENDBACK,
+                    address_reuse.db.AddressReuseRole.SENDER,
+                    address_reuse.db.DataSource.BLOCKCHAIN_INFO, 171,
+                    'ab' * 32, addr2)
+                raise KeyboardInterrupt()
+
+        self.assertEqual(self.database_connector.block_transaction_depth, 0)
+        self.assertEqual(len(self.database_connector.in_memory_blame_cache), 0)
+        self.assertTrue(
+            self.database_connector.has_address_been_seen_cache_if_not(addr1,
+                                                                       172))
+        self.assertFalse(
+            self.database_connector.has_address_been_seen_cache_if_not(addr2,
+                                                                       172))
+
+    def test_block_transaction_rolls_back_on_statement_error(self):
+        address = '1PSSGeFHDnKNxiEyFrD1wcEaHr9hrQDDWc'
+        #The statement's error exits the process, not the rollback after it
+        with self.assertRaises(SystemExit):
+            with self.database_connector.block_transaction():
+                self.database_connector.cache_blame_label_for_btc_address(
+                    address, 'label')
+                self.database_connector.run_statement(
+                    'INSERT INTO tblNoSuchTable VALUES (?)', (1,))
+
+        self.assertEqual(self.database_connector.block_transaction_depth, 0)
+        self.assertIsNone(
+            self.database_connector.get_blame_label_for_btc_address(address))
+
+    def reopen_database_without_busy_timeout(self):
+        orig_timeout = address_reuse.db.SQLITE_BUSY_TIMEOUT_SEC
+        address_reuse.db.SQLITE_BUSY_TIMEOUT_SEC = 0.0
+        try:
+            self.database_connector.close()
+            self.database_connector = address_reuse.db.Database(
+                TEMP_DB_FILENAME)
+        finally:
+            address_reuse.db.SQLITE_BUSY_TIMEOUT_SEC = orig_timeout
+
+    def start_other_worker_holding_lock(self, sec):
+        locked = threading.Event()
+        def hold_lock():
+            other_con = sqlite3.connect(TEMP_DB_FILENAME)
+            other_con.execute('BEGIN EXCLUSIVE')
+            locked.set()
+            time.sleep(sec)
+            other_con.rollback()
+            other_con.close()
+        other_worker = threading.Thread(target=hold_lock)
+        other_worker.start()
+        locked.wait()
+        return other_worker
+
+    def test_run_in_block_transaction_runs_again_while_locked(self):
+        self.reopen_database_without_busy_timeout()
+        address = '1PSSGeFHDnKNxiEyFrD1wcEaHr9hrQDDWc'
+        num_calls = [0]
+        def write_label():
+            num_calls[0] = num_calls[0] + 1
+            self.database_connector.cache_blame_label_for_btc_address(
+                address, 'label')
+
+        other_worker = self.start_other_worker_holding_lock(0.2)
+        try:
+            self.database_connector.run_in_block_transaction(write_label)
+        finally:
+            other_worker.join()
+
+        self.assertEqual(
+            self.database_connector.get_blame_label_for_btc_address(address),
+            'label')
+        stats = self.database_connector.contention_stats
+        self.assertGreater(num_calls[0], 1)
+        self.assertEqual(stats.num_retried_transactions, num_calls[0] - 1)
+        #statements inside the transaction weren't retried on their own
+        self.assertEqual(stats.num_retries, 0)
+
+    def test_block_transaction_exits_at_once_while_locked(self):
+        self.reopen_database_without_busy_timeout()
+        address = '1PSSGeFHDnKNxiEyFrD1wcEaHr9hrQDDWc'
+        other_worker = self.start_other_worker_holding_lock(0.2)
+        try:
+            with self.assertRaises(SystemExit):
+                with self.database_connector.block_transaction():
+                    self.database_connector.cache_blame_label_for_btc_address(
+                        address, 'label')
+            self.assertEqual(
+                self.database_connector.contention_stats.num_retries, 0)
+        finally:
+            other_worker.join()
+        self.assertIsNone(
+            self.database_connector.get_blame_label_for_btc_address(address))
+
+    def test_sqlite_pragmas_and_checkpoint(self):
+        #default profile keeps the original journal mode
+        caller = 'test_sqlite_pragmas_and_checkpoint'
+        rows = self.database_connector.fetch_query_and_handle_errors(
+            'PRAGMA journal_mode', [], caller)
+        self.assertEqual(rows[0][0], 'truncate')
+        self.database_connector.close()
+
+        pragmas = [('busy_timeout', 2000), ('journal_mode', 'WAL'),
+                   ('synchronous', 'NORMAL'), ('temp_store', 'MEMORY')]
+        self.database_connector = address_reuse.db.Database(
+            TEMP_DB_FILENAME, sqlite_pragmas=pragmas)
+        try:
+            for (pragma_name, expected) in [('journal_mode', 'wal'),
+                                            ('synchronous', 1),
+                                            ('temp_store', 2),
+                                            ('busy_timeout', 2000)]:
+                rows = self.database_connector.fetch_query_and_handle_errors(
+                    'PRAGMA ' + pragma_name, [], caller)
+                self.assertEqual(rows[0][0], expected)
+
+            config_store = self.database_connector.config_store
+            config_store.SQLITE_CHECKPOINT_INTERVAL_BLOCKS = 2
+            self.database_connector.checkpoint_if_due()
+            self.assertEqual(
+                self.database_connector.num_blocks_since_checkpoint, 1)
+            self.database_connector.checkpoint_if_due()
+            self.assertEqual(
+                self.database_connector.num_blocks_since_checkpoint, 0)
+            (busy, _, _) = self.database_connector.checkpoint('TRUNCATE')
+            self.assertEqual(busy, 0)
+        finally:
+            #leave the temp db file in rollback journal mode for other tests
+            self.database_connector.run_statement(
+                'PRAGMA journal_mode = TRUNCATE', [])
+
+    def store_records_for_schema_test(self, database):
+        """Write a few rows to each table that schema version 2 encodes."""
+        database.store_blame(
+            'label', address_reuse.db.AddressReuseType.SENDBACK,
+            address_reuse.db.AddressReuseRole.SENDER,
+            address_reuse.db.DataSource.BLOCKCHAIN_INFO, 170, 'ab' * 32,
+            '1PSSGeFHDnKNxiEyFrD1wcEaHr9hrQDDWc')
+        database.write_stored_blame()
+        database.has_address_been_seen_cache_if_not(
+            '1Q2TWHE3GMdB6BZKafqwxXtWAWgFt5Jvm3', 170)
+        database.write_stored_seen_addresses()
+        database.record_relayed_by('cd' * 32, 170, '127.0.0.1')
+        database.add_output_address_to_mem_cache(
+            170, 'ef' * 32, 0, '3J98t1WpEZ73CNmQviecrnyiWrnqRhWNLy')
+        database.add_output_address_to_mem_cache(170, 'ef' * 32, 1, None)
+        database.write_stored_output_addresses()
+
+    def check_records_for_schema_test(self, database):
+        blame_id = database.get_blame_id_for_label('label')
+        records = database.get_blame_records_for_blame_id(blame_id)
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0].tx_id, 'ab' * 32)
+        self.assertEqual(records[0].relevant_address,
+                         '1PSSGeFHDnKNxiEyFrD1wcEaHr9hrQDDWc')
+        self.assertEqual(
+            database.get_blamed_address_list_for_role(
+                address_reuse.db.AddressReuseRole.SENDER),
+            ['1PSSGeFHDnKNxiEyFrD1wcEaHr9hrQDDWc'])
+        self.assertEqual(
+            database.get_blame_id_for_role_and_address(
+                address_reuse.db.AddressReuseRole.SENDER,
+                '1PSSGeFHDnKNxiEyFrD1wcEaHr9hrQDDWc'),
+            blame_id)
+        self.assertEqual(
+            database.get_addresses_in_seen_addresses_table(
+                ['1Q2TWHE3GMdB6BZKafqwxXtWAWgFt5Jvm3',
+                 '1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa']),
+            set(['1Q2TWHE3GMdB6BZKafqwxXtWAWgFt5Jvm3']))
+        self.assertTrue(database.has_address_been_seen_cache_if_not(
+            '1Q2TWHE3GMdB6BZKafqwxXtWAWgFt5Jvm3', 171))
+        self.assertEqual(database.get_cached_relayed_by('cd' * 32),
+                         '127.0.0.1')
+        self.assertEqual(database.get_output_address('ef' * 32, 0),
+                         '3J98t1WpEZ73CNmQviecrnyiWrnqRhWNLy')
+        #output 1 is cached without an address; output 2 isn't cached
+        self.assertEqual(
+            database.get_output_addresses([('ef' * 32, 2), ('ef' * 32, 0),
+                                           ('ef' * 32, 1), ('01' * 32, 0)]),
+            {('ef' * 32, 0): '3J98t1WpEZ73CNmQviecrnyiWrnqRhWNLy',
+             ('ef' * 32, 1): None})
+
+    def test_schema_v1_stores_and_reads_records(self):
+        self.store_records_for_schema_test(self.database_connector)
+        self.check_records_for_schema_test(self.database_connector)
+        self.assertEqual(self.database_connector.get_output_addresses([]), {})
+
+    def test_schema_v2_stores_blobs_and_decodes_transparently(self):
+        self.do_test_schema_stores_encoded_values(2, 'blob')
+
+    def test_schema_v3_stores_ids_and_decodes_transparently(self):
+        self.do_test_schema_stores_encoded_values(3, 'integer')
+
+    def test_schema_v4_stores_ids_and_decodes_transparently(self):
+        self.do_test_schema_stores_encoded_values(4, 'integer')
+
+    def test_relabel_wallet_cluster(self):
+        self.do_test_relabel_wallet_cluster(self.database_connector)
+
+    def test_schema_v4_stores_each_wallet_cluster_label_once(self):
+        v4_filename = TEMP_DB_FILENAME + '-v4'
+        try:
+            os.remove(v4_filename)
+        except OSError:
+            pass
+        database = address_reuse.db.Database(v4_filename,
+                                              new_db_schema_version=4)
+        try:
+            self.do_test_relabel_wallet_cluster(database)
+
+            database.set_wallet_id_for_wallet_cluster('Exchange & Co',
+                                                      '637e58bb505ab93d')
+            caller = 'test_schema_v4_stores_each_wallet_cluster_label_once'
+            stmt = ('SELECT wallet_id, label FROM ' +
+                    address_reuse.db.SQL_TABLE_NAME_WALLET_CLUSTERS +
+                    ' ORDER BY cluster_id')
+            records = database.fetch_query_and_handle_errors(stmt, [], caller)
+            #The merged cluster is gone; 'Other' was since given to an address
+            self.assertEqual([(record['wallet_id'], record['label'])
+                              for record in records],
+                             [('637e58bb505ab93d', 'Exchange &amp; Co'),
+                              (None, 'Other')])
+            stmt = ('SELECT typeof(cluster_id) AS col_type FROM ' +
+                    address_reuse.db.SQL_TABLE_NAME_BLAME_LABEL_CACHE +
+                    ' LIMIT 1')
+            self.assertEqual(database.fetch_query_single_str(
+                stmt, [], caller, 'col_type'), 'integer')
+        finally:
+            database.close()
+            os.remove(v4_filename)
+
+    def do_test_relabel_wallet_cluster(self, database):
+        addresses = ['1PSSGeFHDnKNxiEyFrD1wcEaHr9hrQDDWc',
+                     '1Q2TWHE3GMdB6BZKafqwxXtWAWgFt5Jvm3',
+                     '1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa']
+        database.cache_blame_label_for_btc_addresses(addresses[:2],
+                                                     '637e58bb505ab93d')
+        database.cache_blame_label_for_btc_address(addresses[2], 'Other')
+        database.relabel_wallet_cluster('637e58bb505ab93d', 'Exchange & Co')
+        self.assertEqual(
+            [database.get_blame_label_for_btc_address(address)
+             for address in addresses],
+            ['Exchange &amp; Co', 'Exchange &amp; Co', 'Other'])
+
+        #Relabeling a cluster with an existing cluster's label merges them
+        database.relabel_wallet_cluster('Other', 'Exchange & Co')
+        self.assertEqual(database.get_blame_label_for_btc_address(
+            addresses[2]), 'Exchange &amp; Co')
+        database.relabel_wallet_cluster('Exchange & Co', 'Exchange & Co')
+        self.assertEqual(database.get_blame_label_for_btc_address(
+            addresses[0]), 'Exchange &amp; Co')
+
+        database.update_blame_label_for_btc_address(addresses[1], 'Other')
+        database.write_deferred_blame_record_resolutions()
+        self.assertEqual(database.get_blame_label_for_btc_address(
+            addresses[1]), 'Other')
+
+    def do_test_schema_stores_encoded_values(self, schema_version,
+                                             expected_col_type):
+        v2_filename = TEMP_DB_FILENAME + '-v2'
+        try:
+            os.remove(v2_filename)
+        except OSError:
+            pass
+        database = address_reuse.db.Database(
+            v2_filename, new_db_schema_version=schema_version)
+        try:
+            self.assertEqual(database.schema_version, schema_version)
+            self.store_records_for_schema_test(database)
+            self.check_records_for_schema_test(database)
+            self.assertEqual(database.get_output_address('ef' * 32, 1), None)
+
+            caller = 'do_test_schema_stores_encoded_values'
+            for (table, col) in [
+                    (address_reuse.db.SQL_TABLE_NAME_BLAME_STATS,
+                     'confirmed_tx_id'),
+                    (address_reuse.db.SQL_TABLE_NAME_BLAME_STATS,
+                     'relevant_address'),
+                    (address_reuse.db.SQL_TABLE_NAME_ADDRESSES_SEEN,
+                     'address'),
+                    (address_reuse.db.SQL_TABLE_NAME_RELAYED_BY_CACHE,
+                     'tx_id'),
+                    (address_reuse.db.SQL_TABLE_NAME_TX_OUTPUT_CACHE,
+                     'tx_id')]:
+                stmt = 'SELECT typeof(%s) AS col_type FROM %s LIMIT 1' % (
+                    col, table)
+                self.assertEqual(database.fetch_query_single_str(
+                    stmt, [], caller, 'col_type'), expected_col_type)
+            database.close()
+
+            #version is read back from the file, not the constructor
+            database = address_reuse.db.Database(v2_filename)
+            self.assertEqual(database.schema_version, schema_version)
+            self.check_records_for_schema_test(database)
+        finally:
+            database.close()
+            os.remove(v2_filename)
+
+    def test_migrate_db_schema(self):
+        v2_filename = TEMP_DB_FILENAME + '-v2'
+        v3_filename = TEMP_DB_FILENAME + '-v3'
+        v4_filename = TEMP_DB_FILENAME + '-v4'
+        for filename in [v2_filename, v3_filename, v4_filename]:
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+        self.assertEqual(self.database_connector.schema_version, 1)
+        self.store_records_for_schema_test(self.database_connector)
+        self.database_connector.cache_blame_label_for_btc_address(
+            '1PSSGeFHDnKNxiEyFrD1wcEaHr9hrQDDWc', 'label')
+        self.database_connector.cache_blame_label_for_btc_address(
+            '1Q2TWHE3GMdB6BZKafqwxXtWAWgFt5Jvm3', 'label')
+        #1 -> 2 -> 3 -> 4
+        address_reuse.db.migrate_db_schema(TEMP_DB_FILENAME, v2_filename, 2)
+        address_reuse.db.migrate_db_schema(v2_filename, v3_filename, 3)
+        address_reuse.db.migrate_db_schema(v3_filename, v4_filename, 4)
+        try:
+            for (filename, schema_version) in [(v2_filename, 2),
+                                               (v3_filename, 3),
+                                               (v4_filename, 4)]:
+                database = address_reuse.db.Database(filename)
+                try:
+                    self.assertEqual(database.schema_version, schema_version)
+                    self.check_records_for_schema_test(database)
+                    self.assertEqual(
+                        database.get_blame_id_for_label('label'),
+                        self.database_connector.get_blame_id_for_label(
+                            'label'))
+                    self.assertEqual(database.get_blame_label_for_btc_address(
+                        '1PSSGeFHDnKNxiEyFrD1wcEaHr9hrQDDWc'), 'label')
+                    self.assertEqual(database.get_blame_label_for_btc_address(
+                        '1Q2TWHE3GMdB6BZKafqwxXtWAWgFt5Jvm3'), 'label')
+                finally:
+                    database.close()
+        finally:
+            os.remove(v2_filename)
+            os.remove(v3_filename)
+            os.remove(v4_filename)
+
 class BlameResolverCoordinationDatabaseTestCase(unittest.TestCase):
     
     def setUp(self):
@@ -1182,6 +1838,47 @@ class BlameResolverCoordinationDatabaseTestCase(unittest.TestCase):
 
         address_reuse.db.NUM_ATTEMPTS_UPON_DB_ERROR = orig
     
+    def test_run_invalid_statement_fails_fast(self):
+        stmt = 'INSERT INTO tblDoesntExist (kunfoo) VALUES (panda)'
+        start = time.time()
+        with self.assertRaises(address_reuse.custom_errors.TooManyDatabaseErrors):
+            self.coord_db.run_statement(stmt, [])
+        self.assertLess(time.time() - start, 1.0)
+        self.assertEqual(self.coord_db.contention_stats.num_retries, 0)
+
+    def test_run_statement_retries_while_locked(self):
+        orig_timeout = address_reuse.db.SQLITE_BUSY_TIMEOUT_SEC
+        address_reuse.db.SQLITE_BUSY_TIMEOUT_SEC = 0.0
+        try:
+            self.coord_db.close()
+            self.coord_db = address_reuse.db.BlameResolverCoordinationDatabase(
+                filename_override=TEMP_COORD_DB_FILENAME)
+        finally:
+            address_reuse.db.SQLITE_BUSY_TIMEOUT_SEC = orig_timeout
+
+        #Another worker holds the lock for a short while
+        locked = threading.Event()
+        def hold_lock():
+            other_con = sqlite3.connect(TEMP_COORD_DB_FILENAME)
+            other_con.execute('BEGIN EXCLUSIVE')
+            locked.set()
+            time.sleep(0.2)
+            other_con.rollback()
+            other_con.close()
+        other_worker = threading.Thread(target=hold_lock)
+        other_worker.start()
+        locked.wait()
+        try:
+            self.coord_db.claim_block_height(42)
+        finally:
+            other_worker.join()
+
+        self.assertTrue(self.coord_db.is_block_height_claimed(42))
+        stats = self.coord_db.contention_stats
+        self.assertEqual(stats.num_contended_statements, 1)
+        self.assertGreater(stats.num_retries, 0)
+        self.assertGreater(stats.sec_waited, 0.0)
+
     def test_fetch_empty_result(self):
         stmt = ('SELECT * FROM %s WHERE 1=2' % 
                 address_reuse.db.SQL_TABLE_NAME_COORDINATION_REGISTER)
@@ -0,0 +1,274 @@
+"""Processing blocks in parallel, in two passes over the blockchain.
+
+`BlockProcessor.process_block` normally asks the seen address index whether
+each output's address has received funds before, which only gives the right
+answer if every earlier block has been processed first. Blocks must then be
+processed one at a time, in order.
+
+Pass 1 (`build_first_seen_index`) only records where each address first
+received funds: the block height, the index of the transaction within the
+block, and the index of the output within the transaction. Worker processes
+each map a range of blocks to the first position of every address in it, and
+the ranges are reduced in order of height into the database's first seen
+index, where a position already present is never replaced by a later one.
+That table is keyed by address and has no rowid, so it is kept sorted by
+address on disk.
+
+Pass 2 (`process_blocks_in_parallel`) runs `process_block` on ranges of
+blocks in worker processes, in any order. An output has prior tx history if
+and only if its address was first seen at an earlier position, so the readers
+of pass 2 answer from the first seen index instead of the seen address index,
+which is left untouched. Each range is written to a staging database that is
+merged into the main one once the range is done.
+"""
+
+####################
+# INTERNAL IMPORTS #
+####################
+
+import block_processor
+import db
+import logger
+import seen_address_index
+
+####################
+# EXTERNAL IMPORTS #
+####################
+
+import itertools
+import multiprocessing
+import os
+import time
+
+#############
+# CONSTANTS #
+#############
+
+#Set in each worker process by its initializer
+worker_reader = None
+worker_defer_blaming = True
+worker_schema_version = None
+
+#############
+# FUNCTIONS #
+#############
+
+def get_block_ranges(start_height, end_height, range_size):
+    """Splits blocks into consecutive ranges of at most `range_size` blocks.
+
+    Returns:
+        List[tuple]: (start_height, end_height) of each range, in order,
+            where end_height is the block after the last one in the range.
+    """
+    assert range_size >= 1
+    return [(range_start, min(range_start + range_size, end_height))
+            for range_start in range(start_height, end_height, range_size)]
+
+def get_first_seen_positions(block_reader, start_height, end_height):
+    """Finds the first position of each address that receives funds in a
+    range of blocks.
+
+    Args:
+        block_reader (`blockchain_reader.DecodedTxBlockReader`): Reads the
+            blocks. Its `cache_output_addresses` is called with each block,
+            so that a reader relying on the tx output cache can resolve the
+            inputs of any block in pass 2.
+        start_height (int): First block of the range.
+        end_height (int): Block after the last block of the range.
+
+    Returns:
+        dict: Maps each address key, per
+            `seen_address_index.get_address_key`, to its first
+            (block_height, tx_index, output_pos) in the range.
+    """
+    first_seen = {}
+    for block_height in range(start_height, end_height):
+        (tx_ids, tx_jsons) = block_reader.get_decoded_txs_at_height(
+            block_height)
+        block_reader.cache_output_addresses(block_height, tx_ids, tx_jsons)
+        for tx_index, tx_json in enumerate(tx_jsons):
+            address_list = block_reader.get_output_addresses(tx_json)
+            for output_pos, address in enumerate(address_list):
+                if address is None:
+                    continue
+                key = seen_address_index.get_address_key(address)
+                if key not in first_seen:
+                    first_seen[key] = (block_height, tx_index, output_pos)
+    return first_seen
+
+def init_index_worker(reader_factory):
+    global worker_reader
+    worker_reader = reader_factory()
+
+def get_first_seen_positions_in_range(block_range):
+    (start_height, end_height) = block_range
+    return get_first_seen_positions(worker_reader, start_height, end_height)
+
+def build_first_seen_index(database, reader_factory, end_height, num_workers,
+                           range_size):
+    """Pass 1: extends the first seen index up to, but not including,
+    `end_height`.
+
+    Args:
+        database (`db.Database`): Where the index is merged. Only this
+            process writes the index.
+        reader_factory (callable): Returns a new
+            `blockchain_reader.DecodedTxBlockReader` with its own database
+            connection. Called once in each worker process.
+        end_height (int): Block after the last one to index.
+        num_workers (int): Number of worker processes.
+        range_size (int): Number of blocks each worker reads at a time.
+    """
+    start_height = database.get_first_seen_index_next_height()
+    block_ranges = get_block_ranges(start_height, end_height, range_size)
+    if len(block_ranges) == 0:
+        return
+    pool = multiprocessing.Pool(num_workers, init_index_worker,
+                                (reader_factory,))
+    try:
+        #imap() returns each range's result in order of height, as the merge
+        #   requires, while later ranges are still being read.
+        for (block_range, first_seen) in itertools.izip(
+                block_ranges,
+                pool.imap(get_first_seen_positions_in_range, block_ranges)):
+            database.merge_first_seen_positions(first_seen, *block_range)
+            logger.log_status(('Merged blocks %d to %d into the first seen '
+                               'index.') % (block_range[0],
+                                            block_range[1] - 1))
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+def init_processing_worker(reader_factory, defer_blaming, schema_version):
+    global worker_reader
+    global worker_defer_blaming
+    global worker_schema_version
+    worker_reader = reader_factory()
+    worker_reader.use_first_seen_index = True
+    #The UTXO cache only works for blocks read in order
+    worker_reader.utxo_cache = None
+    worker_defer_blaming = defer_blaming
+    worker_schema_version = schema_version
+
+def get_staging_filename(database_filename, block_range):
+    return '%s-range-%d-%d' % (database_filename, block_range[0],
+                               block_range[1])
+
+def remove_database_file(filename):
+    for suffix in ['', '-journal', '-wal', '-shm']:
+        try:
+            os.remove(filename + suffix)
+        except OSError:
+            pass
+
+def process_block_range(work):
+    """Processes the specified blocks of a range into a new staging database.
+
+    Args:
+        work (tuple): The range's (start_height, end_height), the heights in
+            it to process, and the staging database's filename. Whatever a
+            previous, interrupted run left in that file is discarded.
+
+    Returns:
+        tuple: The range, the staging database's filename, this worker's
+            process id, and the number of seconds taken.
+    """
+    (block_range, block_heights, staging_filename) = work
+    start = time.time()
+    remove_database_file(staging_filename)
+    staging_database = db.Database(
+        staging_filename, new_db_schema_version = worker_schema_version)
+    processor = block_processor.BlockProcessor(worker_reader,
+                                               staging_database)
+    try:
+        for block_height in block_heights:
+            processor.process_block(block_height,
+                                    defer_blaming = worker_defer_blaming)
+    finally:
+        staging_database.close()
+    return (block_range, staging_filename, os.getpid(), time.time() - start)
+
+def process_blocks_in_parallel(database, reader_factory, start_height,
+                               end_height, num_workers, range_size,
+                               defer_blaming = True):
+    """Pass 2: processes the blocks from `start_height` up to, but not
+    including, `end_height` in worker processes.
+
+    The blocks are split into ranges of `range_size` blocks. Each worker reads
+    through its own connection to `database`, for the first seen index and
+    the tx output cache, but writes the stats of each range to a staging
+    database of its own, so that workers don't contend for the lock on
+    `database`. This process merges each staging database into `database` as
+    its range completes. Blocks whose stats are already recorded are skipped,
+    so an interrupted run resumes with the ranges it didn't merge.
+
+    Args:
+        database (`db.Database`): Where the stats of every range are merged.
+        reader_factory (callable): As for `build_first_seen_index`.
+        start_height (int): First block to process.
+        end_height (int): Block after the last one to process.
+        num_workers (int): Number of worker processes.
+        range_size (int): Number of blocks in each range.
+        defer_blaming (Optional[bool]): Passed to `process_block`.
+            Default: True
+
+    Returns:
+        dict: Maps the process id of each worker to the number of blocks, the
+            number of txs and the number of seconds it spent processing
+            them in this run.
+    """
+    if not block_processor.RESOLVE_PRIOR_TX_HISTORY_PER_BLOCK:
+        logger.log_and_die(('Processing blocks in parallel requires '
+                            'RESOLVE_PRIOR_TX_HISTORY_PER_BLOCK in '
+                            'block_processor.'))
+    index_end_height = database.get_first_seen_index_next_height()
+    if end_height > index_end_height:
+        msg = ("Can't process blocks up to %d in parallel: the first seen "
+               "index ends before block %d.") % (end_height - 1,
+                                                 index_end_height)
+        logger.log_and_die(msg)
+
+    processed = database.get_block_heights_processed_in_span(start_height,
+                                                             end_height)
+    work = []
+    for block_range in get_block_ranges(start_height, end_height,
+                                        range_size):
+        block_heights = [block_height for block_height in
+                         range(*block_range) if block_height not in processed]
+        if len(block_heights) > 0:
+            staging_filename = get_staging_filename(
+                database.config_store.SQLITE_DB_FILENAME, block_range)
+            work.append((block_range, block_heights, staging_filename))
+    throughput = {}
+    if len(work) == 0:
+        return throughput
+
+    pool = multiprocessing.Pool(num_workers, init_processing_worker,
+                                (reader_factory, defer_blaming,
+                                 database.schema_version))
+    try:
+        for (block_range, staging_filename, worker_pid,
+             seconds) in pool.imap_unordered(process_block_range, work):
+            (num_blocks, num_txs) = database.merge_staging_database(
+                staging_filename, block_range[0], block_range[1], worker_pid,
+                seconds)
+            remove_database_file(staging_filename)
+            (total_blocks, total_txs, total_seconds) = throughput.get(
+                worker_pid, (0, 0, 0.0))
+            throughput[worker_pid] = (total_blocks + num_blocks,
+                                      total_txs + num_txs,
+                                      total_seconds + seconds)
+            logger.log_status(('Merged blocks %d to %d, processed in %.1f '
+                               'sec by process %d.') % (block_range[0],
+                                                        block_range[1] - 1,
+                                                        seconds, worker_pid))
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return throughput
@@ -1,11 +1,32 @@
-"""A module for making HTTP queries."""
+"""A module for making HTTP queries.
+
+Requests go through a pool of persistent connections by default, so that
+repeated queries of the same API site don't each pay for a new TCP connection
+and TLS handshake. Responses may be compressed with gzip or deflate.
+
+Requests to each host are limited to the rate set in the config file, shared
+by every thread and process (see `rate_limiter`), and slowed down further
+while the host answers 429 Too Many Requests or 503 Service Unavailable.
+
+If the config file names a response cache, responses are stored on disk and
+later requests for the same url are answered from it (see `response_cache`).
+"""
 
 import urllib2          # web scraping
 from time import sleep  # pausing before retrying when API site is down
 import ssl              # ssl.SSLError
 import socket           # socket.error
+import httplib          # persistent connections
+import os               # os.getpid
+import threading
+from multiprocessing.pool import ThreadPool
+import urlparse
+import zlib
 
+import config
 import logger
+import rate_limiter
+import response_cache
 
 MAX_RETRY_TIME_IN_SEC = 60
 #Note: If you are querying a large file, this timeout may cause that to fail.
@@ -13,10 +34,311 @@ MAX_RETRY_TIME_IN_SEC = 60
 #   you're requesting.
 NUM_SEC_TIMEOUT = 30
 
+#Reuse connections between requests. Otherwise each request opens its own
+#   connection with urllib2.
+USE_CONNECTION_POOL = True #TODO: move flag to config file?
+
+MAX_NUM_REDIRECTS = 5
+REDIRECT_STATUSES = [301, 302, 303, 307, 308]
+
+#Responses meaning the host wants fewer requests
+SLOW_DOWN_STATUSES = [429, 503]
+
+USER_AGENT = 'Python-urllib/%s' % urllib2.__version__
+
 ENABLE_DEBUG_PRINT = True
 
-def fetch_url(url):
-    """Fetch contents of remote page as string for specified url."""
+#Created on first use by get_connection_pool(), and again in a child process
+connection_pool = None
+connection_pool_lock = threading.Lock()
+
+#Created on first use by get_rate_limiter(), and again in a child process
+rate_limiter_for_process = None
+is_rate_limited = None #False if the config file sets no rate limit
+rate_limiter_lock = threading.Lock()
+
+#Created on first use by get_response_cache(), and again in a child process
+response_cache_for_process = None
+is_response_cache_enabled = None #False if the config file sets no cache file
+response_cache_lock = threading.Lock()
+
+class ConnectionPool(object):
+    """Keeps HTTP and HTTPS connections open for reuse, per host.
+
+    A connection is returned to the pool once its response has been read, and
+    handed to the next request for the same host. Safe to use from several
+    threads, but not across processes.
+
+    Args:
+        max_connections_per_host (int): Connections to each host open at
+            once, whether idle or in use. A request waits for one to be free.
+        timeout (Optional[float]): Socket timeout in seconds.
+
+    Attributes:
+        num_connections_opened (int): Connections opened so far.
+        num_requests (int): Requests made so far, counting each redirect.
+    """
+
+    def __init__(self, max_connections_per_host, timeout = NUM_SEC_TIMEOUT):
+        assert max_connections_per_host >= 1
+        self.max_connections_per_host = max_connections_per_host
+        self.timeout = timeout
+        self.pid = os.getpid()
+        self.condition = threading.Condition()
+        #(scheme, host, port) => list of idle connections
+        self.idle_connections = {}
+        #(scheme, host, port) => number of connections idle or in use
+        self.num_connections = {}
+        self.num_connections_opened = 0
+        self.num_requests = 0
+
+    def close(self):
+        """Closes the idle connections."""
+        with self.condition:
+            for host_key, connections in self.idle_connections.iteritems():
+                for connection in connections:
+                    connection.close()
+                self.num_connections[host_key] = (
+                    self.num_connections[host_key] - len(connections))
+            self.idle_connections = {}
+
+    def get_connection(self, host_key):
+        """Returns an idle connection to the host, or a new one if there are
+        none, as a tuple of the connection and whether it has been used
+        before."""
+        with self.condition:
+            while True:
+                idle = self.idle_connections.get(host_key)
+                if idle:
+                    return (idle.pop(), True)
+                if (self.num_connections.get(host_key, 0) <
+                        self.max_connections_per_host):
+                    self.num_connections[host_key] = (
+                        self.num_connections.get(host_key, 0) + 1)
+                    self.num_connections_opened = (
+                        self.num_connections_opened + 1)
+                    break
+                self.condition.wait()
+        (scheme, host, port) = host_key
+        if scheme == 'https':
+            connection = httplib.HTTPSConnection(host, port,
+                                                 timeout = self.timeout)
+        else:
+            connection = httplib.HTTPConnection(host, port,
+                                                timeout = self.timeout)
+        return (connection, False)
+
+    def release_connection(self, host_key, connection, is_reusable):
+        with self.condition:
+            if is_reusable:
+                self.idle_connections.setdefault(host_key, []).append(
+                    connection)
+            else:
+                connection.close()
+                self.num_connections[host_key] = (
+                    self.num_connections[host_key] - 1)
+            self.condition.notify()
+
+    def request(self, url):
+        """GETs the url, following redirects.
+
+        Returns:
+            tuple: The response's status code, reason phrase, headers as an
+                `httplib.HTTPMessage`, and body, decompressed.
+
+        Raises:
+            urllib2.URLError: If the url is not HTTP or HTTPS.
+            httplib.HTTPException, socket.error: If the request fails.
+        """
+        for _ in range(0, MAX_NUM_REDIRECTS + 1):
+            (status, reason, headers, body) = self.request_once(url)
+            location = headers.getheader('location')
+            if status not in REDIRECT_STATUSES or location is None:
+                break
+            url = urlparse.urljoin(url, location)
+        return (status, reason, headers,
+                decode_content(body, headers.getheader('content-encoding')))
+
+    def request_once(self, url):
+        parts = urlparse.urlsplit(url)
+        scheme = parts.scheme.lower()
+        if scheme not in ['http', 'https']:
+            raise urllib2.URLError("Unsupported URL scheme in '%s'" % url)
+        default_port = (httplib.HTTPS_PORT if scheme == 'https' else
+                        httplib.HTTP_PORT)
+        host_key = (scheme, parts.hostname, parts.port or default_port)
+        path = parts.path or '/'
+        if parts.query:
+            path = path + '?' + parts.query
+        request_headers = {'Accept-Encoding': 'gzip, deflate',
+                           'User-Agent': USER_AGENT}
+
+        while True:
+            (connection, is_reused) = self.get_connection(host_key)
+            try:
+                connection.request('GET', path, headers = request_headers)
+                response = connection.getresponse()
+                body = response.read()
+            except (httplib.HTTPException, socket.error):
+                self.release_connection(host_key, connection, False)
+                if is_reused:
+                    #The server may close an idle connection at any time, so
+                    #   try again on another one.
+                    continue
+                raise
+            self.release_connection(host_key, connection,
+                                    not response.will_close)
+            with self.condition:
+                self.num_requests = self.num_requests + 1
+            return (response.status, response.reason, response.msg, body)
+
+def get_connection_pool():
+    """Returns this process's connection pool, sized per the config file."""
+    global connection_pool
+    with connection_pool_lock:
+        #A pool inherited from the parent process shares its sockets
+        if connection_pool is None or connection_pool.pid != os.getpid():
+            connection_pool = ConnectionPool(
+                config.Config().HTTP_MAX_CONNECTIONS_PER_HOST)
+        return connection_pool
+
+def get_rate_limiter():
+    """Returns this process's rate limiter per the config file, or None if
+    requests aren't rate limited."""
+    global rate_limiter_for_process, is_rate_limited
+    with rate_limiter_lock:
+        if is_rate_limited is False:
+            return None
+        #A limiter inherited from the parent process shares its connection
+        if (rate_limiter_for_process is None or
+                rate_limiter_for_process.pid != os.getpid()):
+            cfg = config.Config()
+            is_rate_limited = (cfg.RATE_LIMIT_REQUESTS_PER_SEC is not None or
+                               bool(cfg.RATE_LIMIT_REQUESTS_PER_SEC_BY_HOST))
+            if not is_rate_limited:
+                return None
+            rate_limiter_for_process = rate_limiter.TokenBucketRateLimiter(
+                cfg.RATE_LIMIT_STATE_FILENAME, cfg.RATE_LIMIT_REQUESTS_PER_SEC,
+                cfg.RATE_LIMIT_BURST, cfg.RATE_LIMIT_REQUESTS_PER_SEC_BY_HOST)
+        return rate_limiter_for_process
+
+def get_response_cache():
+    """Returns this process's response cache per the config file, or None if
+    responses aren't cached."""
+    global response_cache_for_process, is_response_cache_enabled
+    with response_cache_lock:
+        if is_response_cache_enabled is False:
+            return None
+        if (response_cache_for_process is None or
+                response_cache_for_process.pid != os.getpid()):
+            cfg = config.Config()
+            is_response_cache_enabled = (
+                cfg.HTTP_RESPONSE_CACHE_FILENAME is not None)
+            if not is_response_cache_enabled:
+                return None
+            response_cache_for_process = response_cache.ResponseCache(
+                cfg.HTTP_RESPONSE_CACHE_FILENAME,
+                cfg.HTTP_RESPONSE_CACHE_TTL_SEC,
+                int(cfg.HTTP_RESPONSE_CACHE_MAX_MB * 1024 * 1024))
+        return response_cache_for_process
+
+def get_cached_response(url, benchmarker = None):
+    """Returns the response for the url from the response cache, or None if
+    it isn't cached or there is no cache."""
+    cache = get_response_cache()
+    if cache is None:
+        return None
+    response = cache.get(url)
+    if benchmarker is not None:
+        if response is None:
+            benchmarker.increment_http_cache_misses()
+        else:
+            benchmarker.increment_http_cache_hits()
+    return response
+
+def cache_response(url, response):
+    cache = get_response_cache()
+    if cache is not None:
+        cache.put(url, response)
+
+def uncache_response(url):
+    """Removes the url's response from the response cache, e.g. one that the
+    caller found shouldn't be reused."""
+    cache = get_response_cache()
+    if cache is not None:
+        cache.delete(url)
+
+def get_retry_after_sec(headers):
+    """Returns the number of seconds in a Retry-After header, or None if it
+    is missing or an HTTP date."""
+    if headers is None:
+        return None
+    try:
+        return max(0.0, float(headers.getheader('retry-after')))
+    except (TypeError, ValueError):
+        return None
+
+def decode_content(body, content_encoding):
+    """Decompresses a response body per its Content-Encoding header."""
+    if content_encoding is None:
+        return body
+    content_encoding = content_encoding.strip().lower()
+    if content_encoding in ['gzip', 'x-gzip']:
+        return zlib.decompress(body, 16 + zlib.MAX_WBITS)
+    if content_encoding == 'deflate':
+        try:
+            return zlib.decompress(body)
+        except zlib.error:
+            #some servers send raw deflate data without the zlib header
+            return zlib.decompress(body, -zlib.MAX_WBITS)
+    return body
+
+def open_url(url):
+    """Fetch contents of remote page without retrying, once the host's rate
+    limit allows.
+
+    Raises:
+        urllib2.HTTPError: If the response is not 2xx.
+    """
+    limiter = get_rate_limiter()
+    host = urlparse.urlsplit(url).hostname
+    if limiter is not None and host is not None:
+        limiter.acquire(host)
+    try:
+        if not USE_CONNECTION_POOL:
+            return urllib2.urlopen(url=url, timeout=NUM_SEC_TIMEOUT).read()
+        (status, reason, headers, body) = get_connection_pool().request(url)
+        if not 200 <= status < 300:
+            raise urllib2.HTTPError(url, status, reason, headers, None)
+        return body
+    except urllib2.HTTPError as err:
+        if (limiter is not None and host is not None and
+                err.code in SLOW_DOWN_STATUSES):
+            limiter.slow_down(host, get_retry_after_sec(err.hdrs))
+        raise
+
+def fetch_url(url, benchmarker = None, use_cache = True):
+    """Fetch contents of remote page as string for specified url.
+
+    Args:
+        url (str)
+        benchmarker (Optional[`block_reader_benchmark.Benchmark`]): Counts
+            hits and misses of the response cache.
+        use_cache (Optional[bool]): Whether the response may come from, and
+            be stored in, the response cache. Should be False for urls whose
+            response changes, such as the current block height. Default: True
+    """
+    if use_cache:
+        response = get_cached_response(url, benchmarker)
+        if response is not None:
+            return response
+    response = fetch_url_from_remote(url)
+    if use_cache:
+        cache_response(url, response)
+    return response
+
+def fetch_url_from_remote(url):
+    """Fetch contents of remote page, retrying until it can be fetched."""
 
     current_retry_time_in_sec = 0
 
@@ -27,7 +349,7 @@ def fetch_url(url):
         if current_retry_time_in_sec:
             sleep(current_retry_time_in_sec)
         try:
-            response = urllib2.urlopen(url=url, timeout=NUM_SEC_TIMEOUT).read()
+            response = open_url(url)
             if response is None:
                 #For some reason, no handler handled the request
                 logger.log_and_die("No URL handler utilized.")
@@ -53,7 +375,9 @@ def fetch_url(url):
                 print(("Encountered URLError fetching '%s'. Will wait for "
                        "%d seconds before retrying. Error was: '%s'") %
                       (url, current_retry_time_in_sec, str(err)))
-        except socket.error as err:
+        except httplib.InvalidURL:
+            raise #retrying won't help
+        except (socket.error, httplib.HTTPException) as err:
             if current_retry_time_in_sec == MAX_RETRY_TIME_IN_SEC:
                 logger.log_and_die(("URL '%s' could not be fetched (socket "
                                     "error): %s") % (url, str(err)))
@@ -63,6 +387,59 @@ def fetch_url(url):
                        "%d seconds before retrying. Error was: '%s'") %
                       (url, current_retry_time_in_sec, str(err)))
 
+def fetch_urls(urls, num_threads, benchmarker = None):
+    """Fetch contents of several remote pages like `fetch_url`, using up to
+    `num_threads` requests at once for those not in the response cache.
+
+    Each host's rate limit still applies, so concurrent requests mostly hide
+    the latency of each round trip rather than adding load.
+
+    Returns:
+        dict: Maps each url to its contents.
+    """
+    return dict(fetch_urls_as_completed(urls, num_threads, benchmarker))
+
+def fetch_urls_as_completed(urls, num_threads, benchmarker = None):
+    """Like `fetch_urls`, but yields each (url, contents) as soon as it has
+    been fetched, in whatever order the requests complete.
+
+    Responses found in the response cache are yielded first. If the caller
+    stops early, requests still in flight are abandoned.
+    """
+    urls_to_fetch = []
+    for url in set(urls):
+        response = get_cached_response(url, benchmarker)
+        if response is None:
+            urls_to_fetch.append(url)
+        else:
+            yield (url, response)
+    if num_threads <= 1 or len(urls_to_fetch) <= 1:
+        for url in urls_to_fetch:
+            response = fetch_url_from_remote(url)
+            cache_response(url, response)
+            yield (url, response)
+        return
+    pool = ThreadPool(min(num_threads, len(urls_to_fetch)))
+    try:
+        for (url, response, exit_err) in pool.imap_unordered(
+                fetch_url_in_thread, urls_to_fetch):
+            if exit_err is not None:
+                raise exit_err
+            cache_response(url, response)
+            yield (url, response)
+        pool.close()
+        pool.join()
+    finally:
+        pool.terminate()
+
+def fetch_url_in_thread(url):
+    #SystemExit from logger.log_and_die would otherwise stop the pool's worker
+    #   thread without reporting back, and the pool would never return.
+    try:
+        return (url, fetch_url_from_remote(url), None)
+    except SystemExit as err:
+        return (url, None, err)
+
 def dprint(msg):
     """Print debug message."""
     if ENABLE_DEBUG_PRINT:
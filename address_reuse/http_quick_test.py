@@ -0,0 +1,250 @@
+# Unit tests for http.py
+
+#Covers these classes and functions, against a stand-in HTTP server:
+#   ConnectionPool:
+#       request(url)
+#           * with gzip and deflate responses, a redirect, and connections
+#             closed by the server
+#   open_url(url)
+#       * slowing down the rate limit when the server answers 429
+#   fetch_url(url)
+#       * with and without the connection pool
+#   fetch_urls(urls, num_threads)
+#       * one at a time and concurrently, with and without a rate limiter
+#   fetch_urls_as_completed(urls, num_threads)
+#       * stopping before every url is fetched
+#   fetch_url(url, benchmarker, use_cache), fetch_urls(urls, num_threads,
+#       benchmarker)
+#       * with a response cache
+
+####################
+# INTERNAL IMPORTS #
+####################
+
+import http
+import rate_limiter
+import response_cache
+import benchmark.block_reader_benchmark as block_reader_benchmark
+import benchmark.fake_http_server as fake_http_server
+
+####################
+# EXTERNAL IMPORTS #
+####################
+
+import unittest
+import json
+import time
+import urllib2
+import tempfile
+import shutil
+import os
+
+class HTTPConnectionPoolTestCase(unittest.TestCase):
+
+    server              = None
+
+    def setUp(self):
+        http.ENABLE_DEBUG_PRINT = False
+        http.connection_pool = http.ConnectionPool(
+            max_connections_per_host = 2)
+
+    def tearDown(self):
+        http.USE_CONNECTION_POOL = True
+        http.connection_pool.close()
+        http.connection_pool = None
+        http.rate_limiter_for_process = None
+        http.is_rate_limited = None
+        http.response_cache_for_process = None
+        http.is_response_cache_enabled = None
+        if self.server is not None:
+            self.server.stop()
+            self.server = None
+
+    def start_server(self, **kwargs):
+        self.server = fake_http_server.FakeHTTPServer(**kwargs)
+        self.server.start()
+
+    def fetch_path(self, path):
+        response = http.fetch_url(self.server.get_url(path))
+        return json.loads(response)['path']
+
+    def test_fetch_url_reuses_connection(self):
+        self.start_server()
+        for page_num in range(0, 5):
+            self.assertEqual(self.fetch_path('/page/%d?x=1' % page_num),
+                             '/page/%d?x=1' % page_num)
+        self.assertEqual(self.server.num_connections, 1)
+        self.assertEqual(http.connection_pool.num_connections_opened, 1)
+        self.assertEqual(http.connection_pool.num_requests, 5)
+
+    def test_fetch_url_decodes_gzip_and_deflate(self):
+        for content_encoding in ['gzip', 'deflate']:
+            self.start_server(content_encoding = content_encoding)
+            self.assertEqual(self.fetch_path('/compressed'), '/compressed')
+            self.server.stop()
+            self.server = None
+            http.connection_pool.close()
+
+    def test_fetch_url_follows_redirect(self):
+        self.start_server()
+        self.server.redirects['/old'] = '/new'
+        self.assertEqual(self.fetch_path('/old'), '/new')
+        self.assertEqual(self.server.num_http_requests, 2)
+
+    def test_fetch_url_reconnects_when_server_closes_connection(self):
+        self.start_server(max_requests_per_connection = 1)
+        for page_num in range(0, 3):
+            self.assertEqual(self.fetch_path('/page/%d' % page_num),
+                             '/page/%d' % page_num)
+        self.assertEqual(self.server.num_connections, 3)
+
+    def test_open_url_raises_http_error(self):
+        self.start_server()
+        self.server.statuses['/missing'] = 404
+        try:
+            http.open_url(self.server.get_url('/missing'))
+            self.fail('Expected HTTPError')
+        except urllib2.HTTPError as err:
+            self.assertEqual(err.code, 404)
+        #the connection is still usable
+        self.assertEqual(self.fetch_path('/found'), '/found')
+        self.assertEqual(self.server.num_connections, 1)
+
+    def test_requests_per_second_with_and_without_pool(self):
+        num_requests = 20
+        elapsed = {}
+        for use_connection_pool in [False, True]:
+            http.USE_CONNECTION_POOL = use_connection_pool
+            self.start_server(connection_latency_sec = 0.005)
+            start = time.time()
+            for page_num in range(0, num_requests):
+                self.fetch_path('/page/%d' % page_num)
+            elapsed[use_connection_pool] = time.time() - start
+            num_connections = self.server.num_connections
+            self.server.stop()
+            self.server = None
+            http.connection_pool.close()
+            print(("%s: %.1f requests/sec, %d connections") %
+                  ('pooled' if use_connection_pool else 'unpooled',
+                   num_requests / elapsed[use_connection_pool],
+                   num_connections))
+            if use_connection_pool:
+                self.assertEqual(num_connections, 1)
+            else:
+                self.assertEqual(num_connections, num_requests)
+        self.assertLess(elapsed[True], elapsed[False])
+
+    def test_open_url_slows_down_after_too_many_requests(self):
+        self.start_server()
+        self.server.statuses['/busy'] = 429
+        temp_dir = tempfile.mkdtemp()
+        try:
+            limiter = rate_limiter.TokenBucketRateLimiter(
+                os.path.join(temp_dir, 'rate_limit.db'),
+                requests_per_sec = 1000.0)
+            http.rate_limiter_for_process = limiter
+            http.is_rate_limited = True
+            self.assertEqual(self.fetch_path('/found'), '/found')
+            self.assertAlmostEqual(limiter.get_rate('127.0.0.1'), 1000.0)
+            try:
+                http.open_url(self.server.get_url('/busy'))
+                self.fail('Expected HTTPError')
+            except urllib2.HTTPError as err:
+                self.assertEqual(err.code, 429)
+            self.assertAlmostEqual(limiter.get_rate('127.0.0.1'), 500.0,
+                                   places = 0)
+            limiter.close()
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_fetch_urls_concurrently(self):
+        self.start_server(latency_sec = 0.05)
+        http.connection_pool = http.ConnectionPool(
+            max_connections_per_host = 4)
+        urls = [self.server.get_url('/page/%d' % page_num)
+                for page_num in range(0, 8)]
+        max_concurrent_requests = {}
+        for num_threads in [1, 4]:
+            responses = http.fetch_urls(urls + urls[:2], num_threads)
+            max_concurrent_requests[num_threads] = (
+                self.server.max_concurrent_requests)
+            self.assertEqual(sorted(responses.keys()), sorted(urls))
+            for url in urls:
+                self.assertEqual(json.loads(responses[url])['path'],
+                                 url[url.index('/page/'):])
+        #duplicate urls are fetched once
+        self.assertEqual(self.server.num_http_requests, 2 * len(urls))
+        self.assertEqual(max_concurrent_requests[1], 1)
+        self.assertGreater(max_concurrent_requests[4], 1)
+
+    def test_fetch_urls_concurrently_with_rate_limiter(self):
+        self.start_server()
+        http.connection_pool = http.ConnectionPool(
+            max_connections_per_host = 4)
+        urls = [self.server.get_url('/page/%d' % page_num)
+                for page_num in range(0, 8)]
+        temp_dir = tempfile.mkdtemp()
+        try:
+            limiter = rate_limiter.TokenBucketRateLimiter(
+                os.path.join(temp_dir, 'rate_limit.db'),
+                requests_per_sec = 1000.0, burst = len(urls))
+            http.rate_limiter_for_process = limiter
+            http.is_rate_limited = True
+            #the limiter is first used from this thread, then from the pool's
+            self.assertEqual(self.fetch_path('/found'), '/found')
+            responses = http.fetch_urls(urls, 4)
+            self.assertEqual(sorted(responses.keys()), sorted(urls))
+            limiter.close()
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_fetch_urls_as_completed_stops_early(self):
+        self.start_server(latency_sec = 0.05)
+        http.connection_pool = http.ConnectionPool(
+            max_connections_per_host = 4)
+        urls = [self.server.get_url('/page/%d' % page_num)
+                for page_num in range(0, 40)]
+        fetched = []
+        for (url, response) in http.fetch_urls_as_completed(urls, 4):
+            self.assertEqual(json.loads(response)['path'],
+                             url[url.index('/page/'):])
+            fetched.append(url)
+            if len(fetched) == 2:
+                break
+        #requests not yet started when the caller stopped are abandoned
+        time.sleep(0.2)
+        self.assertLess(self.server.num_http_requests, len(urls) / 2)
+
+    def test_fetch_url_with_response_cache(self):
+        self.start_server()
+        temp_dir = tempfile.mkdtemp()
+        try:
+            cache = response_cache.ResponseCache(
+                os.path.join(temp_dir, 'responses.db'))
+            http.response_cache_for_process = cache
+            http.is_response_cache_enabled = True
+            benchmarker = block_reader_benchmark.Benchmark()
+            for _ in range(0, 3):
+                self.assertEqual(json.loads(http.fetch_url(
+                    self.server.get_url('/tx/1'), benchmarker))['path'],
+                    '/tx/1')
+            self.assertEqual(self.server.num_http_requests, 1)
+            self.assertEqual((benchmarker.http_cache_hits,
+                              benchmarker.http_cache_misses), (2, 1))
+
+            #uncacheable urls are always fetched
+            for _ in range(0, 2):
+                http.fetch_url(self.server.get_url('/latest'),
+                               use_cache = False)
+            self.assertEqual(self.server.num_http_requests, 3)
+
+            urls = [self.server.get_url('/tx/%d' % tx_num)
+                    for tx_num in range(0, 4)]
+            responses = http.fetch_urls(urls, 4, benchmarker)
+            self.assertEqual(sorted(responses.keys()), sorted(urls))
+            self.assertEqual(self.server.num_http_requests, 6)
+            self.assertEqual((benchmarker.http_cache_hits,
+                              benchmarker.http_cache_misses), (3, 4))
+            cache.close()
+        finally:
+            shutil.rmtree(temp_dir)
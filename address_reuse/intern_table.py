@@ -0,0 +1,173 @@
+"""Dictionary tables that map strings such as addresses to dense integer ids.
+
+In schema version 3, `db.Database` stores the id of each address and txid in
+its high-volume tables rather than the value itself, so that every value is
+stored once and the tables referencing it hold small integers. Recently used
+mappings are kept in an LRU in each direction so that most lookups don't
+touch the database.
+"""
+
+####################
+# INTERNAL IMPORTS #
+####################
+
+import lru_cache
+
+###########
+# CLASSES #
+###########
+
+class InternTable(object):
+    """Assigns and looks up integer ids for the values in one table.
+
+    The table must have an INTEGER PRIMARY KEY column holding the ids and a
+    UNIQUE column holding the values. Ids are never deleted or reused, so cached
+    mappings stay valid for as long as the rows that created them are
+    committed; callers must call `clear_cache()` after a rollback.
+
+    Args:
+        database (`db.Database`): Database containing the table.
+        table_name (str)
+        col_name (str): Name of the column holding the values.
+        encode (function): Converts a value to the form stored in the table.
+        decode (function): Inverse of `encode`.
+        cache_size (int): Number of mappings to cache in each direction.
+        id_col_name (Optional[str]): Name of the column holding the ids.
+            Default: 'id'
+    """
+
+    def __init__(self, database, table_name, col_name, encode, decode,
+                 cache_size, id_col_name = 'id'):
+        self.database = database
+        self.table_name = table_name
+        self.col_name = col_name
+        self.id_col_name = id_col_name
+        self.encode = encode
+        self.decode = decode
+        self.ids_by_value = lru_cache.LRUCache(cache_size)
+        self.values_by_id = lru_cache.LRUCache(cache_size)
+
+    def get_id(self, value, add_if_new = True):
+        """Get the id for a value.
+
+        Args:
+            value (str): Value to look up. None maps to None.
+            add_if_new (bool): Whether to assign an id to a value that doesn't
+                have one yet. If False, such a value maps to None, which
+                matches no rows in a query.
+
+        Returns:
+            int or None
+        """
+        if value is None:
+            return None
+        value_id = self.ids_by_value.get(value)
+        if value_id is not None:
+            return value_id
+
+        encoded = self.encode(value)
+        select_stmt = ('SELECT ' + self.id_col_name + ' AS id FROM '
+                       '' + self.table_name + ' WHERE '
+                       '' + self.col_name + ' = ?')
+        caller = 'InternTable.get_id'
+        value_id = self.database.fetch_query_single_int(select_stmt,
+                                                        (encoded,), caller,
+                                                        'id')
+        if value_id is None:
+            if not add_if_new:
+                return None
+            stmt = ('INSERT OR IGNORE INTO ' + self.table_name + ' '
+                    '(' + self.col_name + ') VALUES (?)')
+            self.database.run_statement(stmt, (encoded,))
+            if self.database.cursor.rowcount == 1:
+                value_id = self.database.cursor.lastrowid
+            else:
+                #another process added it first
+                value_id = self.database.fetch_query_single_int(
+                    select_stmt, (encoded,), caller, 'id')
+        self._cache(value, value_id)
+        return value_id
+
+    def get_value(self, value_id):
+        """Get the value for an id. None maps to None."""
+        if value_id is None:
+            return None
+        value = self.values_by_id.get(value_id)
+        if value is not None:
+            return value
+
+        stmt = ('SELECT ' + self.col_name + ' AS value FROM '
+                '' + self.table_name + ' WHERE ' + self.id_col_name + ' = ?')
+        caller = 'InternTable.get_value'
+        rows = self.database.fetch_query_and_handle_errors(stmt, (value_id,),
+                                                           caller)
+        if rows is None:
+            return None
+        value = self.decode(rows[0]['value'])
+        self._cache(value, value_id)
+        return value
+
+    def prefetch_ids(self, values, max_variables, add_if_new = True):
+        """Look up the ids of many values with a few queries.
+
+        Call this before `get_id()` is called for each of a batch of values,
+        e.g. all output addresses in a block, so that the ids are cached.
+
+        Args:
+            values (iterable of str)
+            max_variables (int): Maximum number of values per query.
+            add_if_new (bool): Whether to assign ids to values that don't have
+                one yet.
+        """
+        #key on the encoded form, as that is what the table returns
+        uncached = {}
+        for value in values:
+            if value is not None and value not in self.ids_by_value:
+                uncached[get_hashable(self.encode(value))] = value
+        if len(uncached) == 0:
+            return
+
+        self._prefetch_existing_ids(uncached, max_variables)
+        if add_if_new and len(uncached) > 0:
+            stmt = ('INSERT OR IGNORE INTO ' + self.table_name + ' '
+                    '(' + self.col_name + ') VALUES (?)')
+            arglist = [(self.encode(value),) for value in uncached.values()]
+            self.database.run_statement(stmt, arglist, execute_many = True)
+            self._prefetch_existing_ids(uncached, max_variables)
+
+    def clear_cache(self):
+        """Forget cached mappings, e.g. after a transaction is rolled back."""
+        self.ids_by_value.clear()
+        self.values_by_id.clear()
+
+    def _prefetch_existing_ids(self, uncached, max_variables):
+        """Cache ids of values in the table, removing them from `uncached`."""
+        caller = 'InternTable.prefetch_ids'
+        encoded_values = [self.encode(value) for value in uncached.values()]
+        for start in range(0, len(encoded_values), max_variables):
+            chunk = encoded_values[start:start + max_variables]
+            stmt = ('SELECT ' + self.id_col_name + ' AS id, '
+                    '' + self.col_name + ' AS value FROM '
+                    '' + self.table_name + ' WHERE ' + self.col_name + ' IN '
+                    '(' + ','.join(['?'] * len(chunk)) + ')')
+            rows = self.database.fetch_query_and_handle_errors(stmt, chunk,
+                                                               caller)
+            if rows is None:
+                continue
+            for row in rows:
+                value = uncached.pop(get_hashable(row['value']))
+                self._cache(value, row['id'])
+
+    def _cache(self, value, value_id):
+        self.ids_by_value.put(value, value_id)
+        self.values_by_id.put(value_id, value)
+
+#############
+# FUNCTIONS #
+#############
+
+def get_hashable(encoded):
+    """BLOBs are read back as writable buffers, which can't be dict keys."""
+    if isinstance(encoded, buffer):
+        return str(encoded)
+    return encoded
@@ -0,0 +1,52 @@
+"""A bounded in-process cache that evicts the least recently used entry."""
+
+####################
+# EXTERNAL IMPORTS #
+####################
+
+from collections import OrderedDict
+
+###########
+# CLASSES #
+###########
+
+class LRUCache(object):
+    """Mapping of at most `max_size` entries.
+
+    Looking up or storing a key makes it the most recently used. When a new
+    key is stored in a full cache, the least recently used key is evicted.
+
+    Args:
+        max_size (int): Maximum number of entries held.
+    """
+
+    def __init__(self, max_size):
+        assert max_size > 0
+        self.max_size = max_size
+        self.entries = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default = None):
+        """Get the value for `key`, or `default` if it isn't cached."""
+        try:
+            value = self.entries.pop(key)
+        except KeyError:
+            return default
+        self.entries[key] = value #most recently used is last
+        return value
+
+    def put(self, key, value):
+        """Store `value` for `key`, evicting the oldest entry if full."""
+        if key in self.entries:
+            del self.entries[key]
+        elif len(self.entries) >= self.max_size:
+            self.entries.popitem(last=False)
+        self.entries[key] = value
+
+    def clear(self):
+        self.entries = OrderedDict()
@@ -0,0 +1,215 @@
+"""Limiting the rate of requests to each API site, across threads and processes.
+
+`TokenBucketRateLimiter` keeps a token bucket per host. A bucket refills at
+the host's allowed rate up to a burst capacity, and each request takes a
+token, waiting for one if the bucket is empty. Requests reserve their tokens
+in order, so callers sharing a bucket are spaced evenly at exactly the
+allowed rate rather than all sleeping a fixed interval.
+
+The buckets are kept in a small SQLite file of their own, updated in
+`BEGIN IMMEDIATE` transactions, so that every thread and process using the
+same file shares them. The file is separate from the reuse database so that
+waiting on an API site never holds that database's lock.
+
+When a host answers 429 Too Many Requests or 503 Service Unavailable,
+`slow_down` stops requests to it until its Retry-After time has passed, and
+halves its rate. The rate then recovers linearly to the allowed rate over
+`RATE_RECOVERY_SEC`.
+"""
+
+####################
+# EXTERNAL IMPORTS #
+####################
+
+import os
+import sqlite3
+import threading
+import time
+
+#############
+# CONSTANTS #
+#############
+
+#Seconds for a host's rate to recover from a slow down to its allowed rate
+RATE_RECOVERY_SEC = 60.0
+
+#A host is never slowed below this fraction of its allowed rate
+MIN_RATE_FRACTION = 0.05
+
+#Seconds to wait for another process's transaction on the state file
+STATE_FILE_TIMEOUT_SEC = 60.0
+
+STATE_TABLE_NAME = 'tblTokenBuckets'
+
+###########
+# CLASSES #
+###########
+
+class TokenBucketRateLimiter(object):
+    """Spaces out requests to each host per its allowed rate.
+
+    Safe to use from several threads. Each process needs its own instance;
+    instances with the same state file share their buckets.
+
+    Args:
+        state_filename (str): SQLite file holding the buckets. Created if it
+            doesn't exist.
+        requests_per_sec (Optional[float]): Allowed rate for hosts not in
+            `requests_per_sec_by_host`. None for no limit.
+        burst (Optional[int]): Most requests to a host that may be made at
+            once after a pause. Default: 1
+        requests_per_sec_by_host (Optional[dict]): Maps a hostname to its
+            allowed rate, or to None for no limit.
+        clock (Optional[callable]): Returns the current time in seconds.
+        sleep (Optional[callable]): Sleeps for a number of seconds.
+    """
+
+    def __init__(self, state_filename, requests_per_sec = None, burst = 1,
+                 requests_per_sec_by_host = None, clock = time.time,
+                 sleep = time.sleep):
+        assert burst >= 1
+        self.state_filename = state_filename
+        self.requests_per_sec = requests_per_sec
+        self.burst = burst
+        if requests_per_sec_by_host is None:
+            requests_per_sec_by_host = {}
+        self.requests_per_sec_by_host = dict(
+            (host.lower(), rate) for host, rate in
+            requests_per_sec_by_host.iteritems())
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.con = None
+        self.pid = os.getpid()
+
+    def get_allowed_rate(self, host):
+        return self.requests_per_sec_by_host.get(host.lower(),
+                                                 self.requests_per_sec)
+
+    def acquire(self, host):
+        """Waits until a request may be made to the host.
+
+        Returns:
+            float: Seconds waited.
+        """
+        allowed_rate = self.get_allowed_rate(host)
+        if allowed_rate is None:
+            return 0.0
+        with self.lock:
+            with self.get_transaction() as cursor:
+                now = self.clock()
+                (tokens, rate, updated_at, blocked_until) = self.get_bucket(
+                    cursor, host, allowed_rate, now)
+                elapsed = max(0.0, now - updated_at)
+                rate = min(allowed_rate,
+                           rate + allowed_rate * elapsed / RATE_RECOVERY_SEC)
+                tokens = min(float(self.burst), tokens + elapsed * rate)
+                #Take a token now, even if that leaves the bucket in debt;
+                #   the request then waits until the debt is refilled.
+                tokens = tokens - 1
+                start = max(now, blocked_until)
+                wait_until = start + max(0.0, -tokens) / rate
+                self.put_bucket(cursor, host, tokens, rate,
+                                max(now, updated_at), blocked_until)
+        wait_sec = wait_until - now
+        if wait_sec > 0:
+            self.sleep(wait_sec)
+            return wait_sec
+        return 0.0
+
+    def slow_down(self, host, retry_after_sec = None):
+        """Backs off after the host says it is receiving too many requests.
+
+        Args:
+            host (str)
+            retry_after_sec (Optional[float]): From the response's
+                Retry-After header. If not given, requests wait for one
+                interval at the reduced rate.
+        """
+        allowed_rate = self.get_allowed_rate(host)
+        if allowed_rate is None:
+            return
+        with self.lock:
+            with self.get_transaction() as cursor:
+                now = self.clock()
+                (tokens, rate, updated_at, blocked_until) = self.get_bucket(
+                    cursor, host, allowed_rate, now)
+                tokens = min(float(self.burst),
+                             tokens + max(0.0, now - updated_at) * rate)
+                rate = max(allowed_rate * MIN_RATE_FRACTION, rate / 2.0)
+                if retry_after_sec is None:
+                    retry_after_sec = 1.0 / rate
+                blocked_until = max(blocked_until, now + retry_after_sec)
+                #The bucket starts refilling once the block is over. Requests
+                #   that have already reserved slots still go ahead, so keep
+                #   their debt for later requests to wait behind.
+                self.put_bucket(cursor, host, min(tokens, 0.0), rate,
+                                blocked_until, blocked_until)
+
+    def get_rate(self, host):
+        """Returns the host's current rate, which is lower than its allowed
+        rate after a slow down."""
+        allowed_rate = self.get_allowed_rate(host)
+        if allowed_rate is None:
+            return None
+        with self.lock:
+            with self.get_transaction() as cursor:
+                return self.get_bucket(cursor, host, allowed_rate,
+                                       self.clock())[1]
+
+    def close(self):
+        with self.lock:
+            if self.con is not None:
+                self.con.close()
+                self.con = None
+
+    def get_transaction(self):
+        if self.con is None:
+            self.con = sqlite3.connect(self.state_filename,
+                                       timeout = STATE_FILE_TIMEOUT_SEC,
+                                       isolation_level = None,
+                                       check_same_thread = False)
+            self.con.execute('CREATE TABLE IF NOT EXISTS ' + STATE_TABLE_NAME +
+                             ' (host TEXT PRIMARY KEY, tokens REAL NOT NULL, '
+                             'rate REAL NOT NULL, updated_at REAL NOT NULL, '
+                             'blocked_until REAL NOT NULL)')
+        return StateTransaction(self.con)
+
+    def get_bucket(self, cursor, host, allowed_rate, now):
+        """Returns the host's (tokens, rate, updated_at, blocked_until), or a
+        full bucket if it has none yet."""
+        cursor.execute('SELECT tokens, rate, updated_at, blocked_until FROM ' +
+                       STATE_TABLE_NAME + ' WHERE host = ?', (host.lower(),))
+        row = cursor.fetchone()
+        if row is None:
+            return (float(self.burst), allowed_rate, now, 0.0)
+        (tokens, rate, updated_at, blocked_until) = row
+        #the allowed rate may have been lowered since the bucket was saved
+        return (tokens, min(rate, allowed_rate), updated_at, blocked_until)
+
+    def put_bucket(self, cursor, host, tokens, rate, updated_at,
+                   blocked_until):
+        cursor.execute('INSERT OR REPLACE INTO ' + STATE_TABLE_NAME + ' (host, '
+                       'tokens, rate, updated_at, blocked_until) VALUES '
+                       '(?,?,?,?,?)', (host.lower(), tokens, rate, updated_at,
+                                       blocked_until))
+
+class StateTransaction(object):
+    """Context manager for an immediate transaction on the state file, so
+    that reading and updating a bucket is atomic across processes."""
+
+    def __init__(self, con):
+        self.con = con
+        self.cursor = None
+
+    def __enter__(self):
+        self.cursor = self.con.cursor()
+        self.cursor.execute('BEGIN IMMEDIATE')
+        return self.cursor
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.cursor.execute('COMMIT')
+        else:
+            self.cursor.execute('ROLLBACK')
+        return False
@@ -0,0 +1,148 @@
+# Unit tests for rate_limiter.py
+
+#Covers these classes and functions, with a fake clock:
+#   TokenBucketRateLimiter:
+#       acquire(host)
+#           * a burst, then requests spaced at the allowed rate
+#           * a host with its own rate, and one with no limit
+#           * buckets shared by two limiters using the same state file
+#       slow_down(host, retry_after_sec)
+#           * with and without a Retry-After time, and recovery afterwards
+#           * with requests from other threads already waiting for their slots
+#       get_rate(host)
+
+####################
+# INTERNAL IMPORTS #
+####################
+
+import rate_limiter
+
+####################
+# EXTERNAL IMPORTS #
+####################
+
+import unittest
+import tempfile
+import shutil
+import os
+
+class FakeClock(object):
+    """Stands in for time.time and time.sleep; sleeping advances the time."""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now = self.now + seconds
+
+class TokenBucketRateLimiterTestCase(unittest.TestCase):
+
+    temp_dir            = None
+    clock               = None
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.clock = FakeClock()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def get_limiter(self, requests_per_sec = 2.0, burst = 1,
+                    requests_per_sec_by_host = None):
+        return rate_limiter.TokenBucketRateLimiter(
+            os.path.join(self.temp_dir, 'rate_limit.db'), requests_per_sec,
+            burst, requests_per_sec_by_host, clock = self.clock.time,
+            sleep = self.clock.sleep)
+
+    def test_burst_then_allowed_rate(self):
+        limiter = self.get_limiter(requests_per_sec = 2.0, burst = 3)
+        waits = [limiter.acquire('blockchain.info') for _ in range(0, 6)]
+        for (wait, expected) in zip(waits, [0, 0, 0, 0.5, 0.5, 0.5]):
+            self.assertAlmostEqual(wait, expected)
+
+        #The bucket refills during a pause, up to the burst size
+        self.clock.now = self.clock.now + 10
+        waits = [limiter.acquire('blockchain.info') for _ in range(0, 4)]
+        for (wait, expected) in zip(waits, [0, 0, 0, 0.5]):
+            self.assertAlmostEqual(wait, expected)
+
+    def test_waits_only_for_remainder_of_interval(self):
+        limiter = self.get_limiter(requests_per_sec = 1.0)
+        self.assertEqual(limiter.acquire('blockchain.info'), 0)
+        self.clock.now = self.clock.now + 0.75
+        self.assertAlmostEqual(limiter.acquire('blockchain.info'), 0.25)
+
+    def test_rate_per_host(self):
+        limiter = self.get_limiter(
+            requests_per_sec = None,
+            requests_per_sec_by_host = {'WWW.WalletExplorer.com': 0.5})
+        for _ in range(0, 3):
+            self.assertEqual(limiter.acquire('blockchain.info'), 0)
+        self.assertEqual(limiter.acquire('www.walletexplorer.com'), 0)
+        self.assertAlmostEqual(limiter.acquire('www.walletexplorer.com'), 2.0)
+        self.assertIsNone(limiter.get_rate('blockchain.info'))
+
+    def test_limiters_share_state_file(self):
+        limiter_1 = self.get_limiter(requests_per_sec = 1.0)
+        limiter_2 = self.get_limiter(requests_per_sec = 1.0)
+        self.assertEqual(limiter_1.acquire('blockchain.info'), 0)
+        #Each waits for the tokens the other has taken, as if in different
+        #   processes
+        self.assertAlmostEqual(limiter_2.acquire('blockchain.info'), 1.0)
+        self.assertAlmostEqual(limiter_1.acquire('blockchain.info'), 1.0)
+        limiter_1.close()
+        limiter_2.close()
+
+    def test_slow_down_with_retry_after(self):
+        limiter = self.get_limiter(requests_per_sec = 4.0)
+        limiter.acquire('blockchain.info')
+        limiter.slow_down('blockchain.info', retry_after_sec = 30)
+        self.assertAlmostEqual(limiter.get_rate('blockchain.info'), 2.0)
+        self.assertAlmostEqual(limiter.acquire('blockchain.info'), 30 + 0.5)
+        #The rate has begun to recover during the wait
+        self.assertAlmostEqual(limiter.acquire('blockchain.info'), 0.5,
+                               places = 1)
+
+        #Another slow down halves the rate again, and waits one interval
+        limiter.slow_down('blockchain.info')
+        self.assertAlmostEqual(limiter.get_rate('blockchain.info'), 1.0,
+                               places = 1)
+        self.assertAlmostEqual(limiter.acquire('blockchain.info'), 1.0 + 1.0,
+                               places = 1)
+
+        #The rate recovers over RATE_RECOVERY_SEC
+        self.clock.now = self.clock.now + rate_limiter.RATE_RECOVERY_SEC
+        for _ in range(0, 3):
+            limiter.acquire('blockchain.info')
+        self.assertAlmostEqual(limiter.get_rate('blockchain.info'), 4.0)
+        self.assertAlmostEqual(self.clock.sleeps[-1], 0.25)
+
+    def test_slow_down_keeps_outstanding_reservations(self):
+        #As if each request were made from its own thread, so none has
+        #   waited for its slot yet
+        limiter = rate_limiter.TokenBucketRateLimiter(
+            os.path.join(self.temp_dir, 'rate_limit.db'),
+            requests_per_sec = 1.0, clock = self.clock.time,
+            sleep = lambda seconds: None)
+        waits = [limiter.acquire('blockchain.info') for _ in range(0, 4)]
+        for (wait, expected) in zip(waits, [0, 1, 2, 3]):
+            self.assertAlmostEqual(wait, expected)
+
+        limiter.slow_down('blockchain.info', retry_after_sec = 1)
+        #The next request waits for the Retry-After time, then for the three
+        #   reserved slots and its own at the halved rate, rather than going
+        #   at the same time as the last reserved request
+        self.assertAlmostEqual(limiter.acquire('blockchain.info'),
+                               1 + 4 / 0.5)
+
+    def test_slow_down_has_minimum_rate(self):
+        limiter = self.get_limiter(requests_per_sec = 1.0)
+        for _ in range(0, 20):
+            limiter.slow_down('blockchain.info', retry_after_sec = 0)
+        self.assertAlmostEqual(limiter.get_rate('blockchain.info'),
+                               rate_limiter.MIN_RATE_FRACTION)
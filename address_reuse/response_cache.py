@@ -0,0 +1,194 @@
+"""An on-disk cache of responses from the remote APIs.
+
+`ResponseCache` stores the body of each successful `http.fetch_url` response
+in a SQLite file, compressed with zlib. Responses are keyed by the SHA-256
+hash of their url with any API key removed, so that a cache filled with one
+key is used with another, and the file never contains the keys.
+
+Entries older than the cache's time to live are treated as missing, and the
+oldest entries are evicted when the file grows past its maximum size. Without
+a time to live, reprocessing blocks whose responses are all cached makes no
+requests at all.
+"""
+
+####################
+# EXTERNAL IMPORTS #
+####################
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import urllib
+import urlparse
+import zlib
+
+#############
+# CONSTANTS #
+#############
+
+#Query parameters holding the API keys of Blockchain.info and WalletExplorer
+API_KEY_QUERY_PARAMS = ['api_code', 'caller']
+
+#Check the size of the file after this many new entries
+NUM_PUTS_BETWEEN_SIZE_CHECKS = 100
+
+#When the file is too big, evict entries until it is this fraction of the max
+EVICT_TO_FRACTION = 0.9
+
+#Seconds to wait for another process's transaction on the cache file
+CACHE_FILE_TIMEOUT_SEC = 60.0
+
+CACHE_TABLE_NAME = 'tblResponses'
+
+###########
+# CLASSES #
+###########
+
+class ResponseCache(object):
+    """Stores responses on disk, keyed by url.
+
+    Safe to use from several threads. Each process needs its own instance;
+    instances with the same file share their entries.
+
+    Args:
+        filename (str): SQLite file holding the responses. Created if it
+            doesn't exist.
+        ttl_sec (Optional[float]): Seconds after which a response is no longer
+            used. None to use responses however old they are.
+        max_size_bytes (Optional[int]): Size of compressed responses above
+            which the oldest are evicted. None for no limit.
+        clock (Optional[callable]): Returns the current time in seconds.
+
+    Attributes:
+        num_hits (int): Responses found in the cache so far.
+        num_misses (int): Responses not found, or too old, so far.
+    """
+
+    def __init__(self, filename, ttl_sec = None, max_size_bytes = None,
+                 clock = time.time):
+        self.filename = filename
+        self.ttl_sec = ttl_sec
+        self.max_size_bytes = max_size_bytes
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.con = None
+        self.pid = os.getpid()
+        self.num_hits = 0
+        self.num_misses = 0
+        self.num_puts_since_size_check = 0
+
+    def get(self, url):
+        """Returns the cached response for the url, or None."""
+        with self.lock:
+            con = self.get_connection()
+            row = con.execute('SELECT body, fetched_at FROM ' +
+                              CACHE_TABLE_NAME + ' WHERE key = ?',
+                              (get_cache_key(url),)).fetchone()
+            if row is None or self.is_expired(row[1]):
+                self.num_misses = self.num_misses + 1
+                return None
+            self.num_hits = self.num_hits + 1
+            return zlib.decompress(row[0])
+
+    def put(self, url, body):
+        """Stores the response for the url, replacing any older one."""
+        compressed = zlib.compress(body)
+        with self.lock:
+            con = self.get_connection()
+            with con:
+                con.execute('INSERT OR REPLACE INTO ' + CACHE_TABLE_NAME +
+                            ' (key, url, body, size, fetched_at) VALUES '
+                            '(?,?,?,?,?)', (get_cache_key(url),
+                                            remove_api_keys(url),
+                                            sqlite3.Binary(compressed),
+                                            len(compressed), self.clock()))
+            self.num_puts_since_size_check = (
+                self.num_puts_since_size_check + 1)
+            if self.num_puts_since_size_check >= NUM_PUTS_BETWEEN_SIZE_CHECKS:
+                self.evict()
+
+    def delete(self, url):
+        """Forgets the cached response for the url, if any."""
+        with self.lock:
+            con = self.get_connection()
+            with con:
+                con.execute('DELETE FROM ' + CACHE_TABLE_NAME + ' WHERE '
+                            'key = ?', (get_cache_key(url),))
+
+    def evict(self):
+        """Deletes expired entries, then the oldest entries while the file is
+        over its maximum size. Called periodically by `put`; the caller must
+        hold the lock."""
+        self.num_puts_since_size_check = 0
+        con = self.get_connection()
+        with con:
+            if self.ttl_sec is not None:
+                con.execute('DELETE FROM ' + CACHE_TABLE_NAME + ' WHERE '
+                            'fetched_at < ?', (self.clock() - self.ttl_sec,))
+            if self.max_size_bytes is None:
+                return
+            total_size = con.execute('SELECT COALESCE(SUM(size), 0) FROM ' +
+                                     CACHE_TABLE_NAME).fetchone()[0]
+            if total_size <= self.max_size_bytes:
+                return
+            size_to_free = total_size - self.max_size_bytes * EVICT_TO_FRACTION
+            keys = []
+            for (key, size) in con.execute('SELECT key, size FROM ' +
+                                           CACHE_TABLE_NAME + ' ORDER BY '
+                                           'fetched_at'):
+                if size_to_free <= 0:
+                    break
+                keys.append((key,))
+                size_to_free = size_to_free - size
+            con.executemany('DELETE FROM ' + CACHE_TABLE_NAME + ' WHERE '
+                            'key = ?', keys)
+
+    def get_size_bytes(self):
+        """Returns the total size of the compressed responses."""
+        with self.lock:
+            return self.get_connection().execute(
+                'SELECT COALESCE(SUM(size), 0) FROM ' +
+                CACHE_TABLE_NAME).fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            if self.con is not None:
+                self.con.close()
+                self.con = None
+
+    def is_expired(self, fetched_at):
+        return (self.ttl_sec is not None and
+                self.clock() - fetched_at > self.ttl_sec)
+
+    def get_connection(self):
+        if self.con is None:
+            self.con = sqlite3.connect(self.filename,
+                                       timeout = CACHE_FILE_TIMEOUT_SEC,
+                                       check_same_thread = False)
+            self.con.execute('CREATE TABLE IF NOT EXISTS ' + CACHE_TABLE_NAME +
+                             ' (key TEXT PRIMARY KEY, url TEXT NOT NULL, '
+                             'body BLOB NOT NULL, size INTEGER NOT NULL, '
+                             'fetched_at REAL NOT NULL)')
+            self.con.execute('CREATE INDEX IF NOT EXISTS idx_fetched_at ON ' +
+                             CACHE_TABLE_NAME + ' (fetched_at)')
+        return self.con
+
+#############
+# FUNCTIONS #
+#############
+
+def remove_api_keys(url):
+    """Returns the url without the query parameters holding API keys."""
+    parts = urlparse.urlsplit(url)
+    if not parts.query:
+        return url
+    params = [(name, value) for (name, value) in
+              urlparse.parse_qsl(parts.query, keep_blank_values = True)
+              if name not in API_KEY_QUERY_PARAMS]
+    return urlparse.urlunsplit((parts.scheme, parts.netloc, parts.path,
+                                urllib.urlencode(params), parts.fragment))
+
+def get_cache_key(url):
+    return hashlib.sha256(remove_api_keys(url)).hexdigest()
@@ -0,0 +1,114 @@
+# Unit tests for response_cache.py
+
+#Covers these classes and functions, with a fake clock:
+#   ResponseCache:
+#       get(url), put(url, body)
+#           * hits and misses, shared by two caches using the same file
+#           * with a time to live
+#       delete(url)
+#       evict()
+#           * oldest entries first once over the maximum size
+#   get_cache_key(url)
+#       * ignoring API keys
+
+####################
+# INTERNAL IMPORTS #
+####################
+
+import response_cache
+
+####################
+# EXTERNAL IMPORTS #
+####################
+
+import unittest
+import tempfile
+import shutil
+import os
+
+#############
+# CONSTANTS #
+#############
+
+BCI_TX_URL = ('https://blockchain.info/tx/b1fea52486ce0c62bb442b530a3f0132b826'
+              'c74e473d1f2c220bfa78111c5082?format=json&api_code=%s')
+WE_ADDRESS_URL = ('https://www.walletexplorer.com/api/1/address?address='
+                  '1PSSGeFHDnKNxiEyFrD1wcEaHr9hrQDDWc&caller=%s&from=0&count=100')
+
+class ResponseCacheTestCase(unittest.TestCase):
+
+    temp_dir            = None
+    now                 = None
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.now = 1000.0
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def get_cache(self, ttl_sec = None, max_size_bytes = None):
+        return response_cache.ResponseCache(
+            os.path.join(self.temp_dir, 'responses.db'), ttl_sec,
+            max_size_bytes, clock = lambda: self.now)
+
+    def test_get_cache_key_ignores_api_keys(self):
+        self.assertEqual(response_cache.get_cache_key(BCI_TX_URL % 'key-1'),
+                         response_cache.get_cache_key(BCI_TX_URL % 'key-2'))
+        self.assertEqual(response_cache.get_cache_key(WE_ADDRESS_URL % 'me'),
+                         response_cache.get_cache_key(WE_ADDRESS_URL % 'you'))
+        self.assertNotEqual(response_cache.get_cache_key(BCI_TX_URL % 'key'),
+                            response_cache.get_cache_key(WE_ADDRESS_URL %
+                                                         'key'))
+        self.assertEqual(response_cache.remove_api_keys(WE_ADDRESS_URL % 'me'),
+                         ('https://www.walletexplorer.com/api/1/address?'
+                          'address=1PSSGeFHDnKNxiEyFrD1wcEaHr9hrQDDWc&from=0&'
+                          'count=100'))
+
+    def test_hit_and_miss(self):
+        cache = self.get_cache()
+        body = '{"relayed_by": "127.0.0.1"}' * 100
+        self.assertIsNone(cache.get(BCI_TX_URL % 'key-1'))
+        cache.put(BCI_TX_URL % 'key-1', body)
+        self.assertEqual(cache.get(BCI_TX_URL % 'key-2'), body)
+        self.assertEqual((cache.num_hits, cache.num_misses), (1, 1))
+        #stored compressed
+        self.assertLess(cache.get_size_bytes(), len(body) / 10)
+
+        #another process's cache sees the entry
+        other_cache = self.get_cache()
+        self.assertEqual(other_cache.get(BCI_TX_URL % 'key-1'), body)
+        cache.close()
+        other_cache.close()
+
+    def test_delete(self):
+        cache = self.get_cache()
+        cache.put(WE_ADDRESS_URL % 'me', '{"found": false}')
+        cache.put(BCI_TX_URL % 'key', 'kept')
+        cache.delete(WE_ADDRESS_URL % 'you')
+        self.assertIsNone(cache.get(WE_ADDRESS_URL % 'me'))
+        self.assertEqual(cache.get(BCI_TX_URL % 'key'), 'kept')
+        cache.delete(WE_ADDRESS_URL % 'me')
+        cache.close()
+
+    def test_time_to_live(self):
+        cache = self.get_cache(ttl_sec = 60)
+        cache.put(BCI_TX_URL % 'key', 'old')
+        self.now = self.now + 60
+        self.assertEqual(cache.get(BCI_TX_URL % 'key'), 'old')
+        self.now = self.now + 1
+        self.assertIsNone(cache.get(BCI_TX_URL % 'key'))
+        cache.put(BCI_TX_URL % 'key', 'new')
+        self.assertEqual(cache.get(BCI_TX_URL % 'key'), 'new')
+
+    def test_evicts_oldest_over_max_size(self):
+        body = os.urandom(1000) #incompressible
+        cache = self.get_cache(max_size_bytes = 10 * 1100)
+        for page_num in range(0, response_cache.NUM_PUTS_BETWEEN_SIZE_CHECKS):
+            self.now = self.now + 1
+            cache.put('http://example.com/page/%d' % page_num, body)
+        self.assertLessEqual(cache.get_size_bytes(), 10 * 1100)
+        self.assertIsNone(cache.get('http://example.com/page/0'))
+        last_page_num = response_cache.NUM_PUTS_BETWEEN_SIZE_CHECKS - 1
+        self.assertEqual(cache.get('http://example.com/page/%d' %
+                                   last_page_num), body)
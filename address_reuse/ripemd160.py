@@ -0,0 +1,108 @@
+"""RIPEMD-160 in pure Python, for builds of hashlib that don't provide it.
+
+Some OpenSSL builds leave RIPEMD-160 out of `hashlib.new()`. Decoding
+pay-to-pubkey scripts to addresses requires it, so `hash160()` falls back to
+this implementation. It is slow, but only needs to hash public keys.
+"""
+
+####################
+# EXTERNAL IMPORTS #
+####################
+
+import hashlib
+import struct
+
+#############
+# CONSTANTS #
+#############
+
+INITIAL_STATE = (0x67452301, 0xEFCDAB89, 0x98BADCFE, 0x10325476, 0xC3D2E1F0)
+
+#Message word selected at each step, for the left and right lines
+R_LEFT = [
+    0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15,
+    7, 4, 13, 1, 10, 6, 15, 3, 12, 0, 9, 5, 2, 14, 11, 8,
+    3, 10, 14, 4, 9, 15, 8, 1, 2, 7, 0, 6, 13, 11, 5, 12,
+    1, 9, 11, 10, 0, 8, 12, 4, 13, 3, 7, 15, 14, 5, 6, 2,
+    4, 0, 5, 9, 7, 12, 2, 10, 14, 1, 3, 8, 11, 6, 15, 13]
+R_RIGHT = [
+    5, 14, 7, 0, 9, 2, 11, 4, 13, 6, 15, 8, 1, 10, 3, 12,
+    6, 11, 3, 7, 0, 13, 5, 10, 14, 15, 8, 12, 4, 9, 1, 2,
+    15, 5, 1, 3, 7, 14, 6, 9, 11, 8, 12, 2, 10, 0, 4, 13,
+    8, 6, 4, 1, 3, 11, 15, 0, 5, 12, 2, 13, 9, 7, 10, 14,
+    12, 15, 10, 4, 1, 5, 8, 7, 6, 2, 13, 14, 0, 3, 9, 11]
+
+#Rotation at each step, for the left and right lines
+S_LEFT = [
+    11, 14, 15, 12, 5, 8, 7, 9, 11, 13, 14, 15, 6, 7, 9, 8,
+    7, 6, 8, 13, 11, 9, 7, 15, 7, 12, 15, 9, 11, 7, 13, 12,
+    11, 13, 6, 7, 14, 9, 13, 15, 14, 8, 13, 6, 5, 12, 7, 5,
+    11, 12, 14, 15, 14, 15, 9, 8, 9, 14, 5, 6, 8, 6, 5, 12,
+    9, 15, 5, 11, 6, 8, 13, 12, 5, 12, 13, 14, 11, 8, 5, 6]
+S_RIGHT = [
+    8, 9, 9, 11, 13, 15, 15, 5, 7, 7, 8, 11, 14, 14, 12, 6,
+    9, 13, 15, 7, 12, 8, 9, 11, 7, 7, 12, 7, 6, 15, 13, 11,
+    9, 7, 15, 11, 8, 6, 6, 14, 12, 13, 5, 14, 13, 13, 7, 5,
+    15, 5, 8, 11, 14, 14, 6, 14, 6, 9, 12, 9, 12, 5, 15, 8,
+    8, 5, 12, 9, 12, 5, 14, 6, 8, 13, 6, 5, 15, 13, 11, 11]
+
+#Constant added in each round of 16 steps
+K_LEFT = [0x00000000, 0x5A827999, 0x6ED9EBA1, 0x8F1BBCDC, 0xA953FD4E]
+K_RIGHT = [0x50A28BE6, 0x5C4DD124, 0x6D703EF3, 0x7A6D76E9, 0x00000000]
+
+MASK = 0xFFFFFFFF
+
+#############
+# FUNCTIONS #
+#############
+
+def hash160(data):
+    """RIPEMD-160 of the SHA-256 of `data`, as used in Bitcoin addresses."""
+    sha = hashlib.sha256(data).digest()
+    try:
+        return hashlib.new('ripemd160', sha).digest()
+    except ValueError:
+        return ripemd160(sha)
+
+def ripemd160(data):
+    """Returns the 20-byte RIPEMD-160 digest of a string."""
+    #pad to a multiple of 64 bytes, ending with the bit length, as in MD4
+    padded = (data + '\x80' + '\x00' * ((55 - len(data)) % 64) +
+              struct.pack('<Q', (len(data) * 8) & 0xFFFFFFFFFFFFFFFF))
+    state = INITIAL_STATE
+    for start in range(0, len(padded), 64):
+        words = struct.unpack('<16I', padded[start:start + 64])
+        state = compress(state, words)
+    return struct.pack('<5I', *state)
+
+def compress(state, words):
+    (h0, h1, h2, h3, h4) = state
+    (al, bl, cl, dl, el) = state
+    (ar, br, cr, dr, er) = state
+    for j in range(0, 80):
+        rnd = j // 16
+        t = rotate_left((al + f(j, bl, cl, dl) + words[R_LEFT[j]] +
+                         K_LEFT[rnd]) & MASK, S_LEFT[j])
+        t = (t + el) & MASK
+        (al, el, dl, cl, bl) = (el, dl, rotate_left(cl, 10), bl, t)
+        t = rotate_left((ar + f(79 - j, br, cr, dr) + words[R_RIGHT[j]] +
+                         K_RIGHT[rnd]) & MASK, S_RIGHT[j])
+        t = (t + er) & MASK
+        (ar, er, dr, cr, br) = (er, dr, rotate_left(cr, 10), br, t)
+    return ((h1 + cl + dr) & MASK, (h2 + dl + er) & MASK,
+            (h3 + el + ar) & MASK, (h4 + al + br) & MASK,
+            (h0 + bl + cr) & MASK)
+
+def f(j, x, y, z):
+    if j < 16:
+        return x ^ y ^ z
+    if j < 32:
+        return (x & y) | (~x & z)
+    if j < 48:
+        return (x | ~y) ^ z
+    if j < 64:
+        return (x & z) | (y & ~z)
+    return x ^ (y | ~z)
+
+def rotate_left(x, n):
+    return ((x << n) | (x >> (32 - n))) & MASK
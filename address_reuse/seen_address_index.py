@@ -0,0 +1,85 @@
+"""In-process indexes of addresses that have been seen while processing blocks.
+
+`db.Database` uses one of these to answer "has this output address been seen
+before?" from memory rather than from `tblSeenAddresses`. The table remains
+the durable copy: the index is loaded from it once, and new addresses are
+written back to it in one batch per block.
+"""
+
+####################
+# INTERNAL IMPORTS #
+####################
+
+import base58
+
+###########
+# CLASSES #
+###########
+
+class SeenAddressIndex(object):
+    """Interface for indexes of seen Bitcoin addresses.
+
+    Subclasses may store addresses however they like, so long as membership
+    tests are exact; a false positive would turn a first-time receiver into a
+    reused address.
+    """
+
+    def __contains__(self, btc_address):
+        raise NotImplementedError
+
+    def __len__(self):
+        raise NotImplementedError
+
+    def add(self, btc_address):
+        """Record that the address has been seen."""
+        raise NotImplementedError
+
+    def clear(self):
+        """Forget all addresses, e.g. after the table has been rolled back."""
+        raise NotImplementedError
+
+    def load(self, btc_addresses):
+        """Add every address in an iterable, such as rows of the seen table."""
+        for btc_address in btc_addresses:
+            self.add(btc_address)
+
+class InMemorySeenAddressIndex(SeenAddressIndex):
+    """Hash set of seen addresses keyed on their decoded binary form.
+
+    A decoded address is its 1-byte version followed by its 20-byte hash160,
+    which is less than half the size of the Base58 string and keeps P2PKH and
+    P2SH addresses with the same hash160 distinct. Strings that cannot be
+    decoded are stored as-is.
+    """
+
+    def __init__(self):
+        self.keys = set()
+
+    def __contains__(self, btc_address):
+        return get_address_key(btc_address) in self.keys
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, btc_address):
+        self.keys.add(get_address_key(btc_address))
+
+    def clear(self):
+        self.keys = set()
+
+#############
+# FUNCTIONS #
+#############
+
+def get_address_key(btc_address):
+    """Get the compact key under which an address is stored in an index.
+
+    An address that is already in its decoded form, as it is read from a
+    schema version 2 seen addresses table, is used as-is.
+    """
+    if isinstance(btc_address, buffer):
+        return str(btc_address)
+    decoded = base58.decode_address(btc_address)
+    if decoded is None:
+        return btc_address
+    return decoded
@@ -13,6 +13,7 @@ sender, reciever, and wallet client.
 
 import blockchain_reader
 import db
+import http
 
 DB_DEFERRED_BLAME_PLACEHOLDER = 'DB_DEFERRED_BLAME_PLACEHOLDER'
 
@@ -227,8 +228,39 @@ class Blamer(object):
         return self.walletexplorer_reader.get_wallet_labels(
             tx_id, input_address_list, address, benchmarker, defer_blaming)
 
-    def get_single_wallet_label(self, addr):
+    def prefetch_remote_lookups(self, client_tx_ids, label_addresses,
+                                num_threads, benchmarker=None):
+        """Fetch the remote data needed to blame these txs and addresses at once.
+
+        Makes the requests that `get_wallet_client_blame_record` and
+        `get_single_wallet_label` would make one at a time for whichever of
+        these aren't cached, up to `num_threads` at a time. Later calls to
+        those functions use the responses instead of waiting on the remote
+        APIs, and parse and cache them as usual.
+
+        Args:
+            client_tx_ids (List[str]): Txs whose wallet client will be looked
+                up.
+            label_addresses (List[str]): Addresses whose wallet label will be
+                looked up.
+            num_threads (int): Most requests to make at once.
+            benchmarker (Optional[`block_reader_benchmark.Benchmark`]): Counts
+                hits and misses of the HTTP response cache.
+        """
+
+        bci_urls = self.blockchain_reader.get_relayed_by_urls_to_prefetch(
+            client_tx_ids)
+        we_urls = self.walletexplorer_reader.get_address_urls_to_prefetch(
+            label_addresses)
+        responses = http.fetch_urls(bci_urls + we_urls, num_threads,
+                                    benchmarker)
+        self.blockchain_reader.set_prefetched_responses(
+            dict((url, responses[url]) for url in bci_urls))
+        self.walletexplorer_reader.set_prefetched_responses(
+            dict((url, responses[url]) for url in we_urls))
+
+    def get_single_wallet_label(self, addr, benchmarker = None):
         """Get the wallet label for a single Bitcoin address from remote API."""
 
         return self.walletexplorer_reader.get_wallet_label_for_single_address(
-            addr)
+            addr, benchmarker)
@@ -0,0 +1,186 @@
+"""An in-memory set of unspent transaction outputs and their addresses.
+
+`blockchain_reader.LocalBlockchainRPCReader` uses this to resolve the address
+spent by each input with a dictionary lookup instead of a query of
+`tblTxOutputCache` or an RPC call. Outputs are added when the transaction
+creating them is read, and removed when an input spends them, so the cache
+tracks the live UTXO set rather than every output ever created. When it
+grows past a limit, the oldest transactions are spilled to a table on disk.
+Spilled outputs are looked up a block at a time, and deleted from disk in the
+transaction that writes the block spending them.
+
+A lookup that misses both memory and disk is not an error: the reader falls
+back to its usual sources, e.g. for outputs created before the cache was
+enabled.
+"""
+
+####################
+# INTERNAL IMPORTS #
+####################
+
+import base58
+
+####################
+# EXTERNAL IMPORTS #
+####################
+
+from binascii import hexlify, unhexlify
+from collections import deque
+
+#############
+# CONSTANTS #
+#############
+
+#When full, spill this fraction of the transactions in memory at once, so
+#   that spilling happens in large batches.
+SPILL_FRACTION = 0.1
+
+###########
+# CLASSES #
+###########
+
+class UTXOCache(object):
+    """Unspent outputs keyed on txid and output position.
+
+    Args:
+        database (`db.Database`): Where outputs are spilled.
+        max_in_memory_txs (int): Number of transactions with unspent outputs
+            to hold in memory before spilling the oldest ones.
+
+    Attributes:
+        num_hits (int): Lookups answered from memory.
+        num_spilled_hits (int): Lookups answered from the spill table.
+        num_misses (int): Lookups the cache couldn't answer.
+    """
+
+    def __init__(self, database, max_in_memory_txs):
+        assert max_in_memory_txs > 0
+        self.database = database
+        self.max_in_memory_txs = max_in_memory_txs
+        #binary txid => {output_pos: compact address, or None if the output
+        #   has no address}
+        self.unspent_by_tx = {}
+        #binary txids in the order they were added, to pick which to spill.
+        #   May include txids since spent in full.
+        self.tx_order = deque()
+        #(txid, output_pos) of spilled outputs spent since the last call to
+        #   take_spent_spilled_keys(), which are still on disk
+        self.spent_spilled_keys = set()
+        self.num_hits = 0
+        self.num_spilled_hits = 0
+        self.num_misses = 0
+
+    def __len__(self):
+        return len(self.unspent_by_tx)
+
+    def __str__(self):
+        return ("%d txs with unspent outputs in memory; %d hits, %d hits on "
+                "disk, %d misses") % (len(self), self.num_hits,
+                                      self.num_spilled_hits, self.num_misses)
+
+    def add_tx_outputs(self, tx_id, outputs):
+        """Record the outputs a transaction creates.
+
+        Args:
+            tx_id (str): Hex txid.
+            outputs (list of (int, str or None)): Each output's position and
+                address, or None if the address can't be decoded.
+        """
+        if len(outputs) == 0:
+            return
+        tx_key = unhexlify(tx_id)
+        self.unspent_by_tx[tx_key] = dict(
+            (output_pos, get_compact_address(address))
+            for (output_pos, address) in outputs)
+        self.tx_order.append(tx_key)
+        if len(self.unspent_by_tx) > self.max_in_memory_txs:
+            self.spill(int(self.max_in_memory_txs * SPILL_FRACTION) + 1)
+
+    def spend(self, tx_id, output_pos):
+        """Look up an output in memory and remove it from the cache.
+
+        Outputs not found in memory may have been spilled; look them up with
+        `spend_spilled`.
+
+        Returns:
+            (bool, str or None): Whether the output was found, and if so its
+                address, or None if it has no address.
+        """
+        tx_key = unhexlify(tx_id)
+        outputs = self.unspent_by_tx.get(tx_key)
+        if outputs is not None and output_pos in outputs:
+            compact_address = outputs.pop(output_pos)
+            if len(outputs) == 0:
+                del self.unspent_by_tx[tx_key]
+            self.num_hits = self.num_hits + 1
+            return (True, get_address_from_compact(compact_address))
+        return (False, None)
+
+    def spend_spilled(self, keys):
+        """Look up outputs that `spend` didn't find in the spill table, with
+        one query.
+
+        They stay on disk until the keys from `take_spent_spilled_keys` are
+        passed to `db.Database.delete_spilled_utxos`, but aren't found again.
+
+        Args:
+            keys (list of (str, int)): Hex txid and position of each output.
+
+        Returns:
+            dict: Maps each key found to its address, or to None if it has no
+                address.
+        """
+        spilled = self.database.get_spilled_utxos(
+            [key for key in keys if key not in self.spent_spilled_keys])
+        self.spent_spilled_keys.update(spilled)
+        self.num_spilled_hits = self.num_spilled_hits + len(spilled)
+        self.num_misses = self.num_misses + len(keys) - len(spilled)
+        return spilled
+
+    def take_spent_spilled_keys(self):
+        """Returns the keys of spilled outputs spent since the last call, to
+        be deleted from disk along with the block spending them."""
+        keys = list(self.spent_spilled_keys)
+        self.spent_spilled_keys = set()
+        return keys
+
+    def spill(self, num_txs):
+        """Move the unspent outputs of the oldest transactions to disk."""
+        arglist = []
+        num_spilled = 0
+        while num_spilled < num_txs and len(self.tx_order) > 0:
+            tx_key = self.tx_order.popleft()
+            outputs = self.unspent_by_tx.pop(tx_key, None)
+            if outputs is None:
+                continue #spent in full already
+            tx_id = hexlify(tx_key)
+            for (output_pos, compact_address) in outputs.iteritems():
+                arglist.append((tx_id, output_pos,
+                                get_address_from_compact(compact_address)))
+            num_spilled = num_spilled + 1
+        self.database.write_spilled_utxos(arglist)
+
+    def flush(self):
+        """Spill everything in memory, e.g. before exiting, to keep it."""
+        self.spill(len(self.unspent_by_tx))
+        self.tx_order = deque()
+
+#############
+# FUNCTIONS #
+#############
+
+def get_compact_address(btc_address):
+    """Base58 addresses are held as their 21 decoded bytes."""
+    if btc_address is None:
+        return None
+    decoded = base58.decode_address(btc_address)
+    if decoded is None:
+        return btc_address
+    return decoded
+
+def get_address_from_compact(compact_address):
+    #No address string is as short as a decoded address
+    if (compact_address is not None and
+            len(compact_address) == base58.DECODED_ADDRESS_LEN):
+        return base58.encode_address(compact_address)
+    return compact_address
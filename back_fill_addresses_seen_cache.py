@@ -19,4 +19,7 @@ for address in address_list:
         address_reuse.logger.log_and_die('Somehow we have already seen address %s' % address)
     num_added = num_added +1
 
+if address_reuse.db.USE_IN_MEMORY_SEEN_ADDRESS_INDEX:
+    database_connector.write_stored_seen_addresses()
+
 print("Done. Added %d addresses." % num_added)
@@ -0,0 +1,48 @@
+#Description: Copies a database into a new file that uses a later schema version. Version 2 stores txids and addresses in the high-volume tables as compact BLOBs; version 3 stores integer ids referencing dictionary tables of them; version 4 stores each wallet cluster's label once rather than for every address in the label cache.
+#Local processing only -- no network access required. The source database is not modified; once the copy is verified, point the config file at the new file.
+
+#TODO: move my file location to a utilities directory
+
+####################
+# INTERNAL IMPORTS #
+####################
+
+import address_reuse.db
+import address_reuse.config
+
+####################
+# EXTERNAL IMPORTS #
+####################
+
+import argparse
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('dest_filename',
+                        help='New database file to create')
+    parser.add_argument('--source_filename',
+                        help=('Database file to copy from. Defaults to the '
+                              'file set in the config file.'))
+    parser.add_argument('--schema_version', type=int,
+                        default=address_reuse.db.LATEST_SCHEMA_VERSION,
+                        help='Schema version of the new file')
+    parser.add_argument('--local', action='store_true',
+                        help=('Default to the config file\'s database for '
+                              'bitcoind RPC rather than for remote APIs'))
+    args = parser.parse_args()
+
+    source_filename = args.source_filename
+    if source_filename is None:
+        blockchain_mode = address_reuse.config.BlockchainMode.REMOTE_API
+        if args.local:
+            blockchain_mode = address_reuse.config.BlockchainMode.BITCOIND_RPC
+        source_filename = address_reuse.config.Config(
+            blockchain_mode=blockchain_mode).SQLITE_DB_FILENAME
+
+    address_reuse.db.migrate_db_schema(source_filename, args.dest_filename,
+                                       args.schema_version)
+    print("Done. Migrated '%s' to '%s' with schema version %d." %
+          (source_filename, args.dest_filename, args.schema_version))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,18 @@
+#Description: Rebuilds the on-disk Bloom filter that fronts the table of every unique Bitcoin address seen, e.g. after the table has been edited by hand or the filter file was resized.
+#Updates database with local processing only -- no network access required.
+
+#TODO: move my file location to a utilities directory
+
+####################
+# INTERNAL IMPORTS #
+####################
+
+import address_reuse.db
+
+database_connector = address_reuse.db.Database()
+database_connector.rebuild_seen_address_bloom_filter()
+bloom = database_connector.get_seen_address_bloom_filter()
+database_connector.close()
+
+print(("Done. Filter contains %d addresses. Estimated false positive rate: "
+       "%.6f") % (bloom.num_items, bloom.get_estimated_false_positive_rate()))
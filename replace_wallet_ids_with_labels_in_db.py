@@ -24,9 +24,8 @@ def main():
              'label=? WHERE rowid=?')
     arglist_many1 = []
 
-    stmt2 = ('UPDATE ' + address_reuse.db.SQL_TABLE_NAME_BLAME_LABEL_CACHE + ' '
-             'SET label=? WHERE label=?')
-    arglist_many2 = []
+    #(old label, new label) pairs for the label cache
+    relabels = []
 
     num_records_updated = 0
 
@@ -57,17 +56,17 @@ def main():
 
                 #Update all references to the old lable in
                 #   SQL_TABLE_NAME_BLAME_LABEL_CACHE with the new_label
-                arglist2 = (new_label, label)
-                arglist_many2.append(arglist2)
+                relabels.append((label, new_label))
 
         if rowid % 100 == 0:
             #execute mass batch of update statements
             if len(arglist_many1) > 0:
-                assert len(arglist_many2) > 0
+                assert len(relabels) > 0
                 database.run_statement(stmt1, arglist_many1, execute_many=True)
                 arglist_many1 = []
-                database.run_statement(stmt2, arglist_many2, execute_many=True)
-                arglist_many2 = []
+                for (old_label, new_label) in relabels:
+                    database.relabel_wallet_cluster(old_label, new_label)
+                relabels = []
             print "Completed updates up thru rowid %d " % rowid
 
         rowid = rowid + 1
@@ -138,6 +138,11 @@ def main():
         #   before exiting
         benchmarker.stop()
         benchmarker.print_stats()
+        print("Database contention: %s" % str(db.contention_stats))
+        print("Blame label lookups: %s" % str(db.blame_label_cache_stats))
+        if coord_db is not None:
+            print("Coordination database contention: %s" %
+                  str(coord_db.contention_stats))
 
         #TODO: roll back records upon early exit to safe point as with other
         #   "update" scripts. Actually, I don't think there's any rollback to
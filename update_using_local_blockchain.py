@@ -40,7 +40,11 @@ def main():
     current_blockchain_height = int(api_reader.get_current_blockchain_block_height())
     api_reader = None #Done with API lookups :>
 
-    blockchain_reader = address_reuse.blockchain_reader.LocalBlockchainRPCReader(db)
+    #Read blocks straight from bitcoind's block files if configured to
+    if db.config_store.BLOCKS_DIR is not None:
+        blockchain_reader = address_reuse.blockchain_reader.RawBlockFileReader(db)
+    else:
+        blockchain_reader = address_reuse.blockchain_reader.LocalBlockchainRPCReader(db)
 
     #Determine the last block I've updated in the db
     last_height_in_db = db.get_last_block_height_in_db()
@@ -58,11 +62,19 @@ def main():
     MAX_NUM_BLOCKS_TO_PROCESS_PER_RUN = config.MAX_NUM_BLOCKS_TO_PROCESS_PER_RUN
     num_blocks_remaining_to_process = MAX_NUM_BLOCKS_TO_PROCESS_PER_RUN
 
-    last_block_height_processed = None
-
     benchmarker = address_reuse.benchmark.block_reader_benchmark.Benchmark()
     block_processor = address_reuse.block_processor.BlockProcessor(
         blockchain_reader, db)
+
+    #Fetch the blocks this run will process ahead of processing them
+    if config.PREFETCH_QUEUE_DEPTH > 0:
+        end_height = current_blockchain_height
+        if MAX_NUM_BLOCKS_TO_PROCESS_PER_RUN >= 0:
+            end_height = min(end_height, current_height_iterated +
+                             MAX_NUM_BLOCKS_TO_PROCESS_PER_RUN)
+        blockchain_reader.start_prefetching(
+            current_height_iterated, end_height, config.PREFETCH_QUEUE_DEPTH,
+            config.PREFETCH_NUM_WORKERS)
     try:
         #Process blocks until we're caught up, or have hit the max # blocks to 
         #   process in this run.
@@ -76,7 +88,6 @@ def main():
              #Log successful processing of this block
             address_reuse.logger.log_status('Processed block %d with RPC.' % current_height_iterated)
 
-            last_block_height_processed = current_height_iterated
             current_height_iterated = current_height_iterated + 1
 
             #continue going through blocks until there are no more or hit MAX_NUM_BLOCKS_TO_PROCESS_PER_RUN
@@ -89,32 +100,24 @@ def main():
     finally:
         #whether it finishes normally or is interrupted by ^C, print stats before 
         #   exiting
+        prefetcher = blockchain_reader.block_prefetcher
+        if prefetcher is not None:
+            blockchain_reader.stop_prefetching()
+            benchmarker.add_stage_time('prefetch (all workers)',
+                                       prefetcher.fetch_seconds)
+            benchmarker.add_stage_time('wait for prefetch',
+                                       prefetcher.wait_seconds)
         benchmarker.stop()
         benchmarker.print_stats()
-
-        #handle safe rollback
-        if last_block_height_processed is None and current_height_iterated > 0:
-            #We didn't complete processing any blocks in this run, but we may
-            #   have partially processed one. Need to roll back to the height
-            #   we completed before starting this run
-            last_block_height_processed = current_height_iterated - 1
-
-        if last_block_height_processed is not None:
-            db.rollback_seen_addresses_cache_to_block_height(
-                last_block_height_processed)
-            print(("Due to early exit, rolled 'seen addresses' table back to the "
-                   "last block we finished processing at height %d") % 
-                  last_block_height_processed)
-            #TODO: This method of rollback is crappy because we may want to
-            #   allow users in the future to run multiple instances of this
-            #   script to process multiple block heights simultaneously, but
-            #   this triggers a DELETE that would devestate any other threads
-            #   working at a higher block height. For now, though, it doesnt'
-            #   matter.
-            db.rollback_blame_stats_to_block_height(last_block_height_processed)
-            print(("Due to early exit, rolled 'blame stats' table back to the "
-                   "last block we finished processing at height %d") % 
-                  last_block_height_processed)
+        print("Database contention: %s" % str(db.contention_stats))
+        if blockchain_reader.utxo_cache is not None:
+            print("UTXO cache: %s" % str(blockchain_reader.utxo_cache))
+            #Keep unspent outputs for the next run
+            blockchain_reader.utxo_cache.flush()
+        #A block interrupted part-way through was never committed: its
+        #   transaction is rolled back by BlockProcessor.process_block(), so
+        #   the database already ends at the last block completed.
+        db.close()
 
 if __name__ == "__main__":
     main()
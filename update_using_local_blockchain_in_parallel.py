@@ -0,0 +1,99 @@
+#Update the reuse database using the local blockchain, processing blocks in
+#   several worker processes at once. See address_reuse/first_seen_index.py.
+#Pass 1 indexes the first position at which each address received funds, and
+#   pass 2 processes ranges of blocks in any order against that index, each
+#   into a staging database merged into the main one when the range is done.
+#   An interrupted run resumes with the ranges it didn't merge. Pass 2 does
+#   not fill the seen address index that update_using_local_blockchain.py
+#   relies on, so keep updating a database built this way with this script.
+
+####################
+# INTERNAL IMPORTS #
+####################
+
+import address_reuse.db
+import address_reuse.config
+import address_reuse.blockchain_reader
+import address_reuse.first_seen_index
+import address_reuse.logger
+
+####################
+# EXTERNAL IMPORTS #
+####################
+
+import time
+
+################
+# BEGIN SCRIPT #
+################
+
+def get_reader_factory(db):
+    """Returns a function that creates a block reader with its own database
+    connection, in each worker process."""
+    blockchain_reader = address_reuse.blockchain_reader
+    blockchain_mode = address_reuse.config.BlockchainMode.BITCOIND_RPC
+    if db.config_store.BLOCKS_DIR is not None:
+        #Scan the block files once, here, rather than in every worker
+        block_file_index = blockchain_reader.RawBlockFileReader(
+            db).get_block_file_index()
+        def make_reader():
+            reader = blockchain_reader.RawBlockFileReader(
+                address_reuse.db.Database(blockchain_mode = blockchain_mode))
+            reader.block_file_index = block_file_index.copy()
+            return reader
+    else:
+        def make_reader():
+            return blockchain_reader.LocalBlockchainRPCReader(
+                address_reuse.db.Database(blockchain_mode = blockchain_mode))
+    return make_reader
+
+def main():
+    db = address_reuse.db.Database(
+        blockchain_mode = address_reuse.config.BlockchainMode.BITCOIND_RPC)
+    config = db.config_store
+    reader_factory = get_reader_factory(db)
+    current_blockchain_height = reader_factory(
+        ).get_current_blockchain_block_height()
+
+    #Determine max number of blocks to process. -1 blocks = infinity
+    end_height = current_blockchain_height
+    if config.MAX_NUM_BLOCKS_TO_PROCESS_PER_RUN >= 0:
+        last_height_in_db = db.get_last_block_height_in_db()
+        if last_height_in_db is None:
+            last_height_in_db = -1
+        end_height = min(end_height, last_height_in_db + 1 +
+                         config.MAX_NUM_BLOCKS_TO_PROCESS_PER_RUN)
+
+    try:
+        start = time.time()
+        address_reuse.first_seen_index.build_first_seen_index(
+            db, reader_factory, end_height, config.PARALLEL_NUM_WORKERS,
+            config.PARALLEL_RANGE_SIZE)
+        print("Indexed the first seen addresses of blocks up to %d in %.1f "
+              "sec." % (end_height - 1, time.time() - start))
+
+        start = time.time()
+        throughput = (
+            address_reuse.first_seen_index.process_blocks_in_parallel(
+                db, reader_factory, 0, end_height,
+                config.PARALLEL_NUM_WORKERS, config.PARALLEL_RANGE_SIZE))
+        elapsed = time.time() - start
+        num_blocks_processed = 0
+        print("Throughput per worker process:")
+        for (worker_pid, (num_blocks, num_txs, seconds)) in sorted(
+                throughput.items()):
+            num_blocks_processed = num_blocks_processed + num_blocks
+            print("\tprocess %-8d %8d blocks %10d txs %8.2f blocks/sec "
+                  "%10.2f txs/sec" % (worker_pid, num_blocks, num_txs,
+                                      num_blocks / seconds,
+                                      num_txs / seconds))
+        print("Processed %d blocks in %.1f sec." % (num_blocks_processed,
+                                                    elapsed))
+        address_reuse.logger.log_status(
+            'Processed %d blocks in parallel.' % num_blocks_processed)
+    finally:
+        print("Database contention: %s" % str(db.contention_stats))
+        db.close()
+
+if __name__ == "__main__":
+    main()